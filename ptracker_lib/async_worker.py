@@ -19,11 +19,14 @@
 #
 # This file is part of the ptracker project. See ptracker.py for details.
 ################################################################################
-from threading import Thread
-from queue import Queue
+from threading import Thread, Lock
+from queue import Queue, PriorityQueue
 import traceback
 import sys
 import functools
+import itertools
+import time
+from ptracker_lib.profiler import Histogram
 
 # return traceback in case of exceptions, printed in the main thread
 def threadCallDecorator(f):
@@ -38,13 +41,57 @@ def threadCallDecorator(f):
 
     return new_f
 
+# priority classes of the jobs, lower values are served first
+PRIO_REALTIME = 0      # lap persistence and in-race checks
+PRIO_CLIENT = 1        # requests of connected ptracker clients
+PRIO_HTTP = 2          # web pages
+PRIO_MAINTENANCE = 3   # compression, backups, ...
+PRIO_SHUTDOWN = 4      # after all pending jobs
+PRIO_NAMES = {PRIO_REALTIME:'realtime', PRIO_CLIENT:'client', PRIO_HTTP:'http', PRIO_MAINTENANCE:'maintenance'}
+
+# job queue ordered by priority class (FIFO within a class), keeping track of the queue wait times
+class JobQueue:
+    def __init__(self):
+        self.queue = PriorityQueue()
+        self.seq = itertools.count()
+        self.lock = Lock()
+        self.maxQueued = 0
+        self.waitTimes = dict((p, Histogram(1e-3, 0.0, 10.0)) for p in PRIO_NAMES)
+
+    def put(self, item, priority):
+        self.queue.put( (priority, next(self.seq), time.time(), item) )
+        self.maxQueued = max(self.maxQueued, self.queue.qsize())
+
+    def get(self):
+        priority, seq, t, item = self.queue.get()
+        if not item is None:
+            with self.lock:
+                self.waitTimes[priority].addValue(time.time() - t)
+        return item
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        res = {}
+        with self.lock:
+            for p,h in self.waitTimes.items():
+                res[PRIO_NAMES[p]] = {
+                    'count': h.count,
+                    'avg': h.cum/max(1,h.count),
+                    'max': h.max if h.count > 0 else None,
+                    'median': h.quantile(0.5),
+                    'q95': h.quantile(0.95),
+                    'q99': h.quantile(0.99),
+                }
+        return res
+
 class Worker(Thread):
     def __init__(self, async):
         Thread.__init__(self)
         self.daemon = True
-        self.queueIn = Queue()
+        self.queueIn = JobQueue()
         self.processing = 0
-        self.queueOut = Queue()
         self.async = async
         if async:
             self.start()
@@ -60,24 +107,74 @@ class Worker(Thread):
             f, args, kw, callback = item
             res = f(*args, **kw)
             self.processing = 0
-            if not callback is None:
-                callback(res)
-            else:
-                self.queueOut.put(res)
+            callback(res)
 
-    def apply_async(self, f, args, kw, callback):
+    def apply_async(self, f, args, kw, callback, priority = PRIO_CLIENT):
         if self.async:
-            self.queueIn.put( (f, args, kw, callback) )
+            self.queueIn.put( (f, args, kw, callback), priority )
         else:
             callback(f(*args, **kw))
 
-    def apply(self, f, args, kw):
+    def apply(self, f, args, kw, priority = PRIO_CLIENT):
         if self.async:
-            self.queueIn.put( (f, args, kw, None) )
-            return self.queueOut.get()
+            # each call gets its own result queue, the jobs are not executed in calling order
+            queueOut = Queue()
+            self.queueIn.put( (f, args, kw, queueOut.put), priority )
+            return queueOut.get()
         else:
             return f(*args, **kw)
 
     def shutdown(self):
-        self.queueIn.put( None )
+        self.queueIn.put( None, PRIO_SHUTDOWN )
         self.join()
+
+    def stats(self):
+        return {'threads': 1, 'queued': self.queueIn.qsize(), 'maxQueued': self.queueIn.maxQueued, 'processing': self.processing,
+                'waitTimes': self.queueIn.stats()}
+
+# a pool of threads serving a common queue
+class WorkerPool:
+    def __init__(self, numThreads, initializer = None):
+        self.queueIn = JobQueue()
+        self.lock = Lock()
+        self.processing = 0
+        self.threads = []
+        for i in range(numThreads):
+            t = Thread(target=self.run, args=(initializer,))
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def run(self, initializer):
+        if not initializer is None:
+            initializer()
+        while True:
+            item = self.queueIn.get()
+            if item is None:
+                return
+            with self.lock:
+                self.processing += 1
+            f, args, kw, callback = item
+            res = f(*args, **kw)
+            with self.lock:
+                self.processing -= 1
+            callback(res)
+
+    def apply_async(self, f, args, kw, callback, priority = PRIO_CLIENT):
+        self.queueIn.put( (f, args, kw, callback), priority )
+
+    def apply(self, f, args, kw, priority = PRIO_CLIENT):
+        # each call gets its own result queue, the results of the pool threads might arrive out of order
+        queueOut = Queue()
+        self.apply_async(f, args, kw, queueOut.put, priority)
+        return queueOut.get()
+
+    def shutdown(self):
+        for t in self.threads:
+            self.queueIn.put( None, PRIO_SHUTDOWN )
+        for t in self.threads:
+            t.join()
+
+    def stats(self):
+        return {'threads': len(self.threads), 'queued': self.queueIn.qsize(), 'maxQueued': self.queueIn.maxQueued, 'processing': self.processing,
+                'waitTimes': self.queueIn.stats()}
@@ -0,0 +1,274 @@
+# Copyright 2015-2016 NEYS
+# This file is part of sptracker.
+#
+#    sptracker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sptracker is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+
+################################################################################
+# Never Eat Yellow Snow APPS - ptracker
+#
+# This file is part of the ptracker project. See ptracker.py for details.
+################################################################################
+
+# Storage of the (compressed) lap history infos outside the relational database.
+#
+# The blobs are appended to segment files (seg00000001.blobs, seg00000002.blobs, ...) in a directory;
+# the database only keeps the reference (segment, offset, length, sha1 hash). Segments are never
+# modified in place: a new segment is started when the active one exceeds maxSegmentSize, and the
+# compaction (see GenericBackend.compactBlobStore) copies the live blobs of sparse segments to the
+# active segment and removes the old files afterwards. Reading is done through mmap.
+#
+# All backends of a directory in this process (the writer, the read pool, other LapDatabase instances) share
+# one store instance (see sharedBlobStore), so there is one active segment. The active segment is never
+# removed. The segments written by a transaction are pinned until the transaction has ended (see
+# pinWrites), because the compaction running on another connection does not see the new references yet.
+#
+# Segment layout: MAGIC, followed by records of (length, sha1 digest) header and the blob data.
+
+import os
+import re
+import mmap
+import shutil
+import struct
+import hashlib
+import binascii
+import threading
+from ptracker_lib.helpers import *
+
+MAGIC = b"STBLOBS1"
+RECORD_HEADER = struct.Struct("<I20s")
+
+_stores = {}
+_storesLock = threading.Lock()
+
+def blobHash(data):
+    return binascii.hexlify(hashlib.sha1(bytes(data)).digest()).decode("ascii")
+
+def sharedBlobStore(directory):
+    # the store instance of directory
+    key = os.path.normcase(os.path.realpath(directory))
+    with _storesLock:
+        if not key in _stores:
+            _stores[key] = SegmentBlobStore(directory)
+        return _stores[key]
+
+class SegmentBlobStore:
+    def __init__(self, directory, maxSegmentSize = 64*1024*1024):
+        self.directory = directory
+        self.maxSegmentSize = maxSegmentSize
+        self.lock = threading.RLock()
+        # segment -> (file, mmap)
+        self.maps = {}
+        self.activeSegment = None
+        self.activeFile = None
+        # every put and every end of a transaction increments the write sequence; maps segment -> sequence
+        # of the last write
+        self.writeSeq = 0
+        self.lastWrite = {}
+        # segment -> number of transactions with uncommitted blobs in the segment
+        self.pins = {}
+        # number of running backups, no segment is removed while a backup is running
+        self.removalHolds = 0
+        self.local = threading.local()
+        os.makedirs(directory, exist_ok=True)
+
+    def segmentPath(self, segment):
+        return os.path.join(self.directory, "seg%08d.blobs" % segment)
+
+    def segments(self):
+        res = []
+        for f in os.listdir(self.directory):
+            m = re.match(r"seg([0-9]{8})\.blobs$", f)
+            if not m is None:
+                res.append(int(m.group(1)))
+        return sorted(res)
+
+    def segmentSize(self, segment):
+        with self.lock:
+            if segment == self.activeSegment and not self.activeFile is None:
+                return os.fstat(self.activeFile.fileno()).st_size
+        try:
+            return os.path.getsize(self.segmentPath(segment))
+        except OSError:
+            return 0
+
+    def currentSegment(self):
+        # the segment new blobs are appended to; None if no blob has been written yet
+        with self.lock:
+            if self.activeSegment is None:
+                s = self.segments()
+                return s[-1] if len(s) > 0 else None
+            return self.activeSegment
+
+    def put(self, data):
+        data = bytes(data)
+        digest = hashlib.sha1(data).digest()
+        with self.lock:
+            if not self.activeFile is None and os.fstat(self.activeFile.fileno()).st_nlink == 0:
+                # the file has been removed, the blobs appended to it would be lost
+                acwarning("Blob store segment %d has been removed while in use, starting a new segment.", self.activeSegment)
+                self.activeFile.close()
+                self.activeFile = None
+                self.activeSegment = max(self.segments() + [self.activeSegment]) + 1
+            segment = self.currentSegment()
+            if segment is None or self.segmentSize(segment) >= self.maxSegmentSize:
+                segment = 1 if segment is None else segment + 1
+            if self.activeFile is None or self.activeSegment != segment:
+                if not self.activeFile is None:
+                    self.activeFile.close()
+                self.activeFile = open(self.segmentPath(segment), "ab")
+                self.activeSegment = segment
+            f = self.activeFile
+            if f.tell() == 0:
+                f.write(MAGIC)
+            f.write(RECORD_HEADER.pack(len(data), digest))
+            offset = f.tell()
+            f.write(data)
+            # the reference is committed to the database afterwards, so the data must be on disk first
+            f.flush()
+            os.fsync(f.fileno())
+            self.touch(segment)
+            pinned = getattr(self.local, 'pinned', None)
+            if not pinned is None and not segment in pinned:
+                pinned.add(segment)
+                self.pins[segment] = self.pins.get(segment, 0) + 1
+        return (segment, offset, len(data), binascii.hexlify(digest).decode("ascii"))
+
+    def touch(self, segment):
+        with self.lock:
+            self.writeSeq += 1
+            self.lastWrite[segment] = self.writeSeq
+
+    def writeSequence(self):
+        with self.lock:
+            return self.writeSeq
+
+    def pinWrites(self):
+        # pin the segments written by this thread until releaseWrites is called (after the references have
+        # been committed or rolled back); returns False if the thread already pins its writes
+        if not getattr(self.local, 'pinned', None) is None:
+            return False
+        self.local.pinned = set()
+        return True
+
+    def releaseWrites(self):
+        pinned = self.local.pinned
+        self.local.pinned = None
+        with self.lock:
+            for segment in pinned:
+                self.pins[segment] -= 1
+                if self.pins[segment] == 0:
+                    del self.pins[segment]
+                # the references might have been committed after the live blobs were determined
+                self.touch(segment)
+
+    def seal(self):
+        # start a new segment with the next put, so the current one can be compacted
+        with self.lock:
+            segment = self.currentSegment()
+            if not self.activeFile is None:
+                self.activeFile.close()
+                self.activeFile = None
+            self.activeSegment = 1 if segment is None else segment + 1
+
+    def get(self, segment, offset, length, expectedHash):
+        with self.lock:
+            m = self.maps.get(segment, None)
+            if m is None or offset + length > len(m[1]):
+                # not mapped yet or the segment has grown since
+                self.unmap(segment)
+                try:
+                    f = open(self.segmentPath(segment), "rb")
+                except OSError:
+                    acwarning("Blob store segment %d is missing.", segment)
+                    return None
+                m = (f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                self.maps[segment] = m
+            data = m[1][offset:offset+length]
+        if len(data) != length or blobHash(data) != expectedHash:
+            acwarning("Blob store: inconsistent blob at segment %d, offset %d.", segment, offset)
+            return None
+        return data
+
+    def unmap(self, segment):
+        with self.lock:
+            m = self.maps.pop(segment, None)
+            if not m is None:
+                m[1].close()
+                m[0].close()
+
+    def remove(self, segment, writtenBefore = None):
+        # remove a segment without live blobs, writtenBefore is the write sequence before the live blobs have
+        # been determined. Returns False if the segment is still in use: the active segment, pinned segments,
+        # segments written since writtenBefore and files which cannot be removed now (windows)
+        with self.lock:
+            if (segment == self.currentSegment() or segment in self.pins or self.removalHolds > 0 or
+                    (not writtenBefore is None and self.lastWrite.get(segment, 0) > writtenBefore)):
+                return False
+            self.unmap(segment)
+            self.lastWrite.pop(segment, None)
+            try:
+                os.remove(self.segmentPath(segment))
+            except FileNotFoundError:
+                pass
+            except OSError:
+                acwarning("Cannot remove blob store segment %d now, retrying later.", segment)
+                return False
+        return True
+
+    def holdRemovals(self):
+        with self.lock:
+            self.removalHolds += 1
+
+    def releaseRemovals(self):
+        with self.lock:
+            self.removalHolds -= 1
+
+    def backupTo(self, directory):
+        # copy the segments to directory, to be called between holdRemovals and releaseRemovals. The sealed
+        # segments are not modified anymore, so hard links are used where possible. The active segment is
+        # copied up to its current size. Returns the number of bytes in the copy.
+        os.makedirs(directory, exist_ok=True)
+        with self.lock:
+            active = self.currentSegment()
+            activeSize = self.segmentSize(active) if not active is None else 0
+            segments = [s for s in self.segments() if active is None or s <= active]
+        size = 0
+        for segment in segments:
+            src = self.segmentPath(segment)
+            dst = os.path.join(directory, os.path.basename(src))
+            if segment == active:
+                with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                    remaining = activeSize
+                    while remaining > 0:
+                        data = fsrc.read(min(remaining, 1024*1024))
+                        if len(data) == 0:
+                            break
+                        fdst.write(data)
+                        remaining -= len(data)
+            else:
+                try:
+                    os.link(src, dst)
+                except (OSError, AttributeError):
+                    shutil.copyfile(src, dst)
+            size += os.path.getsize(dst)
+        return size
+
+    def close(self):
+        with self.lock:
+            for segment in list(self.maps.keys()):
+                self.unmap(segment)
+            if not self.activeFile is None:
+                self.activeFile.close()
+                self.activeFile = None
+                self.activeSegment = None
@@ -19,22 +19,38 @@
 #
 # This file is part of the ptracker project. See ptracker.py for details.
 ################################################################################
-from threading import RLock
+from threading import RLock, local
 import functools
+import gzip
+import os
+import shutil
+import time
 import traceback
 from ptracker_lib.helpers import *
-from ptracker_lib.async_worker import Worker, threadCallDecorator
+from ptracker_lib.blobstore import sharedBlobStore
+from ptracker_lib.async_worker import Worker, WorkerPool, threadCallDecorator
+from ptracker_lib.async_worker import PRIO_REALTIME, PRIO_CLIENT, PRIO_HTTP, PRIO_MAINTENANCE
 
 class CallWrapper:
     MAX_PENDING_RESULTS = 20
 
-    def __init__(self, ld, function):
+    def __init__(self, ld, function, readOnly = False, priority = PRIO_HTTP):
         self.wrapper = threadCallDecorator(function)
         self.results = {}
         self.tracebacks = {}
         self.ld = ld
         self.ld.wrappers.append(self)
         self.callCnt = 0
+        # True, False or a predicate on the keyword arguments; read only calls are served by the read pool (if any)
+        self.readOnly = readOnly
+        # default priority class of the calls, can be overwritten by the caller using the __priority keyword
+        self.priority = priority
+
+    def worker(self, kw):
+        if self.ld.readPool is None:
+            return self.ld.worker
+        readOnly = self.readOnly(kw) if callable(self.readOnly) else self.readOnly
+        return self.ld.readPool if readOnly else self.ld.worker
 
     def done(self, res, resultID, add_callback):
         with self.ld.lock:
@@ -58,15 +74,21 @@ class CallWrapper:
             del kw['__db_callback']
         else:
             add_callback = None
+        if '__priority' in kw:
+            priority = kw['__priority']
+            del kw['__priority']
+        else:
+            priority = self.priority
         with self.ld.lock:
             self.ld.checkErrors()
             resultID = self.callCnt
             self.callCnt += 1
         self.tracebacks[resultID] = traceback.extract_stack()
+        worker = self.worker(kw)
         if async:
-            self.ld.worker.apply_async(self.wrapper, args, kw, callback=functools.partial(self.done, resultID=resultID, add_callback=add_callback))
+            worker.apply_async(self.wrapper, args, kw, callback=functools.partial(self.done, resultID=resultID, add_callback=add_callback), priority=priority)
         else:
-            res = self.ld.worker.apply(self.wrapper, args, kw)
+            res = worker.apply(self.wrapper, args, kw, priority=priority)
             self.done(res, resultID, add_callback)
         return functools.partial(self.result, resultID=resultID)
 
@@ -114,65 +136,80 @@ class LapDatabase:
     DB_MODE_READONLY = 1
     DB_MODE_MEMORY = 2
 
-    def __init__(self, lapHistoryFactory, dbMode, backendFactory):
+    def __init__(self, lapHistoryFactory, dbMode, backendFactory, readPoolSize = 0):
         self.lock = RLock()
         self.async = True
         self.worker = Worker(self.async)
         self.dbMode = dbMode
         self.wrappers = []
+        # optional pool of read only connections, serving the statistic queries in parallel to the writer
+        self.readPool = None
+        self.readerLocal = local()
+        if readPoolSize > 0 and self.async:
+            self.readerFactory = functools.partial(backendFactory, lapHistoryFactory, readonly=True)
+            backendFactory = functools.partial(backendFactory, concurrentReaders=True)
+            self.readPool = WorkerPool(readPoolSize, initializer=self.initReader)
         if self.dbMode == self.DB_MODE_READONLY:
             regLap = lambda *args, **kw: None
         else:
             regLap = lambda *args, self=self, **kw: self.db().registerLap(*args, **kw)
-        self.createDB =              CallWrapper(self, backendFactory)
+        self.createDB =              CallWrapper(self, backendFactory, priority=PRIO_REALTIME)
         # create db access functions
-        self.registerLap =           CallWrapper(self, regLap)
-        self.getBestSectorTimes =    CallWrapper(self, lambda *args, self=self, **kw: self.db().getBestSectorTimes(*args, **kw))
-        self.getBestLap =            CallWrapper(self, lambda *args, self=self, **kw: self.db().getBestLap(*args, **kw))
-        self.getBestLapWithSectors = CallWrapper(self, lambda *args, self=self, **kw: self.db().getBestLap(*args, **kw))
-        self.finishSession =         CallWrapper(self, lambda *args, self=self, **kw: self.db().finishSession(*args, **kw))
-        self.newSession =            CallWrapper(self, lambda *args, self=self, **kw: self.db().newSession(*args, **kw))
-        self.lapStats =              CallWrapper(self, lambda *args, self=self, **kw: self.db().lapStats(*args, **kw))
-        self.sessionStats =          CallWrapper(self, lambda *args, self=self, **kw: self.db().sessionStats(*args, **kw))
-        self.alltracks =             CallWrapper(self, lambda *args, self=self, **kw: self.db().alltracks(*args, **kw))
-        self.allcars =               CallWrapper(self, lambda *args, self=self, **kw: self.db().allcars(*args, **kw))
-        self.allservers =            CallWrapper(self, lambda *args, self=self, **kw: self.db().allservers(*args, **kw))
-        self.auth =                  CallWrapper(self, lambda *args, self=self, **kw: self.db().auth(*args, **kw))
-        self.currentCombo =          CallWrapper(self, lambda *args, self=self, **kw: self.db().currentCombo(*args, **kw))
-        self.lapDetails =            CallWrapper(self, lambda *args, self=self, **kw: self.db().lapDetails(*args, **kw))
-        self.setOnline =             CallWrapper(self, lambda *args, self=self, **kw: self.db().setOnline(*args, **kw))
-        self.getSBandPB =            CallWrapper(self, lambda *args, self=self, **kw: self.db().getSBandPB(*args, **kw))
-        self.compressDB =            CallWrapper(self, lambda *args, self=self, **kw: self.db().compressDB(*args, **kw))
-        self.sessionDetails =        CallWrapper(self, lambda *args, self=self, **kw: self.db().sessionDetails(*args, **kw))
-        self.playerInSessionDetails =CallWrapper(self, lambda *args, self=self, **kw: self.db().playerInSessionDetails(*args, **kw))
-        self.getPlayers =            CallWrapper(self, lambda *args, self=self, **kw: self.db().getPlayers(*args, **kw))
-        self.playerDetails =         CallWrapper(self, lambda *args, self=self, **kw: self.db().playerDetails(*args, **kw))
+        self.registerLap =           CallWrapper(self, regLap, priority=PRIO_REALTIME)
+        self.getBestSectorTimes =    CallWrapper(self, lambda *args, self=self, **kw: self.rdb().getBestSectorTimes(*args, **kw), readOnly=True, priority=PRIO_REALTIME)
+        self.getBestLap =            CallWrapper(self, lambda *args, self=self, **kw: self.rdb().getBestLap(*args, **kw), readOnly=True, priority=PRIO_REALTIME)
+        self.getBestLapWithSectors = CallWrapper(self, lambda *args, self=self, **kw: self.rdb().getBestLap(*args, **kw), readOnly=True, priority=PRIO_REALTIME)
+        self.finishSession =         CallWrapper(self, lambda *args, self=self, **kw: self.db().finishSession(*args, **kw), priority=PRIO_REALTIME)
+        self.newSession =            CallWrapper(self, lambda *args, self=self, **kw: self.db().newSession(*args, **kw), priority=PRIO_REALTIME)
+        self.applySpoolRecords =     CallWrapper(self, lambda *args, self=self, **kw: self.db().applySpoolRecords(*args, **kw), priority=PRIO_REALTIME)
+        self.lapStats =              CallWrapper(self, lambda *args, self=self, **kw: self.rdb().lapStats(*args, **kw), readOnly=True)
+        self.sessionStats =          CallWrapper(self, lambda *args, self=self, **kw: self.rdb().sessionStats(*args, **kw), readOnly=True)
+        self.alltracks =             CallWrapper(self, lambda *args, self=self, **kw: self.rdb().alltracks(*args, **kw), readOnly=True)
+        self.allcars =               CallWrapper(self, lambda *args, self=self, **kw: self.rdb().allcars(*args, **kw), readOnly=True)
+        self.allservers =            CallWrapper(self, lambda *args, self=self, **kw: self.rdb().allservers(*args, **kw), readOnly=True)
+        self.auth =                  CallWrapper(self, lambda *args, self=self, **kw: self.rdb().auth(*args, **kw), readOnly=True, priority=PRIO_CLIENT)
+        self.currentCombo =          CallWrapper(self, lambda *args, self=self, **kw: self.rdb().currentCombo(*args, **kw), readOnly=True, priority=PRIO_CLIENT)
+        self.lapDetails =            CallWrapper(self, lambda *args, self=self, **kw: self.rdb().lapDetails(*args, **kw), readOnly=True)
+        self.setOnline =             CallWrapper(self, lambda *args, self=self, **kw: self.db().setOnline(*args, **kw), priority=PRIO_REALTIME)
+        self.getSBandPB =            CallWrapper(self, lambda *args, self=self, **kw: self.rdb().getSBandPB(*args, **kw), readOnly=True, priority=PRIO_REALTIME)
+        self.bestTimesCacheStats =   CallWrapper(self, lambda *args, self=self, **kw: self.rdb().bestTimesCacheStats(*args, **kw), readOnly=True, priority=PRIO_CLIENT)
+        self.pageGeneration =        CallWrapper(self, lambda *args, self=self, **kw: self.rdb().pageGeneration(*args, **kw), readOnly=True)
+        self.compressDB =            CallWrapper(self, lambda *args, self=self, **kw: self.db().compressDB(*args, **kw), priority=PRIO_MAINTENANCE)
+        self.compactHistoryInfos =   CallWrapper(self, lambda *args, self=self, **kw: self.db().compactHistoryInfos(*args, **kw), priority=PRIO_MAINTENANCE)
+        self.compactBlobStore =      CallWrapper(self, lambda *args, self=self, **kw: self.db().compactBlobStore(*args, **kw), priority=PRIO_MAINTENANCE)
+        self.backupStart =           CallWrapper(self, lambda *args, self=self, **kw: self.db().backupStart(*args, **kw), priority=PRIO_MAINTENANCE)
+        self.backupStep =            CallWrapper(self, lambda *args, self=self, **kw: self.db().backupStep(*args, **kw), priority=PRIO_MAINTENANCE)
+        self.backupAbort =           CallWrapper(self, lambda *args, self=self, **kw: self.db().backupAbort(*args, **kw), priority=PRIO_MAINTENANCE)
+        self.sessionDetails =        CallWrapper(self, lambda *args, self=self, **kw: self.rdb().sessionDetails(*args, **kw), readOnly=True)
+        self.playerInSessionDetails =CallWrapper(self, lambda *args, self=self, **kw: self.rdb().playerInSessionDetails(*args, **kw), readOnly=True)
+        self.getPlayers =            CallWrapper(self, lambda *args, self=self, **kw: self.rdb().getPlayers(*args, **kw), readOnly=True)
+        self.playerDetails =         CallWrapper(self, lambda *args, self=self, **kw: self.rdb().playerDetails(*args, **kw), readOnly=True)
         self.modifyBlacklistEntry =  CallWrapper(self, lambda *args, self=self, **kw: self.db().modifyBlacklistEntry(*args, **kw))
         self.modifyGroup =           CallWrapper(self, lambda *args, self=self, **kw: self.db().modifyGroup(*args, **kw))
-        self.setupDepositGet =       CallWrapper(self, lambda *args, self=self, **kw: self.db().setupDepositGet(*args, **kw))
-        self.setupDepositSave =      CallWrapper(self, lambda *args, self=self, **kw: self.db().setupDepositSave(*args, **kw))
-        self.setupDepositRemove =    CallWrapper(self, lambda *args, self=self, **kw: self.db().setupDepositRemove(*args, **kw))
-        self.csGetSeasons =          CallWrapper(self, lambda *args, self=self, **kw: self.db().csGetSeasons(*args, **kw))
+        self.setupDepositGet =       CallWrapper(self, lambda *args, self=self, **kw: self.rdb().setupDepositGet(*args, **kw), readOnly=True, priority=PRIO_CLIENT)
+        self.setupDepositSave =      CallWrapper(self, lambda *args, self=self, **kw: self.db().setupDepositSave(*args, **kw), priority=PRIO_CLIENT)
+        self.setupDepositRemove =    CallWrapper(self, lambda *args, self=self, **kw: self.db().setupDepositRemove(*args, **kw), priority=PRIO_CLIENT)
+        self.csGetSeasons =          CallWrapper(self, lambda *args, self=self, **kw: self.rdb().csGetSeasons(*args, **kw), readOnly=True)
         self.csModify =              CallWrapper(self, lambda *args, self=self, **kw: self.db().csModify(*args, **kw))
         self.playerInSessionPaCModify = CallWrapper(self, lambda *args, self=self, **kw: self.db().playerInSessionPaCModify(*args, **kw))
         self.modifyLap =             CallWrapper(self, lambda *args, self=self, **kw: self.db().modifyLap(*args, **kw))
         self.modifyRequiredChecksums = CallWrapper(self, lambda *args, self=self, **kw: self.db().modifyRequiredChecksums(*args, **kw))
-        self.getRequiredChecksums = CallWrapper(self, lambda *args, self=self, **kw: self.db().getRequiredChecksums(*args, **kw))
-        self.reconnect            = CallWrapper(self, lambda *args, self=self, **kw: self.db().reconnect(*args, **kw))
+        self.getRequiredChecksums = CallWrapper(self, lambda *args, self=self, **kw: self.rdb().getRequiredChecksums(*args, **kw), readOnly=True, priority=PRIO_CLIENT)
+        self.reconnect            = CallWrapper(self, lambda *args, self=self, **kw: self.db().reconnect(*args, **kw), priority=PRIO_REALTIME)
         self.csSetTeamName        = CallWrapper(self, lambda *args, self=self, **kw: self.db().csSetTeamName(*args, **kw))
-        self.statistics           = CallWrapper(self, lambda *args, self=self, **kw: self.db().statistics(*args, **kw))
-        self.trackAndCarDetails   = CallWrapper(self, lambda *args, self=self, **kw: self.db().trackAndCarDetails(*args, **kw))
-        self.trackMap             = CallWrapper(self, lambda *args, self=self, **kw: self.db().trackMap(*args, **kw))
-        self.carBadge             = CallWrapper(self, lambda *args, self=self, **kw: self.db().carBadge(*args, **kw))
-        self.comparisonInfo       = CallWrapper(self, lambda *args, self=self, **kw: self.db().comparisonInfo(*args, **kw))
-        self.queryFuelConsumption = CallWrapper(self, lambda *args, self=self, **kw: self.db().queryFuelConsumption(*args, **kw))
-        self.allgroups            = CallWrapper(self, lambda *args, self=self, **kw: self.db().allgroups(*args, **kw))
-        self.recordChat           = CallWrapper(self, lambda *args, self=self, **kw: self.db().recordChat(*args, **kw))
-        self.filterChat           = CallWrapper(self, lambda *args, self=self, **kw: self.db().filterChat(*args, **kw))
-        self.messagesDisabled     = CallWrapper(self, lambda *args, self=self, **kw: self.db().messagesDisabled(*args, **kw))
-        self.anonymize            = CallWrapper(self, lambda *args, self=self, **kw: self.db().anonymize(*args, **kw))
-        self.getPtsResponse       = CallWrapper(self, lambda *args, self=self, **kw: self.db().getPtsResponse(*args, **kw))
-        self.queryMR              = CallWrapper(self, lambda *args, self=self, **kw: self.db().queryMR(*args, **kw))
+        self.statistics           = CallWrapper(self, lambda *args, self=self, **kw: self.rdb().statistics(*args, **kw), readOnly=lambda kw: not kw.get('invalidate_laps', False))
+        self.trackAndCarDetails   = CallWrapper(self, lambda *args, self=self, **kw: self.db().trackAndCarDetails(*args, **kw), priority=PRIO_CLIENT)
+        self.trackMap             = CallWrapper(self, lambda *args, self=self, **kw: self.rdb().trackMap(*args, **kw), readOnly=True)
+        self.carBadge             = CallWrapper(self, lambda *args, self=self, **kw: self.rdb().carBadge(*args, **kw), readOnly=True)
+        self.comparisonInfo       = CallWrapper(self, lambda *args, self=self, **kw: self.rdb().comparisonInfo(*args, **kw), readOnly=True)
+        self.queryFuelConsumption = CallWrapper(self, lambda *args, self=self, **kw: self.rdb().queryFuelConsumption(*args, **kw), readOnly=True)
+        self.allgroups            = CallWrapper(self, lambda *args, self=self, **kw: self.rdb().allgroups(*args, **kw), readOnly=True)
+        self.recordChat           = CallWrapper(self, lambda *args, self=self, **kw: self.db().recordChat(*args, **kw), priority=PRIO_REALTIME)
+        self.filterChat           = CallWrapper(self, lambda *args, self=self, **kw: self.rdb().filterChat(*args, **kw), readOnly=True)
+        self.messagesDisabled     = CallWrapper(self, lambda *args, self=self, **kw: self.db().messagesDisabled(*args, **kw), priority=PRIO_REALTIME)
+        self.anonymize            = CallWrapper(self, lambda *args, self=self, **kw: self.db().anonymize(*args, **kw), priority=PRIO_CLIENT)
+        self.getPtsResponse       = CallWrapper(self, lambda *args, self=self, **kw: self.db().getPtsResponse(*args, **kw), priority=PRIO_CLIENT)
+        self.queryMR              = CallWrapper(self, lambda *args, self=self, **kw: self.db().queryMR(*args, **kw), priority=PRIO_CLIENT)
         self.isOnline = lambda self=self: self.db().isOnline()
         # create the database
         self._db = None
@@ -180,7 +217,10 @@ class LapDatabase:
 
     def db(self, maxTries = None):
         while self._db is None and (maxTries is None or maxTries > 0):
-            self._db = self.dbRef()
+            db = self.dbRef()
+            # db() might be called concurrently from the reader threads, the result is delivered only once
+            if not db is None:
+                self._db = db
             if not maxTries is None:
                 maxTries -= 1
             if (maxTries is None or maxTries > 0) and self._db is None:
@@ -190,7 +230,86 @@ class LapDatabase:
     def dbReady(self):
         return not self.db(maxTries = 1) is None
 
+    def initReader(self):
+        self.readerLocal.isReader = True
+        self.readerLocal.db = None
+
+    def rdb(self):
+        # the read only backend of the current thread, the main backend if not called from the read pool
+        if not getattr(self.readerLocal, 'isReader', False):
+            return self.db()
+        if self.readerLocal.db is None:
+            # wait until the writer has created (and possibly migrated) the database
+            self.db()
+            self.readerLocal.db = self.readerFactory()
+        return self.readerLocal.db
+
+    def onlineBackup(self, backupName, pagesPerStep = 100, stepPause = 0.05, compress = False, progress = None, blobStoreDir = None):
+        # Backup of the (sqlite) database while it is in use. The database is copied in steps of pagesPerStep
+        # pages, each step is a separate maintenance job of the worker with a pause of stepPause seconds
+        # in between, so the lap inserts are not delayed by more than one step. With compress=True, the
+        # copy is gzipped (in the calling thread) to backupName + ".gz". progress(pagesCopied, pageCount)
+        # is called after each step. Must not be called from the worker thread; returns some statistics.
+        # The segments of the blob store in blobStoreDir are copied to backupName + ".blobs"; the blob store
+        # compaction does not remove segments until the copy is complete.
+        t0 = time.time()
+        tmpName = backupName + ".tmp"
+        if os.path.exists(tmpName):
+            os.remove(tmpName)
+        blobStore = sharedBlobStore(blobStoreDir) if blobStoreDir else None
+        if not blobStore is None:
+            blobStore.holdRemovals()
+        try:
+            self.backupStart(__sync=True, backupName=tmpName)()
+            steps = 0
+            busySteps = 0
+            try:
+                while 1:
+                    p = self.backupStep(__sync=True, pages=pagesPerStep)()
+                    steps += 1
+                    busySteps += p['busy']
+                    if not progress is None:
+                        progress(p['pageCount'] - p['remaining'], p['pageCount'])
+                    if p['done']:
+                        break
+                    time.sleep(stepPause)
+            except:
+                self.backupAbort(__sync=True)()
+                if os.path.exists(tmpName):
+                    os.remove(tmpName)
+                raise
+            blobsName = None
+            blobsSize = 0
+            if not blobStore is None:
+                # the references of the copied database point to the segments existing now
+                blobsName = backupName + ".blobs"
+                if os.path.exists(blobsName):
+                    shutil.rmtree(blobsName)
+                blobsSize = blobStore.backupTo(blobsName)
+        finally:
+            if not blobStore is None:
+                blobStore.releaseRemovals()
+        tCopy = time.time() - t0
+        if compress:
+            backupName += ".gz"
+            with open(tmpName, "rb") as fsrc, gzip.open(backupName, "wb", compresslevel=6) as fdst:
+                shutil.copyfileobj(fsrc, fdst, 1024*1024)
+            os.remove(tmpName)
+        else:
+            os.replace(tmpName, backupName)
+        return {'file':backupName, 'pages':p['pageCount'], 'steps':steps, 'busySteps':busySteps,
+                'copyTime':tCopy, 'totalTime':time.time() - t0, 'size':os.path.getsize(backupName),
+                'blobs':blobsName, 'blobsSize':blobsSize}
+
+    def queueStats(self):
+        res = {'writer': self.worker.stats()}
+        if not self.readPool is None:
+            res['readers'] = self.readPool.stats()
+        return res
+
     def shutdown(self):
+        if not self.readPool is None:
+            self.readPool.shutdown()
         self.worker.shutdown()
 
     def checkErrors(self):
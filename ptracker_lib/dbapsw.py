@@ -23,11 +23,14 @@ import os.path
 import shutil
 import apsw
 import time
+import itertools
 #apsw.config(apsw.SQLITE_CONFIG_SERIALIZED)
 import traceback
 import threading
+import json
 from ptracker_lib.helpers import *
 from ptracker_lib.dbgeneric import GenericBackend
+from ptracker_lib.profiler import queryProfiler, StatementCache
 
 #stmt_log = open("apsw_log.sql", "w")
 
@@ -70,7 +73,11 @@ class CursorWrapper:
         if not self.db.inTransaction:
             acwarning("Execute but not in transaction?")
             acwarning("\n".join(traceback.format_stack()))
+        # the cursor is shared, so executing a statement finishes the previous one
+        self.db.finishProfile()
         tStart = time.time()
+        lockWait = self.db.lockWait
+        prepared = self.db.statements.lookup(stmt)
         while 1:
             try:
                 #t = stmt
@@ -81,20 +88,58 @@ class CursorWrapper:
                 #        t = t.replace(":" + k, v)
                 #stmt_log.write(t+";\n")
                 #stmt_log.flush()
-                return self.cur.execute(stmt, kw)
+                self.cur.execute(stmt, kw)
+                self.db.profile = [stmt, time.time() - tStart, 0, self.db.lockWait - lockWait, prepared]
+                return self
             except apsw.LockedError as e:
                 if time.time() - tStart > 1.:
                     acwarning("Waiting too long for database to get unlocked")
                     raise e
                 time.sleep(0.2)
+                self.db.lockWait += 0.2
             except apsw.BusyError as e:
                 raise DBBusyError(str(e))
 
+    def executemany(self, stmt, rows):
+        if not self.db.inTransaction:
+            acwarning("Executemany but not in transaction?")
+        self.db.finishProfile()
+        tStart = time.time()
+        lockWait = self.db.lockWait
+        prepared = self.db.statements.lookup(stmt)
+        try:
+            self.cur.executemany(stmt, rows)
+            self.db.profile = [stmt, time.time() - tStart, 0, self.db.lockWait - lockWait, prepared]
+            return self
+        except apsw.BusyError as e:
+            raise DBBusyError(str(e))
+
     def fetchone(self):
-        return self.cur.fetchone()
+        t = time.time()
+        res = self.cur.fetchone()
+        self.db.profileFetch(time.time() - t, 0 if res is None else 1, res is None)
+        return res
+
+    def fetchmany(self, n):
+        t = time.time()
+        res = list(itertools.islice(self.cur, n))
+        self.db.profileFetch(time.time() - t, len(res), len(res) < n)
+        return res
 
     def fetchall(self):
-        return self.cur.fetchall()
+        t = time.time()
+        res = self.cur.fetchall()
+        self.db.profileFetch(time.time() - t, len(res), True)
+        return res
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
 
     def __enter__(self):
         return self.cur.__enter__()
@@ -105,10 +150,34 @@ class CursorWrapper:
 
 class ApswConnectionWrapper:
 
-    def __init__(self, apswconn):
+    def __init__(self, apswconn, statementCacheSize):
         self.db = apswconn
         self.inTransaction = False
         self.cur = None
+        # apsw keeps the prepared statements per connection, keyed by the statement text
+        self.statements = StatementCache(statementCacheSize)
+        # [statement, time, rows, lock wait, prepared] of the statement whose result is currently fetched
+        self.profile = None
+        # accumulated time spent waiting for database locks
+        self.lockWait = 0.
+
+    def busy(self, n):
+        acdebug("busy handler called (%d)", n)
+        time.sleep(0.1)
+        self.lockWait += 0.1
+        return True
+
+    def profileFetch(self, dt, rows, finished):
+        if not self.profile is None:
+            self.profile[1] += dt
+            self.profile[2] += rows
+            if finished:
+                self.finishProfile()
+
+    def finishProfile(self):
+        if not self.profile is None:
+            queryProfiler.record(*self.profile)
+            self.profile = None
 
     def __enter__(self):
         self.inTransaction = True
@@ -119,10 +188,12 @@ class ApswConnectionWrapper:
         if tb is None:
             c = self.cursor()
             c.execute("COMMIT")
+            self.finishProfile()
             self.inTransaction = False
         else:
             c = self.cursor()
             c.execute("ROLLBACK")
+            self.finishProfile()
             self.inTransaction = False
 
     def commit(self):
@@ -142,25 +213,40 @@ class ApswConnectionWrapper:
 
 # class serving as a proxy object for our database access
 class SqliteBackend(GenericBackend):
+    # number of prepared statements cached per connection
+    statementCacheSize = 200
 
-    def __init__(self, lapHistoryFactory, dbname, perform_backups, force_version = None):
+    def __init__(self, lapHistoryFactory, dbname, perform_backups, force_version = None, readonly = False, concurrentReaders = False, blobStoreDir = None):
         self.dbname = dbname
-        acinfo("Using database '%s'" % dbname)
+        acinfo("Using database '%s'%s" % (dbname, " (read only)" if readonly else ""))
         self.blob = "BLOB"
         self.primkey = "INTEGER PRIMARY KEY"
         self.nullslast = ""
-        db = apsw.Connection(dbname)
-        db.setbusyhandler(self.busy)
-        GenericBackend.__init__(self, lapHistoryFactory, ApswConnectionWrapper(db), perform_backups, force_version=force_version)
+        # (backup connection, apsw backup object) of the running online backup
+        self.onlineBackup = None
+        if readonly:
+            db = apsw.Connection(dbname, flags=apsw.SQLITE_OPEN_READONLY, statementcachesize=self.statementCacheSize)
+            perform_backups = False
+        else:
+            db = apsw.Connection(dbname, statementcachesize=self.statementCacheSize)
+        try:
+            # the values of IN lists are passed as one json array parameter, see GenericBackend.inList
+            db.cursor().execute("SELECT value FROM json_each('[1]')").fetchall()
+            self.listSelect = "SELECT value FROM json_each(:%s)"
+            self.listParam = json.dumps
+        except apsw.SQLError:
+            acinfo("sqlite has no json support, IN lists are expanded.")
+        conn = ApswConnectionWrapper(db, self.statementCacheSize)
+        db.setbusyhandler(conn.busy)
+        if concurrentReaders:
+            # in WAL mode, the readers are not blocked by the writer and vice versa
+            mode = db.cursor().execute("PRAGMA journal_mode=WAL").fetchone()[0]
+            acinfo("Database journal mode: %s", mode)
+        GenericBackend.__init__(self, lapHistoryFactory, conn, perform_backups, force_version=force_version, blobStoreDir=blobStoreDir)
 
     def selectOrderedAggregate(self, non_agg_field, agg_field, agg_field_name, table_name):
         return "SELECT %(non_agg_field)s, GROUP_CONCAT(%(agg_field)s) AS %(agg_field_name)s FROM (SELECT %(non_agg_field)s,%(agg_field)s FROM %(table_name)s ORDER BY %(non_agg_field)s,%(agg_field)s) GROUP BY %(non_agg_field)s" % locals()
 
-    def busy(self, n):
-        acdebug("busy handler called (%d)", n)
-        time.sleep(0.1)
-        return True
-
     def backup(self, old_version, new_version):
         if os.path.exists(self.dbname):
             backup_name = self.dbname + ".bak_%d_%d" % (old_version, new_version)
@@ -177,6 +263,40 @@ class SqliteBackend(GenericBackend):
         else:
             acinfo("Skipping backup of %s", self.dbname)
 
+    def backupStart(self, backupName):
+        # start a stepwise backup of the database into backupName, see LapDatabase.onlineBackup. The steps
+        # use the connection of the writer, so the lap inserts between the steps are copied as well and
+        # don't restart the backup.
+        if not self.onlineBackup is None:
+            acwarning("Aborting the running online backup.")
+            self.backupAbort()
+        backupDb = apsw.Connection(backupName)
+        self.onlineBackup = (backupDb, backupDb.backup("main", self.db.db, "main"))
+
+    def backupStep(self, pages):
+        # copy the next pages; returns the progress of the backup, which is finished if done is True
+        backupDb, b = self.onlineBackup
+        busy = False
+        try:
+            b.step(pages)
+        except (apsw.BusyError, apsw.LockedError):
+            # the database is locked by another connection, the step is repeated later
+            busy = True
+        except:
+            self.backupAbort()
+            raise
+        res = {'remaining':b.remaining, 'pageCount':b.pagecount, 'done':b.done, 'busy':busy}
+        if b.done:
+            self.backupAbort()
+        return res
+
+    def backupAbort(self):
+        if not self.onlineBackup is None:
+            backupDb, b = self.onlineBackup
+            self.onlineBackup = None
+            b.finish()
+            backupDb.close()
+
     def getVersion(self, cur = None):
         if cur is None:
             with self.db:
@@ -195,6 +315,11 @@ class SqliteBackend(GenericBackend):
     def setVersion(self, cur, version):
         cur.execute("PRAGMA user_version = %d" % version)
 
+    def cacheIdentity(self):
+        if self.dbname == ":memory:":
+            return None
+        return os.path.abspath(self.dbname)
+
     def isOnline(self):
         return True
 
@@ -211,12 +336,28 @@ class SqliteBackend(GenericBackend):
     def deferr_foreign_key_constraints(self, cur):
         cur.execute("PRAGMA defer_foreign_keys = 1")
 
+    def incrementalVacuum(self, cur):
+        if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # not in incremental mode (yet), the space is reclaimed at the next VACUUM
+            return 0
+        freed = cur.execute("PRAGMA freelist_count").fetchone()[0]*cur.execute("PRAGMA page_size").fetchone()[0]
+        cur.execute("PRAGMA incremental_vacuum").fetchall()
+        return freed
+
+    def tableDependencies(self, cur):
+        res = {}
+        for table in self.tables(cur):
+            res[table.lower()] = set([r[2].lower() for r in cur.execute("PRAGMA foreign_key_list(%s)" % table).fetchall()])
+        return res
+
     def postPopulate(self, cur):
         pass
 
     def postCompress(self, cur):
         if cur is None:
             cur = self.db.db.cursor()
+            # from now on, free pages can be given back with incrementalVacuum
+            cur.execute("PRAGMA auto_vacuum = INCREMENTAL")
             cur.execute("VACUUM")
         else:
             acdebug("discarding vacuum call from within a transaction.")
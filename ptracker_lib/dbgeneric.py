@@ -23,20 +23,22 @@ import datetime
 import pickle
 import zlib
 import struct
+import array
+import itertools
+import copy
 import functools
+import sys
 import re
 import time
+import threading
 import traceback
 from ptracker_lib.helpers import *
-from ptracker_lib.dbschemata import DbSchemata
+from ptracker_lib.dbschemata import DbSchemata, nameTrigrams
+from ptracker_lib.blobstore import sharedBlobStore, blobHash
+from ptracker_lib.lrucache import LruCache
 import ptracker_lib
 from ptracker_lib.constants import *
 
-def prof(s, proft):
-    t = time.time()
-    acdebug("profiling %s: %.1f s", s, t-proft)
-    return t
-
 class DictCursor:
     def __init__(self, cols, description):
         colNames = list(map(lambda x: x[0], description))
@@ -54,7 +56,67 @@ class Session:
             setattr(self, k, kw[k])
         self.guid_cars_mapping = {}
 
-def compress(sampleTimes, worldPositions, velocities, normSplinePositions, minDt = None):
+# History info blob formats. The legacy format is a plain zlib stream of
+# interleaved, individually packed signals (a zlib stream always starts with 0x78).
+# Newer formats start with a magic and a version byte, followed by a zlib stream
+# of a columnar layout: number of samples, the (min,max) quantization ranges of
+# the 7 float signals and 8 little endian int32 columns of delta encoded values
+# (sampleTimes, normSplinePositions, worldPositions x/y/z, velocities x/y/z),
+# stored as 4 byte planes. The columns can be decoded in bulk using array (or numpy).
+HISTORY_INFO_LEGACY = 1
+HISTORY_INFO_COLUMNAR = 2
+HISTORY_INFO_VERSION = HISTORY_INFO_COLUMNAR
+historyInfoMagic = b'PTHI'
+historyInfoResolution = 2**30
+
+def compress(sampleTimes, worldPositions, velocities, normSplinePositions, minDt = None, version = HISTORY_INFO_VERSION):
+    def take(array, idx):
+        return list(map(lambda i, a=array: a[i], idx))
+    if not minDt is None and len(sampleTimes) >= 2:
+        idx = [0]
+        for i in range(1,len(sampleTimes)-1):
+            if sampleTimes[i] - sampleTimes[idx[-1]] >= minDt:
+                idx.append(i)
+        idx.append(len(sampleTimes)-1)
+        sampleTimes = take(sampleTimes, idx)
+        normSplinePositions = take(normSplinePositions, idx)
+        worldPositions = take(worldPositions, idx)
+        velocities = take(velocities, idx)
+    n = len(sampleTimes)
+    if version == HISTORY_INFO_COLUMNAR and not all([len(x) == n for x in [worldPositions, velocities, normSplinePositions]]):
+        # the columnar format needs signals of equal length
+        version = HISTORY_INFO_LEGACY
+    if version == HISTORY_INFO_LEGACY:
+        return compressLegacy(sampleTimes, worldPositions, velocities, normSplinePositions)
+    myassert(version == HISTORY_INFO_COLUMNAR)
+    def deltas(l):
+        return [l[0]] + [x1-x0 for x0,x1 in zip(l[:-1], l[1:])] if len(l) > 0 else []
+    columns = [normSplinePositions]
+    for signal in [worldPositions, velocities]:
+        for i in range(3):
+            columns.append([x[i] for x in signal])
+    ranges = []
+    data = array.array('i', deltas(sampleTimes))
+    for l in columns:
+        if len(l) == 0:
+            l_min, l_max = 0.0, 0.1
+        else:
+            l_min = min(l)
+            l_max = max(l)
+            if l_max < l_min + 0.1:
+                l_max = l_min + 0.1
+        scale = historyInfoResolution/(l_max-l_min)
+        ranges.extend([l_min, l_max])
+        data.extend(deltas([int((x-l_min)*scale) for x in l]))
+    if sys.byteorder != 'little':
+        data.byteswap()
+    # store the bytes of the int32 values in byte planes, the deltas are small
+    # so the upper planes are nearly constant and compress well
+    data = data.tobytes()
+    o = struct.pack('<I14d', n, *ranges) + b"".join([data[i::4] for i in range(4)])
+    return historyInfoMagic + struct.pack('<B', version) + zlib.compress(o, 6)
+
+def compressLegacy(sampleTimes, worldPositions, velocities, normSplinePositions):
     def compressTimeIntSignal(l):
         if len(l) == 0:
             l = [0]
@@ -70,7 +132,7 @@ def compress(sampleTimes, worldPositions, velocities, normSplinePositions, minDt
         l_max = max(l)
         if l_max < l_min + 0.1:
             l_max = l_min + 0.1
-        resolution = 2**30
+        resolution = historyInfoResolution
         tl = tuple(map(lambda x: int((x-l_min)/(l_max-l_min)*resolution), l))
         return struct.pack('ffi', l_min, l_max, resolution) + compressTimeIntSignal(tl)
     def compress3dTimeFloatSignal(l):
@@ -81,25 +143,53 @@ def compress(sampleTimes, worldPositions, velocities, normSplinePositions, minDt
             tl = tuple(map(lambda x: x[i], l))
             o += compressTimeFloatSignal(tl)
         return o
-    def take(array, idx):
-        return list(map(lambda i, a=array: a[i], idx))
-    if not minDt is None and len(sampleTimes) >= 2:
-        idx = [0]
-        for i in range(1,len(sampleTimes)-1):
-            if sampleTimes[i] - sampleTimes[idx[-1]] >= minDt:
-                idx.append(i)
-        idx.append(len(sampleTimes)-1)
-        sampleTimes = take(sampleTimes, idx)
-        normSplinePositions = take(normSplinePositions, idx)
-        worldPositions = take(worldPositions, idx)
-        velocities = take(velocities, idx)
     o = compressTimeIntSignal(sampleTimes)
     o += compressTimeFloatSignal(normSplinePositions)
     o += compress3dTimeFloatSignal(worldPositions)
     o += compress3dTimeFloatSignal(velocities)
     return zlib.compress(o, 9)
 
+def historyInfoVersion(buffer):
+    if bytes(buffer[:len(historyInfoMagic)]) == historyInfoMagic:
+        return struct.unpack('<B', bytes(buffer[len(historyInfoMagic):len(historyInfoMagic)+1]))[0]
+    return HISTORY_INFO_LEGACY
+
+def transcodeHistoryInfo(buffer, version):
+    if buffer is None or historyInfoVersion(buffer) == version:
+        return buffer
+    return compress(*decompress(buffer), version=version)
+
 def decompress(buffer):
+    version = historyInfoVersion(buffer)
+    if version == HISTORY_INFO_LEGACY:
+        return decompressLegacy(buffer)
+    myassert(version == HISTORY_INFO_COLUMNAR)
+    o = zlib.decompress(bytes(buffer[len(historyInfoMagic)+1:]))
+    hsize = struct.calcsize('<I14d')
+    n = struct.unpack('<I', o[:4])[0]
+    ranges = struct.unpack('<I14d', o[:hsize])[1:]
+    planes = o[hsize:]
+    myassert(len(planes) == 8*4*n)
+    interleaved = bytearray(len(planes))
+    for i in range(4):
+        interleaved[i::4] = planes[i*8*n:(i+1)*8*n]
+    data = array.array('i')
+    data.frombytes(bytes(interleaved))
+    if sys.byteorder != 'little':
+        data.byteswap()
+    myassert(len(data) == 8*n)
+    columns = [list(itertools.accumulate(data[i*n:(i+1)*n])) for i in range(8)]
+    sampleTimes = columns[0]
+    for i in range(7):
+        l_min = ranges[2*i]
+        scale = (ranges[2*i+1]-l_min)/historyInfoResolution
+        columns[i+1] = [x*scale + l_min for x in columns[i+1]]
+    normSplinePositions = columns[1]
+    worldPositions = list(zip(*columns[2:5]))
+    velocities = list(zip(*columns[5:8]))
+    return (sampleTimes, worldPositions, velocities, normSplinePositions)
+
+def decompressLegacy(buffer):
     def decompressTimeIntSignal(o):
         n,l0 = struct.unpack('ii', o[:8])
         dl = struct.unpack('i'*(n-1), o[8:8+(n-1)*4])
@@ -135,41 +225,208 @@ def valueListToDict(l, prefix, d):
         res = res + "%s:%s" %(","*(i>0),l)
     return res
 
-if 0:
-  class CursorDebug:
-    def __init__(self, cur):
-        self.cur = cur
-
-    def __getattr__(self, a):
-        return getattr(self.cur, a)
-
-    def execute(self, stmt, replacements = {}):
-        def repl(M):
-            v = M.group(1)
-            r = replacements.get(v)
-            if type(r) == str:
-                return "'"+r+"'"
-            elif r is None:
-                return "NULL"
-            else:
-                return "%s" % r
-        acdebug(re.subn(':([a-zA-Z_0-9]+)', repl, stmt)[0])
-        import time
-        t0 = time.time()
-        res = self.cur.execute(stmt, replacements)
-        t1 = time.time()
-        acdebug("Time used: %.1f secs", t1-t0)
-        return res
-else:
-    def CursorDebug(c):
-        return c
+
+# a history info is either stored in LapBinBlob.HistoryInfo or referenced in the blob store
+HISTORY_INFO_COLUMNS = "LapBinBlob.HistoryInfo, LapBinBlob.BlobSegment, LapBinBlob.BlobOffset, LapBinBlob.BlobLength, LapBinBlob.BlobHash"
+HISTORY_INFO_NOTNULL = "(LapBinBlob.HistoryInfo NOTNULL OR LapBinBlob.BlobHash NOTNULL)"
+HISTORY_INFO_SET_NULL = "HistoryInfo=NULL, BlobSegment=NULL, BlobOffset=NULL, BlobLength=NULL, BlobHash=NULL"
+
+# result caches (see GenericBackend.cachedBestTimes and GenericBackend.cachedCount), shared by all backends
+# of the same database in this process (i.e. the writer and the read pool), maps (cache identity, name) -> LruCache
+sharedCaches = {}
+sharedCachesLock = threading.Lock()
+
+def sharedCache(identity, name, maxEntries, maxAge):
+    if identity is None:
+        return LruCache(maxEntries, maxAge)
+    with sharedCachesLock:
+        if not (identity, name) in sharedCaches:
+            sharedCaches[(identity, name)] = LruCache(maxEntries, maxAge)
+        return sharedCaches[(identity, name)]
+
+def pinsBlobSegments(f):
+    # the blob store segments written by the transaction of f are pinned until f returns
+    @functools.wraps(f)
+    def wrapper(self, *args, **kw):
+        if self.blobStore is None or not self.blobStore.pinWrites():
+            return f(self, *args, **kw)
+        try:
+            return f(self, *args, **kw)
+        finally:
+            self.blobStore.releaseWrites()
+    return wrapper
 
 class GenericBackend(DbSchemata):
-    def __init__(self, lapHistoryFactory, db, perform_backups, force_version = None):
+    # maximum number of cached best time results and their maximum age [s] (None: until invalidated)
+    bestTimesCacheSize = 2000
+    bestTimesCacheMaxAge = None
+    # the total counts of the paged views are cached for some seconds, so they are approximate after modifications
+    pageCountCacheSize = 500
+    pageCountCacheMaxAge = 30.
+    # number of cached row ids of the session and day scoped rows maintained by registerLap (player in session,
+    # leaderboard and daily rollups)
+    rowIdCacheSize = 5000
+    # sub select of the values of a list parameter (with %s replaced by the parameter name) and the conversion
+    # of the list to the parameter value; set by the backends supporting list parameters (see inList)
+    listSelect = None
+    listParam = None
+
+    def __init__(self, lapHistoryFactory, db, perform_backups, force_version = None, blobStoreDir = None):
         self.currentSession = None
+        # optional storage of the history infos outside the database
+        self.blobStore = sharedBlobStore(blobStoreDir) if blobStoreDir else None
+        # write-through cache of the dimension ids (tracks, cars, players, teams, tyre compounds) used by
+        # registerLap, maps (table, key...) -> id
+        self.dimensionIds = {}
+        # the same for the rows of registerLap which are needed for some time only, bounded
+        self.rowIds = LruCache(self.rowIdCacheSize)
+        # cached championship results, maps cs_id -> (generation, result)
+        self.csCache = {}
+        # cached results of getSBandPB, getBestSectorTimes and getBestLap, keys start with (function, track, car)
+        self.bestTimesCache = sharedCache(self.cacheIdentity(), "BestTimes", self.bestTimesCacheSize, self.bestTimesCacheMaxAge)
+        # cached total counts of lapStats, sessionStats, getPlayers and filterChat, keys are (statement, parameters...)
+        self.pageCountCache = sharedCache(self.cacheIdentity(), "PageCounts", self.pageCountCacheSize, self.pageCountCacheMaxAge)
         DbSchemata.__init__(self, lapHistoryFactory, db, perform_backups, force_version)
+        # the schema might have been migrated
+        self.invalidateDimensionIds()
+
+    def invalidateDimensionIds(self, table = None):
+        if table is None:
+            self.dimensionIds = {}
+            self.rowIds.invalidate()
+        else:
+            self.dimensionIds = dict(filter(lambda x: x[0][0] != table, self.dimensionIds.items()))
+            self.rowIds.invalidate(lambda k: k[0] == table)
+
+    def cacheIdentity(self):
+        # backends returning the same identity share the cached best times; None means a private cache
+        return None
+
+    def cachedBestTimes(self, key, epoch, f):
+        # return the cached result for key, or the result of f() which is stored if epoch is not None
+        hit, res = self.bestTimesCache.lookup(key)
+        if hit:
+            return copy.deepcopy(res)
+        res = f()
+        if not epoch is None:
+            self.bestTimesCache.put(key, copy.deepcopy(res), epoch)
+        return res
+
+    def invalidateBestTimes(self, track = None, car = None):
+        # must be called after the commit of the lap modifications. None invalidates all tracks or cars
+        if track is None:
+            self.bestTimesCache.invalidate()
+        else:
+            self.bestTimesCache.invalidate(lambda k: k[1] == track and (car is None or k[2] is None or k[2] == car))
+
+    def bestTimesCacheStats(self):
+        return self.bestTimesCache.stats()
+
+    def inList(self, values, name, d):
+        # the statement text of an IN list, i.e. "x IN (%s)" % self.inList(...). The values are stored in d as
+        # one parameter, so the statement (and its prepared form) does not depend on the number of values.
+        values = list(values)
+        if self.listSelect is None:
+            return valueListToDict(values, name, d)
+        d[name] = self.listParam(values)
+        return self.listSelect % name
+
+    def cachedCount(self, cur, stmt, params):
+        # execute the COUNT(*) statement stmt or return its cached result; the key consists of the statement
+        # and the values of the parameters used in it
+        names = sorted(set(re.findall(r":([A-Za-z_][A-Za-z0-9_]*)", stmt)))
+        key = (stmt,) + tuple([params.get(n, None) for n in names])
+        key = tuple([tuple(k) if type(k) == list else k for k in key])
+        hit, count = self.pageCountCache.lookup(key)
+        if not hit:
+            count = cur.execute(stmt, params).fetchone()[0]
+            self.pageCountCache.put(key, count)
+        return count
+
+    def generation(self, cur, name):
+        # return the change counter of the derived data with the given name
+        ans = cur.execute("SELECT Generation FROM Generations WHERE Name=:name", locals()).fetchone()
+        return ans[0] if not ans is None else 0
+
+    def bumpGeneration(self, cur, name):
+        # invalidate all cached results depending on the derived data with the given name. The rendered
+        # http pages depend on all data, so the "Pages" generation is bumped as well.
+        for name in sorted(set([name, "Pages"])):
+            cur.execute("UPDATE Generations SET Generation=Generation+1 WHERE Name=:name", locals())
+            cur.execute("""
+                INSERT INTO Generations(Name, Generation)
+                    SELECT :name, 1
+                    WHERE NOT EXISTS (SELECT 1 FROM Generations WHERE Name=:name)
+            """, locals())
+
+    def pageGeneration(self):
+        # change counter of the data shown on the http pages (see the page cache of stracker_lib/http_server.py)
+        with self.db:
+            cur = self.db.cursor()
+            return self.generation(cur, "Pages")
+
+    def loadHistoryInfo(self, historyInfo, blobSegment, blobOffset, blobLength, blobHash):
+        # get the history info from the values of HISTORY_INFO_COLUMNS
+        if not historyInfo is None:
+            return bytes(historyInfo)
+        if blobHash is None:
+            return None
+        if self.blobStore is None:
+            acwarning("The history info is stored in the blob store, but there is no blob store configured.")
+            return None
+        return self.blobStore.get(blobSegment, blobOffset, blobLength, blobHash)
+
+    def storeHistoryInfo(self, cur, historyInfo):
+        # put the history info into the blob store and return the reference; identical blobs are stored once
+        h = blobHash(historyInfo)
+        ref = cur.execute("""
+            SELECT BlobSegment, BlobOffset, BlobLength FROM LapBinBlob WHERE BlobHash=:h LIMIT 1
+        """, locals()).fetchone()
+        if not ref is None:
+            return (ref[0], ref[1], ref[2], h)
+        return self.blobStore.put(historyInfo)
+
+    def maintenanceState(self, cur, name):
+        # return the persisted position of the maintenance task with the given name
+        ans = cur.execute("SELECT Value FROM MaintenanceState WHERE Name=:name", locals()).fetchone()
+        return ans[0] if not ans is None else 0
+
+    def setMaintenanceState(self, cur, name, value):
+        cur.execute("UPDATE MaintenanceState SET Value=:value WHERE Name=:name", locals())
+        cur.execute("""
+            INSERT INTO MaintenanceState(Name, Value)
+                SELECT :name, :value
+                WHERE NOT EXISTS (SELECT 1 FROM MaintenanceState WHERE Name=:name)
+        """, locals())
+
+    def indexPlayerName(self, cur, playerId):
+        # keep the trigram index (see getPlayers) in sync after the player's name has been set
+        ans = cur.execute("SELECT Name FROM Players WHERE PlayerId=:playerId", locals()).fetchone()
+        cur.execute("DELETE FROM PlayerNameTrigrams WHERE PlayerId=:playerId", locals())
+        if not ans is None:
+            self.insertRows(cur, "PlayerNameTrigrams", [(t, playerId) for t in nameTrigrams(ans[0])])
+
+    def dimensionId(self, cur, newIds, table, idColumn, column, value):
+        # return the id of the row in table with column=value, create it if it not exists
+        key = (table, value)
+        res = self.dimensionIds.get(key, newIds.get(key, None))
+        if res is None:
+            cur.execute("""
+                INSERT INTO %(table)s(%(column)s)
+                    SELECT :value
+                    WHERE NOT EXISTS (SELECT 1 FROM %(table)s WHERE %(column)s=:value)
+            """ % locals(), locals())
+            res = cur.execute("SELECT %(idColumn)s FROM %(table)s WHERE %(column)s=:value" % locals(), locals()).fetchone()[0]
+            # the id is valid only after the transaction is commited
+            newIds[key] = res
+        return res
 
     def getBestLap(self, trackname, carname, assertValidSectors=0, playerGuid=None, allowSoftSplits=False, assertHistoryInfo=False):
+        key = ("BestLap", trackname, carname, playerGuid, assertValidSectors, allowSoftSplits, assertHistoryInfo)
+        return self.cachedBestTimes(key, self.bestTimesCache.epoch,
+                                    lambda: self.queryBestLap(trackname, carname, assertValidSectors, playerGuid, allowSoftSplits, assertHistoryInfo))
+
+    def queryBestLap(self, trackname, carname, assertValidSectors, playerGuid, allowSoftSplits, assertHistoryInfo):
         with self.db:
             cur = self.db.cursor()
 
@@ -187,7 +444,7 @@ class GenericBackend(DbSchemata):
                 else:
                     stmt += " AND NOT SectorTime0=:invalid"
             if assertHistoryInfo:
-                stmt += " AND LapId IN (SELECT LapId FROM LapBinBlob WHERE HistoryInfo NOTNULL)"
+                stmt += " AND LapId IN (SELECT LapId FROM LapBinBlob WHERE %s)" % HISTORY_INFO_NOTNULL
             if not playerGuid is None:
                 stmt += " AND SteamGuid=:playerGuid"
             lapValid = 1
@@ -212,8 +469,8 @@ class GenericBackend(DbSchemata):
                 if s >= self.invalidSplit:
                     sectorTimes[i] = None
             lapId = row[11]
-            hi = cur.execute("SELECT HistoryInfo FROM LapBinBlob WHERE LapId=:lapId", locals()).fetchone()
-            if not hi is None: hi = hi[0]
+            hi = cur.execute("SELECT %s FROM LapBinBlob WHERE LapId=:lapId" % HISTORY_INFO_COLUMNS, locals()).fetchone()
+            if not hi is None: hi = self.loadHistoryInfo(*hi)
             try:
                 sampleTimes, worldPositions, velocities, normSplinePositions = decompress(hi)
                 res = self.lapHistoryFactory(lapTime=int(row[0]),
@@ -242,16 +499,25 @@ class GenericBackend(DbSchemata):
             return res
 
     def getSBandPB(self, trackname, carname, playerGuid, cursor = None):
+        # results computed in a transaction of the caller are not cached, it might have been started before an invalidation
+        key = ("SBandPB", trackname, carname, playerGuid)
+        epoch = self.bestTimesCache.epoch if cursor is None else None
+        return self.cachedBestTimes(key, epoch, lambda: self.querySBandPB(trackname, carname, playerGuid, cursor))
+
+    def querySBandPB(self, trackname, carname, playerGuid, cursor = None):
         if cursor is None:
             with self.db:
                 cur = self.db.cursor()
-                return self.getSBandPB(trackname, carname, playerGuid, cur)
+                return self.querySBandPB(trackname, carname, playerGuid, cur)
         else:
             cur = cursor
             cur.execute("""
-                SELECT LapTime
-                FROM LapTimes
-                WHERE (Track=:trackname AND Car=:carname AND SteamGuid=:playerGuid AND Valid>=1) ORDER BY LapTime ASC LIMIT 1;
+                SELECT MIN(LapTime)
+                FROM Leaderboard
+                WHERE TrackId IN (SELECT TrackId FROM Tracks WHERE Track=:trackname) AND
+                      CarId IN (SELECT CarId FROM Cars WHERE Car=:carname) AND
+                      PlayerId IN (SELECT PlayerId FROM Players WHERE SteamGuid=:playerGuid) AND
+                      Valid>=1
             """, locals())
             r = cur.fetchone()
             if r is None:
@@ -260,9 +526,11 @@ class GenericBackend(DbSchemata):
                 pb = r[0]
 
             cur.execute("""
-                SELECT LapTime
-                FROM LapTimes
-                WHERE (Track=:trackname AND Car=:carname AND Valid>=1) ORDER BY LapTime ASC LIMIT 1;
+                SELECT MIN(LapTime)
+                FROM Leaderboard
+                WHERE TrackId IN (SELECT TrackId FROM Tracks WHERE Track=:trackname) AND
+                      CarId IN (SELECT CarId FROM Cars WHERE Car=:carname) AND
+                      Valid>=1
             """, locals())
             r = cur.fetchone()
             if r is None:
@@ -273,30 +541,38 @@ class GenericBackend(DbSchemata):
             return {'pb':pb, 'sb':sb}
 
     def getBestSectorTimes(self, trackname, carname, playerGuid = None, cursor = None):
+        key = ("BestSectorTimes", trackname, carname, playerGuid)
+        epoch = self.bestTimesCache.epoch if cursor is None else None
+        return self.cachedBestTimes(key, epoch, lambda: self.queryBestSectorTimes(trackname, carname, playerGuid, cursor))
+
+    def queryBestSectorTimes(self, trackname, carname, playerGuid = None, cursor = None):
         if cursor is None:
             with self.db:
                 c = self.db.cursor()
-                return self.getBestSectorTimes(trackname, carname, playerGuid, c)
+                return self.queryBestSectorTimes(trackname, carname, playerGuid, c)
         else:
             cur = cursor
-            res = []
             stmt = ""
             if not playerGuid is None:
-                stmt += " AND SteamGuid=:playerGuid"
+                stmt += " AND PlayerInSession.PlayerId IN (SELECT PlayerId FROM Players WHERE SteamGuid=:playerGuid)"
             lapValid = 1
-            for i in range(10):
-                cur.execute("""
-                    SELECT SectorTime%d
-                    FROM LapTimes
-                    WHERE (Track=:trackname AND Car=:carname AND Valid=:lapValid %s)
-                    ORDER BY SectorTime%d ASC LIMIT 1;
-                """ % (i,stmt,i), locals())
-                row = cur.fetchone()
-
-                if row is None:
+            cols = ",".join(["MIN(SectorTime%d)" % i for i in range(10)])
+            row = cur.execute("""
+                SELECT %s
+                FROM Lap
+                WHERE Valid=:lapValid AND
+                      PlayerInSessionId IN (
+                        SELECT PlayerInSessionId FROM PlayerInSession JOIN Session ON (PlayerInSession.SessionId = Session.SessionId)
+                        WHERE Session.TrackId IN (SELECT TrackId FROM Tracks WHERE Track=:trackname) AND
+                              PlayerInSession.CarId IN (SELECT CarId FROM Cars WHERE Car=:carname)
+                              %s)
+            """ % (cols,stmt), locals()).fetchone()
+            res = []
+            for v in row:
+                if v is None:
                     res.append(None)
                 else:
-                    res.append(int(row[0]+0.5))
+                    res.append(int(v+0.5))
 
             for i,r in enumerate(res):
                 if not r is None and r >= self.invalidSplit:
@@ -305,7 +581,8 @@ class GenericBackend(DbSchemata):
             return res
 
     def newSession(self, trackname, carnames, sessionType, multiplayer,
-                   numberOfLaps, duration, server, sessionState):
+                   numberOfLaps, duration, server, sessionState, startTime = None, idempotencyKey = None):
+        # startTime and idempotencyKey are passed when replaying the lap spool (see stracker_lib/lap_spool.py)
         self.currentSession = Session(
                 trackname=trackname,
                 carnames=set(carnames),
@@ -314,9 +591,10 @@ class GenericBackend(DbSchemata):
                 numberOfLaps=numberOfLaps,
                 duration=duration,
                 server=server,
-                startTime=unixtime_now(),
+                startTime=unixtime_now() if startTime is None else startTime,
                 endTime=0,
                 dbSessionId=None,
+                idempotencyKey=idempotencyKey,
                 penaltiesEnabled=sessionState.get('penaltiesEnabled',None),
                 allowedTyresOut=sessionState.get('allowedTyresOut',None),
                 tyreWearFactor=sessionState.get('tyreWearFactor',None),
@@ -324,16 +602,52 @@ class GenericBackend(DbSchemata):
                 damage=sessionState.get('damage',None),
         )
 
-    def finishSession(self, positions, ac_positions = None):
+    def finishSession(self, positions, ac_positions = None, endTime = None, idempotencyKey = None):
+        # endTime and idempotencyKey are passed when replaying the lap spool (see stracker_lib/lap_spool.py)
         if self.currentSession is None:
             acinfo("currentsession is none, no session to finish.")
             return
         sessionId = self.currentSession.dbSessionId
+        sessionKey = self.currentSession.idempotencyKey
+        if sessionId is None and not sessionKey is None:
+            # the laps of the session might have been inserted before replaying the lap spool after a restart
+            with self.db:
+                ans = self.db.cursor().execute("SELECT ObjectId FROM IdempotencyKeys WHERE IdempotencyKey=:sessionKey", locals()).fetchone()
+                if not ans is None:
+                    sessionId = ans[0]
         if sessionId is None:
             acdebug("session seems to be empty, ignoring")
             return
         with self.db:
             cur = self.db.cursor()
+            if not idempotencyKey is None:
+                if not cur.execute("SELECT ObjectId FROM IdempotencyKeys WHERE IdempotencyKey=:idempotencyKey", locals()).fetchone() is None:
+                    acinfo("Session %s has already been finished, ignoring.", idempotencyKey)
+                    self.currentSession = None
+                    return
+                self.insertIdempotencyKey(cur, idempotencyKey, sessionId)
+                # the keys are needed only until the spool records are acknowledged
+                keysBefore = unixtime_now() - 30*24*3600
+                cur.execute("DELETE FROM IdempotencyKeys WHERE Timestamp < :keysBefore", locals())
+            # the player in session ids and lap counts of the session, (guid, car) -> [(pisid, numlaps), ...]
+            pisByGuidCar = {}
+            # the last car of the players in the database; the mapping of the current session is incomplete if
+            # the laps have been registered before a restart (e.g. when replaying the lap spool)
+            guidCarsInDb = {}
+            ans = cur.execute("""
+                SELECT PlayerInSessionId,SteamGuid,Car,
+                       (SELECT COUNT(*) FROM Lap WHERE Lap.PlayerInSessionId=PlayerInSessionView.PlayerInSessionId)
+                FROM PlayerInSessionView
+                WHERE SessionId=:sessionId
+                ORDER BY PlayerInSessionId
+            """, locals()).fetchall()
+            for a in ans:
+                pisByGuidCar.setdefault((a[1], a[2]), []).append((a[0], a[3]))
+                guidCarsInDb[a[1]] = a[2]
+            if ac_positions is None:
+                ac_positions = {}
+            updates = []
+            corrections = []
             for i,p in enumerate(positions):
                 sessionPosition = i+1
                 steamGuid = p['steamGuid']
@@ -345,80 +659,85 @@ class GenericBackend(DbSchemata):
                     else:
                         steamGuid = "unknown_guid_"
                     steamGuid += playerName
-                carname = self.currentSession.guid_cars_mapping.get(steamGuid, None)
+                carname = self.currentSession.guid_cars_mapping.get(steamGuid, guidCarsInDb.get(steamGuid, None))
                 if carname is None:
                     acinfo("Player %s (Position %d) has not been associated in this session. Ignoring." % (playerName, sessionPosition))
                     continue
                 raceFinished = p['raceFinished']
                 finishTime = p['finishTime']
-                if ac_positions is None:
-                    ac_positions = {}
                 if not raceFinished:
                     sessionPosition += 1000
-                cur.execute("""
+                pis = pisByGuidCar.get((steamGuid, carname), [])
+                for pisid,numlaps in pis:
+                    updates.append(dict(pisid=pisid, sessionPosition=sessionPosition, raceFinished=raceFinished, finishTime=finishTime))
+                if (steamGuid, carname) in ac_positions:
+                    if len(pis) == 0:
+                        acwarning("Error while using results.json to correct player %s (no laps in this session). Continuing anyways.", playerName)
+                        continue
+                    pisid, numlaps = pis[0]
+                    acp = ac_positions[(steamGuid, carname)]
+                    deltaLaps = None
+                    deltaTime = None
+                    if finishTime != acp['totaltime']:
+                        deltaTime = acp['totaltime'] - finishTime
+                        acinfo("Correcting finish time of %s (%d)", playerName, deltaTime)
+                    if numlaps != acp['numlaps']:
+                        deltaLaps = acp['numlaps'] - numlaps
+                        acinfo("Correcting number of laps of %s (%d)", playerName, deltaLaps)
+                    corrections.append((playerName, pisid, deltaTime, deltaLaps))
+            if len(updates) > 0:
+                cur.executemany("""
                     UPDATE PlayerInSession SET
                         FinishPosition = :sessionPosition,
                         FinishPositionOrig = :sessionPosition,
                         RaceFinished = :raceFinished,
                         FinishTime = :finishTime
-                    WHERE PlayerInSessionId IN (SELECT PlayerInSessionId FROM PlayerInSessionView
-                                                WHERE SteamGuid=:steamGuid AND Car=:carname AND SessionId=:sessionId)
-                """, locals())
-                if (steamGuid, carname) in ac_positions:
-                    try:
-                        cur.execute("SELECT PlayerInSessionId FROM PlayerInSessionView WHERE SteamGuid=:steamGuid AND Car=:carname AND SessionId=:sessionId", locals())
-                        pisid = cur.fetchone()
-                        if not pisid is None:
-                            pisid = pisid[0]
-                        cur.execute("""
-                            SELECT COUNT(*)
-                            FROM Lap
-                            WHERE PlayerInSessionId=:pisid
-                        """, locals())
-                        numlaps = cur.fetchone()
-                        numlaps = numlaps[0] if not numlaps is None else ac_positions[(steamGuid, carname)]['numlaps']
-                        deltaLaps = None
-                        deltaTime = None
-                        if finishTime != ac_positions[(steamGuid, carname)]['totaltime']:
-                            deltaTime = ac_positions[(steamGuid, carname)]['totaltime'] - finishTime
-                            acinfo("Correcting finish time of %s (%d)", playerName, deltaTime)
-                        if numlaps != ac_positions[(steamGuid, carname)]['numlaps']:
-                            deltaLaps = ac_positions[(steamGuid, carname)]['numlaps'] - numlaps
-                            acinfo("Correcting number of laps of %s (%d)", playerName, deltaLaps)
-                        self.playerInSessionPaCModify(pis_id=pisid, delta_time=deltaTime, delta_points=None, delta_laps=deltaLaps, comment="Auto-corrected for AC Lap timing bug", cursor=cur)
-                    except:
-                        acwarning("Error while using results.json to correct player %s. Continuing anyways.", playerName)
-                        acwarning(traceback.format_exc())
-            endTime = unixtime_now()
+                    WHERE PlayerInSessionId = :pisid
+                """, updates)
+            for playerName, pisid, deltaTime, deltaLaps in corrections:
+                try:
+                    # the positions are recalculated once for all corrections below
+                    self.playerInSessionPaCModify(pis_id=pisid, delta_time=deltaTime, delta_points=None, delta_laps=deltaLaps, comment="Auto-corrected for AC Lap timing bug", cursor=cur, recalculate=False)
+                except:
+                    acwarning("Error while using results.json to correct player %s. Continuing anyways.", playerName)
+                    acwarning(traceback.format_exc())
+            if len(corrections) > 0:
+                self.recalculateSessionPositions(cur, sessionId)
+            if endTime is None:
+                endTime = unixtime_now()
             cur.execute("""
                 UPDATE Session SET
                     EndTimeDate = :endTime
                 WHERE SessionId = :sessionId
             """, locals())
+            self.bumpGeneration(cur, "Championships")
         self.currentSession = None
 
+    @pinsBlobSegments
     def registerLap(self, trackChecksum, carChecksum, acVersion,
                     steamGuid, playerName, playerIsAI,
                     lapHistory, tyre, lapCount, sessionTime, fuelRatio, valid, carname,
                     staticAssists, dynamicAssists, maxSpeed, timeInPitLane, timeInPit, escKeyPressed,
-                    teamName, gripLevel, collisionsCar, collisionsEnv, cuts, ballast):
+                    teamName, gripLevel, collisionsCar, collisionsEnv, cuts, ballast, timestamp = None, idempotencyKey = None):
+        # returns the id of the new lap. Laps with an idempotency key (replayed from the lap spool) are
+        # inserted only once, the id of the existing lap is returned for a known key.
         ptVersion = ptracker_lib.version
+        newIds = {}
+        newRows = {}
         with self.db:
             cur = self.db.cursor()
+            if not idempotencyKey is None:
+                ans = cur.execute("SELECT ObjectId FROM IdempotencyKeys WHERE IdempotencyKey=:idempotencyKey", locals()).fetchone()
+                if not ans is None:
+                    acinfo("Lap %s has already been registered, ignoring.", idempotencyKey)
+                    return ans[0]
             trackname = self.currentSession.trackname
             # assert we have the combo in the database
-            cur.execute("""
-                INSERT INTO Tracks(Track)
-                    SELECT :trackname
-                    WHERE NOT EXISTS (SELECT 1 FROM Tracks WHERE Track=:trackname)
-            """, locals())
+            trackId = self.dimensionId(cur, newIds, "Tracks", "TrackId", "Track", trackname)
             self.currentSession.carnames.add(carname)
             for cn in self.currentSession.carnames:
-                cur.execute("""
-                    INSERT INTO Cars(Car)
-                        SELECT :cn
-                        WHERE NOT EXISTS (SELECT 1 FROM Cars WHERE Car=:cn)
-                """, locals())
+                self.dimensionId(cur, newIds, "Cars", "CarId", "Car", cn)
+            carId = self.dimensionId(cur, newIds, "Cars", "CarId", "Car", carname)
             # assert we have the player in the database
             if steamGuid is None:
                 if playerIsAI:
@@ -426,43 +745,57 @@ class GenericBackend(DbSchemata):
                 else:
                     steamGuid = "unknown_guid_"
                 steamGuid += playerName
-            cur.execute("""
-                INSERT INTO Players(SteamGuid,Name,ArtInt)
-                    SELECT :steamGuid,:playerName,:playerIsAI
-                    WHERE NOT EXISTS (SELECT 1 FROM Players WHERE SteamGuid=:steamGuid)
-            """, locals())
-            cur.execute("""
-                UPDATE Players SET
-                    Name = :playerName,
-                    ArtInt = :playerIsAI
-                WHERE SteamGuid=:steamGuid AND Anonymized!=1
-            """, locals())
+            key = ("Players", steamGuid)
+            player = self.dimensionIds.get(key, newIds.get(key, None))
+            if player is None:
+                cur.execute("""
+                    INSERT INTO Players(SteamGuid,Name,ArtInt)
+                        SELECT :steamGuid,:playerName,:playerIsAI
+                        WHERE NOT EXISTS (SELECT 1 FROM Players WHERE SteamGuid=:steamGuid)
+                """, locals())
+                playerId = cur.execute("SELECT PlayerId FROM Players WHERE SteamGuid=:steamGuid", locals()).fetchone()[0]
+            else:
+                playerId = player[0]
+            if player is None or player[1:] != (playerName, playerIsAI):
+                oldName = cur.execute("SELECT Name FROM Players WHERE PlayerId=:playerId", locals()).fetchone()[0]
+                cur.execute("""
+                    UPDATE Players SET
+                        Name = :playerName,
+                        ArtInt = :playerIsAI
+                    WHERE SteamGuid=:steamGuid AND Anonymized!=1
+                """, locals())
+                self.indexPlayerName(cur, playerId)
+                if oldName != playerName and cur.execute("SELECT Name FROM Players WHERE PlayerId=:playerId", locals()).fetchone()[0] == playerName:
+                    # the cached championship standings contain the player names
+                    self.bumpGeneration(cur, "Championships")
+                newIds[key] = (playerId, playerName, playerIsAI)
             # team
             if teamName is None or teamName.strip() == "":
                 teamName = None
                 teamId = None
             else:
                 teamName = teamName.strip()
-                cur.execute("""
-                    INSERT INTO Teams(TeamName)
-                    SELECT :teamName
-                    WHERE NOT EXISTS (SELECT 1 FROM Teams WHERE TeamName=:teamName)
-                """, locals())
-                teamId = cur.execute("SELECT TeamId FROM Teams WHERE TeamName=:teamName", locals()).fetchone()[0]
+                teamId = self.dimensionId(cur, newIds, "Teams", "TeamId", "TeamName", teamName)
             # assert we have the tyre in the database
             if tyre is None:
                 tyre = "unknown"
-            cur.execute("""
-                INSERT INTO TyreCompounds(TyreCompound)
-                    SELECT :tyre
-                    WHERE NOT EXISTS (SELECT 1 FROM TyreCompounds WHERE TyreCompound=:tyre)
-            """, locals())
+            tyreCompoundId = self.dimensionId(cur, newIds, "TyreCompounds", "TyreCompoundId", "TyreCompound", tyre)
             # assert we have the combo in the database
             carnames = self.currentSession.carnames
             # assert we have the session in the database
             myassert(not self.currentSession is None)
-            if self.currentSession.dbSessionId is None:
-                self.currentSession.comboId = self.getOrCreateComboId(cur, trackname, carnames)
+            # the session ids are stored in the current session after the commit
+            sessionId = self.currentSession.dbSessionId
+            comboId = self.currentSession.comboId if not sessionId is None else None
+            sessionKey = self.currentSession.idempotencyKey
+            if sessionId is None and not sessionKey is None:
+                # the session might have been inserted before replaying the lap spool after a restart
+                ans = cur.execute("SELECT ObjectId FROM IdempotencyKeys WHERE IdempotencyKey=:sessionKey", locals()).fetchone()
+                if not ans is None:
+                    sessionId = ans[0]
+                    comboId = cur.execute("SELECT ComboId FROM Session WHERE SessionId=:sessionId", locals()).fetchone()[0]
+            if sessionId is None:
+                comboId = self.getOrCreateComboId(cur, trackname, carnames)
                 cur.execute("""
                     INSERT INTO Session(
                         TrackId,
@@ -496,13 +829,12 @@ class GenericBackend(DbSchemata):
                         :damage,
                         :comboId
                     FROM Tracks WHERE Track=:trackname
-                """, self.currentSession.__dict__)
-                self.currentSession.dbSessionId = cur.lastrowid
-                myassert( not self.currentSession.dbSessionId is None)
+                """, dict(self.currentSession.__dict__, comboId=comboId))
+                sessionId = cur.lastrowid
+                myassert( not sessionId is None)
+                if not sessionKey is None:
+                    self.insertIdempotencyKey(cur, sessionKey, sessionId)
             self.currentSession.guid_cars_mapping[steamGuid] = carname
-            sessionId = self.currentSession.dbSessionId
-            playerId = cur.execute("SELECT PlayerId FROM Players WHERE SteamGuid=:steamGuid", locals()).fetchone()[0]
-            carId = cur.execute("SELECT CarId FROM Cars WHERE Car=:carname", locals()).fetchone()[0]
             absUsed = staticAssists.get('ABS', None)
             autoBlibUsed = staticAssists.get('autoBlib', None)
             autoBrakeUsed = staticAssists.get('autoBrake', None)
@@ -521,33 +853,44 @@ class GenericBackend(DbSchemata):
             autoShifterUsed = dynamicAssists.get('autoShifter', None)
             idealLineUsed = dynamicAssists.get('idealLine', None)
             # assert we have the player associated with the session
-            cur.execute("""
-                INSERT INTO PlayerInSession(
-                    SessionId,
-                    PlayerId,
-                    ACVersion,
-                    PTVersion,
-                    TrackChecksum,
-                    CarChecksum,
-                    CarId,
-                    InputMethod,
-                    Shifter,
-                    TeamId
-                    )
-                SELECT :sessionId, :playerId, :acVersion, :ptVersion, :trackChecksum, :carChecksum, :carId,
-                       :inputMethod, :shifter, :teamId
-                WHERE NOT EXISTS (SELECT 1 FROM PlayerInSession WHERE
-                                    SessionId=:sessionId AND PlayerID=:playerId AND CarID=:carId)
-            """, locals())
-            if len(staticAssists) > 0:
+            key = ("PlayerInSession", sessionId, playerId, carId)
+            pis = self.rowIds.lookup(key)[1]
+            if pis is None:
+                cur.execute("""
+                    INSERT INTO PlayerInSession(
+                        SessionId,
+                        PlayerId,
+                        ACVersion,
+                        PTVersion,
+                        TrackChecksum,
+                        CarChecksum,
+                        CarId,
+                        InputMethod,
+                        Shifter,
+                        TeamId
+                        )
+                    SELECT :sessionId, :playerId, :acVersion, :ptVersion, :trackChecksum, :carChecksum, :carId,
+                           :inputMethod, :shifter, :teamId
+                    WHERE NOT EXISTS (SELECT 1 FROM PlayerInSession WHERE
+                                        SessionId=:sessionId AND PlayerID=:playerId AND CarID=:carId)
+                """, locals())
+                playerInSessionId = cur.execute("""
+                    SELECT PlayerInSessionId FROM PlayerInSession
+                    WHERE SessionId=:sessionId AND PlayerID=:playerId AND CarID=:carId
+                """, locals()).fetchone()[0]
+                pis = (playerInSessionId, None, None)
+            playerInSessionId = pis[0]
+            if len(staticAssists) > 0 and pis[1:] != (inputMethod, shifter):
                 # make sure we update the stracker db with the correct data, even if we have saved a lap
                 # without these assist data already
                 cur.execute("""
                     UPDATE PlayerInSession SET
                         InputMethod = :inputMethod,
                         Shifter = :shifter
-                    WHERE SessionId=:sessionId AND PlayerID=:playerId AND CarID=:carId
+                    WHERE PlayerInSessionId=:playerInSessionId
                 """, locals())
+                pis = (playerInSessionId, inputMethod, shifter)
+            newRows[key] = pis
             # finally we can store the lap :-)
             sectorTimes = [int(s+0.5) if not s is None else None for s in lapHistory.sectorTimes[:]]
             while len(sectorTimes) < 10:
@@ -563,7 +906,8 @@ class GenericBackend(DbSchemata):
                 historyInfoCmp = None
             lapTime = lapHistory.lapTime
             st0, st1, st2, st3, st4, st5, st6, st7, st8, st9 = tuple(sectorTimes[:10])
-            timestamp = unixtime_now()
+            if timestamp is None:
+                timestamp = unixtime_now()
             if gripLevel == 0.0: gripLevel = None
             if not maxSpeed is None:
                 maxSpeed *= 3.6 # convert m/s to km/h
@@ -604,9 +948,9 @@ class GenericBackend(DbSchemata):
                     Cuts,
                     Ballast
                     )
-                SELECT
-                    tmp.PlayerInSessionId,
-                    tmp.TyreCompoundId,
+                VALUES(
+                    :playerInSessionId,
+                    :tyreCompoundId,
                     :lapCount,
                     :sessionTime,
                     :lapTime,
@@ -638,42 +982,119 @@ class GenericBackend(DbSchemata):
                     :collisionsEnv,
                     :cuts,
                     :ballast
-                FROM
-                    ((SELECT PlayerInSessionId FROM PlayerInSessionView
-                        WHERE SteamGuid=:steamGuid AND Car=:carname AND SessionId=:sessionId) AS tmp0
-                     CROSS JOIN
-                     (SELECT TyreCompoundId FROM TyreCompounds WHERE TyreCompound=:tyre) AS tmp1) AS tmp
+                    )
             """, locals())
             lapId = cur.lastrowid
-            if not historyInfoCmp is None:
+            if not idempotencyKey is None:
+                self.insertIdempotencyKey(cur, idempotencyKey, lapId)
+            if not historyInfoCmp is None and self.blobStore is None:
                 cur.execute("INSERT INTO LapBinBlob(LapId, HistoryInfo) VALUES(:lapId, :historyInfoCmp)", locals())
+            elif not historyInfoCmp is None:
+                blobSegment, blobOffset, blobLength, blobHash = self.storeHistoryInfo(cur, historyInfoCmp)
+                cur.execute("""
+                    INSERT INTO LapBinBlob(LapId, BlobSegment, BlobOffset, BlobLength, BlobHash)
+                    VALUES(:lapId, :blobSegment, :blobOffset, :blobLength, :blobHash)
+                """, locals())
+            # keep the leaderboard in sync (on ties, the most recent lap wins)
+            if not lapTime is None:
+                cur.execute("""
+                    UPDATE Leaderboard SET
+                        LapId = CASE WHEN :lapTime <= LapTime THEN :lapId ELSE LapId END,
+                        LapTime = CASE WHEN :lapTime < LapTime THEN :lapTime ELSE LapTime END,
+                        NumLaps = NumLaps + 1
+                    WHERE TrackId=:trackId AND CarId=:carId AND PlayerId=:playerId AND Valid=:valid
+                """, locals())
+                key = ("Leaderboard", trackId, carId, playerId, valid)
+                if not self.rowIds.lookup(key)[0]:
+                    cur.execute("""
+                        INSERT INTO Leaderboard(TrackId, CarId, PlayerId, Valid, LapTime, LapId, NumLaps)
+                            SELECT :trackId, :carId, :playerId, :valid, :lapTime, :lapId, 1
+                            WHERE NOT EXISTS (SELECT 1 FROM Leaderboard WHERE
+                                                TrackId=:trackId AND CarId=:carId AND PlayerId=:playerId AND Valid=:valid)
+                    """, locals())
+                    newRows[key] = True
+            # keep the daily statistic rollups in sync
+            day = self.currentSession.startTime//(60*60*24)
+            server = self.currentSession.server if not self.currentSession.server is None else ''
+            startTime = self.currentSession.startTime
+            cur.execute("""
+                UPDATE StatsDaily SET
+                    NumLaps = NumLaps + 1,
+                    LastStart = CASE WHEN :startTime > LastStart THEN :startTime ELSE LastStart END
+                WHERE Day=:day AND ServerIpPort=:server AND ComboId=:comboId AND TrackId=:trackId AND CarId=:carId
+            """, locals())
+            key = ("StatsDaily", day, server, comboId, trackId, carId)
+            if not self.rowIds.lookup(key)[0]:
+                cur.execute("""
+                    INSERT INTO StatsDaily(Day, ServerIpPort, ComboId, TrackId, CarId, NumLaps, LastStart)
+                        SELECT :day, :server, :comboId, :trackId, :carId, 1, :startTime
+                        WHERE NOT EXISTS (SELECT 1 FROM StatsDaily WHERE
+                                            Day=:day AND ServerIpPort=:server AND ComboId=:comboId AND TrackId=:trackId AND CarId=:carId)
+                """, locals())
+                newRows[key] = True
+            key = ("StatsDailyPlayers", day, server, trackId, carId, playerId)
+            if not self.rowIds.lookup(key)[0]:
+                cur.execute("""
+                    INSERT INTO StatsDailyPlayers(Day, ServerIpPort, TrackId, CarId, PlayerId)
+                        SELECT :day, :server, :trackId, :carId, :playerId
+                        WHERE NOT EXISTS (SELECT 1 FROM StatsDailyPlayers WHERE
+                                            Day=:day AND ServerIpPort=:server AND TrackId=:trackId AND CarId=:carId AND PlayerId=:playerId)
+                """, locals())
+                newRows[key] = True
+            self.bumpGeneration(cur, "Pages")
+        self.dimensionIds.update(newIds)
+        for key in newRows:
+            self.rowIds.put(key, newRows[key])
+        self.currentSession.dbSessionId = sessionId
+        self.currentSession.comboId = comboId
+        self.invalidateBestTimes(trackname, carname)
+        return lapId
+
+    def insertIdempotencyKey(self, cur, idempotencyKey, objectId):
+        timestamp = unixtime_now()
+        cur.execute("""
+            INSERT INTO IdempotencyKeys(IdempotencyKey, ObjectId, Timestamp)
+            VALUES(:idempotencyKey, :objectId, :timestamp)
+        """, locals())
+
+    def applySpoolRecords(self, records):
+        # replay the (kind, keyword arguments) records of the lap spool in order, see stracker_lib/lap_spool.py.
+        # Returns the results of the applied records and the exception of the first failing record (or None).
+        res = []
+        for kind, kw in records:
+            myassert(kind in ["newSession", "registerLap", "finishSession"])
+            try:
+                res.append(getattr(self, kind)(**kw))
+            except Exception as e:
+                return res, e
+        return res, None
 
-    def lapStats(self, mode, limit, track, artint, cars, ego_guid, valid, minSessionStartTime, tyre_list = None, server=None, group_by_guid=False, groups=[], withHistoryInfo=False, lapIdOnly=False, cursor=None):
+    def lapStats(self, mode, limit, track, artint, cars, ego_guid, valid, minSessionStartTime, tyre_list = None, server=None, group_by_guid=False, groups=[], withHistoryInfo=False, lapIdOnly=False, cursor=None, after=None):
+        # limit is [first row (1-based), number of rows], a first row of None centers the rows around the
+        # ego player. For keyset pagination, pass the 'nextKey' of the previous page as after; the first row
+        # is only used for numbering the positions then.
         if cursor is None:
             with self.db:
                 c = self.db.cursor()
-                return self.lapStats( mode, limit, track, artint, cars, ego_guid, valid, minSessionStartTime, tyre_list, server, group_by_guid, groups, cursor=c)
+                return self.lapStats( mode, limit, track, artint, cars, ego_guid, valid, minSessionStartTime, tyre_list, server, group_by_guid, groups, cursor=c, after=after)
         else:
-            proft = time.time()
-            startt = proft
             if track is None:
                 acwarning("supplied track value is None. Ignoring query.")
                 return
             limitOffset = limit[0]
             limitNum = limit[1]
             if limitOffset is None:
-                pass
+                after = None
             elif limitOffset < 1:
                 limitOffset = 0
             else:
                 limitOffset -= 1 # position to index
             myassert(not "'" in track and all([not "'" in car for car in cars]))
             if mode in ['top', 'top-extended']:
-                cur = CursorDebug(cursor)
-                cur.execute("DROP TABLE IF EXISTS BestLapTimeHelper")
+                cur = cursor
                 carMapping = self.carMapping(cur)
-                carValues = valueListToDict(cars, 'selected_cars', locals())
-                lapValidVals = valueListToDict(valid, 'selected_valid', locals())
+                carValues = self.inList(cars, 'selected_cars', locals())
+                lapValidVals = self.inList(valid, 'selected_valid', locals())
                 try:
                     time_from = minSessionStartTime[0]
                     time_to = minSessionStartTime[1]
@@ -699,9 +1120,11 @@ class GenericBackend(DbSchemata):
                     tyre_compound_cond = ""
                 else:
                     myassert(not "'" in " ".join(tyre_list))
-                    tyre_compound_cond = "Lap.TyreCompoundId IN (SELECT TyreCompoundId FROM TyreCompounds WHERE "
-                    tyre_compound_cond += " OR ".join(["LOWER(TyreCompound) LIKE '%"+t+"%'" for t in tyre_list])
-                    tyre_compound_cond += ") AND"
+                    tyrePatterns = self.inList(["%" + t + "%" for t in tyre_list], 'selected_tyres', locals())
+                    tyre_compound_cond = """
+                        Lap.TyreCompoundId IN (SELECT TyreCompoundId FROM TyreCompounds WHERE EXISTS
+                            (SELECT 1 FROM (%(tyrePatterns)s) AS TyrePatterns WHERE LOWER(TyreCompound) LIKE TyrePatterns.value)) AND
+                    """ % locals()
                 if server is None:
                     server_cond = ""
                 else:
@@ -709,15 +1132,35 @@ class GenericBackend(DbSchemata):
                 if len(groups) == 0 or 0 in groups:
                     groups_cond = ""
                 else:
-                    groups_cond = "PlayerInSession.PlayerId IN (SELECT PlayerId FROM GroupEntries WHERE GroupId IN ("
-                    groups_cond += ",".join([str(int(g)) for g in groups])
-                    groups_cond += ")) AND"
+                    groupValues = self.inList([int(g) for g in groups], 'selected_groups', locals())
+                    groups_cond = "PlayerInSession.PlayerId IN (SELECT PlayerId FROM GroupEntries WHERE GroupId IN (%s)) AND" % groupValues
                 if withHistoryInfo:
-                    hi_cond = "LapBinBlob.HistoryInfo NOTNULL AND"
+                    hi_cond = HISTORY_INFO_NOTNULL + " AND"
                     hi_tab = "JOIN LapBinBlob ON (LapBinBlob.LapId = Lap.LapId)"
                 else:
                     hi_cond = ""
                     hi_tab = ""
+                if len(groups) == 0 or 0 in groups:
+                    lb_groups_cond = ""
+                else:
+                    groupValues = self.inList([int(g) for g in groups], 'selected_groups', locals())
+                    lb_groups_cond = "Leaderboard.PlayerId IN (SELECT PlayerId FROM GroupEntries WHERE GroupId IN (%s)) AND" % groupValues
+                # the leaderboard table holds the best laps per track/car/player/valid, so we can
+                # use it as long as no filter on lap level (time, tyres, server, history info) is requested
+                useLeaderboard = (time_to is None and not time_from and tyre_list is None and
+                                  server is None and not withHistoryInfo)
+                # the lap id makes the order unique, which is needed for the keyset pagination
+                if after is None:
+                    keyset_where = ""
+                    keyset_having = ""
+                else:
+                    afterLapTime = after[0]
+                    afterLapId = after[1]
+                    keyset_where = "AND BestLapTimeHelper.LapTime >= :afterLapTime"
+                    keyset_having = """
+                        HAVING BestLapTimeHelper.LapTime > :afterLapTime OR
+                               (BestLapTimeHelper.LapTime = :afterLapTime AND MAX(%s) > :afterLapId)
+                    """ % ("Leaderboard.LapId" if useLeaderboard else "Lap.LapId")
                 if group_by_guid in [True, 1]:
                     # group by player only
                     group_by_clause = "GROUP BY PlayerInSession.PlayerId"
@@ -725,11 +1168,17 @@ class GenericBackend(DbSchemata):
                     blth_carId = "PlayerInSession.PlayerId AS PlayerId"
                     matchLapTimesCond = "AND BestLapTimeHelper.PlayerId=LapTimes.PlayerId"
                     matchPISCond = "AND BestLapTimeHelper.PlayerId = PlayerInSession.PlayerId"
+                    lb_keys = "Leaderboard.PlayerId"
+                    lb_carId = "Leaderboard.PlayerId AS PlayerId"
+                    matchLbCond = "AND BestLapTimeHelper.PlayerId = Leaderboard.PlayerId"
                 elif group_by_guid == 2:
                     group_by_clause = "GROUP BY PlayerInSession.CarId"
                     blth_carId = "PlayerInSession.CarId AS CarId"
                     matchLapTimesCond = "AND BestLapTimeHelper.CarId=LapTimes.CarId"
                     matchPISCond = "AND BestLapTimeHelper.CarId=PlayerInSession.CarId"
+                    lb_keys = "Leaderboard.CarId"
+                    lb_carId = "Leaderboard.CarId AS CarId"
+                    matchLbCond = "AND BestLapTimeHelper.CarId = Leaderboard.CarId"
                 else:
                     # group by player/car
                     group_by_clause = "GROUP BY PlayerInSession.PlayerId,PlayerInSession.CarId"
@@ -737,76 +1186,142 @@ class GenericBackend(DbSchemata):
                     blth_carId = "PlayerInSession.PlayerId AS PlayerId , PlayerInSession.CarId AS CarId"
                     matchLapTimesCond = "AND BestLapTimeHelper.PlayerId=LapTimes.PlayerId AND BestLapTimeHelper.CarId=LapTimes.CarId"
                     matchPISCond = "AND BestLapTimeHelper.PlayerId = PlayerInSession.PlayerId AND BestLapTimeHelper.CarId=PlayerInSession.CarId"
-                stmt_select_loi = """
-                    SELECT PlayerInSession.PlayerInSessionId AS PlayerInSessionId FROM
-                        PlayerInSession JOIN Session ON (PlayerInSession.SessionId=Session.SessionId)
-                                        JOIN Players ON (Players.PlayerId=PlayerInSession.PlayerId)
-                    WHERE Players.ArtInt=:artint AND
-                          Session.TrackId IN (SELECT TrackId FROM Tracks WHERE Track=:track) AND
-                          %(session_time_cond)s
-                          %(server_cond)s
-                          %(groups_cond)s
-                          PlayerInSession.CarId IN (SELECT CarId FROM Cars WHERE Car IN (%(carValues)s))
-                """ % locals()
-                stmt = """
-                    CREATE TEMP TABLE BestLapTimeHelper AS
-                        SELECT MIN(LapTime) AS LapTime, COUNT(Lap.LapId) AS NumLaps, %(blth_carId)s
-                        FROM Lap JOIN PlayerInSession ON (Lap.PlayerInSessionId=PlayerInSession.PlayerInSessionId)
-                                 %(hi_tab)s
-                        WHERE
-                            Lap.Valid IN (%(lapValidVals)s)  AND
-                            %(lap_timestamp_cond)s
-                            %(tyre_compound_cond)s
-                            %(hi_cond)s
-                            Lap.PlayerInSessionId IN (%(stmt_select_loi)s)
-                        %(group_by_clause)s
-                """ % locals()
-                cur.execute(stmt, locals())
-                proft = prof("ls create bestlaptimehelper", proft)
-                totalNumLaps = cur.execute("SELECT COUNT(*) FROM BestLapTimeHelper").fetchone()[0]
+                    lb_keys = "Leaderboard.PlayerId, Leaderboard.CarId"
+                    lb_carId = "Leaderboard.PlayerId AS PlayerId, Leaderboard.CarId AS CarId"
+                    matchLbCond = "AND BestLapTimeHelper.PlayerId = Leaderboard.PlayerId AND BestLapTimeHelper.CarId = Leaderboard.CarId"
+                if useLeaderboard:
+                    stmt_lb_cond = """
+                        Leaderboard.TrackId IN (SELECT TrackId FROM Tracks WHERE Track=:track) AND
+                        Leaderboard.CarId IN (SELECT CarId FROM Cars WHERE Car IN (%(carValues)s)) AND
+                        Leaderboard.PlayerId IN (SELECT PlayerId FROM Players WHERE ArtInt=:artint) AND
+                        %(lb_groups_cond)s
+                        Leaderboard.Valid IN (%(lapValidVals)s)
+                    """ % locals()
+                    blth = """
+                        (SELECT MIN(LapTime) AS LapTime, SUM(NumLaps) AS NumLaps, %(lb_carId)s
+                         FROM Leaderboard
+                         WHERE %(stmt_lb_cond)s
+                         GROUP BY %(lb_keys)s)
+                    """ % locals()
+                    stmt_ego_best = """
+                        SELECT MIN(LapTime) FROM Leaderboard
+                        WHERE %(stmt_lb_cond)s AND
+                              Leaderboard.PlayerId IN (SELECT PlayerId FROM Players WHERE SteamGuid=:ego_guid)
+                    """ % locals()
+                    stmt_best_lap_ids = """
+                        SELECT MAX(Leaderboard.LapId) AS LapId, MAX(BestLapTimeHelper.NumLaps) AS NumLaps FROM
+                            %(blth)s AS BestLapTimeHelper
+                            JOIN Leaderboard ON (BestLapTimeHelper.LapTime = Leaderboard.LapTime %(matchLbCond)s)
+                        WHERE %(stmt_lb_cond)s %(keyset_where)s
+                        GROUP BY BestLapTimeHelper.LapTime, %(lb_keys)s
+                        %(keyset_having)s
+                        ORDER BY BestLapTimeHelper.LapTime, MAX(Leaderboard.LapId)
+                        LIMIT :limitNum
+                        OFFSET :limitOffset
+                    """ % locals()
+                    stmt_best_sectors_from = """
+                        Lap WHERE LapId IN (
+                            SELECT Leaderboard.LapId FROM
+                                %(blth)s AS BestLapTimeHelper
+                                JOIN Leaderboard ON (BestLapTimeHelper.LapTime = Leaderboard.LapTime %(matchLbCond)s)
+                            WHERE %(stmt_lb_cond)s)
+                    """ % locals()
+                else:
+                    stmt_select_loi = """
+                        SELECT PlayerInSession.PlayerInSessionId AS PlayerInSessionId FROM
+                            PlayerInSession JOIN Session ON (PlayerInSession.SessionId=Session.SessionId)
+                                            JOIN Players ON (Players.PlayerId=PlayerInSession.PlayerId)
+                        WHERE Players.ArtInt=:artint AND
+                              Session.TrackId IN (SELECT TrackId FROM Tracks WHERE Track=:track) AND
+                              %(session_time_cond)s
+                              %(server_cond)s
+                              %(groups_cond)s
+                              PlayerInSession.CarId IN (SELECT CarId FROM Cars WHERE Car IN (%(carValues)s))
+                    """ % locals()
+                    stmt = """
+                        CREATE TEMP TABLE BestLapTimeHelper AS
+                            SELECT MIN(LapTime) AS LapTime, COUNT(Lap.LapId) AS NumLaps, %(blth_carId)s
+                            FROM Lap JOIN PlayerInSession ON (Lap.PlayerInSessionId=PlayerInSession.PlayerInSessionId)
+                                     %(hi_tab)s
+                            WHERE
+                                Lap.Valid IN (%(lapValidVals)s)  AND
+                                %(lap_timestamp_cond)s
+                                %(tyre_compound_cond)s
+                                %(hi_cond)s
+                                Lap.PlayerInSessionId IN (%(stmt_select_loi)s)
+                            %(group_by_clause)s
+                    """ % locals()
+                    cur.execute("DROP TABLE IF EXISTS BestLapTimeHelper")
+                    cur.execute(stmt, locals())
+                    blth = "BestLapTimeHelper"
+                    stmt_ego_best = """
+                        SELECT MIN(LapTime) FROM BestLapTimeHelper
+                        WHERE PlayerId IN (SELECT PlayerId FROM Players WHERE SteamGuid=:ego_guid)
+                    """
+                    stmt_best_lap_ids = """
+                        SELECT MAX(Lap.LapId) AS LapId, MAX(NumLaps) AS NumLaps FROM
+                             BestLapTimeHelper
+                                 JOIN Lap ON (BestLapTimeHelper.LapTime = Lap.LapTime %(keyset_where)s)
+                                 JOIN PlayerInSession ON (Lap.PlayerInSessionId = PlayerInSession.PlayerInSessionId AND
+                                                          PlayerInSession.PlayerInSessionId IN (%(stmt_select_loi)s)
+                                                          %(matchPISCond)s)
+                             GROUP BY Lap.LapTime,PlayerInSession.PlayerId ,PlayerInSession.CarId
+                             %(keyset_having)s
+                             ORDER BY Lap.LapTime, MAX(Lap.LapId)
+                             LIMIT :limitNum
+                             OFFSET :limitOffset
+                    """ % locals()
+                    stmt_best_sectors_from = """
+                        BestLapTimeHelper JOIN LapTimes ON
+                            (BestLapTimeHelper.LapTime=LapTimes.LapTime
+                             %(matchLapTimesCond)s)
+                    """ % locals()
+                if useLeaderboard:
+                    totalNumLaps = self.cachedCount(cur, "SELECT COUNT(*) FROM %(blth)s AS BestLapTimeHelper" % locals(), locals())
+                else:
+                    # the temporary table is already computed, counting it is cheap
+                    totalNumLaps = cur.execute("SELECT COUNT(*) FROM BestLapTimeHelper").fetchone()[0]
                 if limitOffset is None:
                     a = cur.execute("""
-                        SELECT COUNT(*) FROM BestLapTimeHelper
-                        WHERE BestLapTimeHelper.LapTime < (SELECT MIN(LapTime) FROM BestLapTimeHelper
-                                                           WHERE PlayerId IN (SELECT PlayerId FROM Players WHERE SteamGuid=:ego_guid))
-                    """, locals()).fetchone()
+                        SELECT COUNT(*) FROM %(blth)s AS BestLapTimeHelper
+                        WHERE BestLapTimeHelper.LapTime < (%(stmt_ego_best)s)
+                    """ % locals(), locals()).fetchone()
                     limitOffset = max(0, a[0] - limitNum//2)
-                if limitOffset > 0:
-                    c = cur.execute("SELECT COUNT(*) FROM BestLapTimeHelper").fetchone()[0]
+                if limitOffset > 0 and after is None:
+                    c = totalNumLaps
                     if c < limitOffset + limitNum:
                         limitOffset = max(0, c-limitNum)
-                proft = prof("ls limits", proft)
+                posOffset = limitOffset
+                if not after is None:
+                    limitOffset = 0
 
                 bestServerLaps = {}
                 fastestLap = 0
                 if not lapIdOnly:
                     # get best server laps
                     cur.execute("""
-                        SELECT Car, MIN(LapTime) AS LapTime
-                        FROM Lap NATURAL JOIN PlayerInSession NATURAL JOIN Session NATURAL JOIN Tracks NATURAL JOIN Cars NATURAL JOIN Players
-                        WHERE Track=:track AND Car IN (%(carValues)s) AND ArtInt=:artint AND Valid IN (%(lapValidVals)s)
-                        GROUP BY Car
+                        SELECT Cars.Car AS Car, MIN(Leaderboard.LapTime) AS LapTime
+                        FROM Leaderboard JOIN Tracks ON (Leaderboard.TrackId=Tracks.TrackId)
+                                         JOIN Cars ON (Leaderboard.CarId=Cars.CarId)
+                                         JOIN Players ON (Leaderboard.PlayerId=Players.PlayerId)
+                        WHERE Track=:track AND Car IN (%(carValues)s) AND ArtInt=:artint AND Leaderboard.Valid IN (%(lapValidVals)s)
+                        GROUP BY Cars.Car
                     """ % locals(), locals())
 
                     for a in cur.fetchall():
                         bestServerLaps[a[0]] = a[1]
                     if len(bestServerLaps) > 0:
                         fastestLap = min(bestServerLaps.values())
-                    proft = prof("ls get best server laps", proft)
 
+                if mode == 'top-extended':
+                    ext_cols = "Cuts, CollisionsCar, CollisionsEnv, GripLevel, Ballast,"
+                    ext_tab = """JOIN (SELECT LapId AS ExtLapId, Cuts, CollisionsCar, CollisionsEnv, GripLevel, Ballast FROM Lap) AS LapExt
+                                      ON (BestLapIds.LapId = LapExt.ExtLapId)"""
+                else:
+                    ext_cols = ""
+                    ext_tab = ""
                 cur.execute("""
-                    WITH BestLapIds AS (
-                              SELECT MAX(Lap.LapId) AS LapId, MAX(NumLaps) AS NumLaps FROM
-                                   BestLapTimeHelper
-									       JOIN Lap ON (BestLapTimeHelper.LapTime = Lap.LapTime)
-									       JOIN PlayerInSession ON (Lap.PlayerInSessionId = PlayerInSession.PlayerInSessionId AND
-                                                                    PlayerInSession.PlayerInSessionId IN (%(stmt_select_loi)s)
-                                                                    %(matchPISCond)s)
-                                   GROUP BY Lap.LapTime,PlayerInSession.PlayerId ,PlayerInSession.CarId
-                                   ORDER BY Lap.LapTime
-                                   LIMIT :limitNum
-                                   OFFSET :limitOffset
-                                  )
+                    WITH BestLapIds AS (%(stmt_best_lap_ids)s)
                     SELECT LapTimes.LapTime AS LapTime, Valid, Name, LapTimes.Car AS Car, LapTimes.Timestamp AS Timestamp,
                            TyreCompound, LapTimes.SteamGuid AS SteamGuid, LapTimes.LapId AS LapId,
                            PenaltiesEnabled, TyreWearFactor, FuelRate, Damage, AidABS,
@@ -814,13 +1329,13 @@ class GenericBackend(DbSchemata):
                            AidIdealLine, AidStabilityControl, AidTractionControl,
                            AidSlipStream, AidTyreBlankets, InputMethod, InputShifter, LapMaxABS,
                            LapMaxTC, TemperatureAmbient, TemperatureTrack, MaxSpeed_KMH,
-                           TimeInPitLane, TimeInPit, NumLaps,
+                           TimeInPitLane, TimeInPit, NumLaps, %(ext_cols)s
                            SectorTime0, SectorTime1, SectorTime2, SectorTime3, SectorTime4, SectorTime5,
                            SectorTime6, SectorTime7, SectorTime8, SectorTime9
                     FROM BestLapIds JOIN LapTimes ON (BestLapIds.LapId = LapTimes.LapId)
-                    ORDER BY LapTime
+                                    %(ext_tab)s
+                    ORDER BY LapTime, LapId
                 """ % locals(),locals())
-                proft = prof("ls lap stat table", proft)
 
                 desc = cur.description
                 ans = cur.fetchall()
@@ -828,7 +1343,7 @@ class GenericBackend(DbSchemata):
                 for i,cols in enumerate(ans):
                     a = DictCursor(cols, desc)
                     r = {}
-                    r['pos'] = limitOffset + i + 1
+                    r['pos'] = posOffset + i + 1
                     r['lapTime'] = a["LapTime"]
                     r['valid'] = a["Valid"]
                     r['name'] = ['?',a["Name"]][not a["Name"] is None]
@@ -865,19 +1380,14 @@ class GenericBackend(DbSchemata):
                     r['timeInPitLane'] = a['TimeInPitLane']
                     r['timeInPit'] = a['TimeInPit']
                     r['numLaps'] = a['NumLaps']
+                    if mode == 'top-extended':
+                        r['cuts'] = a['Cuts']
+                        r['collcar'] = a['CollisionsCar']
+                        r['collenv'] = a['CollisionsEnv']
+                        r['grip'] = a['GripLevel']
+                        r['ballast'] = a['Ballast']
+                        r['tyres'] = a['TyreCompound']
                     laps.append(r)
-                if mode == 'top-extended':
-                    for r in laps:
-                        lapId = r['id']
-                        a = cur.execute("SELECT Cuts, CollisionsCar, CollisionsEnv, GripLevel, Ballast, TyreCompound FROM Lap NATURAL JOIN TyreCompounds WHERE LapId=:lapId", locals()).fetchone()
-                        if a is None: a = [None]*6
-                        r['cuts'] = a[0]
-                        r['collcar'] = a[1]
-                        r['collenv'] = a[2]
-                        r['grip'] = a[3]
-                        r['ballast'] = a[4]
-                        r['tyres'] = a[5]
-                    proft = prof("ls extended", proft)
                 bestSectors = []
                 if not lapIdOnly:
                     cur.execute("""
@@ -891,9 +1401,7 @@ class GenericBackend(DbSchemata):
                              , MIN(SectorTime7)
                              , MIN(SectorTime8)
                              , MIN(SectorTime9)
-                        FROM BestLapTimeHelper JOIN LapTimes ON
-                            (BestLapTimeHelper.LapTime=LapTimes.LapTime
-                             %(matchLapTimesCond)s)
+                        FROM %(stmt_best_sectors_from)s
                         LIMIT 1
                     """ % locals(), locals())
                     bestSectors = list(cur.fetchone())
@@ -902,9 +1410,10 @@ class GenericBackend(DbSchemata):
                             bestSectors[si] = None
                         elif not bestSectors[si] is None:
                             bestSectors[si] = int(bestSectors[si]+0.5)
-                    proft = prof("ls best sectors", proft)
-                prof("ls total", startt)
-                return {'laps':laps, 'bestSectors':bestSectors, 'totalNumLaps':totalNumLaps}
+                nextKey = None
+                if len(laps) == limitNum:
+                    nextKey = (laps[-1]['lapTime'], laps[-1]['id'])
+                return {'laps':laps, 'bestSectors':bestSectors, 'totalNumLaps':totalNumLaps, 'nextKey':nextKey}
 
     def getNameByGuid(self, guid):
         with self.db:
@@ -915,7 +1424,9 @@ class GenericBackend(DbSchemata):
                 return a[0]
             return None
 
-    def sessionStats(self, limit, tracks, sessionTypes, ego_guid, minSessionStartTime, minNumPlayers, multiplayer, minNumLaps = None):
+    def sessionStats(self, limit, tracks, sessionTypes, ego_guid, minSessionStartTime, minNumPlayers, multiplayer, minNumLaps = None, after = None):
+        # limit is [first row (1-based), number of rows]. For keyset pagination, pass the 'nextKey' of the
+        # previous page as after; the first row is only used for numbering the sessions then.
         with self.db:
             c = self.db.cursor()
 
@@ -923,7 +1434,7 @@ class GenericBackend(DbSchemata):
             if sessionTypes is None:
                 sessionTypeCond = ""
             else:
-                sessionTypeValues = valueListToDict(sessionTypes, 'session_type_selected', locals())
+                sessionTypeValues = self.inList(sessionTypes, 'session_type_selected', locals())
                 sessionTypeCond = "AND SessionType IN (%s)" % sessionTypeValues
 
             if type(tracks) == type(""): tracks = [tracks]
@@ -931,14 +1442,14 @@ class GenericBackend(DbSchemata):
                 trackSelection = "SELECT TrackId FROM Tracks"
                 trackWhereStmt = ""
             else:
-                trackValues = valueListToDict(tracks, 'tracks_selected', locals())
+                trackValues = self.inList(tracks, 'tracks_selected', locals())
                 trackSelection = "SELECT TrackId FROM Tracks WHERE Track IN (%s)" % trackValues
                 trackWhereStmt = "WHERE SelectedSessions.TrackId IN (SELECT * FROM SelectedTrackIds)"
 
             if multiplayer is None or (0 in multiplayer and 1 in multiplayer):
                 mpCondition = ""
             else:
-                mpValues = valueListToDict(multiplayer, 'mp_selected', locals())
+                mpValues = self.inList(multiplayer, 'mp_selected', locals())
                 mpCondition = "AND Multiplayer IN (%s)" % mpValues
 
             if minNumLaps is None:
@@ -956,12 +1467,15 @@ class GenericBackend(DbSchemata):
                 tCond = "StartTimeDate > :t1"
             else:
                 tCond = "StartTimeDate BETWEEN :t1 AND :t2"
+            # the session id makes the order unique, which is needed for the keyset pagination
+            keysetCond = ""
 
             # the following is a session statistics select statement
             stmt = """
                 WITH SelectedSessions AS (
                         SELECT * FROM Session
                         WHERE %(tCond)s
+                              %(keysetCond)s
                               %(sessionTypeCond)s
                               %(mpCondition)s
                               %(nlCondition)s
@@ -1004,19 +1518,26 @@ class GenericBackend(DbSchemata):
                          FROM PlayersWithPositions GROUP BY SessionId) AS NumPlayers ON (SelectedSessions.SessionId = NumPlayers.SessionId)
                     ) AS Result
                 WHERE Result.NumPlayers >= :minNumPlayers
-                ORDER BY Result.StartTimeDate DESC
-                """ % locals()
+                ORDER BY Result.StartTimeDate DESC, Result.SessionId DESC
+                """
             limitOffset = limit[0]
             if limitOffset is None: limitOffset = 0
             limitNum = limit[1]
             limitOffset -= 1
 
-            count = c.execute("SELECT COUNT(*) FROM (%s) AS TMP" % stmt, locals()).fetchone()[0]
-            if limitOffset > 0:
+            count = self.cachedCount(c, "SELECT COUNT(*) FROM (%s) AS TMP" % (stmt % locals()), locals())
+            if limitOffset > 0 and after is None:
                 if count < limitOffset + limitNum:
                     limitOffset = count-limitNum
             limitOffset = max(0, limitOffset)
+            posOffset = limitOffset
+            if not after is None:
+                afterStartTime = after[0]
+                afterSessionId = after[1]
+                keysetCond = "AND (StartTimeDate < :afterStartTime OR (StartTimeDate = :afterStartTime AND SessionId < :afterSessionId))"
+                limitOffset = 0
 
+            stmt = stmt % locals()
             stmt += "LIMIT :limitNum OFFSET :limitOffset"
 
             ans = c.execute(stmt, locals()).fetchall()
@@ -1035,13 +1556,16 @@ class GenericBackend(DbSchemata):
                 r['multiplayer'] = a[8]
                 r['track'] = a[9]
                 r['uitrack'] = trackMapping.get(r['track'], r['track'])
-                r['counter'] = limitOffset + i + 1
+                r['counter'] = posOffset + i + 1
                 sessions.append(r)
-            return {'sessions' : sessions, 'numberOfSessions' : count}
+            nextKey = None
+            if len(sessions) == limitNum:
+                nextKey = (sessions[-1]['timeStamp'], sessions[-1]['id'])
+            return {'sessions' : sessions, 'numberOfSessions' : count, 'nextKey' : nextKey}
 
     def alltracks(self):
         with self.db:
-            c = CursorDebug(self.db.cursor())
+            c = self.db.cursor()
             ans = c.execute("SELECT Track FROM Tracks NATURAL JOIN Combos GROUP BY Track").fetchall()
             trackMapping = self.trackMapping(c)
             res = []
@@ -1051,7 +1575,7 @@ class GenericBackend(DbSchemata):
 
     def allcars(self):
         with self.db:
-            c = CursorDebug(self.db.cursor())
+            c = self.db.cursor()
             ans = c.execute("SELECT Car FROM Cars NATURAL JOIN ComboCars GROUP BY Car").fetchall()
             carMapping = self.carMapping(c)
             res = []
@@ -1061,7 +1585,7 @@ class GenericBackend(DbSchemata):
 
     def allservers(self):
         with self.db:
-            c = CursorDebug(self.db.cursor())
+            c = self.db.cursor()
             ans = c.execute("SELECT DISTINCT ServerIpPort FROM Session").fetchall()
             res = []
             for a in ans:
@@ -1070,7 +1594,7 @@ class GenericBackend(DbSchemata):
 
     def currentCombo(self, server=None):
         with self.db:
-            c = CursorDebug(self.db.cursor())
+            c = self.db.cursor()
             scond = " WHERE ServerIpPort = :server" if not server is None else ""
             acdebug("currentCombo.")
             ans = c.execute("SELECT Track,CarIds FROM Session NATURAL JOIN ComboView NATURAL JOIN Tracks WHERE SessionId IN (SELECT MAX(SessionId) FROM Session %(scond)s)"%locals(), locals()).fetchone()
@@ -1089,50 +1613,75 @@ class GenericBackend(DbSchemata):
         if lapid is None:
             return {}
         with self.db:
-            proft = time.time()
-            startt = proft
             c = self.db.cursor()
-            trackMapping = self.trackMapping(c)
-            carMapping = self.carMapping(c)
+            # lap, session and combo details in one go; the columns not being part of LapTimes are
+            # prefixed with ld_ and removed from the result
+            if withHistoryInfo:
+                hi_col = """, LapBinBlob.HistoryInfo AS ld_BinHistoryInfo, LapBinBlob.BlobSegment AS ld_BlobSegment,
+                            LapBinBlob.BlobOffset AS ld_BlobOffset, LapBinBlob.BlobLength AS ld_BlobLength,
+                            LapBinBlob.BlobHash AS ld_BlobHash"""
+                hi_tab = "LEFT JOIN LapBinBlob ON (LapBinBlob.LapId = LapTimes.LapId)"
+            else:
+                hi_col = ""
+                hi_tab = ""
             ans = c.execute("""
-                SELECT * FROM LapTimes WHERE LapId=:lapid
-            """, locals()).fetchone()
+                SELECT LapTimes.*,
+                       Lap.Cuts AS Cuts, Lap.CollisionsCar AS CollisionsCar, Lap.CollisionsEnv AS CollisionsEnv,
+                       Lap.GripLevel AS GripLevel, Lap.Ballast AS Ballast, Lap.FuelRatio AS ld_FuelRatio,
+                       Session.SessionId AS ld_SessionId, Session.TrackId AS ld_TrackId,
+                       PlayerInSession.ACVersion AS ld_ACVersion, PlayerInSession.PTVersion AS ld_PTVersion,
+                       PlayerInSession.TrackChecksum AS ld_TrackChecksum, PlayerInSession.CarChecksum AS ld_CarChecksum,
+                       Session.ServerIpPort AS ld_ServerIpPort, Session.EndTimeDate AS ld_EndTimeDate,
+                       Tracks.UiTrackName AS ld_UiTrackName, Tracks.RequiredTrackChecksum AS ld_RequiredTrackChecksum,
+                       Cars.UiCarName AS ld_UiCarName, Cars.RequiredCarChecksum AS ld_RequiredCarChecksum
+                       %(hi_col)s
+                FROM LapTimes JOIN Lap ON (Lap.LapId = LapTimes.LapId)
+                              JOIN PlayerInSession ON (PlayerInSession.PlayerInSessionId = LapTimes.PlayerInSessionId)
+                              JOIN Session ON (Session.SessionId = PlayerInSession.SessionId)
+                              JOIN Tracks ON (Tracks.TrackId = Session.TrackId)
+                              JOIN Cars ON (Cars.CarId = LapTimes.CarId)
+                              %(hi_tab)s
+                WHERE LapTimes.LapId=:lapid
+            """ % locals(), locals()).fetchone()
             if ans is None:
                 return {}
             res = {}
+            ld = {}
             for i,v in enumerate(ans):
-                if c.description[i][0].lower() == 'historyinfo' and not v is None:
+                k = c.description[i][0].lower()
+                if k in ['historyinfo', 'ld_binhistoryinfo'] and not v is None:
                     # convert the 'memoryinfo' instance to a bytes array
                     v = bytes(v)
-                res[c.description[i][0].lower()] = v
+                if k.startswith('ld_'):
+                    ld[k[3:]] = v
+                else:
+                    res[k] = v
             for s in range(10):
                 if res['sectortime%d'%s] == self.invalidSplit:
                     res['sectortime%d'%s] = None
                 else:
                     res['sectortime%d'%s] = int(res['sectortime%d'%s]+0.5)
-            proft = prof("ld normal info", proft)
             if withHistoryInfo:
-                ans = c.execute("SELECT HistoryInfo FROM LapBinBlob WHERE LapId=:lapid", locals()).fetchone()
-                if not ans is None and not ans[0] is None: res['historyinfo'] = bytes(ans[0])
-            proft = prof("ld binary blob", proft)
-            ans = c.execute("SELECT Cuts, CollisionsCar, CollisionsEnv, GripLevel, Ballast FROM Lap WHERE LapId=:lapid", locals()).fetchone()
-            proft = prof("ld collision info", proft)
-            res['cuts'] = ans[0]
-            res['collisionscar'] = ans[1]
-            res['collisionsenv'] = ans[2]
-            res['griplevel'] = ans[3]
-            res['ballast'] = ans[4]
-            # get the lap counts
+                hi = self.loadHistoryInfo(ld['binhistoryinfo'], ld['blobsegment'], ld['bloboffset'], ld['bloblength'], ld['blobhash'])
+                if not hi is None:
+                    res['historyinfo'] = hi
+            # get the lap counts and the personal best from the leaderboard
             playerid = res['playerid']
-            track = res['track']
+            trackid = ld['trackid']
             carid = res['carid']
             numLapKeys = {0:"numlaps_invalid", 1:"numlaps_valid", 2:"numlaps_unknown"}
-            for valid in [0,1,2]:
-                ans = c.execute("""
-                    SELECT COUNT(*) FROM Lap NATURAL JOIN PlayerInSession NATURAL JOIN Session NATURAL JOIN Tracks WHERE Track=:track AND CarId=:carid AND valid=:valid AND PlayerId=:playerid
-                """, locals()).fetchone()
-                res[numLapKeys[valid]] = ans[0]
-            proft = prof("ld valid count", proft)
+            for k in numLapKeys.values():
+                res[k] = 0
+            pb = None
+            for valid, numLaps, lapTime in c.execute("""
+                    SELECT Valid, NumLaps, LapTime FROM Leaderboard
+                    WHERE TrackId=:trackid AND CarId=:carid AND PlayerId=:playerid
+                """, locals()).fetchall():
+                if valid in numLapKeys:
+                    res[numLapKeys[valid]] = numLaps
+                if valid >= 1 and (pb is None or lapTime < pb):
+                    pb = lapTime
+            res['pb'] = pb
             # get the theoretical best
             bestSectors = self.getBestSectorTimes(res['track'], res['car'], res['steamguid'], cursor=c)
             tb = 0
@@ -1146,113 +1695,103 @@ class GenericBackend(DbSchemata):
                 tb = None
             res['bestSectors'] = bs
             res['tb'] = tb
-            proft = prof("ld best sectors", proft)
-            # best lap time
-            sbAndPb = self.getSBandPB(res['track'], res['car'], res['steamguid'], cursor=c)
-            res['pb'] = sbAndPb['pb']
-            proft = prof("ld sb and pb", proft)
             # get the versions used
-            pisid = res['playerinsessionid']
-            ans = c.execute("""
-                SELECT ACVersion, PTVersion, TrackChecksum, CarChecksum, ServerIpPort, EndTimeDate
-                FROM PlayerInSession NATURAL JOIN Session
-                WHERE PlayerInSessionId = :pisid
-            """, locals()).fetchone()
-            if not ans[0] is None:
-                M = re.match(r'(.*)\s*PT@AC\s*(.*)', ans[0])
+            if not ld['acversion'] is None:
+                M = re.match(r'(.*)\s*PT@AC\s*(.*)', ld['acversion'])
                 if not M is None:
                     res['acVersion'] = M.group(2)
                     res['ptVersion'] = M.group(1)
                 else:
-                    res['acVersion'] = ans[0]
+                    res['acVersion'] = ld['acversion']
                     res['ptVersion'] = "unknown"
             else:
                 res["acVersion"] = "unknown"
                 res["ptVersion"] = "unknown"
-            res['stVersion'] = ans[1]
-            res['trackChecksum'] = ans[2]
-            res['carChecksum'] = ans[3]
-            res['server'] = ans[4]
-            et = ans[5]
-            ans = c.execute("SELECT FuelRatio FROM Lap WHERE LapId=:lapid", locals()).fetchone()
-            if ans is None or et == 0:
+            res['stVersion'] = ld['ptversion']
+            res['trackChecksum'] = ld['trackchecksum']
+            res['carChecksum'] = ld['carchecksum']
+            res['server'] = ld['serveripport']
+            if ld['endtimedate'] == 0:
                 res['fuelratio'] = -1.
             else:
-                res['fuelratio'] = ans[0]
+                res['fuelratio'] = ld['fuelratio']
             track = res['track']
             car = res['car']
-            ans = c.execute("SELECT RequiredTrackChecksum FROM Tracks WHERE Track=:track", locals()).fetchone()
-            if ans[0] is None:
+            if ld['requiredtrackchecksum'] is None:
                 res['trackChecksumCheck'] = None
             else:
-                res['trackChecksumCheck'] = res['trackChecksum'] == ans[0]
-            ans = c.execute("SELECT RequiredCarChecksum FROM Cars WHERE Car=:car", locals()).fetchone()
-            if ans[0] is None:
+                res['trackChecksumCheck'] = res['trackChecksum'] == ld['requiredtrackchecksum']
+            if ld['requiredcarchecksum'] is None:
                 res['carChecksumCheck'] = None
             else:
-                res['carChecksumCheck'] = res['carChecksum'] == ans[0]
-            res['uitrack'] = trackMapping.get(res['track'], res['track'])
-            res['uicar'] = carMapping.get(res['car'], res['car'])
-            proft = prof("ld versions and checksums", proft)
-            lapId = res['lapid']
+                res['carChecksumCheck'] = res['carChecksum'] == ld['requiredcarchecksum']
+            res['uitrack'] = res['track'] if ld['uitrackname'] is None else ld['uitrackname']
+            res['uicar'] = res['car'] if ld['uicarname'] is None else ld['uicarname']
+            pisid = res['playerinsessionid']
+            sessionid = ld['sessionid']
             c.execute("""
                 WITH ValidPlayerInSessionLaps AS (
 	               SELECT LapId, LapTime
-	               FROM Lap NATURAL JOIN PlayerInSession NATURAL JOIN Session
-	               WHERE PlayerInSessionId = (SELECT PlayerInSessionId FROM Lap NATURAL JOIN PlayerInSession WHERE LapId=:lapId) AND VALID = 1
+	               FROM Lap
+	               WHERE PlayerInSessionId = :pisid AND VALID = 1
                 ) SELECT LapId FROM ValidPlayerInSessionLaps WHERE LapTime = (SELECT MIN(LapTime) FROM ValidPlayerInSessionLaps)
-            """ % locals(), locals())
+            """, locals())
             a = c.fetchone()
             res['driversBestValidSessionLapId'] = None if a is None else a[0]
-            proft = prof("ld best players session lapId", proft)
             c.execute("""
                 WITH ValidSessionLaps AS (
                 	SELECT LapId, LapTime
-                	FROM Lap NATURAL JOIN PlayerInSession NATURAL JOIN Session
-                	WHERE SessionId = (SELECT SessionId FROM Lap NATURAL JOIN PlayerInSession NATURAL JOIN Session WHERE LapId=:lapId) AND VALID = 1
+                	FROM Lap
+                	WHERE PlayerInSessionId IN (SELECT PlayerInSessionId FROM PlayerInSession WHERE SessionId = :sessionid) AND VALID = 1
                 ) SELECT LapId FROM ValidSessionLaps WHERE LapTime = (SELECT MIN(LapTime) FROM ValidSessionLaps)
             """, locals())
             a = c.fetchone()
             res['bestValidSessionLapId'] = None if a is None else a[0]
-            proft = prof("ld best session lapId", proft)
-            # fetch session cars
+            # best laps with history info of the driver and of the server for the session's combo
+            hiNotNull = HISTORY_INFO_NOTNULL
             c.execute("""
-                SELECT Car FROM
-                    Lap LEFT JOIN PlayerInSession ON Lap.PlayerInSessionId = PlayerInSession.PlayerInSessionId LEFT JOIN
-                    Session ON PlayerInSession.SessionId = Session.SessionId LEFT JOIN
-                    ComboCars ON (Session.ComboId = ComboCars.ComboId) LEFT JOIN
-                    Cars ON (ComboCars.CarId = Cars.CarId)
-                WHERE Lap.LapId = :lapid
-            """, locals())
-            comboCars = [x[0] for x in c.fetchall()]
-            proft = prof("ld session cars", proft)
-            bestEgoServerLap = self.lapStats('top', [None,1], track, 0, comboCars, res['steamguid'], [1,2], 0, withHistoryInfo=True, lapIdOnly=True, cursor=c)
-            res['driversBestValidServerLapId'] = None if len(bestEgoServerLap['laps']) == 0 else bestEgoServerLap['laps'][0]['id']
-            proft = prof("ld driver's best info", proft)
-            bestServerLap = self.lapStats('top', [0,1], track, 0, comboCars, res['steamguid'], [1,2], 0, withHistoryInfo=True, lapIdOnly=True, cursor=c)
-            res['bestValidServerLapId'] = None if len(bestServerLap['laps']) == 0 else bestServerLap['laps'][0]['id']
-            proft = prof("ld server's best info", proft)
-            prof("ld total",startt)
+                WITH ComboLaps AS (
+                    SELECT Lap.LapId AS LapId, Lap.LapTime AS LapTime, PlayerInSession.PlayerId AS PlayerId
+                    FROM Lap JOIN PlayerInSession ON (Lap.PlayerInSessionId = PlayerInSession.PlayerInSessionId)
+                             JOIN LapBinBlob ON (LapBinBlob.LapId = Lap.LapId)
+                    WHERE Lap.Valid IN (1,2) AND
+                          Lap.PlayerInSessionId IN (
+                            SELECT PlayerInSession.PlayerInSessionId
+                            FROM PlayerInSession JOIN Session ON (PlayerInSession.SessionId = Session.SessionId)
+                                                 JOIN Players ON (PlayerInSession.PlayerId = Players.PlayerId)
+                            WHERE Session.TrackId = :trackid AND
+                                  PlayerInSession.CarId IN (SELECT ComboCars.CarId FROM Session JOIN ComboCars ON (Session.ComboId = ComboCars.ComboId)
+                                                            WHERE Session.SessionId = :sessionid) AND
+                                  Players.ArtInt = 0) AND
+                          %(hiNotNull)s
+                )
+                SELECT (SELECT LapId FROM ComboLaps WHERE PlayerId = :playerid ORDER BY LapTime, LapId DESC LIMIT 1),
+                       (SELECT LapId FROM ComboLaps ORDER BY LapTime, LapId DESC LIMIT 1)
+            """ % locals(), locals())
+            a = c.fetchone()
+            res['bestValidServerLapId'] = a[1]
+            # if the driver has no lap with history info, the server's best lap is used
+            res['driversBestValidServerLapId'] = a[1] if a[0] is None else a[0]
             return res
 
     def comparisonInfo(self, lapIds):
         with self.db:
-            t = time.time()
             c = self.db.cursor()
             trackMapping = self.trackMapping(c)
             carMapping = self.carMapping(c)
-            lapIds = ",".join(map(lambda x: str(x), lapIds))
+            args = {}
+            lapIds = self.inList([int(x) for x in lapIds], 'lapIds', args)
             c.execute("""
-                SELECT Track, Car, LapTime, LapBinBlob.HistoryInfo, Lap.LapId, Length, Name
+                SELECT Track, Car, LapTime, Lap.LapId, Length, Name, %s
                 FROM Lap NATURAL JOIN PlayerInSession NATURAL JOIN Session NATURAL JOIN Tracks NATURAL JOIN Cars NATURAL JOIN Players JOIN LapBinBlob ON (Lap.LapId = LapBinBlob.LapId)
                 WHERE Lap.LapId IN (%s)
-            """ % lapIds)
+            """ % (HISTORY_INFO_COLUMNS, lapIds), args)
             res = {}
             for a in c.fetchall():
-                if a[3] is None:
+                hi = self.loadHistoryInfo(*a[6:])
+                if hi is None:
                     continue
-                res[a[4]] = dict(track=a[0], uitrack=trackMapping.get(a[0],a[0]), uicar=carMapping.get(a[1],a[1]), laptime=a[2], length=a[5], historyinfo=a[3], player=a[6])
-            prof("ci total", t)
+                res[a[3]] = dict(track=a[0], uitrack=trackMapping.get(a[0],a[0]), uicar=carMapping.get(a[1],a[1]), laptime=a[2], length=a[4], historyinfo=hi, player=a[5])
             return res
 
     def sessionDetails(self, sessionid):
@@ -1340,6 +1879,8 @@ class GenericBackend(DbSchemata):
             return dict(sessionInfo=sessionInfo, classification=classification)
 
     def recalculateSessionPositions(self, c, sid):
+        # the laps of the session are read with one query and replayed in memory, the changed positions are
+        # written back with one executemany
         ans = c.execute("SELECT NumberOfLaps,SessionType FROM Session WHERE SessionId=:sid", locals()).fetchone()
         numLaps = ans[0] if not ans is None else None
         sType = ans[1] if not ans is None else None
@@ -1347,91 +1888,81 @@ class GenericBackend(DbSchemata):
             # not supported. Only races with fixed number of laps can be handled atm.
             return
         ans = c.execute("""
-            SELECT PlayerInSessionId,FinishPositionOrig,DeltaTime,DeltaLaps,FinishTime
+            SELECT PlayerInSessionId,FinishPositionOrig,DeltaTime,DeltaLaps,FinishTime,FinishPosition
             FROM PlayerInSession NATURAL LEFT JOIN PisCorrections
             WHERE SessionId=:sid
             ORDER BY FinishPositionOrig
         """, locals()).fetchall()
         players = []
-        correctionsFound = False
         for a in ans:
             players.append(dict(pisid=a[0],
                                 posorig=a[1],
                                 deltatime=a[2] if not a[2] is None else 0,
                                 deltalaps=a[3] if not a[3] is None else 0,
-                                finishtime=a[4]))
-            correctionsFound = correctionsFound or players[-1]['deltatime'] != 0 or players[-1]['deltalaps'] != 0
-            acinfo("correctionsFound=%s",correctionsFound)
+                                finishtime=a[4],
+                                pos=a[5]))
+        correctionsFound = any([p['deltatime'] != 0 or p['deltalaps'] != 0 for p in players])
+        acinfo("correctionsFound=%s",correctionsFound)
         if not correctionsFound:
             c.execute("""
                 UPDATE PlayerInSession SET
                     FinishPosition=FinishPositionOrig
-                WHERE PlayerInSessionId IN (SELECT PlayerInSessionId FROM Session NATURAL JOIN PlayerInSession WHERE SessionId=:sid)
+                WHERE SessionId=:sid
             """, locals())
             return
+        lapsByPis = {}
+        ans = c.execute("""
+            SELECT PlayerInSessionId,LapCount,LapTime FROM Lap
+            WHERE PlayerInSessionId IN (SELECT PlayerInSessionId FROM PlayerInSession WHERE SessionId=:sid)
+                  AND NOT LapCount IS NULL
+            ORDER BY PlayerInSessionId,LapId
+        """, locals()).fetchall()
+        for a in ans:
+            lapsByPis.setdefault(a[0], []).append((a[1], a[2]))
         finishLineCrossings = []
         for p in players:
             pisid = p['pisid']
             p['newPos'] = 1000
-            ans = c.execute("""
-                SELECT MAX(LapCount) FROM Lap
-                WHERE PlayerInSessionId=:pisid
-            """, locals()).fetchone()
-            if ans:
-                lapCount = ans[0]
-                ans = c.execute("SELECT LapId FROM Lap WHERE LapCount=:lapCount AND PlayerInSessionId=:pisid", locals()).fetchall()
-                lastLapCandidates = list(map(lambda x: x[0], ans))
-                laps = []
-                for llc in lastLapCandidates:
-                    laps = []
-                    ft = 0
-                    for lc in range(1,lapCount+1):
-                        ans = c.execute("SELECT MAX(LapId) FROM Lap WHERE LapId<=:llc AND PlayerInSessionId=:pisid AND LapCount=:lc", locals()).fetchone()
-                        lapid = ans[0]
-                        acinfo("lapid=%s, llc=%s, pisid=%s, lc=%s", lapid, llc, pisid, lc)
-                        ans = c.execute("SELECT LapTime FROM Lap WHERE LapId=:lapid", locals()).fetchone()
-                        if ans is None:
-                            acinfo("Cannot reconstruct race timing from database.")
-                            ft = None
-                            break
-                        laptime = ans[0]
-                        laps.append((ans[0], laptime))
-                        ft += laptime
-                    if ft is None:
-                        break
-                    if ft == p['finishtime']:
+            laps = lapsByPis.get(pisid, [])
+            lapCount = max([l[0] for l in laps]) if len(laps) > 0 else None
+            # Every lap with the maximum lap count is a candidate for the last lap (there might be more than one
+            # after reconnects). The race of a candidate consists of the latest laps with the counts 1..lapCount
+            # driven up to the candidate; the first candidate matching the finish time is used.
+            latest = {}
+            lapTimes = []
+            ft = None
+            for lc,laptime in laps:
+                latest[lc] = laptime
+                if lc != lapCount:
+                    continue
+                lapTimes = []
+                for i in range(1, lapCount+1):
+                    if not i in latest:
                         break
-                if not p['finishtime'] is None and not ft is None:
-                    if ft != p['finishtime']:
-                        acwarning("recalculateSessionPositions could not reconstruct the finish time from the driven laps (PlayerInSessionId=%d), using a virtual start time", pisid)
-                        acwarning("  finishtime=%d sum(laps)=%d", p['finishtime'], ft)
-                    p['startTime'] = p['finishtime'] - ft
-                else:
-                    p['startTime'] = 0
-                p['laps'] = laps
+                    lapTimes.append(latest[i])
+                if len(lapTimes) < lapCount:
+                    acinfo("Cannot reconstruct race timing from database.")
+                    ft = None
+                    break
+                ft = sum(lapTimes)
+                if ft == p['finishtime']:
+                    break
+            if not p['finishtime'] is None and not ft is None:
+                if ft != p['finishtime']:
+                    acwarning("recalculateSessionPositions could not reconstruct the finish time from the driven laps (PlayerInSessionId=%d), using a virtual start time", pisid)
+                    acwarning("  finishtime=%d sum(laps)=%d", p['finishtime'], ft)
+                t = p['finishtime'] - ft
             else:
-                p['startTime'] = 0
-                p['laps'] = []
-            t = p['startTime'] + p['deltatime']
+                t = 0
+            t += p['deltatime']
             finishLineCrossings.append( (p, t, 0+p['deltalaps']) )
-            for lapcount,ld in enumerate(p['laps']):
-                laptime = ld[1]
+            for lapcount,laptime in enumerate(lapTimes):
                 t += laptime
                 finishLineCrossings.append( (p, t, lapcount+1+p['deltalaps']) )
 
         # sort the fl crossings with ascending t
         finishLineCrossings.sort(key=lambda x: x[1])
 
-        for flc in finishLineCrossings:
-            p = flc[0]
-            t = flc[1]
-            lc= flc[2]
-            m = t // 60000
-            s =(t-m*60000)//1000
-            ms = t%1000
-            acdebug("  <oldpos=%2s> <t=%02d:%03d.%03d> <lc=%2s>", p['posorig'],m,s,ms,lc)
-
-        classment = []
         cNumLaps = 0
         winnerIdx = None
         if numLaps == 0: # this has been a timed race
@@ -1446,35 +1977,27 @@ class GenericBackend(DbSchemata):
         playersFinished = set([])
         for flc in finishLineCrossings[winnerIdx:]:
             p = flc[0]
-            t = flc[1]
-            lc = flc[2]
             if not p['pisid'] in playersFinished:
                 playersFinished.add(p['pisid'])
-                finish.append( (p, t, lc) )
-        def cmpFinish(f1, f2):
-            lc1 = f1[2]
-            lc2 = f2[2]
-            t1 = f1[1]
-            t2 = f2[1]
-            if lc1 > lc2: return -1
-            if lc2 > lc1: return 1
-            if t1 < t2: return -1
-            if t2 < t1: return 1
-            return 0
-        finish.sort(key=functools.cmp_to_key(cmpFinish))
+                finish.append(flc)
+        # more laps first, then the earlier crossing (the sort is stable for equal crossings)
+        finish.sort(key=lambda flc: (-flc[2], flc[1]))
         for idx,flc in enumerate(finish):
             flc[0]['newPos'] = idx+1
+        updates = []
         for p in players:
-            pisid = p['pisid']
-            newpos = p['newPos']
-            acdebug("recalc players pos: %d <oldPos=%s> <newPos=%d>", pisid, p['posorig'], newpos)
-            c.execute("""
+            acdebug("recalc players pos: %d <oldPos=%s> <newPos=%d>", p['pisid'], p['posorig'], p['newPos'])
+            if p['newPos'] != p['pos']:
+                updates.append(dict(pisid=p['pisid'], newpos=p['newPos']))
+        if len(updates) > 0:
+            c.executemany("""
                 UPDATE PlayerInSession
                 SET FinishPosition=:newpos
                 WHERE PlayerInSessionId=:pisid
-            """, locals())
+            """, updates)
 
-    def playerInSessionPaCModify(self, pis_id, delta_time, delta_points, delta_laps, comment, cursor = None):
+    def playerInSessionPaCModify(self, pis_id, delta_time, delta_points, delta_laps, comment, cursor = None, recalculate = True):
+        # recalculate=False leaves the recalculation of the positions to the caller (e.g. finishSession)
         if cursor is None:
             with self.db:
                 c = self.db.cursor()
@@ -1510,7 +2033,9 @@ class GenericBackend(DbSchemata):
                     c.execute("""
                         DELETE FROM PisCorrections WHERE PisCorrectionId=:piscid
                     """, locals())
-            self.recalculateSessionPositions(c, sid)
+            if recalculate:
+                self.recalculateSessionPositions(c, sid)
+                self.bumpGeneration(c, "Championships")
 
     def playerInSessionDetails(self, pisId):
         with self.db:
@@ -1585,13 +2110,36 @@ class GenericBackend(DbSchemata):
                 laps.append(r)
             return {'laps':laps, 'playerInSessioInfo':pisInfo}
 
-    def getPlayers(self, limit, searchPattern = None, inBanList = False, group_id = None, include_groups = False, inWhitelist = False, orderby=None, anonymized = False):
+    def getPlayers(self, limit, searchPattern = None, inBanList = False, group_id = None, include_groups = False, inWhitelist = False, orderby=None, anonymized = False, after = None):
+        # limit is [first row (1-based), number of rows]. For keyset pagination, pass the 'nextKey' of the
+        # previous page as after; the first row is ignored then.
         with self.db:
-            c = CursorDebug(self.db.cursor())
+            c = self.db.cursor()
             now = unixtime_now()
+            args = {}
             if not searchPattern is None:
+                trigrams = nameTrigrams(searchPattern)
                 searchPattern = "%" + searchPattern.lower() + "%"
                 search_stmt = "WHERE LOWER(Name) LIKE :searchPattern"
+                if len(trigrams) > 0:
+                    # candidates from the trigram index, patterns shorter than 3 characters need a full scan.
+                    # Frequent trigrams (e.g. of a common name prefix) don't narrow the candidates much, so only
+                    # the rare ones are used (counted up to a limit), the index is not used at all if there is none.
+                    # LIKE checks the complete pattern anyway.
+                    maxPostings = 1000
+                    freq = []
+                    for t in trigrams:
+                        n = c.execute("""
+                            SELECT COUNT(*) FROM (SELECT 1 FROM PlayerNameTrigrams WHERE Trigram=:t LIMIT :maxPostings) AS Postings
+                        """, locals()).fetchone()[0]
+                        freq.append((n, t))
+                    freq.sort()
+                    trigrams = [t for n,t in freq[:3] if n < maxPostings]
+                if len(trigrams) > 0:
+                    trigram_list = self.inList(trigrams, 'trigrams', args)
+                    args['num_trigrams'] = len(trigrams)
+                    search_stmt += """ AND PlayerId IN (SELECT PlayerId FROM PlayerNameTrigrams WHERE Trigram IN (%(trigram_list)s)
+                                                        GROUP BY PlayerId HAVING COUNT(*) = :num_trigrams)""" % locals()
             else:
                 search_stmt = ""
             if inBanList:
@@ -1605,12 +2153,16 @@ class GenericBackend(DbSchemata):
             else:
                 if orderby is None:
                     orderby = 'lastseen'
+            # the player id makes the order unique, which is needed for the keyset pagination
             if orderby == 'banneduntil':
-                order_stmt = "ORDER BY BannedUntil DESC"
+                order_stmt = "ORDER BY BannedUntil DESC, PlayerId DESC"
+                keyset_stmt = "BannedUntil < :key0 OR (BannedUntil = :key0 AND PlayerId < :key1)"
             elif orderby == 'drivername':
-                order_stmt = "ORDER BY Name"
+                order_stmt = "ORDER BY Name, PlayerId"
+                keyset_stmt = "Name > :key0 OR (Name = :key0 AND PlayerId > :key1)"
             else: # orderby == 'lastseen':
-                order_stmt = "ORDER BY PisId DESC " + self.nullslast
+                order_stmt = "ORDER BY PisId DESC " + self.nullslast + ", PlayerId DESC"
+                keyset_stmt = "MAX(PlayerInSessionId) < :key0 OR MAX(PlayerInSessionId) IS NULL OR (MAX(PlayerInSessionId) = :key0 AND PlayerId < :key1)"
             if inWhitelist:
                 if search_stmt == "":
                     search_stmt = "WHERE"
@@ -1630,17 +2182,17 @@ class GenericBackend(DbSchemata):
                     search_stmt = " AND"
                 search_stmt += " Anonymized = 1"
             limit_stmt = ""
-            count = c.execute("""
+            having_stmt = ""
+            # only the blacklisted players are aggregated, all other players get NULL values from the outer join
+            count = self.cachedCount(c, """
                 WITH BannedPlayers AS (
-                    SELECT PlayerId,MAX(BanCount) AS BanCount,MAX(BannedUntil) AS BannedUntil FROM Players NATURAL LEFT JOIN BlacklistedPlayers
-                    GROUP BY PlayerId, Name, SteamGuid, IsOnline
+                    SELECT PlayerId,MAX(BanCount) AS BanCount,MAX(BannedUntil) AS BannedUntil FROM BlacklistedPlayers
+                    GROUP BY PlayerId
                 )
                 SELECT COUNT(*) FROM (SELECT PlayerId, Name, SteamGuid, IsOnline, BanCount, BannedUntil, Whitelisted FROM Players NATURAL LEFT JOIN PlayerInSession NATURAL LEFT JOIN Session NATURAL LEFT JOIN BannedPlayers NATURAL LEFT JOIN GroupEntries
                                       %(search_stmt)s
                                       GROUP BY PlayerId, Name, SteamGuid, IsOnline, BanCount, BannedUntil, Whitelisted) AS Temp
-            """ % locals(), locals()).fetchone()
-            if count is None: count = 0
-            else: count = count[0]
+            """ % locals(), dict(locals(), **args))
             if not limit is None:
                 if limit[0] is None:
                     offset = 1
@@ -1648,6 +2200,14 @@ class GenericBackend(DbSchemata):
                     offset = limit[0]
                 offset -= 1
                 limit = limit[1]
+                if not after is None:
+                    offset = 0
+                    if after[0] is None:
+                        # players without sessions are at the end of the 'lastseen' order
+                        keyset_stmt = "MAX(PlayerInSessionId) IS NULL AND PlayerId < :key1"
+                    having_stmt = "HAVING " + keyset_stmt
+                    args['key0'] = after[0]
+                    args['key1'] = after[1]
                 if offset + limit > count:
                     offset = count-limit
                 if offset < 0:
@@ -1655,20 +2215,29 @@ class GenericBackend(DbSchemata):
                 limit_stmt = "LIMIT %d OFFSET %d" % (limit, offset)
             ans = c.execute("""
                 WITH BannedPlayers AS (
-                    SELECT PlayerId,MAX(BanCount) AS BanCount,MAX(BannedUntil) AS BannedUntil FROM Players NATURAL LEFT JOIN BlacklistedPlayers
-                    GROUP BY PlayerId, Name, SteamGuid, IsOnline
+                    SELECT PlayerId,MAX(BanCount) AS BanCount,MAX(BannedUntil) AS BannedUntil FROM BlacklistedPlayers
+                    GROUP BY PlayerId
                 )
                 SELECT PlayerId, MAX(PlayerInSessionId) AS PisId, Name, SteamGuid, IsOnline, MAX(StartTimeDate), BanCount, BannedUntil, Whitelisted
                 FROM Players NATURAL LEFT JOIN PlayerInSession NATURAL LEFT JOIN Session NATURAL LEFT JOIN BannedPlayers NATURAL LEFT JOIN GroupEntries
                 %(search_stmt)s
                 GROUP BY PlayerId, Name, SteamGuid, IsOnline, BanCount, BannedUntil, Whitelisted
+                %(having_stmt)s
                 %(order_stmt)s
                 %(limit_stmt)s
-            """ % locals(), locals()).fetchall()
+            """ % locals(), dict(locals(), **args)).fetchall()
             ply = []
             for p in ans:
                 ply.append(dict(playerId=p[0], lastSessionId=p[1], name=p[2], guid=p[3], isOnline=p[4], lastSeen=p[5], banCount=p[6], bannedUntil=p[7], whitelisted=p[8]))
-            res = {'players':ply, 'count':count}
+            res = {'players':ply, 'count':count, 'nextKey':None}
+            if not limit is None and len(ans) == limit:
+                last = ans[-1]
+                if orderby == 'banneduntil':
+                    res['nextKey'] = (last[7], last[0])
+                elif orderby == 'drivername':
+                    res['nextKey'] = (last[2], last[0])
+                else:
+                    res['nextKey'] = (last[1], last[0])
             if include_groups:
                 res['groups'] = self.allgroups(c)
             return res
@@ -1691,6 +2260,7 @@ class GenericBackend(DbSchemata):
             if not add_group is None:
                 c.execute("INSERT INTO PlayerGroups(GroupName) VALUES(:add_group)", locals())
                 group_id=c.lastrowid
+                self.bumpGeneration(c, "Pages")
                 return group_id
             elif not del_group is None and del_group != 0:
                 c.execute("DELETE FROM GroupEntries WHERE GroupId=:del_group", locals())
@@ -1704,6 +2274,7 @@ class GenericBackend(DbSchemata):
                 c.execute("UPDATE Players SET Whitelisted = 1 WHERE PlayerId = :whitelist_player_id", locals())
             elif not unwhitelist_player_id is None:
                 c.execute("UPDATE Players SET Whitelisted = NULL WHERE PlayerId = :unwhitelist_player_id", locals())
+            self.bumpGeneration(c, "Pages")
 
     def setupDepositGet(self, guid, car, track, setupid = None):
         with self.db:
@@ -1789,16 +2360,7 @@ class GenericBackend(DbSchemata):
             else:
                 plyCond = " WHERE SteamGUID=:guid"
             res = {}
-            if 0:
-                def c_execute(*args, **kw):
-                    acdebug("Executing SQL:\n        %s", args[0].replace("\n", "\n        "))
-                    t = time.time()
-                    res = c.execute(*args, **kw)
-                    t = time.time() - t
-                    acdebug("Profiling result: %dm %.1fs" % (t // 60., t % 60.))
-                    return res
-            else:
-                c_execute = c.execute
+            c_execute = c.execute
             ans = c_execute("SELECT * FROM Players %(plyCond)s"%locals(), locals()).fetchone()
             playerInfo = {}
             for i,v in enumerate(ans):
@@ -1948,6 +2510,7 @@ class GenericBackend(DbSchemata):
                     # don't create a new player at the first message sent
                     return False
                 c.execute("INSERT INTO Players(SteamGuid,Name) VALUES(:guid,:name)", locals())
+                self.indexPlayerName(c, c.lastrowid)
             if not newVal is None:
                 c.execute("UPDATE Players SET MessagesDisabled=:newVal WHERE SteamGuid=:guid", locals())
             return c.execute("SELECT MessagesDisabled FROM Players WHERE SteamGuid=:guid", locals()).fetchone()[0]
@@ -1988,8 +2551,9 @@ class GenericBackend(DbSchemata):
                         SET Duration=:newDur
                         WHERE BlacklistId=:blId
                     """, locals())
+            self.bumpGeneration(c, "Pages")
 
-    def auth(self, guid, track=None, cars=None, server=None, valid=None, minNumLaps=None, maxTimePercentage=None, tyre_list=None, maxRank=None, groups=[]):
+    def auth(self, guid, track=None, cars=None, server=None, valid=None, minNumLaps=None, maxTimePercentage=None, tyre_list=None, maxRank=None, groups=[], preventAnon=False):
         now = unixtime_now()
         with self.db:
             c = self.db.cursor()
@@ -2089,138 +2653,150 @@ class GenericBackend(DbSchemata):
                 c.execute("UPDATE Players SET IsOnline=:server_name WHERE SteamGuid=:guid", locals())
             for guid in old_guids - guids_online:
                 c.execute("UPDATE Players SET IsOnline=NULL WHERE SteamGuid=:guid", locals())
+            if guids_online != old_guids:
+                self.bumpGeneration(c, "Pages")
 
     def csGetSeasons(self, cs_id = None):
         with self.db:
             c = self.db.cursor()
-            ans = c.execute("SELECT CSId,CSName FROM CSSeasons ORDER BY CSId DESC", locals()).fetchall()
-            seasons = []
-            events = None
+            # the standings only change with the mutations calling bumpGeneration(c, "Championships")
+            generation = self.generation(c, "Championships")
+            cached = self.csCache.get(cs_id, None)
+            if not cached is None and cached[0] == generation:
+                return copy.deepcopy(cached[1])
+            res = self.csCalcSeasons(c, cs_id)
+            self.csCache[cs_id] = (generation, copy.deepcopy(res))
+            return res
+
+    def csCalcSeasons(self, c, cs_id):
+        ans = c.execute("SELECT CSId,CSName FROM CSSeasons ORDER BY CSId DESC", locals()).fetchall()
+        seasons = []
+        events = None
+        for a in ans:
+            seasons.append(dict(id=a[0], name=a[1]))
+        point_schemata = []
+        ans = c.execute("SELECT PointSchemaId,PSName FROM CSPointSchema ORDER BY PointSchemaId DESC", locals()).fetchall()
+        for a in ans:
+            point_schemata.append(dict(pointSchemaId=a[0], psName=a[1]))
+        for ps in point_schemata:
+            psid = ps['pointSchemaId']
+            ans = c.execute("SELECT Position,Points FROM CSPointSchemaEntry WHERE PointSchemaId = :psid", locals()).fetchall()
+            schema = {}
             for a in ans:
-                seasons.append(dict(id=a[0], name=a[1]))
-            point_schemata = []
-            ans = c.execute("SELECT PointSchemaId,PSName FROM CSPointSchema ORDER BY PointSchemaId DESC", locals()).fetchall()
+                if not a[0] is None and not a[1] is None:
+                    schema[a[0]] = a[1]
+            ps['schema'] = schema
+            ans = c.execute("SELECT COUNT(*) FROM CSEventSessions WHERE PointSchemaId=:psid", locals()).fetchone()
+            ps['removable'] = ans is None or (ans[0] == 0)
+        if not cs_id is None:
+            ans = c.execute("SELECT EventId,EventName FROM CSEvent WHERE CSId = :cs_id ORDER BY EventId DESC", locals()).fetchall()
+            events = []
             for a in ans:
-                point_schemata.append(dict(pointSchemaId=a[0], psName=a[1]))
-            for ps in point_schemata:
-                psid = ps['pointSchemaId']
-                ans = c.execute("SELECT Position,Points FROM CSPointSchemaEntry WHERE PointSchemaId = :psid", locals()).fetchall()
-                schema = {}
-                for a in ans:
-                    if not a[0] is None and not a[1] is None:
-                        schema[a[0]] = a[1]
-                ps['schema'] = schema
-                ans = c.execute("SELECT COUNT(*) FROM CSEventSessions WHERE PointSchemaId=:psid", locals()).fetchone()
-                ps['removable'] = ans is None or (ans[0] == 0)
-            if not cs_id is None:
-                ans = c.execute("SELECT EventId,EventName FROM CSEvent WHERE CSId = :cs_id ORDER BY EventId DESC", locals()).fetchall()
-                events = []
+                events.append(dict(id=a[0], name=a[1]))
+            players = {}
+            teams = {}
+            for e in events:
+                eid = e['id']
+                ans = c.execute("""
+                    SELECT CSEventSessionId,SessionId,PointSchemaId,SessionType,Duration,NumberOfLaps,StartTimeDate,EndTimeDate,PSName,SessionName
+                    FROM CSEventSessions NATURAL JOIN Session NATURAL JOIN CSPointSchema
+                    WHERE EventId = :eid
+                    ORDER BY CSEventSessionId
+                """, locals()).fetchall()
+                sessions = []
+                startTime = None
+                endTime = None
                 for a in ans:
-                    events.append(dict(id=a[0], name=a[1]))
-                players = {}
-                teams = {}
-                for e in events:
-                    eid = e['id']
+                    sessions.append(dict(eventSessionId=a[0],
+                                         sessionId=a[1],
+                                         pointSchemaId=a[2],
+                                         sessionType=a[3],
+                                         duration=a[4],
+                                         numberOfLaps=a[5],
+                                         startTime=a[6],
+                                         endTime=a[7],
+                                         psName=a[8],
+                                         sessionName=a[9]))
+                    if startTime is None or (not a[6] is None and a[6] < startTime):
+                        startTime = a[6]
+                    if endTime is None or (not a[7] is None and a[7] > endTime):
+                        endTime = a[7]
+                e['startTime'] = startTime
+                e['endTime'] = endTime
+                e['sessions'] = sessions
+                for s in sessions:
+                    sid = s['sessionId']
+                    psid = s['pointSchemaId']
                     ans = c.execute("""
-                        SELECT CSEventSessionId,SessionId,PointSchemaId,SessionType,Duration,NumberOfLaps,StartTimeDate,EndTimeDate,PSName,SessionName
-                        FROM CSEventSessions NATURAL JOIN Session NATURAL JOIN CSPointSchema
-                        WHERE EventId = :eid
-                        ORDER BY CSEventSessionId
+                        SELECT SteamGuid,Name,PlayerId,Position,Points,DeltaPoints,Teams.TeamId,TeamName
+                        FROM Session
+                             NATURAL JOIN PlayerInSession
+                             NATURAL JOIN Players
+                             LEFT JOIN CSPointSchemaEntry ON (PlayerInSession.FinishPosition = CSPointSchemaEntry.Position)
+                             NATURAL LEFT JOIN PisCorrections
+                             LEFT JOIN Teams ON (PlayerInSession.TeamId = Teams.TeamId)
+                        WHERE SessionId = :sid AND (CSPointSchemaEntry.PointSchemaId IS NULL OR CSPointSchemaEntry.PointSchemaId = :psid)
+                        ORDER BY PlayerInSession.FinishPosition
                     """, locals()).fetchall()
-                    sessions = []
-                    startTime = None
-                    endTime = None
+                    classment = []
+                    teamClassment = {}
                     for a in ans:
-                        sessions.append(dict(eventSessionId=a[0],
-                                             sessionId=a[1],
-                                             pointSchemaId=a[2],
-                                             sessionType=a[3],
-                                             duration=a[4],
-                                             numberOfLaps=a[5],
-                                             startTime=a[6],
-                                             endTime=a[7],
-                                             psName=a[8],
-                                             sessionName=a[9]))
-                        if startTime is None or (not a[6] is None and a[6] < startTime):
-                            startTime = a[6]
-                        if endTime is None or (not a[7] is None and a[7] > endTime):
-                            endTime = a[7]
-                    e['startTime'] = startTime
-                    e['endTime'] = endTime
-                    e['sessions'] = sessions
-                    for s in sessions:
-                        sid = s['sessionId']
-                        psid = s['pointSchemaId']
-                        ans = c.execute("""
-                            SELECT SteamGuid,Name,PlayerId,Position,Points,DeltaPoints,Teams.TeamId,TeamName
-                            FROM Session
-                                 NATURAL JOIN PlayerInSession
-                                 NATURAL JOIN Players
-                                 LEFT JOIN CSPointSchemaEntry ON (PlayerInSession.FinishPosition = CSPointSchemaEntry.Position)
-                                 NATURAL LEFT JOIN PisCorrections
-                                 LEFT JOIN Teams ON (PlayerInSession.TeamId = Teams.TeamId)
-                            WHERE SessionId = :sid AND (CSPointSchemaEntry.PointSchemaId IS NULL OR CSPointSchemaEntry.PointSchemaId = :psid)
-                            ORDER BY PlayerInSession.FinishPosition
-                        """, locals()).fetchall()
-                        classment = []
-                        teamClassment = {}
-                        for a in ans:
-                            guid = a[0]
-                            name = a[1]
-                            pid = a[2]
-                            pos = a[3]
-                            points = a[4]
-                            delta_points = a[5]
-                            teamId = a[6]
-                            teamName = a[7]
-                            if points is None and delta_points is None:
-                                continue
-                            if not pid in players:
-                                players[pid] = dict(name=name, guid=guid, cum_points=0, teams=set())
-                            if points is None:
-                                points = 0
-                            if delta_points is None:
-                                delta_points = 0
-                            points += delta_points
-                            players[pid]['cum_points'] += points
-                            players[pid]['teams'].add(teamName if not teamName is None else "(none)")
-                            classment.append( (pid, pos, points) )
-                            if not teamId is None:
-                                if not teamId in teams:
-                                    teams[teamId] = dict(name=teamName, cum_points=0)
-                                teams[teamId]['cum_points'] += points
-                                if not teamId in teamClassment:
-                                    teamClassment[teamId] = 0
-                                teamClassment[teamId] += points
-                        teamClassment = sorted(teamClassment.items(), key=lambda x: x[1], reverse=True)
-                        res = []
-                        for i,tci in enumerate(teamClassment):
-                            res.append( (tci[0], i+1, tci[1]) )
-                        s['classment'] = classment
-                        s['teamClassment'] = res
-                # players is a dict mapping player ids to a dict with cum_points, name and guid
-                # next line converts this into a list of dicts with cum_points, name, guid and playerid
-                players = list(map(lambda x: dict(list(x[1].items()) + [('pid',x[0])]), players.items()))
-                # sort in descending cum_points order
-                players.sort(key=lambda x: x['cum_points'], reverse=True)
-
-                # same for teams
-                teams = list(map(lambda x: dict(list(x[1].items()) + [('pid',x[0])]), teams.items()))
-                teams.sort(key=lambda x: x['cum_points'], reverse=True)
+                        guid = a[0]
+                        name = a[1]
+                        pid = a[2]
+                        pos = a[3]
+                        points = a[4]
+                        delta_points = a[5]
+                        teamId = a[6]
+                        teamName = a[7]
+                        if points is None and delta_points is None:
+                            continue
+                        if not pid in players:
+                            players[pid] = dict(name=name, guid=guid, cum_points=0, teams=set())
+                        if points is None:
+                            points = 0
+                        if delta_points is None:
+                            delta_points = 0
+                        points += delta_points
+                        players[pid]['cum_points'] += points
+                        players[pid]['teams'].add(teamName if not teamName is None else "(none)")
+                        classment.append( (pid, pos, points) )
+                        if not teamId is None:
+                            if not teamId in teams:
+                                teams[teamId] = dict(name=teamName, cum_points=0)
+                            teams[teamId]['cum_points'] += points
+                            if not teamId in teamClassment:
+                                teamClassment[teamId] = 0
+                            teamClassment[teamId] += points
+                    teamClassment = sorted(teamClassment.items(), key=lambda x: x[1], reverse=True)
+                    res = []
+                    for i,tci in enumerate(teamClassment):
+                        res.append( (tci[0], i+1, tci[1]) )
+                    s['classment'] = classment
+                    s['teamClassment'] = res
+            # players is a dict mapping player ids to a dict with cum_points, name and guid
+            # next line converts this into a list of dicts with cum_points, name, guid and playerid
+            players = list(map(lambda x: dict(list(x[1].items()) + [('pid',x[0])]), players.items()))
+            # sort in descending cum_points order
+            players.sort(key=lambda x: x['cum_points'], reverse=True)
+
+            # same for teams
+            teams = list(map(lambda x: dict(list(x[1].items()) + [('pid',x[0])]), teams.items()))
+            teams.sort(key=lambda x: x['cum_points'], reverse=True)
 
-            else:
-                ans = c.execute("""
-                    SELECT EventId,CSName||':'||EventName,CSId FROM
-                    CSEvent NATURAL JOIN CSSeasons
-                    ORDER BY EventId DESC
-                """, locals()).fetchall()
-                events = []
-                for a in ans:
-                    events.append(dict(id=a[0], name=a[1], cs_id=a[2]))
-                players = None
-                teams = None
+        else:
+            ans = c.execute("""
+                SELECT EventId,CSName||':'||EventName,CSId FROM
+                CSEvent NATURAL JOIN CSSeasons
+                ORDER BY EventId DESC
+            """, locals()).fetchall()
+            events = []
+            for a in ans:
+                events.append(dict(id=a[0], name=a[1], cs_id=a[2]))
+            players = None
+            teams = None
 
-            return dict(seasons=seasons, events=events, point_schemata=point_schemata, players=players, teams=teams)
+        return dict(seasons=seasons, events=events, point_schemata=point_schemata, players=players, teams=teams)
 
     def csModify(self,
                  add_season_name=None, del_season=None, cs_id=None,
@@ -2231,6 +2807,7 @@ class GenericBackend(DbSchemata):
                  remove_event_session_id=None):
         with self.db:
             c = self.db.cursor()
+            self.bumpGeneration(c, "Championships")
             if not add_season_name is None:
                 c.execute("INSERT INTO CSSeasons(CSName) VALUES(:add_season_name)", locals())
                 return c.lastrowid
@@ -2302,11 +2879,25 @@ class GenericBackend(DbSchemata):
                      WHERE CSId=:cs_id AND PlayerId=:pid
                     )
             """, locals())
+            self.bumpGeneration(cur, "Championships")
 
     def modifyLap(self, lapid, valid):
         with self.db:
             c = self.db.cursor()
             c.execute("UPDATE Lap SET Valid=:valid WHERE LapId=:lapid", locals())
+            a = c.execute("""
+                SELECT TrackId, CarId, PlayerId,
+                       (SELECT Track FROM Tracks WHERE Tracks.TrackId=Session.TrackId),
+                       (SELECT Car FROM Cars WHERE Cars.CarId=PlayerInSession.CarId)
+                FROM Lap NATURAL JOIN PlayerInSession NATURAL JOIN Session
+                WHERE LapId=:lapid
+            """, locals()).fetchone()
+            if not a is None:
+                self.rebuildLeaderboard(c, trackId=a[0], carId=a[1], playerId=a[2])
+                self.invalidateDimensionIds("Leaderboard")
+            self.bumpGeneration(c, "Pages")
+        if not a is None:
+            self.invalidateBestTimes(a[3], a[4])
 
     def modifyRequiredChecksums(self, track = None, reqTrackChecksum = None, car = None, reqCarChecksum = None):
         with self.db:
@@ -2330,31 +2921,46 @@ class GenericBackend(DbSchemata):
             return {'tracks':trackres, 'cars':carres}
 
     def statistics(self, servers=None, startDate=None, endDate=None, cars=None, tracks=None, invalidate_laps=False):
+        invalidatedTracks = []
         with self.db:
             res = {}
             c = self.db.cursor()
-            trackMapping=self.trackMapping(c)
-            carMapping=self.carMapping(c)
 
-            conditions = []
             if endDate is None:
                 endDate = int(datetime2unixtime(datetime.datetime.now()))
             if startDate is None:
                 startDate = endDate - 3*30*24*60*60
-            conditions.append("Session.StartTimeDate >= %d AND Session.StartTimeDate <= %d" % ((startDate), (endDate)))
-            list_to_str = lambda l: ",".join(["'" + x.replace("'", "") + "'" for x in l])
+            startDate = int(startDate)
+            endDate = int(endDate)
+            # the filter values are passed as parameters, so the statements don't depend on them
+            filters = []
+            rollupFilters = []
+            args = {}
             if not servers is None:
-                conditions.append("Session.ServerIpPort IN (%s)" % list_to_str(servers))
+                serverValues = self.inList(servers, 'servers', args)
+                filters.append("Session.ServerIpPort IN (%s)" % serverValues)
+                rollupFilters.append("ServerIpPort IN (%s)" % serverValues)
             if not cars is None:
-                conditions.append("PlayerInSession.CarId IN (SELECT CarId FROM Cars WHERE Car IN (%s))" % list_to_str(cars))
+                carValues = self.inList(cars, 'cars', args)
+                filters.append("PlayerInSession.CarId IN (SELECT CarId FROM Cars WHERE Car IN (%s))" % carValues)
+                rollupFilters.append("CarId IN (SELECT CarId FROM Cars WHERE Car IN (%s))" % carValues)
             if not tracks is None:
-                conditions.append("Session.TrackId IN (SELECT TrackId FROM Tracks WHERE Track IN (%s))" % list_to_str(tracks))
-
-            cond = " AND ".join(conditions)
-            if cond != "":
-                cond = "WHERE " + cond
+                trackValues = self.inList(tracks, 'tracks', args)
+                filters.append("Session.TrackId IN (SELECT TrackId FROM Tracks WHERE Track IN (%s))" % trackValues)
+                rollupFilters.append("TrackId IN (SELECT TrackId FROM Tracks WHERE Track IN (%s))" % trackValues)
+            args['startDate'] = startDate
+            args['endDate'] = endDate
 
             if invalidate_laps:
+                cond = "WHERE " + " AND ".join(["Session.StartTimeDate >= :startDate AND Session.StartTimeDate <= :endDate"] + filters)
+                invalidatedTracks = c.execute("""
+                    SELECT DISTINCT TrackId, Track FROM
+                        Lap NATURAL JOIN
+                        PlayerInSession NATURAL JOIN
+                        Session NATURAL JOIN
+                        Tracks
+                    %(cond)s
+                """ % locals(), args).fetchall()
                 c.execute("""
                     UPDATE Lap SET Valid=0 WHERE LapId IN
                         (SELECT LapId FROM
@@ -2363,62 +2969,95 @@ class GenericBackend(DbSchemata):
                             Session NATURAL JOIN
                             Tracks
                          %(cond)s)
-                """ % locals())
-
-            ans = c.execute("SELECT COUNT(*), SUM(length)/1000. FROM Lap NATURAL JOIN PlayerInSession NATURAL JOIN Session NATURAL JOIN Tracks %(cond)s" % locals()).fetchone()
-            res['numLaps'] = ans[0]
-            res['kmDriven'] = ans[1]
-
-            trackIds = c.execute("""
-                SELECT TrackId,Track,Cnt FROM
+                """ % locals(), args)
+                for trackId, track in invalidatedTracks:
+                    self.rebuildLeaderboard(c, trackId=trackId)
+                self.invalidateDimensionIds("Leaderboard")
+                self.bumpGeneration(c, "Pages")
+
+            # the full days of the range are read from the daily rollups (see registerLap), only the
+            # partial days at the borders of the range are aggregated from the session and lap tables
+            secondsPerDay = 60*60*24
+            dayFrom = (startDate + secondsPerDay - 1)//secondsPerDay
+            dayTo = max(dayFrom, (endDate + 1)//secondsPerDay)
+            args['dayFrom'] = dayFrom
+            args['dayTo'] = dayTo
+            # the range might end before the first full day
+            args['dayFromStart'] = min(dayFrom*secondsPerDay, endDate + 1)
+            args['dayToStart'] = dayTo*secondsPerDay
+            rollupCond = " AND ".join(["Day >= :dayFrom AND Day < :dayTo"] + rollupFilters)
+            rawCond = " AND ".join(["((Session.StartTimeDate >= :startDate AND Session.StartTimeDate < :dayFromStart) OR (Session.StartTimeDate >= :dayToStart AND Session.StartTimeDate <= :endDate))"]
+                                   + filters)
+
+            trackInfo = {}
+            for trackId, track, uiTrack, length in c.execute("SELECT TrackId,Track,UiTrackName,Length FROM Tracks").fetchall():
+                trackInfo[trackId] = (track, uiTrack if not uiTrack is None else track, length)
+            carInfo = {}
+            for carId, car, uiCar in c.execute("SELECT CarId,Car,UiCarName FROM Cars").fetchall():
+                carInfo[carId] = (car, uiCar if not uiCar is None else car)
+
+            aggregates = c.execute("""
+                SELECT TrackId, CarId, ComboId, SUM(NumLaps), MAX(LastStart) FROM
                 (
-                	SELECT TrackId,COUNT(LapId) AS Cnt
-                	FROM Lap
-                		NATURAL JOIN PlayerInSession
-                		NATURAL JOIN Session
-                    %(cond)s
-                	GROUP BY TrackId
-                ) AS Tmp NATURAL JOIN Tracks""" % locals() ).fetchall()
+                    SELECT TrackId, CarId, ComboId, NumLaps, LastStart
+                    FROM StatsDaily
+                    WHERE %(rollupCond)s
+                  UNION ALL
+                    SELECT Session.TrackId, PlayerInSession.CarId, Session.ComboId, COUNT(Lap.LapId), MAX(Session.StartTimeDate)
+                    FROM Session JOIN PlayerInSession ON (PlayerInSession.SessionId=Session.SessionId)
+                                 LEFT JOIN Lap ON (Lap.PlayerInSessionId=PlayerInSession.PlayerInSessionId)
+                    WHERE %(rawCond)s
+                    GROUP BY Session.TrackId, PlayerInSession.CarId, Session.ComboId
+                ) AS Tmp
+                GROUP BY TrackId, CarId, ComboId
+            """ % locals(), args).fetchall()
+            numLaps = 0
+            meters = None
+            lapsPerCombo = {}
+            recentCombos = {}
             res['lapsPerTrack'] = {}
-            for tid,tname,nLaps in trackIds:
-                res['lapsPerTrack'][trackMapping.get(tname,tname)] = nLaps
-            carIds = c.execute("""
-                SELECT CarId,Car,Cnt FROM
-                (
-                	SELECT CarId,COUNT(LapId) AS Cnt
-                	FROM Lap
-                		NATURAL JOIN PlayerInSession
-                        NATURAL JOIN Session
-                    %(cond)s
-                	GROUP BY CarId
-                ) AS Tmp NATURAL JOIN Cars""" % locals() ).fetchall()
             res['lapsPerCar'] = {}
-            for cid,cname,nLaps in carIds:
-                res['lapsPerCar'][carMapping.get(cname,cname)] = nLaps
-            comboIds = c.execute("""
-                SELECT ComboId, COUNT(LapId) AS Cnt
-                FROM Lap NATURAL JOIN PlayerInSession NATURAL JOIN Session
-                %(cond)s
-                GROUP BY ComboId
-                ORDER BY Cnt DESC
-            """ % locals() ).fetchall()
+            for trackId, carId, comboId, nLaps, lastStart in aggregates:
+                if recentCombos.get(comboId, lastStart) <= lastStart:
+                    recentCombos[comboId] = lastStart
+                if nLaps == 0:
+                    continue
+                numLaps += nLaps
+                track, uiTrack, length = trackInfo[trackId]
+                if not length is None:
+                    meters = (meters or 0) + nLaps*length
+                res['lapsPerTrack'][uiTrack] = res['lapsPerTrack'].get(uiTrack, 0) + nLaps
+                uiCar = carInfo[carId][1]
+                res['lapsPerCar'][uiCar] = res['lapsPerCar'].get(uiCar, 0) + nLaps
+                lapsPerCombo[comboId] = lapsPerCombo.get(comboId, 0) + nLaps
+            res['numLaps'] = numLaps
+            res['kmDriven'] = meters/1000. if not meters is None else None
+
+            comboIds = [comboId for comboId in lapsPerCombo.keys() if not comboId is None]
+            comboInfo = {}
+            if len(comboIds) > 0:
+                comboArgs = {}
+                comboIds = self.inList(sorted(comboIds), 'comboIds', comboArgs)
+                for comboId, trackId, carId in c.execute("""
+                        SELECT Combos.ComboId, Combos.TrackId, ComboCars.CarId
+                        FROM Combos LEFT JOIN ComboCars ON (ComboCars.ComboId=Combos.ComboId)
+                        WHERE Combos.ComboId IN (%(comboIds)s)
+                    """ % locals(), comboArgs).fetchall():
+                    info = comboInfo.setdefault(comboId, (trackId, []))
+                    if not carId is None:
+                        info[1].append(carId)
             res['lapsPerCombo'] = {}
-            for comboId, nLaps in comboIds:
-                res['lapsPerCombo'][comboId] = {}
-                res['lapsPerCombo'][comboId]['lapCount'] = nLaps
-                res['lapsPerCombo'][comboId]['track'] = c.execute("SELECT Track FROM Tracks NATURAL JOIN Combos WHERE Combos.ComboId = :comboId", locals()).fetchone()[0]
-                res['lapsPerCombo'][comboId]['uitrack'] = trackMapping.get(res['lapsPerCombo'][comboId]['track'],res['lapsPerCombo'][comboId]['track'])
-                res['lapsPerCombo'][comboId]['cars'] = [x[0] for x in c.execute("SELECT Car FROM Cars NATURAL JOIN ComboCars WHERE ComboId = :comboId ORDER BY Car", locals()).fetchall()]
-                res['lapsPerCombo'][comboId]['uicars'] = [carMapping.get(x, x) for x in res['lapsPerCombo'][comboId]['cars']]
-            res['recentCombos'] = []
-            for comboId,startTD in c.execute("""
-                        SELECT ComboId, Max(StartTimeDate) AS StartTimeDate
-                        FROM Session NATURAL JOIN PlayerInSession
-                        %(cond)s
-                        GROUP BY ComboId
-                        ORDER BY StartTimeDate DESC
-                    """ % locals()).fetchall():
-                res['recentCombos'].append( (comboId, startTD) )
+            for comboId, nLaps in sorted(lapsPerCombo.items(), key=lambda x: x[1], reverse=True):
+                if not comboId in comboInfo:
+                    continue
+                trackId, carIds = comboInfo[comboId]
+                comboCars = sorted([carInfo[carId] for carId in carIds])
+                res['lapsPerCombo'][comboId] = dict(lapCount=nLaps,
+                                                    track=trackInfo[trackId][0],
+                                                    uitrack=trackInfo[trackId][1],
+                                                    cars=[x[0] for x in comboCars],
+                                                    uicars=[x[1] for x in comboCars])
+            res['recentCombos'] = sorted(recentCombos.items(), key=lambda x: x[1], reverse=True)
 
             res['numPlayers'] = c.execute("SELECT COUNT(*) FROM Players").fetchone()[0]
             now = unixtime_now()
@@ -2427,18 +3066,25 @@ class GenericBackend(DbSchemata):
                 WHERE NOT BannedUntil IS NULL AND BannedUntil >= :now
                 """, locals()).fetchone()[0]
             ppd = c.execute("""
-                SELECT Day,COUNT(PlayerId) FROM (
-                    SELECT (StartTimeDate/(60*60*24)) AS Day,PlayerId
-                    FROM PlayerInSession NATURAL JOIN Session
-                    %(cond)s
-                    GROUP BY Day,PlayerId
-                    ORDER BY Day
-                ) AS Tmp GROUP BY Day
-                """ % locals() ).fetchall()
+                SELECT Day,COUNT(DISTINCT PlayerId) FROM
+                (
+                    SELECT Day, PlayerId
+                    FROM StatsDailyPlayers
+                    WHERE %(rollupCond)s
+                  UNION ALL
+                    SELECT (Session.StartTimeDate/(60*60*24)) AS Day, PlayerInSession.PlayerId
+                    FROM Session JOIN PlayerInSession ON (PlayerInSession.SessionId=Session.SessionId)
+                    WHERE %(rawCond)s
+                ) AS Tmp
+                GROUP BY Day
+                ORDER BY Day
+                """ % locals(), args).fetchall()
             res['numPlayersOnlinePerDay'] = []
             for day,cnt in ppd:
                 res['numPlayersOnlinePerDay'].append(dict(datetime=unixtime2datetime(day*60*60*24), count=cnt))
-            return res
+        for trackId, track in invalidatedTracks:
+            self.invalidateBestTimes(track)
+        return res
 
     def trackAndCarDetails(self, tracks = None, cars = None, overwrite = False):
         with self.db:
@@ -2463,6 +3109,8 @@ class GenericBackend(DbSchemata):
                     if "uiname" in c: cur.execute("UPDATE Cars SET UiCarName=:uiname WHERE Car=:car" + (" AND UiCarName IS NULL")*cond, c)
                     if "brand" in c:  cur.execute("UPDATE Cars SET Brand=:brand WHERE Car=:car" + (" AND Brand IS NULL")*cond, c)
                     if "badge" in c:  cur.execute("UPDATE Cars SET BadgeData=:badge WHERE Car=:car" + (" AND BadgeData IS NULL")*cond, c)
+            if len(tracks or []) > 0 or len(cars or []) > 0:
+                self.bumpGeneration(cur, "Pages")
             cur.execute("SELECT Track,UiTrackName,Length,Length(MapData) > 0 FROM Tracks ORDER BY UiTrackName,Track")
             tracks = list(map(lambda x: dict(acname=x[0], uiname=x[1], length=x[2], mapdata=x[3]), cur.fetchall()))
             cur.execute("SELECT Car,UiCarName,Brand,Length(BadgeData) > 0 FROM Cars ORDER BY UiCarName,Car")
@@ -2561,11 +3209,14 @@ class GenericBackend(DbSchemata):
             if ans is None:
                 cur.execute("INSERT INTO Players(SteamGuid, Name) VALUES(:guid, :name)", locals())
                 pid = cur.lastrowid
+                self.indexPlayerName(cur, pid)
             else:
                 pid = ans[0]
             cur.execute("INSERT INTO ChatHistory(PlayerId, Timestamp, Content, Server) VALUES(:pid, :now, :message, :server)", locals())
 
-    def filterChat(self, guid = None, server = None, startTime = None, endTime = None, limit = None):
+    def filterChat(self, guid = None, server = None, startTime = None, endTime = None, limit = None, after = None):
+        # limit is [first row (1-based), number of rows]. For keyset pagination, pass the 'nextKey' of the
+        # previous page as after; the first row is ignored then.
         with self.db:
             cur = self.db.cursor()
             search = []
@@ -2579,7 +3230,7 @@ class GenericBackend(DbSchemata):
                 search.append("Timestamp <= :endTime")
             search = " AND ".join(search)
             if search != '': search = "WHERE " + search
-            count = cur.execute("SELECT COUNT(*) FROM ChatHistory %(search)s" % locals(), locals()).fetchone()[0]
+            count = self.cachedCount(cur, "SELECT COUNT(*) FROM ChatHistory %(search)s" % locals(), locals())
             if limit is None:
                 limit = [1, count]
             limitOffset = limit[0]
@@ -2590,11 +3241,18 @@ class GenericBackend(DbSchemata):
                 limitOffset = 0
             else:
                 limitOffset -= 1 # position to index
+            if not after is None:
+                afterTimestamp = after[0]
+                afterChatHistoryId = after[1]
+                keyset = "(Timestamp < :afterTimestamp OR (Timestamp = :afterTimestamp AND ChatHistoryId < :afterChatHistoryId))"
+                search = (search + " AND " if search != '' else "WHERE ") + keyset
+                limitOffset = 0
             slimit = "LIMIT :limitNum OFFSET :limitOffset"
+            # the chat history id makes the order unique, which is needed for the keyset pagination
             cur.execute("""
-                SELECT Name, Timestamp, Content, PlayerId FROM ChatHistory NATURAL JOIN Players
+                SELECT Name, Timestamp, Content, PlayerId, ChatHistoryId FROM ChatHistory NATURAL JOIN Players
                 %(search)s
-                ORDER BY Timestamp DESC
+                ORDER BY Timestamp DESC, ChatHistoryId DESC
                 %(slimit)s
             """ % locals(), locals())
             desc = cur.description
@@ -2602,10 +3260,13 @@ class GenericBackend(DbSchemata):
             res = []
             for r in ans:
                 line = {}
-                for i,v in enumerate(r):
+                for i,v in enumerate(r[:-1]):
                     line[desc[i][0].lower()] = v
                 res.append(line)
-            return {'messages' : res, 'totalCount': count}
+            nextKey = None
+            if len(ans) == limitNum:
+                nextKey = (ans[-1][1], ans[-1][4])
+            return {'messages' : res, 'totalCount': count, 'nextKey': nextKey}
 
     def queryMR(self, guid, set_rating = None):
         with self.db:
@@ -2640,6 +3301,7 @@ class GenericBackend(DbSchemata):
                 else:
                     enabled = 0
                 cur.execute("UPDATE Players SET Anonymized = :enabled WHERE PlayerId = :pid", locals())
+                self.invalidateDimensionIds("Players")
                 if enabled:
                     acdebug("anon: update 2")
                     cur.execute("UPDATE Players SET Name = '<anonymized>' WHERE PlayerId = :pid", locals())
@@ -2649,6 +3311,8 @@ class GenericBackend(DbSchemata):
                 else:
                     acdebug("anon: update 3")
                     cur.execute("UPDATE Players SET Name = :name WHERE PlayerId = :pid", locals())
+                self.indexPlayerName(cur, pid)
+                self.bumpGeneration(cur, "Championships")
             acdebug("anon: get status")
             try:
                 status = cur.execute("SELECT Anonymized FROM Players WHERE SteamGuid = :guid", locals()).fetchone()
@@ -2656,45 +3320,95 @@ class GenericBackend(DbSchemata):
                 acerror(str(e))
             return status[0] if not status is None else True
 
-    def populate(self, other):
-        def arg_list(n):
-            return (','.join([':%d']*n)) % tuple(range(n))
+    def backupStart(self, backupName):
+        # online backups are supported by the sqlite backend only (see dbapsw.py)
+        raise NotImplementedError("Online backups are not supported for this database type.")
+
+    def populate(self, other, resume=False, chunkSize=10000):
+        # copy the contents of the other database into this one. The tables are streamed in chunks and
+        # each table is copied in its own transaction (parents before children), so an interrupted
+        # migration can be continued with resume=True; completely copied tables are skipped then.
+        with other.db:
+            other_cur = other.db.cursor()
+            tables = other.tables(cur=other_cur)
+        with self.db:
+            cur = self.db.cursor()
+            dependencies = self.tableDependencies(cur)
+            todo = []
+            for table in tables:
+                if cur.execute("SELECT 1 FROM " + table + " LIMIT 1").fetchone() is None:
+                    todo.append(table)
+                elif resume:
+                    acinfo("table %s has already been populated, skipping", table)
+                else:
+                    raise RuntimeError("Table %s is not empty. Cannot migrate to non-empty database!" % table)
+        t0 = time.time()
+        numRows = 0
+        for table in self.populateOrder(todo, dependencies):
+            numRows += self.populateTable(other, table, chunkSize)
+        with self.db:
+            cur = self.db.cursor()
+            self.postPopulate(cur)
+        self.invalidateDimensionIds()
+        self.invalidateBestTimes()
+        acinfo("populated %d rows in %.0f seconds", numRows, time.time()-t0)
+
+    def populateOrder(self, tables, dependencies):
+        # sort the tables such that referenced tables are populated before the referencing ones
+        # dependencies maps lower case table names to the set of lower case tables referenced
+        res = []
+        remaining = sorted(tables)
+        while len(remaining) > 0:
+            names = set([t.lower() for t in remaining])
+            ready = [t for t in remaining if len((dependencies.get(t.lower(), set()) - set([t.lower()])) & names) == 0]
+            if len(ready) == 0:
+                acwarning("cyclic foreign key references between tables %s", remaining)
+                ready = remaining
+            res.extend(ready)
+            remaining = [t for t in remaining if not t in ready]
+        return res
+
+    def populateTable(self, other, table, chunkSize):
         with other.db:
             other_cur = other.db.cursor()
+            total = other_cur.execute("SELECT COUNT(*) FROM " + table).fetchone()[0]
+            acinfo("populating %s (%d rows)", table, total)
             with self.db:
                 cur = self.db.cursor()
-                tables = other.tables(cur=other_cur)
-                for table in tables:
-                    if not (len(cur.execute("SELECT * FROM " + table).fetchall()) == 0):
-                        raise RuntimeError("Table %s is not empty. Cannot migrate to non-empty database!" % table)
                 self.deferr_foreign_key_constraints(cur)
-                for table in sorted(tables):
-                    acinfo("populating %s", table)
-                    other_cur.execute('SELECT * FROM ' + table)
-                    for row in other_cur.fetchall():
-                        # bypass the :<name> substitution
-                        stmt = 'INSERT INTO ' + table + ' VALUES(' + arg_list(len(row)) + ')'
-                        mrow = tuple(map(lambda x: [x, None][x == float('inf')], row))
-                        try:
-                            cur.execute(stmt, mrow)
-                        except:
-                            acerror("statement: %s", stmt)
-                            for i,p in enumerate(row):
-                                acerror("  parameter: type %s %s -> %s", type(p), repr(p), repr(mrow[i]))
-                            raise
-                self.postPopulate(cur)
+                t0 = time.time()
+                tlog = t0
+                n = 0
+                for rows in other.selectChunks(other_cur, "SELECT * FROM " + table, chunkSize):
+                    rows = [tuple(map(lambda x: [x, None][x == float('inf')], row)) for row in rows]
+                    try:
+                        self.insertRows(cur, table, rows)
+                    except:
+                        acerror("error while populating %s (rows %d to %d)", table, n, n+len(rows))
+                        raise
+                    n += len(rows)
+                    if time.time() - tlog > 10.:
+                        tlog = time.time()
+                        acinfo("  %s: %d/%d rows (%.0f%%), %.0f rows/s", table, n, total, n*100./max(1,total), n/(tlog-t0))
+            acinfo("  %s: %d rows in %.1f seconds", table, n, time.time()-t0)
+        return n
+
+    def selectChunks(self, cur, stmt, chunkSize):
+        # iterate over the result of stmt in lists of at most chunkSize rows
+        cur.execute(stmt)
+        while 1:
+            rows = cur.fetchmany(chunkSize)
+            if len(rows) == 0:
+                break
+            yield rows
+
+    def insertRows(self, cur, table, rows):
+        if len(rows) > 0:
+            # bypass the :<name> substitution
+            stmt = 'INSERT INTO ' + table + ' VALUES(' + (','.join([':%d']*len(rows[0])) % tuple(range(len(rows[0])))) + ')'
+            cur.executemany(stmt, rows)
 
     def compressDB(self, mode, steamGuid=None):
-        # create the compress index if not exists
-        try:
-            with self.db:
-                cur = self.db.cursor()
-                cur.execute("CREATE INDEX IdxCompressLapTime ON Lap(LapTime,PlayerInSessionId,Valid)")
-        except (KeyboardInterrupt, SystemExit):
-            raise
-        except:
-            # we assume that the index already exists
-            pass
         with self.db:
             cur = self.db.cursor()
             delete_time = unixtime_now() - 25 * 3600
@@ -2702,49 +3416,188 @@ class GenericBackend(DbSchemata):
             if mode == COMPRESS_DELETE_ALL:
                 tables = self.tables(cur)
                 # make sure we delete the foreign key tables first
-                tables = ["Lap", "PlayerInSession", "Session", "SetupDeposit", "ComboCars", "Combos"] + tables
+                tables = ["Leaderboard", "Lap", "PlayerInSession", "Session", "SetupDeposit", "ComboCars", "Combos"] + tables
+                # the change counters must not restart, cached results could be taken as valid otherwise
+                tables = [t for t in tables if not t.lower() in ["generations", "maintenancestate"]]
                 for t in tables:
                     cur.execute("DELETE FROM %(t)s" % locals())
+                # the maintenance positions are kept, but start over with the next run
+                cur.execute("UPDATE MaintenanceState SET Value=0")
+                self.bumpGeneration(cur, "Championships")
+                self.invalidateDimensionIds()
+                if not self.currentSession is None:
+                    self.currentSession.dbSessionId = None
             elif mode == COMPRESS_NULL_ALL_BINARY_BLOBS:
-                cur.execute("UPDATE LapBinBlob SET HistoryInfo = NULL")
+                cur.execute("UPDATE LapBinBlob SET %s" % HISTORY_INFO_SET_NULL)
             elif mode == COMPRESS_NULL_ALL_BINARY_BLOBS_EXCEPT_GUID:
-                cur.execute("UPDATE LapBinBlob SET HistoryInfo = NULL WHERE LapId NOT IN (SELECT LapId FROM LapTimes WHERE SteamGuid=:steamGuid)", locals())
-            elif mode == COMPRESS_NULL_SLOW_BINARY_BLOBS:
-                timenow = unixtime2datetime(unixtime_now())
-                thresh_1day = int(datetime2unixtime(timenow - datetime.timedelta(days=1)))
-                thresh_2days = int(datetime2unixtime(timenow - datetime.timedelta(days=2)))
-                thresh_5days = int(datetime2unixtime(timenow - datetime.timedelta(days=5)))
-                thresh_1wk = int(datetime2unixtime(timenow - datetime.timedelta(days=7)))
-                thresh_1month = int(datetime2unixtime(timenow - datetime.timedelta(days=31)))
-                thresh_1year = int(datetime2unixtime(timenow - datetime.timedelta(days=365)))
-                cur.execute("""
-                    WITH CompressHelper AS (
-                       SELECT MIN(LapTime) AS LapTime,
-                              PlayerInSession.PlayerId AS PlayerId,
-                              PlayerInSession.CarId AS CarId,
-                              Session.TrackId AS TrackId,
-                              Valid,
-                              CASE WHEN StartTimeDate >= :thresh_1day THEN 1
-                                   WHEN StartTimeDate >= :thresh_2days THEN 2
-                                   WHEN StartTimeDate >= :thresh_5days THEN 3
-                                   WHEN StartTimeDate >= :thresh_1wk THEN 4
-                                   WHEN StartTimeDate >= :thresh_1month THEN 5
-                                   WHEN StartTimeDate >= :thresh_1year THEN 6
-                                   ELSE 7
-                              END AS DateTimeClass
-                       FROM Lap JOIN PlayerInSession ON (Lap.PlayerInSessionId=PlayerInSession.PlayerInSessionId)
-                                JOIN Session ON (PlayerInSession.SessionId=Session.SessionId)
-                       GROUP BY PlayerId,CarId,TrackId,Valid,DateTimeClass
-                    )
-                    UPDATE LapBinBlob SET HistoryInfo=NULL
-                    WHERE LapId NOT IN (SELECT LapId FROM Lap NATURAL JOIN PlayerInSession
-                                                              NATURAL JOIN Session
-                                                              JOIN CompressHelper ON
-                                                                (CompressHelper.LapTime=Lap.LapTime AND
-                                                                 CompressHelper.PlayerId=PlayerInSession.PlayerId AND
-                                                                 CompressHelper.TrackId=Session.TrackId AND
-                                                                 CompressHelper.Valid=Lap.Valid))
-                """, locals())
+                cur.execute("UPDATE LapBinBlob SET %s WHERE LapId NOT IN (SELECT LapId FROM LapTimes WHERE SteamGuid=:steamGuid)" % HISTORY_INFO_SET_NULL, locals())
             self.postCompress(cur)
+        self.invalidateBestTimes()
+        if mode == COMPRESS_NULL_SLOW_BINARY_BLOBS:
+            # one complete pass, chunk by chunk
+            res = dict(lapIdTo=0, finished=False)
+            while not res['finished']:
+                res = self.compactHistoryInfos(10000, lapIdFrom=res['lapIdTo'])
         self.postCompress(None)
         return True
+
+    def compactHistoryInfos(self, chunkSize, lapIdFrom = None):
+        # null the history infos of the slow laps with lap ids in (lapIdFrom, lapIdFrom+chunkSize]. A lap is slow
+        # if the player has a faster lap with the same car, track and valid flag in the same age class.
+        # Without lapIdFrom, the chunk starts at the persisted position, which is advanced with every call and
+        # wraps around at the end of a pass.
+        with self.db:
+            cur = self.db.cursor()
+            persistent = lapIdFrom is None
+            if persistent:
+                lapIdFrom = self.maintenanceState(cur, "CompactHistoryInfos")
+            if lapIdFrom == 0:
+                delete_time = unixtime_now() - 25 * 3600
+                cur.execute("DELETE FROM MinoratingCache WHERE Timestamp < :delete_time", locals())
+            lapIdTo = lapIdFrom + chunkSize
+            timenow = unixtime2datetime(unixtime_now())
+            thresh_1day = int(datetime2unixtime(timenow - datetime.timedelta(days=1)))
+            thresh_2days = int(datetime2unixtime(timenow - datetime.timedelta(days=2)))
+            thresh_5days = int(datetime2unixtime(timenow - datetime.timedelta(days=5)))
+            thresh_1wk = int(datetime2unixtime(timenow - datetime.timedelta(days=7)))
+            thresh_1month = int(datetime2unixtime(timenow - datetime.timedelta(days=31)))
+            thresh_1year = int(datetime2unixtime(timenow - datetime.timedelta(days=365)))
+            ageClass = """
+                CASE WHEN Session.StartTimeDate >= :thresh_1day THEN 1
+                     WHEN Session.StartTimeDate >= :thresh_2days THEN 2
+                     WHEN Session.StartTimeDate >= :thresh_5days THEN 3
+                     WHEN Session.StartTimeDate >= :thresh_1wk THEN 4
+                     WHEN Session.StartTimeDate >= :thresh_1month THEN 5
+                     WHEN Session.StartTimeDate >= :thresh_1year THEN 6
+                     ELSE 7
+                END"""
+            hiNotNull = HISTORY_INFO_NOTNULL
+            ans = cur.execute("""
+                WITH ChunkLaps AS (
+                    SELECT Lap.LapId AS LapId,
+                           Lap.LapTime AS LapTime,
+                           COALESCE(LENGTH(LapBinBlob.HistoryInfo), LapBinBlob.BlobLength) AS NumBytes,
+                           PlayerInSession.PlayerId AS PlayerId,
+                           PlayerInSession.CarId AS CarId,
+                           Session.TrackId AS TrackId,
+                           Lap.Valid AS Valid,
+                           %(ageClass)s AS AgeClass
+                    FROM LapBinBlob JOIN Lap ON (Lap.LapId=LapBinBlob.LapId)
+                                    JOIN PlayerInSession ON (PlayerInSession.PlayerInSessionId=Lap.PlayerInSessionId)
+                                    JOIN Session ON (Session.SessionId=PlayerInSession.SessionId)
+                    WHERE LapBinBlob.LapId > :lapIdFrom AND LapBinBlob.LapId <= :lapIdTo AND %(hiNotNull)s
+                ), ChunkGroups AS (
+                    SELECT DISTINCT PlayerId, CarId, TrackId, Valid, AgeClass FROM ChunkLaps
+                ), ChunkBest AS (
+                    SELECT ChunkGroups.PlayerId AS PlayerId,
+                           ChunkGroups.CarId AS CarId,
+                           ChunkGroups.TrackId AS TrackId,
+                           ChunkGroups.Valid AS Valid,
+                           ChunkGroups.AgeClass AS AgeClass,
+                           MIN(Lap.LapTime) AS LapTime
+                    FROM ChunkGroups JOIN PlayerInSession ON (PlayerInSession.PlayerId=ChunkGroups.PlayerId AND
+                                                              PlayerInSession.CarId=ChunkGroups.CarId)
+                                     JOIN Session ON (Session.SessionId=PlayerInSession.SessionId AND
+                                                      Session.TrackId=ChunkGroups.TrackId)
+                                     JOIN Lap ON (Lap.PlayerInSessionId=PlayerInSession.PlayerInSessionId AND
+                                                  Lap.Valid=ChunkGroups.Valid)
+                    WHERE %(ageClass)s = ChunkGroups.AgeClass
+                    GROUP BY ChunkGroups.PlayerId, ChunkGroups.CarId, ChunkGroups.TrackId, ChunkGroups.Valid, ChunkGroups.AgeClass
+                )
+                SELECT ChunkLaps.LapId, ChunkLaps.NumBytes
+                FROM ChunkLaps LEFT JOIN ChunkBest ON (ChunkBest.PlayerId=ChunkLaps.PlayerId AND
+                                                       ChunkBest.CarId=ChunkLaps.CarId AND
+                                                       ChunkBest.TrackId=ChunkLaps.TrackId AND
+                                                       ChunkBest.Valid=ChunkLaps.Valid AND
+                                                       ChunkBest.AgeClass=ChunkLaps.AgeClass)
+                WHERE ChunkLaps.LapTime IS NULL OR ChunkLaps.LapTime > ChunkBest.LapTime
+            """ % locals(), locals()).fetchall()
+            nulled = len(ans)
+            numBytes = sum([a[1] for a in ans])
+            if nulled > 0:
+                lapIds = ",".join([str(a[0]) for a in ans])
+                cur.execute("UPDATE LapBinBlob SET %s WHERE LapId IN (%s)" % (HISTORY_INFO_SET_NULL, lapIds))
+            maxLapId = cur.execute("SELECT MAX(LapId) FROM LapBinBlob").fetchone()[0]
+            finished = maxLapId is None or lapIdTo >= maxLapId
+            if persistent:
+                self.setMaintenanceState(cur, "CompactHistoryInfos", 0 if finished else lapIdTo)
+            freed = self.incrementalVacuum(cur)
+        if nulled > 0:
+            # the cached best laps include the history infos
+            self.bestTimesCache.invalidate(lambda k: k[0] == "BestLap")
+        return dict(lapIdFrom=lapIdFrom, lapIdTo=lapIdTo, finished=finished, nulled=nulled, bytes=numBytes, freed=freed)
+
+    @pinsBlobSegments
+    def compactBlobStore(self, chunkSize, minLiveRatio = 0.5):
+        # one step of the blob store maintenance, returns finished=True when there is nothing left to do:
+        # - history infos still stored in the database are moved to the blob store (chunkSize per step)
+        # - segments which don't contain live blobs anymore (because compressDB / compactHistoryInfos nulled
+        #   the references or the laps have been deleted) are removed
+        # - the live blobs of one sparse segment (less than minLiveRatio live bytes) are copied to the active
+        #   segment, the old segment is removed after the references have been committed. A sparse active
+        #   segment is sealed first.
+        res = dict(finished=True, externalized=0, moved=0, removed=0, freed=0)
+        if self.blobStore is None:
+            return res
+        compacted = None
+        # segments written after this point might contain blobs which are not in the live set
+        writtenBefore = self.blobStore.writeSequence()
+        with self.db:
+            cur = self.db.cursor()
+            ans = cur.execute("""
+                SELECT LapBinBlobId, HistoryInfo FROM LapBinBlob WHERE HistoryInfo NOTNULL LIMIT :chunkSize
+            """, locals()).fetchall()
+            for lapBinBlobId, historyInfo in ans:
+                blobSegment, blobOffset, blobLength, blobHash = self.storeHistoryInfo(cur, historyInfo)
+                cur.execute("""
+                    UPDATE LapBinBlob SET HistoryInfo=NULL, BlobSegment=:blobSegment, BlobOffset=:blobOffset,
+                                          BlobLength=:blobLength, BlobHash=:blobHash
+                    WHERE LapBinBlobId=:lapBinBlobId
+                """, locals())
+            if len(ans) > 0:
+                res['externalized'] = len(ans)
+                res['finished'] = False
+                res['freed'] = self.incrementalVacuum(cur)
+                return res
+            live = dict(cur.execute("""
+                SELECT BlobSegment, SUM(BlobLength)
+                FROM (SELECT DISTINCT BlobSegment, BlobOffset, BlobLength FROM LapBinBlob WHERE BlobSegment NOTNULL) AS LiveBlobs
+                GROUP BY BlobSegment
+            """).fetchall())
+            activeSegment = self.blobStore.currentSegment()
+            if not activeSegment is None and live.get(activeSegment, 0) < minLiveRatio*self.blobStore.segmentSize(activeSegment):
+                self.blobStore.seal()
+                activeSegment = self.blobStore.currentSegment()
+            for segment in self.blobStore.segments():
+                if segment == activeSegment:
+                    continue
+                size = self.blobStore.segmentSize(segment)
+                if not segment in live:
+                    if self.blobStore.remove(segment, writtenBefore):
+                        res['removed'] += 1
+                        res['freed'] += size
+                    continue
+                if live[segment] >= minLiveRatio*size:
+                    continue
+                ans = cur.execute("""
+                    SELECT DISTINCT BlobOffset, BlobLength, BlobHash FROM LapBinBlob WHERE BlobSegment=:segment
+                """, locals()).fetchall()
+                for blobOffset, blobLength, blobHash in ans:
+                    historyInfo = self.blobStore.get(segment, blobOffset, blobLength, blobHash)
+                    if historyInfo is None:
+                        # unreadable, the references are dropped
+                        cur.execute("UPDATE LapBinBlob SET %s WHERE BlobSegment=:segment AND BlobOffset=:blobOffset" % HISTORY_INFO_SET_NULL, locals())
+                        continue
+                    newSegment, newOffset, blobLength, blobHash = self.blobStore.put(historyInfo)
+                    cur.execute("""
+                        UPDATE LapBinBlob SET BlobSegment=:newSegment, BlobOffset=:newOffset
+                        WHERE BlobSegment=:segment AND BlobOffset=:blobOffset
+                    """, locals())
+                res['moved'] = len(ans)
+                res['finished'] = False
+                compacted = (segment, size)
+                break
+        if not compacted is None and self.blobStore.remove(compacted[0], writtenBefore):
+            res['removed'] += 1
+            res['freed'] += compacted[1]
+        return res
@@ -21,10 +21,15 @@
 ################################################################################
 import os.path
 import re
+import io
+import time
+import binascii
 import traceback
 from ptracker_lib.helpers import *
 from ptracker_lib.constants import *
 from ptracker_lib.dbgeneric import GenericBackend
+from ptracker_lib.profiler import queryProfiler
+from ptracker_lib.lrucache import LruCache
 from ptracker_lib.dbapsw import SqliteBackend # for backup support
 
 try:
@@ -40,8 +45,10 @@ if postgresqlSupport:
 
     class MySQLCurWrapper:
         regexp = re.compile(r':([a-zA-Z_0-9]+)')
-        def __init__(self, cur):
+        def __init__(self, cur, statements):
             self.cur = cur
+            # statement -> (translated statement, parameter names), shared by the cursors of the connection
+            self.statements = statements
 
         def __getattr__(self, a):
             if a == "lastrowid":
@@ -51,11 +58,11 @@ if postgresqlSupport:
                 return self.cur.description
             return self.__dict__[a]
 
-        def execute(self, stmt, kw={}):
-            #acinfo("old statement:" + stmt)
+        def translate(self, stmt):
+            # convert the :name parameters to the psycopg2 syntax, :0, :1, ... are positional parameters
             rest = stmt
             nstmt = ""
-            nkw = None
+            params = []
             while 1:
                 M = self.regexp.search(rest)
                 if M is None:
@@ -63,15 +70,34 @@ if postgresqlSupport:
                 v = M.group(1)
                 try:
                     v = int(v)
-                    # positional parameters
-                    if nkw is None: nkw = []
                     replacement = '%s'
-                    nkw.append(kw[v])
-                except:
-                    # keyword parameters
-                    myassert(type(kw) == type({}))
-                    if nkw is None:
-                        nkw = {}
+                except ValueError:
+                    replacement = r'%%(%s)s' % v
+                params.append(v)
+                nstmt += rest[:M.start()] + replacement
+                rest = rest[M.end():]
+            nstmt += rest
+            return nstmt, params
+
+        def lookup(self, stmt):
+            # returns hit, (translated statement, parameter names)
+            hit, translated = self.statements.lookup(stmt)
+            if not hit:
+                translated = self.translate(stmt)
+                self.statements.put(stmt, translated)
+            return hit, translated
+
+        def arguments(self, params, kw):
+            if len(params) == 0:
+                return kw
+            elif type(params[0]) == int:
+                # positional parameters
+                return [kw[v] for v in params]
+            else:
+                # keyword parameters
+                myassert(type(kw) == type({}))
+                nkw = {}
+                for v in params:
                     if v in kw:
                         p = kw[v]
                         if type(p) == type(True):
@@ -80,18 +106,37 @@ if postgresqlSupport:
                         nkw[v] = p
                     else:
                         acwarning("%s is not in supplued keyword arguments :-/", v)
-                    replacement = r'%%(%s)s' % v
-                nstmt += rest[:M.start()] + replacement
-                rest = rest[M.end():]
-            nstmt += rest
-            if nkw is None:
-                nkw = kw
-            #acinfo("new statement:" + nstmt)
+                return nkw
+
+        def execute(self, stmt, kw={}):
+            t = time.time()
+            hit, translated = self.lookup(stmt)
+            prepareTime = time.time() - t
+            nstmt, params = translated
+            nkw = self.arguments(params, kw)
             try:
                 self.cur.execute(nstmt, nkw)
             except:
                 acdebug("exception on postgresql sql statement. Statement:\n%s\narguments:\n%s\n", nstmt, nkw)
                 raise
+            # the result is transferred by execute, so the fetch time is negligible; lock waits are not visible here.
+            # psycopg2 sends the statements with the parameters interpolated, so preparing is the translation above.
+            queryProfiler.record(stmt, time.time() - t, self.cur.rowcount if not self.cur.description is None else 0,
+                                 prepared=not hit, prepareTime=None if hit else prepareTime)
+            return self
+
+        def executemany(self, stmt, rows):
+            t = time.time()
+            hit, translated = self.lookup(stmt)
+            prepareTime = time.time() - t
+            nstmt, params = translated
+            nrows = [self.arguments(params, kw) for kw in rows]
+            try:
+                self.cur.executemany(nstmt, nrows)
+            except:
+                acdebug("exception on postgresql sql statement. Statement:\n%s\n%d rows\n", nstmt, len(nrows))
+                raise
+            queryProfiler.record(stmt, time.time() - t, 0, prepared=not hit, prepareTime=None if hit else prepareTime)
             return self
 
         def fetchone(self):
@@ -100,6 +145,9 @@ if postgresqlSupport:
         def fetchall(self):
             return self.cur.fetchall()
 
+        def __iter__(self):
+            return iter(self.cur)
+
         def __enter__(self):
             return self.cur.__enter__()
 
@@ -107,8 +155,9 @@ if postgresqlSupport:
             return self.cur.__exit__(type, value, tb)
 
     class MySQLConWrapper:
-        def __init__(self, db):
+        def __init__(self, db, statementCacheSize):
             self.db = db
+            self.statements = LruCache(statementCacheSize)
 
         def __enter__(self):
             return self.db.__enter__()
@@ -117,7 +166,7 @@ if postgresqlSupport:
             return self.db.__exit__(type, value, tb)
 
         def cursor(self):
-            return MySQLCurWrapper(self.db.cursor())
+            return MySQLCurWrapper(self.db.cursor(), self.statements)
 
         def commit(self):
             return self.db.commit()
@@ -127,13 +176,27 @@ if postgresqlSupport:
 
 
     class PostgresqlBackend(GenericBackend):
+        # other stracker instances might register laps in the same database, their laps do not invalidate our cache
+        bestTimesCacheMaxAge = 10.
+        # number of translated statements cached per connection
+        statementCacheSize = 200
 
-        def __init__(self, lapHistoryFactory, user, host, password, database, perform_backups, force_version=None):
+        def __init__(self, lapHistoryFactory, user, host, password, database, perform_backups, force_version=None, readonly=False, concurrentReaders=False, blobStoreDir=None):
+            # read only backends just use a separate connection; postgres' read only transactions would forbid the temporary tables used in the queries
             db = psycopg2.connect(user=user, password=password, host=host, database=database)
+            if readonly:
+                perform_backups = False
             self.blob = "BYTEA"
             self.primkey = "SERIAL PRIMARY KEY"
             self.nullslast = "NULLS LAST"
-            GenericBackend.__init__(self, lapHistoryFactory, MySQLConWrapper(db), perform_backups, force_version=force_version)
+            # the values of IN lists are passed as one array parameter, see GenericBackend.inList
+            self.listSelect = "SELECT UNNEST(:%s) AS value"
+            self.listParam = list
+            self.connectionIdentity = ("postgresql", host, database)
+            GenericBackend.__init__(self, lapHistoryFactory, MySQLConWrapper(db, self.statementCacheSize), perform_backups, force_version=force_version, blobStoreDir=blobStoreDir)
+
+        def cacheIdentity(self):
+            return self.connectionIdentity
 
         def selectOrderedAggregate(self, non_agg_field, agg_field, agg_field_name, table_name):
             return "SELECT %(non_agg_field)s, array_to_string(array_agg(%(agg_field)s ORDER BY %(agg_field)s), ',') AS %(agg_field_name)s FROM %(table_name)s GROUP BY %(non_agg_field)s" % locals()
@@ -195,6 +258,50 @@ if postgresqlSupport:
         def deferr_foreign_key_constraints(self, cur):
             cur.execute("SET CONSTRAINTS ALL DEFERRED")
 
+        def tableDependencies(self, cur):
+            cur.execute("""
+                SELECT TC.table_name, CCU.table_name
+                FROM information_schema.table_constraints AS TC
+                     JOIN information_schema.constraint_column_usage AS CCU ON (TC.constraint_name = CCU.constraint_name)
+                WHERE TC.constraint_type = 'FOREIGN KEY' AND TC.table_schema = 'public'
+            """)
+            res = {}
+            for table, parent in cur.fetchall():
+                res.setdefault(table.lower(), set()).add(parent.lower())
+            return res
+
+        def selectChunks(self, cur, stmt, chunkSize):
+            # server side cursor, otherwise psycopg2 transfers the complete result at once
+            c = self.db.db.cursor(name="select_chunks")
+            c.itersize = chunkSize
+            try:
+                c.execute(stmt)
+                while 1:
+                    rows = c.fetchmany(chunkSize)
+                    if len(rows) == 0:
+                        break
+                    yield rows
+            finally:
+                c.close()
+
+        def insertRows(self, cur, table, rows):
+            # bulk load using COPY (text format)
+            def copyValue(v):
+                if v is None:
+                    return r"\N"
+                if type(v) in [bytes, bytearray, memoryview]:
+                    return r"\\x" + binascii.hexlify(bytes(v)).decode('ascii')
+                if type(v) == type(True) or (type(v) == float and v.is_integer()):
+                    # integral floats might come from sqlite's dynamic typing; '3.0' is no valid integer input
+                    v = int(v)
+                return str(v).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+            buf = io.StringIO()
+            for row in rows:
+                buf.write("\t".join(map(copyValue, row)))
+                buf.write("\n")
+            buf.seek(0)
+            cur.cur.copy_expert("COPY " + table + " FROM STDIN", buf)
+
         def postPopulate(self, cur):
             cur.execute(r"""
                 SELECT 'SELECT SETVAL(' ||
@@ -223,6 +330,10 @@ if postgresqlSupport:
         def postCompress(self, cur):
             pass
 
+        def incrementalVacuum(self, cur):
+            # postgres' autovacuum takes care of the dead rows
+            return 0
+
 
 if __name__ == "__main__":
     # basic db testing (postgres and sqlite)
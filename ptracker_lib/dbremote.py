@@ -27,6 +27,7 @@ import ptracker_lib
 from threading import Thread,RLock
 from ptracker_lib import dbgeneric
 from ptracker_lib.ps_protocol import ProtocolHandler
+from ptracker_lib.lrucache import LruCache
 from ptracker_lib.helpers import *
 from ptracker_lib.config import config
 
@@ -47,6 +48,8 @@ def reconnectOnError(f):
 
 
 class PtrackerClient:
+    # number of pts answers kept for revalidation with their etags
+    ptsCacheSize = 100
 
     def __init__(self, server_address, server_port, guid):
         server_overrides = config.GLOBAL.override_stracker_server.split(",")
@@ -73,7 +76,7 @@ class PtrackerClient:
         self.thread = None
         self.ptsReplies = Queue()
         self.mapAnsIdsToUrls = {}
-        self.url_cache = {}
+        self.url_cache = LruCache(self.ptsCacheSize)
         self.connectionInProgress = False
         self.initialConnectThread = Thread(target=self.connect, daemon=True)
         self.initialConnectThread.start()
@@ -94,7 +97,7 @@ class PtrackerClient:
         self.lastKnownGoodPort = p
         acinfo("Connected to %s:%d" % (self.server_address,p))
         self.sock.settimeout(20.)
-        self.url_cache = {}
+        # the cached pts answers are kept, they are revalidated by their etags
 
     def connect(self):
         if self.isOnline():
@@ -183,7 +186,7 @@ class PtrackerClient:
             self.thread.join()
             self.thread = None
         if self.proto: self.proto.shutdown()
-        self.url_cache = {}
+        self.url_cache = LruCache(self.ptsCacheSize)
         acinfo("Client shut down ok")
 
     @reconnectOnError
@@ -325,35 +328,39 @@ class PtrackerClient:
     @reconnectOnError
     def getPtsResponse(self, url):
         with self.lock:
-            if url in self.url_cache:
-                res = self.url_cache[url]
-                tmp = (res[0], res[1], res[2], time.time())
-                self.memoizePtsAnswer(tmp, url)
-                res = res[3]
-                acinfo("PtsRequest[cache(%d/%d)]: %s", len(self.url_cache), len(self.mapAnsIdsToUrls), url)
+            # a cached answer is revalidated with its etag, the server answers PTS_NOT_MODIFIED if it is still valid
+            hit, cached = self.url_cache.lookup(url)
+            etag = cached[4] if hit else ""
             try:
-                self.proto.req_post_pts_request(url = url)
+                self.proto.req_post_pts_request(url = url, etag = etag)
                 res = self.getAnswer(self.proto.ANS_POST_PTS_REQUEST)
                 self.mapAnsIdsToUrls[res] = url
                 acinfo("PtsRequest[protv=13]: %s", url)
             except NotImplementedError:
-                self.proto.req_get_pts_response(url = url)
+                self.proto.req_get_pts_response(url = url, etag = etag)
                 res = self.getAnswer(self.proto.ANS_GET_PTS_RESPONSE)
                 acinfo("PtsRequest[protv=12]: %s", url)
-                tmp = (res[0], res[1], res[2], time.time())
+                tmp = (res[0], res[1], res[2], time.time(), res[3])
                 self.memoizePtsAnswer(tmp, url)
                 res = tmp[3]
             return res
 
     def memoizePtsAnswer(self, ptsReply, url = None):
+        # ptsReply is (content, content type, cacheable, answer id, etag)
         if url is None:
             url = self.mapAnsIdsToUrls.get(ptsReply[3], None)
             if url is None:
                 acwarning("Cannot find ptsReply ID in mapAnsIdsToUrls.")
             else:
                 del self.mapAnsIdsToUrls[ptsReply[3]]
-        if ptsReply[2] and not url is None:
-            self.url_cache[url] = ptsReply
+        if ptsReply[1] == ProtocolHandler.PTS_NOT_MODIFIED:
+            hit, cached = self.url_cache.lookup(url)
+            if hit:
+                ptsReply = (cached[0], cached[1], cached[2], ptsReply[3], cached[4])
+            else:
+                acwarning("Cached pts answer of %s is not available anymore.", url)
+        if (ptsReply[2] or ptsReply[4] != "") and not url is None:
+            self.url_cache.put(url, ptsReply)
         self.ptsReplies.put(ptsReply)
 
 class RemoteBackend:
@@ -397,7 +404,9 @@ class RemoteBackend:
             myassert(ans['ok'] == 1)
             self.registered = 1
         acdebug("send_lap_info")
-        lhCompressed = dbgeneric.compress(lapHistory.sampleTimes, lapHistory.worldPositions, lapHistory.velocities, lapHistory.normSplinePositions, minDt=1.)
+        # use the legacy history info format on the wire, older stracker versions cannot decode the newer ones
+        lhCompressed = dbgeneric.compress(lapHistory.sampleTimes, lapHistory.worldPositions, lapHistory.velocities, lapHistory.normSplinePositions, minDt=1.,
+                                          version=dbgeneric.HISTORY_INFO_LEGACY)
         ans = self.client.send_lap_info(lapHistory.lapTime, lapHistory.sectorTimes, lapHistory.sectorsAreSoftSplits,
                                         tyre, valid, lhCompressed, staticAssists, dynamicAssists, maxSpeed,
                                         timeInPitLane, timeInPit, escKeyPressed, ballast, fuelRatio)
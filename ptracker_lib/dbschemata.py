@@ -23,6 +23,14 @@ import time
 
 from ptracker_lib.helpers import *
 
+def nameTrigrams(name):
+    # the distinct lower case trigrams of a player name; a name contains a search pattern of at least
+    # 3 characters only if it contains all trigrams of the pattern
+    if name is None:
+        return []
+    name = name.lower()
+    return sorted(set([name[i:i+3] for i in range(len(name)-2)]))
+
 class DbSchemata:
     def __init__(self, lapHistoryFactory, db, perform_backups, force_version = None):
         self.lapHistoryFactory = lapHistoryFactory
@@ -33,7 +41,7 @@ class DbSchemata:
         if not force_version is None:
             self.version = force_version
         else:
-            self.version = 24
+            self.version = 33
             if version < self.version and perform_backups:
                 print("Performing database backup before migration. This might take a while. You'd better not interrupt this process.")
                 self.backup(version, self.version)
@@ -1583,3 +1591,232 @@ class DbSchemata:
             cur.execute("UPDATE Players SET SteamGuid = :guid WHERE PlayerId = :pid", locals())
         cur.execute("ALTER TABLE Players ADD COLUMN Anonymized INTEGER")
         self.setVersion(cur, 24)
+
+    def migrate_24_25(self):
+        cur = self.db.cursor()
+        # persistent leaderboard: best lap per track / car / player / valid flag,
+        # maintained by registerLap and modifyLap
+        cur.execute("""
+            CREATE TABLE Leaderboard(
+                LeaderboardId %(primkey)s,
+                TrackId INTEGER,
+                CarId INTEGER,
+                PlayerId INTEGER,
+                Valid INTEGER,
+                LapTime INTEGER,
+                LapId INTEGER,
+                NumLaps INTEGER,
+                FOREIGN KEY (TrackId) REFERENCES Tracks(TrackId) DEFERRABLE,
+                FOREIGN KEY (CarId) REFERENCES Cars(CarId) DEFERRABLE,
+                FOREIGN KEY (PlayerId) REFERENCES Players(PlayerId) DEFERRABLE,
+                FOREIGN KEY (LapId) REFERENCES Lap(LapId) DEFERRABLE
+            )
+        """ % self.__dict__)
+        cur.execute("CREATE UNIQUE INDEX LeaderboardUniqueIndex ON Leaderboard(TrackId,CarId,PlayerId,Valid)")
+        cur.execute("CREATE INDEX LeaderboardRankIndex ON Leaderboard(TrackId,CarId,Valid,LapTime)")
+        self.rebuildLeaderboard(cur)
+        self.setVersion(cur, 25)
+        acinfo("Migrated from db version 24 to 25.")
+
+    def migrate_25_26(self):
+        cur = self.db.cursor()
+        # the lap details join the binary blobs by lap id
+        cur.execute("CREATE INDEX LapBinBlobLapId ON LapBinBlob(LapId)")
+        self.setVersion(cur, 26)
+        acinfo("Migrated from db version 25 to 26.")
+
+    def migrate_26_27(self):
+        cur = self.db.cursor()
+        # daily rollups for the statistics page, maintained by registerLap
+        # laps and latest session start per day / server / combo / car
+        cur.execute("""
+            CREATE TABLE StatsDaily(
+                StatsDailyId %(primkey)s,
+                Day INTEGER,
+                ServerIpPort TEXT,
+                ComboId INTEGER,
+                TrackId INTEGER,
+                CarId INTEGER,
+                NumLaps INTEGER,
+                LastStart INTEGER
+            )
+        """ % self.__dict__)
+        cur.execute("CREATE UNIQUE INDEX StatsDailyUniqueIndex ON StatsDaily(Day,ServerIpPort,ComboId,TrackId,CarId)")
+        # players seen per day / server / track / car
+        cur.execute("""
+            CREATE TABLE StatsDailyPlayers(
+                StatsDailyPlayersId %(primkey)s,
+                Day INTEGER,
+                ServerIpPort TEXT,
+                TrackId INTEGER,
+                CarId INTEGER,
+                PlayerId INTEGER
+            )
+        """ % self.__dict__)
+        cur.execute("CREATE UNIQUE INDEX StatsDailyPlayersUniqueIndex ON StatsDailyPlayers(Day,ServerIpPort,TrackId,CarId,PlayerId)")
+        # the partial days at the borders of a statistics range are counted from the lap table
+        cur.execute("CREATE INDEX LapPlayerInSessionId ON Lap(PlayerInSessionId)")
+        self.rebuildStatsDaily(cur)
+        self.setVersion(cur, 27)
+        acinfo("Migrated from db version 26 to 27.")
+
+    def migrate_27_28(self):
+        cur = self.db.cursor()
+        # change counters of derived data, cached results are valid as long as the counter is unchanged
+        cur.execute("""
+            CREATE TABLE Generations(
+                Name TEXT,
+                Generation INTEGER
+            )
+        """)
+        cur.execute("CREATE UNIQUE INDEX GenerationsUniqueIndex ON Generations(Name)")
+        self.setVersion(cur, 28)
+        acinfo("Migrated from db version 27 to 28.")
+
+    def migrate_28_29(self):
+        cur = self.db.cursor()
+        # persisted positions of the incremental maintenance tasks
+        cur.execute("""
+            CREATE TABLE MaintenanceState(
+                Name TEXT,
+                Value INTEGER
+            )
+        """)
+        cur.execute("CREATE UNIQUE INDEX MaintenanceStateUniqueIndex ON MaintenanceState(Name)")
+        # the history info compaction works on lap id ranges and doesn't need this index anymore
+        cur.execute("DROP INDEX IF EXISTS IdxCompressLapTime")
+        self.setVersion(cur, 29)
+        acinfo("Migrated from db version 28 to 29.")
+
+    def migrate_29_30(self):
+        cur = self.db.cursor()
+        # reference of history infos stored outside the database (see blobstore.py); HistoryInfo is NULL then
+        cur.execute("ALTER TABLE LapBinBlob ADD COLUMN BlobSegment INTEGER")
+        cur.execute("ALTER TABLE LapBinBlob ADD COLUMN BlobOffset INTEGER")
+        cur.execute("ALTER TABLE LapBinBlob ADD COLUMN BlobLength INTEGER")
+        cur.execute("ALTER TABLE LapBinBlob ADD COLUMN BlobHash TEXT")
+        cur.execute("CREATE INDEX LapBinBlobSegment ON LapBinBlob(BlobSegment, BlobOffset)")
+        cur.execute("CREATE INDEX LapBinBlobHash ON LapBinBlob(BlobHash)")
+        self.setVersion(cur, 30)
+        acinfo("Migrated from db version 29 to 30.")
+
+    def migrate_30_31(self):
+        cur = self.db.cursor()
+        # trigram index of the player names for the substring search, maintained by indexPlayerName
+        cur.execute("""
+            CREATE TABLE PlayerNameTrigrams(
+                Trigram TEXT,
+                PlayerId INTEGER,
+                FOREIGN KEY (PlayerId) REFERENCES Players(PlayerId) DEFERRABLE
+            )
+        """)
+        cur.execute("CREATE UNIQUE INDEX PlayerNameTrigramsUniqueIndex ON PlayerNameTrigrams(Trigram,PlayerId)")
+        cur.execute("CREATE INDEX PlayerNameTrigramsPlayerId ON PlayerNameTrigrams(PlayerId)")
+        self.rebuildPlayerNameTrigrams(cur)
+        self.setVersion(cur, 31)
+        acinfo("Migrated from db version 30 to 31.")
+
+    def migrate_31_32(self):
+        cur = self.db.cursor()
+        # indices for the keyset pagination of the chat log (ordered by timestamp and id)
+        cur.execute("CREATE INDEX ChatHistoryTimestamp ON ChatHistory(Timestamp, ChatHistoryId)")
+        cur.execute("CREATE INDEX ChatHistoryServerTimestamp ON ChatHistory(Server, Timestamp, ChatHistoryId)")
+        self.setVersion(cur, 32)
+        acinfo("Migrated from db version 31 to 32.")
+
+    def migrate_32_33(self):
+        cur = self.db.cursor()
+        # idempotency keys of the sessions and laps replayed from the lap spool (see stracker_lib/lap_spool.py)
+        cur.execute("""
+            CREATE TABLE IdempotencyKeys(
+                IdempotencyKey TEXT,
+                ObjectId INTEGER,
+                Timestamp INTEGER
+            )
+        """)
+        cur.execute("CREATE UNIQUE INDEX IdempotencyKeysUniqueIndex ON IdempotencyKeys(IdempotencyKey)")
+        cur.execute("CREATE INDEX IdempotencyKeysTimestamp ON IdempotencyKeys(Timestamp)")
+        self.setVersion(cur, 33)
+        acinfo("Migrated from db version 32 to 33.")
+
+    def rebuildPlayerNameTrigrams(self, cur):
+        # recalculate the trigram index from the Players table
+        cur.execute("DELETE FROM PlayerNameTrigrams")
+        players = cur.execute("SELECT PlayerId, Name FROM Players").fetchall()
+        rows = []
+        for playerId, name in players:
+            rows.extend([(t, playerId) for t in nameTrigrams(name)])
+            if len(rows) >= 10000:
+                self.insertRows(cur, "PlayerNameTrigrams", rows)
+                rows = []
+        self.insertRows(cur, "PlayerNameTrigrams", rows)
+
+    def rebuildStatsDaily(self, cur):
+        # recalculate the daily statistic rollups from the Session, PlayerInSession and Lap tables
+        # sessions are accounted to the day of their start time (UTC)
+        cur.execute("DELETE FROM StatsDaily")
+        cur.execute("""
+            INSERT INTO StatsDaily(Day, ServerIpPort, ComboId, TrackId, CarId, NumLaps, LastStart)
+            SELECT Session.StartTimeDate/(60*60*24) AS Day,
+                   COALESCE(Session.ServerIpPort, '') AS ServerIpPort,
+                   Session.ComboId,
+                   Session.TrackId,
+                   PlayerInSession.CarId,
+                   COUNT(Lap.LapId),
+                   MAX(Session.StartTimeDate)
+            FROM Session JOIN PlayerInSession ON (PlayerInSession.SessionId=Session.SessionId)
+                         LEFT JOIN Lap ON (Lap.PlayerInSessionId=PlayerInSession.PlayerInSessionId)
+            GROUP BY Day, COALESCE(Session.ServerIpPort, ''), Session.ComboId, Session.TrackId, PlayerInSession.CarId
+        """)
+        cur.execute("DELETE FROM StatsDailyPlayers")
+        cur.execute("""
+            INSERT INTO StatsDailyPlayers(Day, ServerIpPort, TrackId, CarId, PlayerId)
+            SELECT DISTINCT
+                   Session.StartTimeDate/(60*60*24),
+                   COALESCE(Session.ServerIpPort, ''),
+                   Session.TrackId,
+                   PlayerInSession.CarId,
+                   PlayerInSession.PlayerId
+            FROM Session JOIN PlayerInSession ON (PlayerInSession.SessionId=Session.SessionId)
+        """)
+
+    def rebuildLeaderboard(self, cur, trackId = None, carId = None, playerId = None):
+        # recalculate the leaderboard entries from the Lap table, optionally restricted to
+        # a track / car / player
+        lb_cond = []
+        lap_cond = []
+        if not trackId is None:
+            lb_cond.append("TrackId = :trackId")
+            lap_cond.append("Session.TrackId = :trackId")
+        if not carId is None:
+            lb_cond.append("CarId = :carId")
+            lap_cond.append("PlayerInSession.CarId = :carId")
+        if not playerId is None:
+            lb_cond.append("PlayerId = :playerId")
+            lap_cond.append("PlayerInSession.PlayerId = :playerId")
+        if len(lb_cond) > 0:
+            lb_cond = "WHERE " + " AND ".join(lb_cond)
+            lap_cond = "WHERE " + " AND ".join(lap_cond)
+        else:
+            lb_cond = ""
+            lap_cond = ""
+        cur.execute("DELETE FROM Leaderboard %(lb_cond)s" % locals(), locals())
+        cur.execute("""
+            INSERT INTO Leaderboard(TrackId, CarId, PlayerId, Valid, LapTime, LapId, NumLaps)
+            SELECT Best.TrackId, Best.CarId, Best.PlayerId, Best.Valid, Best.LapTime, MAX(Lap.LapId), Best.NumLaps
+            FROM (SELECT Session.TrackId AS TrackId,
+                         PlayerInSession.CarId AS CarId,
+                         PlayerInSession.PlayerId AS PlayerId,
+                         Lap.Valid AS Valid,
+                         MIN(Lap.LapTime) AS LapTime,
+                         COUNT(Lap.LapId) AS NumLaps
+                  FROM Lap JOIN PlayerInSession ON (Lap.PlayerInSessionId=PlayerInSession.PlayerInSessionId)
+                           JOIN Session ON (PlayerInSession.SessionId=Session.SessionId)
+                  %(lap_cond)s
+                  GROUP BY Session.TrackId, PlayerInSession.CarId, PlayerInSession.PlayerId, Lap.Valid) AS Best
+                 JOIN PlayerInSession ON (PlayerInSession.PlayerId=Best.PlayerId AND PlayerInSession.CarId=Best.CarId)
+                 JOIN Session ON (PlayerInSession.SessionId=Session.SessionId AND Session.TrackId=Best.TrackId)
+                 JOIN Lap ON (Lap.PlayerInSessionId=PlayerInSession.PlayerInSessionId AND
+                              Lap.LapTime=Best.LapTime AND Lap.Valid=Best.Valid)
+            GROUP BY Best.TrackId, Best.CarId, Best.PlayerId, Best.Valid, Best.LapTime, Best.NumLaps
+        """ % locals(), locals())
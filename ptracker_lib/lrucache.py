@@ -0,0 +1,91 @@
+# Copyright 2015-2016 NEYS
+# This file is part of sptracker.
+#
+#    sptracker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sptracker is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+
+################################################################################
+# Never Eat Yellow Snow APPS - ptracker
+#
+# This file is part of the ptracker project. See ptracker.py for details.
+################################################################################
+
+# Thread safe, size bounded cache with least recently used eviction.
+#
+# Results computed from the database must not be stored if an invalidation happened during the
+# computation (the result might be based on the old data). Therefore the epoch is read before the
+# computation and passed to put(); every invalidation increments the epoch.
+
+import time
+import threading
+from collections import OrderedDict
+
+class LruCache:
+    def __init__(self, maxEntries, maxAge = None):
+        self.maxEntries = maxEntries
+        # optional maximum age of the entries [s]
+        self.maxAge = maxAge
+        self.lock = threading.Lock()
+        # key -> (timestamp, value), least recently used first
+        self.entries = OrderedDict()
+        self.epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def lookup(self, key):
+        # returns (True, value) if the key is cached, (False, None) otherwise
+        with self.lock:
+            e = self.entries.get(key, None)
+            if not e is None and not self.maxAge is None and time.time() - e[0] > self.maxAge:
+                del self.entries[key]
+                e = None
+            if e is None:
+                self.misses += 1
+                return (False, None)
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return (True, e[1])
+
+    def put(self, key, value, epoch = None):
+        with self.lock:
+            if not epoch is None and epoch != self.epoch:
+                return
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, predicate = None):
+        # remove the entries with predicate(key) == True (all entries if predicate is None)
+        with self.lock:
+            self.epoch += 1
+            if predicate is None:
+                keys = list(self.entries.keys())
+            else:
+                keys = [k for k in self.entries.keys() if predicate(k)]
+            for k in keys:
+                del self.entries[k]
+            self.invalidations += len(keys)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries),
+                    'maxEntries': self.maxEntries,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'hitRatio': self.hits/max(1, self.hits + self.misses),
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations}
@@ -16,7 +16,10 @@
 
 import time
 import array
+import re
+import threading
 from ptracker_lib.helpers import *
+from ptracker_lib.lrucache import LruCache
 
 class Histogram:
     def __init__(self, acc, vmin, vmax):
@@ -93,3 +96,147 @@ class Profiler:
     def __exit__(self, exc_type, exc_value, traceback):
         self.register_prof_time(time.time()-self.lastStart)
         del self.lastStart
+
+def statementTemplate(stmt):
+    # normalize a sql statement: literals and the members of IN lists are replaced by ?, whitespace is collapsed
+    t = re.sub(r"'(?:[^']|'')*'", "?", stmt)
+    t = re.sub(r"(?<![\w.:])-?[0-9]+(?:\.[0-9]+)?(?:[eE][-+]?[0-9]+)?\b", "?", t)
+    t = re.sub(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", "IN (?)", t, flags=re.IGNORECASE)
+    return " ".join(t.split())
+
+class QueryStats:
+    # maximum number of distinct statement texts counted per template
+    maxVariants = 1000
+
+    def __init__(self):
+        self.latency = Histogram(1e-3, 0.0, 2.0)
+        self.rows = 0
+        self.maxRows = 0
+        self.lockWait = 0.
+        self.maxLockWait = 0.
+        self.lockWaitCount = 0
+        # executions with (prepares) and without (cached) preparing the statement, see StatementCache
+        self.prepares = 0
+        self.prepareTime = 0.
+        self.prepareTimeKnown = True
+        self.uncachedTime = 0.
+        self.cached = 0
+        self.cachedTime = 0.
+        self.variants = set()
+
+    def estimatedPrepareTime(self):
+        # the measured prepare time if the backend reports it, otherwise the extra time of the executions
+        # needing a prepare compared to the cached ones (None if there are no cached executions)
+        if self.prepareTimeKnown:
+            return self.prepareTime
+        if self.cached == 0:
+            return None if self.prepares > 0 else 0.
+        return max(0., self.uncachedTime - self.prepares*self.cachedTime/self.cached)
+
+class StatementCache:
+    # mirror of the prepared statement cache of a database connection (least recently used statement
+    # texts), telling whether the execution of a statement needs to prepare it
+    def __init__(self, maxEntries):
+        self.cache = LruCache(maxEntries)
+
+    def lookup(self, stmt):
+        # returns True if the statement has to be prepared
+        hit, v = self.cache.lookup(stmt)
+        if not hit:
+            self.cache.put(stmt, True)
+        return not hit
+
+    def stats(self):
+        return self.cache.stats()
+
+class QueryProfiler:
+    # statistics of the executed sql statements (execution + fetch time, returned rows and time spent
+    # waiting for database locks), grouped by statement template
+    maxCachedStatements = 5000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # statement -> template
+        self.templates = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.resetTime = time.time()
+            # template -> QueryStats
+            self.stats = {}
+
+    def template(self, stmt):
+        t = self.templates.get(stmt, None)
+        if t is None:
+            t = statementTemplate(stmt)
+            if len(self.templates) >= self.maxCachedStatements:
+                self.templates = {}
+            self.templates[stmt] = t
+        return t
+
+    def record(self, stmt, duration, rows, lockWait = None, prepared = None, prepareTime = None):
+        # prepared tells whether the statement had to be prepared for this execution (None if unknown),
+        # prepareTime is the part of the duration spent for that if the backend can measure it
+        t = self.template(stmt)
+        with self.lock:
+            s = self.stats.get(t, None)
+            if s is None:
+                s = QueryStats()
+                self.stats[t] = s
+            s.latency.addValue(duration)
+            s.rows += rows
+            s.maxRows = max(s.maxRows, rows)
+            if not lockWait is None and lockWait > 0.:
+                s.lockWait += lockWait
+                s.maxLockWait = max(s.maxLockWait, lockWait)
+                s.lockWaitCount += 1
+            if prepared:
+                s.prepares += 1
+                s.uncachedTime += duration
+                if prepareTime is None:
+                    s.prepareTimeKnown = False
+                else:
+                    s.prepareTime += prepareTime
+            elif prepared is False:
+                s.cached += 1
+                s.cachedTime += duration
+            if len(s.variants) < QueryStats.maxVariants:
+                s.variants.add(hash(stmt))
+
+    def dump(self):
+        # machine readable statistics, sorted by the total time spent
+        res = []
+        prepares = 0
+        executions = 0
+        with self.lock:
+            for t,s in self.stats.items():
+                h = s.latency
+                prepares += s.prepares
+                executions += s.prepares + s.cached
+                res.append({
+                    'template': t,
+                    'count': h.count,
+                    'total': h.cum,
+                    'avg': h.cum/max(1,h.count),
+                    'min': h.min,
+                    'max': h.max,
+                    'median': h.quantile(0.5),
+                    'q95': h.quantile(0.95),
+                    'q99': h.quantile(0.99),
+                    'rows': s.rows,
+                    'avgRows': s.rows/max(1,h.count),
+                    'maxRows': s.maxRows,
+                    'lockWait': s.lockWait,
+                    'maxLockWait': s.maxLockWait,
+                    'lockWaitCount': s.lockWaitCount,
+                    'prepares': s.prepares,
+                    'prepareTime': s.estimatedPrepareTime(),
+                    'prepareTimeEstimated': not s.prepareTimeKnown,
+                    'variants': len(s.variants),
+                })
+            period = time.time() - self.resetTime
+        res.sort(key=lambda x: x['total'], reverse=True)
+        return {'period': period, 'statements': res, 'prepares': prepares, 'executions': executions}
+
+queryProfiler = QueryProfiler()
@@ -113,7 +113,7 @@ class CompressedConnection:
 class ProtocolHandler:
 
     # protocol version
-    PROT_VERSION = 16
+    PROT_VERSION = 17
 
     # requests as seen from ptracker as client and stracker as server
     REQ_PROTO_START = 0
@@ -151,6 +151,9 @@ class ProtocolHandler:
     ANS_POST_PTS_REQUEST = 35
     REQ_POST_PTS_REPLY = 36 # no answer expected
 
+    # content type of a pts answer without content: the etag sent with the request is still valid (prot_version >= 17)
+    PTS_NOT_MODIFIED = "x-status/not-modified"
+
     # capabilities
     CAP_HAS_STRACKER                   = (1 << 0)
     CAP_SEND_SETUP                     = (1 << 1)
@@ -422,24 +425,24 @@ class ProtocolHandler:
             self.socket.sendall(dgram,self.ANS_DEPOSIT_REMOVE)
 
     # following requests are deprecated and will be removed...
-    def req_get_pts_response(self, url):
+    def req_get_pts_response(self, url, etag = ""):
         if self.prot_version >= 12:
-            dgram = self._request_pack(self.REQ_GET_PTS_RESPONSE, url=url)
+            dgram = self._request_pack(self.REQ_GET_PTS_RESPONSE, url=url, etag=etag)
             self.socket.sendall(dgram, self.REQ_GET_PTS_RESPONSE)
         else:
             raise NotImplementedError
 
-    def ans_get_pts_response(self, content, ctype, cacheable):
+    def ans_get_pts_response(self, content, ctype, cacheable, etag = ""):
         if self.prot_version >= 12:
-            dgram = self._request_pack(self.ANS_GET_PTS_RESPONSE, content=content, ctype=ctype, cacheable=cacheable)
+            dgram = self._request_pack(self.ANS_GET_PTS_RESPONSE, content=content, ctype=ctype, cacheable=cacheable, etag=etag)
             self.socket.sendall(dgram, self.ANS_GET_PTS_RESPONSE)
         else:
             raise NotImplementedError
 
     # use these instead
-    def req_post_pts_request(self, url):
+    def req_post_pts_request(self, url, etag = ""):
         if self.prot_version >= 13:
-            dgram = self._request_pack(self.REQ_POST_PTS_REQUEST, url=url)
+            dgram = self._request_pack(self.REQ_POST_PTS_REQUEST, url=url, etag=etag)
             self.socket.sendall(dgram, self.REQ_POST_PTS_REQUEST)
         else:
             raise NotImplementedError
@@ -451,9 +454,9 @@ class ProtocolHandler:
         else:
             raise NotImplementedError
 
-    def req_post_pts_reply(self, content, ctype, cacheable, ansId):
+    def req_post_pts_reply(self, content, ctype, cacheable, ansId, etag = ""):
         if self.prot_version >= 13:
-            dgram = self._request_pack(self.REQ_POST_PTS_REPLY, content=content, ctype=ctype, cacheable=cacheable, ansId=ansId)
+            dgram = self._request_pack(self.REQ_POST_PTS_REPLY, content=content, ctype=ctype, cacheable=cacheable, ansId=ansId, etag=etag)
             self.socket.sendall(dgram, self.REQ_POST_PTS_REPLY)
         else:
             raise NotImplementedError
@@ -847,12 +850,16 @@ class ProtocolHandler:
             pass
         elif req in [self.REQ_GET_PTS_RESPONSE, self.REQ_POST_PTS_REQUEST]:
             packed += self._pack_string(kw['url'])
+            if self.prot_version >= 17:
+                packed += self._pack_string(kw['etag'])
         elif req in [self.ANS_GET_PTS_RESPONSE, self.REQ_POST_PTS_REPLY]:
             packed += self._pack_string(kw['ctype'])
             packed += self._pack_bytes(kw['content'])
             packed += struct.pack('<B', kw['cacheable'])
             if req == self.REQ_POST_PTS_REPLY:
                 packed += struct.pack('<I', kw['ansId'])
+            if self.prot_version >= 17:
+                packed += self._pack_string(kw['etag'])
         elif req == self.ANS_POST_PTS_REQUEST:
             packed += struct.pack('<I', kw['ansId'])
         else:
@@ -1228,6 +1235,8 @@ class ProtocolHandler:
             self.socket.enableRcvCompression()
         elif req in [self.REQ_GET_PTS_RESPONSE, self.REQ_POST_PTS_REQUEST]:
             res = {'url': self._unpack_string()}
+            if self.prot_version >= 17:
+                res['etag'] = self._unpack_string()
             acdebug("got url: %s", res['url'])
         elif req in [self.ANS_GET_PTS_RESPONSE, self.REQ_POST_PTS_REPLY]:
             ctype = self._unpack_string()
@@ -1235,9 +1244,11 @@ class ProtocolHandler:
             cacheable, = self._unpack_from_format('<B')
             if req == self.REQ_POST_PTS_REPLY:
                 ansId, = self._unpack_from_format('<I')
-                res = (content, ctype, cacheable, ansId)
+            etag = self._unpack_string() if self.prot_version >= 17 else ""
+            if req == self.REQ_POST_PTS_REPLY:
+                res = (content, ctype, cacheable, ansId, etag)
             else:
-                res = (content, ctype, cacheable)
+                res = (content, ctype, cacheable, etag)
         elif req == self.ANS_POST_PTS_REQUEST:
             ansId, = self._unpack_from_format('<I')
             res = ansId
@@ -78,7 +78,7 @@ class PtsReplyLocal(PtsReplyBase):
     @callbackDecorator
     def do_construct(self, url, http_server):
         try:
-            content, header, cacheable = http_server.serve_pts(url)
+            content, header, cacheable, etag = http_server.serve_pts(url)
             self.content = content
             self.setHeader(QtNetwork.QNetworkRequest.ContentTypeHeader, header)
             self.setHeader(QtNetwork.QNetworkRequest.ContentLengthHeader, len(self.content))
@@ -55,7 +55,7 @@ baseTemplate = SimpleTemplate("""
     <script type="text/javascript" src="/pygal/pygal-tooltips.min.js"></script>
 % end
 
-    % title_texts = dict(lapstat="Laps", sesstat="Sessions", players="Drivers", cs="Championships", stats="Statistics", livemap="Live Map", banlist="Ban List", groups="Groups", admin="General Admin", log="Log")
+    % title_texts = dict(lapstat="Laps", sesstat="Sessions", players="Drivers", cs="Championships", stats="Statistics", livemap="Live Map", banlist="Ban List", groups="Groups", admin="General Admin", log="Log", querystats="Database Queries")
     % title = title_texts.get(src, "stracker")
     <title>{{title}}</title>
     <link rel="shortcut icon" type="image/x-icon" href="/img/brand_icon_small_wob.png">
@@ -219,6 +219,7 @@ baseTemplate = SimpleTemplate("""
           <ul class="dropdown-menu">
             <li><a href="{{!rootpage}}log">Stracker log</a></li>
             <li><a href="{{!rootpage}}chatlog">Chat log</a></li>
+            <li><a href="{{!rootpage}}db_query_stats">Database queries</a></li>
           </ul>
         </li>
 % end
@@ -255,15 +256,21 @@ baseTemplate = SimpleTemplate("""
 % if not pagination is None:
 %    page = pagination[0]
 %    totalPages = pagination[1]
+%    nextToken = pagination[2] if len(pagination) > 2 else None
 % import re
 % def link_to_page(p):
 %    nopage_url = re.sub(r"([?&])page=[^?&]*([?&])?", r"\g<1>", curr_url)
+%    nopage_url = re.sub(r"([?&])after=[^?&]*([?&])?", r"\g<1>", nopage_url)
 %    if not '?' in nopage_url:
 %        nopage_url += "?"
 %    elif not nopage_url[-1] in ['?', '&']:
 %        nopage_url += "&"
 %    end
 %    res = nopage_url + ("page=%d" % p)
+%    if p == page+1 and not nextToken is None:
+%        # continue after the last row of this page (keyset pagination)
+%        res += "&after=" + nextToken
+%    end
 %    return res
 % end
 % def class_of_page(p, cp):
@@ -34,31 +34,51 @@ livemapTemplate = SimpleTemplate("""
 
 <script>
 $(function() {
+% from stracker_lib import async_streaming
+% params = ("server="+server+"&" if not server is None else "") + "global_scale=%.5f"%(gscale*scale)
+
+  function apply(data) {
+    if ('svg_data' in data) {
+        $('#livemap_contents')[0].innerHTML = data.svg_data;
+    }
+    if ('session_data' in data) {
+        $('#session_display')[0].innerHTML = data.session_data;
+    }
+    if ('class_data' in data) {
+        $('#class_display')[0].innerHTML = data.class_data;
+    }
+    if ('alive_data' in data) {
+        $('#alive_ticker')[0].innerHTML = data.alive_data;
+    }
+    if ('chat_data' in data) {
+        $('#chat_contents')[0].innerHTML = data.chat_data;
+    }
+  }
 
   function update() {
-    $.getJSON('livemap_stream?key={{!key}}{{!("&server="+server if not server is None else "") + "&global_scale=%.5f"%(gscale*scale)}}', {}, function(data) {
+    $.getJSON('livemap_stream?key={{!key}}&{{!params}}', {}, function(data) {
       if (data.state != 'done') {
-        if ('svg_data' in data) {
-            $('#livemap_contents')[0].innerHTML = data.svg_data;
-        }
-        if ('session_data' in data) {
-            $('#session_display')[0].innerHTML = data.session_data;
-        }
-        if ('class_data' in data) {
-            $('#class_display')[0].innerHTML = data.class_data;
-        }
-        if ('alive_data' in data) {
-            $('#alive_ticker')[0].innerHTML = data.alive_data;
-        }
-        if ('chat_data' in data) {
-            $('#chat_contents')[0].innerHTML = data.chat_data;
-        }
+        apply(data);
         setTimeout(update, 0);
       }
     });
   }
 
-  update();
+  if (window.EventSource) {
+    // one long-lived connection, the browser reconnects with the last event id
+    var events = new EventSource({{!async_streaming.eventSource('livemap', 'livemap_events?'+params, server=server, global_scale="%.5f"%(gscale*scale), admin=bool(features['admin']))}});
+    events.onmessage = function(e) {
+      apply(JSON.parse(e.data));
+    };
+    events.onerror = function() {
+      // the browser gave up (e.g. the token of an admin stream has expired), continue with polling
+      if (events.readyState == EventSource.CLOSED) {
+        update();
+      }
+    };
+  } else {
+    update();
+  }
 });
 </script>
 <div class="container">
@@ -26,26 +26,45 @@ from bottle import SimpleTemplate
 logTemplate = SimpleTemplate("""
 <script>
 $(function() {
-
-  function update() {
+%from stracker_lib import async_streaming
 %if not server is None:
 %   serverStr = "&server="+server
 %else:
 %   serverStr = ""
 %end
 %serverStr += "&level="+level
+
+  function append(content) {
+    if(content != '') {
+        $('#log_contents').append(content);
+        window.scrollTo(0,document.body.scrollHeight);
+    }
+  }
+
+  function update() {
     $.getJSON('log_stream?key={{!key}}&limit={{!str(limit) + serverStr}}', {}, function(data) {
       if (data.state != 'done') {
-        if(data.content != '') {
-            $('#log_contents').append(data.content);
-            window.scrollTo(0,document.body.scrollHeight);
-        }
+        append(data.content);
         setTimeout(update, 0);
       }
     });
   }
 
-  update();
+  if (window.EventSource) {
+    // one long-lived connection, the browser reconnects with the last event id
+    var events = new EventSource({{!async_streaming.eventSource('log', 'log_events?limit='+str(limit)+serverStr, limit=limit, server=server, level=level)}});
+    events.onmessage = function(e) {
+      append(JSON.parse(e.data));
+    };
+    events.onerror = function() {
+      // the browser gave up (e.g. the token of an admin stream has expired), continue with polling
+      if (events.readyState == EventSource.CLOSED) {
+        update();
+      }
+    };
+  } else {
+    update();
+  }
 });
 </script>
 <div class="container">
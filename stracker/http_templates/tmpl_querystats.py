@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2015-2016 NEYS
+# This file is part of sptracker.
+#
+#    sptracker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sptracker is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+from bottle import SimpleTemplate
+
+# ----------------------------------------------
+# database query statistics template
+# ----------------------------------------------
+
+queryStatsTemplate = SimpleTemplate("""
+% sortKeys = [('total', 'Total time'), ('avg', 'Average time'), ('max', 'Maximum time'), ('count', 'Calls'), ('rows', 'Rows'), ('lockWait', 'Lock wait'), ('prepares', 'Prepares'), ('variants', 'Variants')]
+<div class="container">
+    <div class="row page-header">
+        <div class="col-md-6"><img src="/img/banner.png" title="Logo Track" class="ACimg"></div>
+        <div class="col-md-6">
+            <form class="form-horizontal collapse-group" role="form">
+                <div class="form-group">
+                    <label for="sort" class="col-md-2 control-label">Sort by</label>
+                    <div class="col-md-10">
+                        <select id="sort" name="sort" class="form-control" onChange="this.form.submit()">
+% for k,n in sortKeys:
+                            <option {{!"selected" if k == sort else ""}} value="{{k}}">{{n}}</option>
+% end
+                        </select>
+                    </div>
+                </div>
+                <div class="form-group">
+                    <div class="col-md-3 col-md-offset-2">
+                        <a class="form-control btn btn-sm btn-primary" href="db_query_stats?sort={{sort}}&reset=1">Reset</a>
+                    </div>
+                    <div class="col-md-3">
+                        <a class="form-control btn btn-sm btn-primary" href="db_query_stats_json">JSON</a>
+                    </div>
+                    <div class="col-md-3">
+                        <button class="form-control btn btn-sm btn-primary" onClick="window.history.back()">
+                            Back
+                        </button>
+                    </div>
+                </div>
+            </form>
+            <p>Statistics of the last {{"%.0f" % (stats['period']/60.)}} minutes. Times in milliseconds.</p>
+            <p>Statement cache: {{stats['prepares']}} of {{stats['executions']}} executions needed to prepare the statement. Variants is the number of distinct statement texts of a template, each of them is prepared separately. Prepare times marked with * are estimated from the latency of the cached executions.</p>
+            <p>Best times cache (since start): {{cacheStats['entries']}}/{{cacheStats['maxEntries']}} entries, {{cacheStats['hits']}} hits, {{cacheStats['misses']}} misses ({{"%.0f" % (cacheStats['hitRatio']*100.)}}% hit ratio), {{cacheStats['evictions']}} evictions, {{cacheStats['invalidations']}} invalidations.</p>
+% if not pageCacheStats is None:
+            <p>Page cache (since start): {{pageCacheStats['entries']}}/{{pageCacheStats['maxEntries']}} pages, {{pageCacheStats['hits']}} hits, {{pageCacheStats['misses']}} misses ({{"%.0f" % (pageCacheStats['hitRatio']*100.)}}% hit ratio), {{pageCacheStats['evictions']}} evictions.</p>
+% end
+% if not spoolStats is None:
+            <p>Lap spool: {{spoolStats['depth']}} pending records (oldest {{"%.0f" % spoolStats['oldestAge']}} s), {{spoolStats['applied']}}/{{spoolStats['appended']}} applied in {{spoolStats['batches']}} batches, {{spoolStats['failures']}} failures, {{spoolStats['rejected']}} rejected, log size {{"%.0f" % (spoolStats['logSize']/1024.)}} kB.</p>
+%   if not spoolStats['lastError'] is None:
+            <p>Last lap spool error: {{spoolStats['lastError']}}</p>
+%   end
+% end
+        </div>
+    </div>
+    <div class="row">
+        <div class="col-md-12">
+            <table class="table table-responsive table-hover table-striped table-condensed">
+                <thead>
+                    <tr>
+                        <th class="text-right">Calls</th>
+                        <th class="text-right">Total</th>
+                        <th class="text-right">Avg</th>
+                        <th class="text-right">Median</th>
+                        <th class="text-right">Q(95%)</th>
+                        <th class="text-right">Q(99%)</th>
+                        <th class="text-right">Max</th>
+                        <th class="text-right">Rows (avg/max)</th>
+                        <th class="text-right">Lock wait (total/max)</th>
+                        <th class="text-right">Prepares (count/time)</th>
+                        <th class="text-right">Variants</th>
+                        <th>Statement</th>
+                    </tr>
+                </thead>
+                <tbody>
+% for s in stats['statements']:
+                    <tr>
+                        <td class="text-right">{{"%d" % s['count']}}</td>
+                        <td class="text-right">{{"%.0f" % (s['total']*1000.)}}</td>
+                        <td class="text-right">{{"%.1f" % (s['avg']*1000.)}}</td>
+                        <td class="text-right">{{"%.0f" % (s['median']*1000.)}}</td>
+                        <td class="text-right">{{"%.0f" % (s['q95']*1000.)}}</td>
+                        <td class="text-right">{{"%.0f" % (s['q99']*1000.)}}</td>
+                        <td class="text-right">{{"%.1f" % (s['max']*1000.)}}</td>
+                        <td class="text-right">{{"%.1f/%d" % (s['avgRows'], s['maxRows'])}}</td>
+                        <td class="text-right">{{"%.0f/%.0f" % (s['lockWait']*1000., s['maxLockWait']*1000.)}}</td>
+                        <td class="text-right">{{"%d/%s%s" % (s['prepares'], "-" if s['prepareTime'] is None else "%.1f" % (s['prepareTime']*1000.), "*" if s['prepareTimeEstimated'] else "")}}</td>
+                        <td class="text-right">{{"%d" % s['variants']}}</td>
+                        <td><small><code>{{s['template']}}</code></small></td>
+                    </tr>
+% end
+                </tbody>
+            </table>
+        </div>
+    </div>
+</div>
+""")
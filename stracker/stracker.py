@@ -90,14 +90,16 @@ def backend_factory():
     if config.config.DATABASE.database_type == config.config.DBTYPE_SQLITE3:
         dbBackend = functools.partial(SqliteBackend,
                                       dbname=config.config.DATABASE.database_file,
-                                      perform_backups=config.config.DATABASE.perform_backups)
+                                      perform_backups=config.config.DATABASE.perform_backups,
+                                      blobStoreDir=config.config.DATABASE.blob_store_dir)
     else:
         dbBackend = functools.partial(PostgresqlBackend,
                                       user=config.config.DATABASE.postgres_user,
                                       password=config.config.DATABASE.postgres_pwd,
                                       database=config.config.DATABASE.postgres_db,
                                       host=config.config.DATABASE.postgres_host,
-                                      perform_backups=config.config.DATABASE.perform_backups)
+                                      perform_backups=config.config.DATABASE.perform_backups,
+                                      blobStoreDir=config.config.DATABASE.blob_store_dir)
     return dbBackend
 
 def main(stracker_ini):
@@ -129,6 +131,7 @@ if __name__ == "__main__":
     parser.add_argument("--migrate_from_sqlite3", action="store_true", required=False, help='migrate from the sqlite database to the postgresql database. The postgresql db must be empty for that process.')
     parser.add_argument("--migrate_from_postgres", action="store_true", required=False, help='migrate from the postgresql database to the sqlite database. The sqlite db must be empty (non existing) for that process.')
     parser.add_argument("--perform_backup", required=False, help='perform a database backup to the specified file (backup will be stored as sqlite db).')
+    parser.add_argument("--resume_migration", action="store_true", required=False, help='continue an interrupted migration or backup; completely copied tables are skipped.')
     args = parser.parse_args()
 
     migrate = args.migrate_from_sqlite3 or args.migrate_from_postgres
@@ -197,7 +200,7 @@ if __name__ == "__main__":
         print("Performing the requested backup. Please wait ...")
         dbToBeCopied = backend_factory()(None)
         dbBackup = SqliteBackend(None, dbname=args.perform_backup, perform_backups = False)
-        dbBackup.populate(dbToBeCopied)
+        dbBackup.populate(dbToBeCopied, resume=args.resume_migration)
         print("done")
     elif migrate:
         dbBackendSqlite = SqliteBackend(None,
@@ -211,9 +214,9 @@ if __name__ == "__main__":
                                       perform_backups=config.config.DATABASE.perform_backups)
         print("Migrating the database. Please wait ...")
         if args.migrate_from_sqlite3:
-            dbBackendPostgres.populate(dbBackendSqlite)
+            dbBackendPostgres.populate(dbBackendSqlite, resume=args.resume_migration)
         else:
-            dbBackendSqlite.populate(dbBackendPostgres)
+            dbBackendSqlite.populate(dbBackendPostgres, resume=args.resume_migration)
     else:
         print("Starting stracker - press ctrl+c for shutdown")
         main(args.stracker_ini)
@@ -27,6 +27,7 @@ import traceback
 import random
 import copy
 import os
+import shutil
 import platform
 import struct
 import hashlib
@@ -44,9 +45,11 @@ from stracker_lib import livemap
 from stracker_lib.ac_session_manager import SessionManager
 from stracker_lib import chatfilter
 from stracker_lib.mr_query import MRQuery
+from stracker_lib.lap_spool import LapSpool
 from stracker_lib import jsonresult_parser
 from ptracker_lib.ps_protocol import ProtocolHandler
 from ptracker_lib import dbgeneric
+from ptracker_lib.async_worker import PRIO_REALTIME, PRIO_CLIENT
 from ptracker_lib.database import LapDatabase
 from ptracker_lib.message_types import *
 from ptracker_lib.helpers import *
@@ -645,6 +648,10 @@ class ACMonitor:
         self.raceFinished = lambda *args, **kw: None
         self.softSplitCalculator = SoftSplitCalculator(self.database)
         self.lastRTPositionUpdate = time.time()
+        # optional write-ahead spool for the session mutations, laps are saved asynchronously then
+        self.lapSpool = None
+        if config.config.DATABASE.lap_spool_dir != '':
+            self.lapSpool = LapSpool(config.config.DATABASE.lap_spool_dir, database, self.lapRegistered)
 
     # --------------------------------------------------------------------------------------------------
     # --------------------------------------------------------------------------------------------------
@@ -831,16 +838,20 @@ class ACMonitor:
         return 1
 
     def lapStats(self, **kw):
-        ref = self.database.lapStats(__sync=True, **kw)
+        ref = self.database.lapStats(__sync=True, __priority=PRIO_CLIENT, **kw)
         return ref()
 
     def sessionStats(self, **kw):
-        ref = self.database.sessionStats(__sync=True, **kw)
+        ref = self.database.sessionStats(__sync=True, __priority=PRIO_CLIENT, **kw)
         return {'sessions':ref()['sessions']}
 
     def lapDetails(self, **kw):
-        ref = self.database.lapDetails(__sync=True, **kw)
-        return {'lap_details':ref()}
+        ref = self.database.lapDetails(__sync=True, __priority=PRIO_CLIENT, **kw)
+        res = ref()
+        if not res is None and 'historyinfo' in res:
+            # ptracker clients expect the legacy history info format
+            res['historyinfo'] = dbgeneric.transcodeHistoryInfo(res['historyinfo'], dbgeneric.HISTORY_INFO_LEGACY)
+        return {'lap_details':res}
 
     def setupDepositGet(self, **kw):
         kw["guid"] = dbGuidMapper.guid_new(kw["guid"])
@@ -1060,7 +1071,10 @@ class ACMonitor:
                 except:
                     acwarning("Error while parsing JSON results.")
                     acwarning(traceback.format_exc())
-            self.database.finishSession(__sync=True, positions=positions, ac_positions=ac_positions)()
+            if self.lapSpool is None:
+                self.database.finishSession(__sync=True, positions=positions, ac_positions=ac_positions)()
+            else:
+                self.lapSpool.finishSession(positions=positions, ac_positions=ac_positions)
             self.currentSession = None
             self.allDrivers.setupNewSession()
         else:
@@ -1074,6 +1088,11 @@ class ACMonitor:
             acerror("Traceback while finishing session in shutdown:")
             acerror(traceback.format_exc())
 
+    def shutdownLapSpool(self):
+        # not locked, the drainer might need the lock for the lap notifications
+        if not self.lapSpool is None:
+            self.lapSpool.shutdown()
+
     @acquire_lock
     def feedUdpLap(self, carInfo):
         d = self.allDrivers.byCarId(carInfo.carId)
@@ -1134,8 +1153,7 @@ class ACMonitor:
             stracker_udp_plugin.SESST_DRAG:'Drag',
             stracker_udp_plugin.SESST_DRIFT:'Drift',
         }
-        self.database.newSession(
-            __sync=True,
+        sessionArgs = dict(
             trackname=self.currentSession.trackname,
             carnames=self.currentSession.cars,
             sessionType=session_types.get(self.currentSession.sessionType, 'unknown'),
@@ -1144,7 +1162,11 @@ class ACMonitor:
             duration=self.currentSession.sessionTime,
             server=config.config.STRACKER_CONFIG.server_name,
             sessionState=self.currentSession.getSessionState(),
-        )()
+        )
+        if self.lapSpool is None:
+            self.database.newSession(__sync=True, **sessionArgs)()
+        else:
+            self.lapSpool.newSession(**sessionArgs)
         self.compare_checksums()
         self.ptClientsNewServerData()
         self.softSplitCalculator.setTrack(self.currentSession.trackname)
@@ -1430,7 +1452,7 @@ class ACMonitor:
         dynamicAssists['ambientTemp'] = self.currentSession.ambientTemp
         dynamicAssists['trackTemp'] = self.currentSession.roadTemp
 
-        self.database.registerLap(__sync=True, trackChecksum=driver.track_checksum, carChecksum=driver.car_checksum, acVersion=driver.getPTACVersion(),
+        lapArgs = dict(trackChecksum=driver.track_checksum, carChecksum=driver.car_checksum, acVersion=driver.getPTACVersion(),
             steamGuid=dbGuidMapper.guid_new(driver.guid), playerName=driver.name, playerIsAI=0,
             lapHistory=lh, tyre=lap.tyre, lapCount=lap.lapCount, sessionTime=driver.totalTime(),
             fuelRatio=lap.fuelRatio, valid=valid, carname=driver.car, staticAssists=lap.staticAssists,
@@ -1441,29 +1463,45 @@ class ACMonitor:
             collisionsCar=lap.collCarCount,
             collisionsEnv=lap.collEnvCount,
             cuts=lap.cuts,
-            ballast=lap.ballast)()
+            ballast=lap.ballast)
+        notify = dict(track=self.currentSession.trackname, cars=list(self.currentSession.cars), car=driver.car,
+                      guid=dbGuidMapper.guid_new(driver.guid), playerName=driver.name, lapTime=lh.lapTime)
+        if self.lapSpool is None:
+            self.database.registerLap(__sync=True, **lapArgs)()
+            self.notifyBestLap(**notify)
+        else:
+            # the PB/SB messages are sent by lapRegistered as soon as the lap is in the database
+            self.lapSpool.registerLap(notify=notify, **lapArgs)
+
+    def lapRegistered(self, notify, lapId):
+        # called by the lap spool's drainer thread
+        self.notifyBestLap(**notify)
+
+    def notifyBestLap(self, track, cars, car, guid, playerName, lapTime):
         dbRes_percar = self.database.lapStats(
             __sync=True,
+            __priority=PRIO_REALTIME,
             mode='top',
             limit=[None,1],
-            track=self.currentSession.trackname,
+            track=track,
             artint=0,
-            cars=[driver.car],
-            ego_guid=dbGuidMapper.guid_new(driver.guid),
+            cars=[car],
+            ego_guid=guid,
             valid=[1,2],
             minSessionStartTime=0)()
         dbRes_combo = self.database.lapStats(
             __sync=True,
+            __priority=PRIO_REALTIME,
             mode='top',
             limit=[None,1],
-            track=self.currentSession.trackname,
+            track=track,
             artint=0,
-            cars=self.currentSession.cars,
-            ego_guid=dbGuidMapper.guid_new(driver.guid),
+            cars=cars,
+            ego_guid=guid,
             valid=[1,2],
             minSessionStartTime=0,
             group_by_guid=True)()
-        self.check_pb_sb_callback(dbRes_percar, dbRes_combo, lapTime=lh.lapTime, guid=dbGuidMapper.guid_new(driver.guid), playerName=driver.name)
+        self.check_pb_sb_callback(dbRes_percar, dbRes_combo, lapTime=lapTime, guid=guid, playerName=playerName)
         self.ptClientsNewServerData()
 
     @acquire_lock
@@ -1597,7 +1635,7 @@ class STrackerServerHandler(BaseRequestHandler):
                         pass
                     elif request[0] == ProtocolHandler.REQ_GET_PTS_RESPONSE:
                         res = self.server.pts_server.serve_pts(**request[1])
-                        p.ans_get_pts_response(content = res[0], ctype=res[1], cacheable=res[2])
+                        p.ans_get_pts_response(content = res[0], ctype=res[1], cacheable=res[2], etag=res[3])
                     elif request[0] == ProtocolHandler.REQ_POST_PTS_REQUEST:
                         ptsId = (ptsId + 1)%1073741824
                         p.ans_post_pts_request(ansId = ptsId)
@@ -1623,7 +1661,7 @@ class STrackerServerHandler(BaseRequestHandler):
         with self.lock:
             try:
                 res = self.server.pts_server.serve_pts(**kwargs)
-                self.proto.req_post_pts_reply(content=res[0], ctype=res[1], cacheable=res[2], ansId=ptsId)
+                self.proto.req_post_pts_reply(content=res[0], ctype=res[1], cacheable=res[2], ansId=ptsId, etag=res[3])
             except (KeyboardInterrupt, SystemExit):
                 raise
             except ConnectionError as e:
@@ -1679,23 +1717,72 @@ class STrackerServerHandler(BaseRequestHandler):
             acerror(traceback.format_exc())
 
 
-def maintain_forever(dbBackend, udp_plugin):
+def compact_history_infos(database):
+    # remove the history infos of slow laps chunk by chunk; each chunk is a separate (low priority) database job,
+    # so lap registrations are not blocked for long. The position is persisted in the database, a run exceeding
+    # the time budget is continued at the next compression interval.
+    cfg = config.config.DB_COMPRESSION
+    t0 = time.time()
+    chunks = 0
+    nulled = 0
+    numBytes = 0
+    freed = 0
+    while 1:
+        res = database.compactHistoryInfos(chunkSize=cfg.chunk_size, __sync=True)()
+        chunks += 1
+        nulled += res['nulled']
+        numBytes += res['bytes']
+        freed += res['freed']
+        if res['finished']:
+            break
+        if cfg.time_budget > 0 and time.time() - t0 > cfg.time_budget:
+            acinfo("Time budget exceeded, continuing at lap id %d next time.", res['lapIdTo'])
+            break
+        time.sleep(cfg.chunk_pause)
+    acinfo("Compacted %d chunks in %.1f seconds (%s): %d history infos removed, %d bytes reclaimed, %d bytes returned to the file system",
+           chunks, time.time()-t0, "pass complete" if res['finished'] else "pass incomplete", nulled, numBytes, freed)
+
+def compact_blob_store(database):
+    # move the history infos to the blob store and reclaim the space of removed infos, with the same
+    # chunking and time budget as compact_history_infos
+    cfg = config.config.DB_COMPRESSION
+    t0 = time.time()
+    res = dict(externalized=0, moved=0, removed=0, freed=0)
+    while 1:
+        r = database.compactBlobStore(chunkSize=cfg.chunk_size, __sync=True)()
+        for k in res:
+            res[k] += r[k]
+        if r['finished']:
+            break
+        if cfg.time_budget > 0 and time.time() - t0 > cfg.time_budget:
+            acinfo("Time budget exceeded, continuing blob store maintenance next time.")
+            break
+        time.sleep(cfg.chunk_pause)
+    acinfo("Blob store maintenance in %.1f seconds: %d history infos moved to the store, %d blobs copied, %d segments (%d bytes) removed",
+           time.time()-t0, res['externalized'], res['moved'], res['removed'], res['freed'])
+
+def maintain_forever(database, udp_plugin):
+    # the maintenance uses the database of the lap saving: the chunks are low priority jobs of the same worker
+    # and the blob store is not written by two backends
     try:
-        database = LapDatabase(lambda *args, **kw: None, LapDatabase.DB_MODE_NORMAL, dbBackend)
         lastCompressTime = time.time() - config.config.DB_COMPRESSION.interval*60 - 1
         while 1:
             t = time.time()
             work_performed = 0
             method = config.config.DB_COMPRESSION.mode
-            if method != config.config.DBCOMPRESSION_HI_SAVE_ALL and t > lastCompressTime + config.config.DB_COMPRESSION.interval*60:
+            useBlobStore = config.config.DATABASE.blob_store_dir != ''
+            if (method != config.config.DBCOMPRESSION_HI_SAVE_ALL or useBlobStore) and t > lastCompressTime + config.config.DB_COMPRESSION.interval*60:
                 if not config.config.DB_COMPRESSION.needs_empty_server or udp_plugin.empty():
                     acinfo("Compressing database ...")
                     work_performed += 1
                     lastCompressTime = t
                     if method == config.config.DBCOMPRESSION_HI_SAVE_FAST:
-                        database.compressDB(COMPRESS_NULL_SLOW_BINARY_BLOBS, __sync=True)()
+                        compact_history_infos(database)
                     elif method == config.config.DBCOMPRESSION_HI_SAVE_NONE:
                         database.compressDB(COMPRESS_NULL_ALL_BINARY_BLOBS, __sync=True)()
+                    if useBlobStore:
+                        # reclaims the space of the history infos removed above
+                        compact_blob_store(database)
                     acinfo("Compressing database done")
             if work_performed:
                 time.sleep(1)
@@ -1707,6 +1794,66 @@ def maintain_forever(dbBackend, udp_plugin):
         acerror("Unexpected exception from maintain_forever.")
         acerror(traceback.format_exc())
 
+def online_backup(database):
+    # create a backup of the running database and remove the old ones
+    cfg = config.config.DB_BACKUP
+    backupDir = cfg.backup_dir
+    if backupDir == '':
+        backupDir = os.path.dirname(os.path.abspath(config.config.DATABASE.database_file))
+    os.makedirs(backupDir, exist_ok=True)
+    backupName = os.path.join(backupDir, time.strftime("stracker_backup_%Y%m%d_%H%M%S.db3"))
+    acinfo("Creating online backup %s ...", backupName)
+    lastReported = [0]
+    def progress(pagesCopied, pageCount):
+        percent = pagesCopied*100//max(1, pageCount)
+        if percent >= lastReported[0] + 10:
+            lastReported[0] = percent
+            acdebug("Online backup: %d%% (%d/%d pages)", percent, pagesCopied, pageCount)
+    res = database.onlineBackup(backupName, pagesPerStep=cfg.pages_per_step, stepPause=cfg.step_pause, compress=cfg.compress, progress=progress,
+                                blobStoreDir=config.config.DATABASE.blob_store_dir)
+    acinfo("Online backup %s created: %d pages in %d steps (%d busy), %.1f seconds copy time, %.1f seconds total, %d bytes",
+           res['file'], res['pages'], res['steps'], res['busySteps'], res['copyTime'], res['totalTime'], res['size'])
+    if not res['blobs'] is None:
+        acinfo("Blob store copied to %s (%d bytes)", res['blobs'], res['blobsSize'])
+    backups = sorted(f for f in os.listdir(backupDir) if f.startswith("stracker_backup_") and (f.endswith(".db3") or f.endswith(".db3.gz")))
+    for f in backups[:max(0, len(backups)-cfg.keep)]:
+        acinfo("Removing old backup %s", f)
+        os.remove(os.path.join(backupDir, f))
+        # the blob store copy belonging to the backup
+        blobs = os.path.join(backupDir, f[:-len(".gz")] if f.endswith(".gz") else f) + ".blobs"
+        if os.path.isdir(blobs):
+            shutil.rmtree(blobs)
+
+def backup_forever(database):
+    # the backups must use the database of the lap saving (as the maintenance does, see maintain_forever):
+    # sqlite restarts a stepwise backup if the database is modified by another connection
+    try:
+        interval = config.config.DB_BACKUP.interval*3600
+        backupDir = config.config.DB_BACKUP.backup_dir
+        if backupDir == '':
+            backupDir = os.path.dirname(os.path.abspath(config.config.DATABASE.database_file))
+        lastBackupTime = 0
+        if os.path.isdir(backupDir):
+            for f in os.listdir(backupDir):
+                if f.startswith("stracker_backup_"):
+                    lastBackupTime = max(lastBackupTime, os.path.getmtime(os.path.join(backupDir, f)))
+        while 1:
+            if time.time() > lastBackupTime + interval:
+                lastBackupTime = time.time()
+                try:
+                    online_backup(database)
+                except (KeyboardInterrupt, SystemExit):
+                    raise
+                except:
+                    acerror("Online backup failed:")
+                    acerror(traceback.format_exc())
+            time.sleep(60)
+    except (KeyboardInterrupt, SystemExit):
+        raise
+    except:
+        acerror("Unexpected exception from backup_forever.")
+        acerror(traceback.format_exc())
+
 def onServerRestart(acmonitor):
     global connections
     for c in connections:
@@ -1876,7 +2023,8 @@ def run(dbBackend):
     server = None
     serverIsActive = False
     try:
-        database = LapDatabase(fromLapHistory, LapDatabase.DB_MODE_NORMAL, dbBackend)
+        database = LapDatabase(fromLapHistory, LapDatabase.DB_MODE_NORMAL, dbBackend,
+                               readPoolSize=config.config.DATABASE.read_connections)
         # get config items needed
         port = int(config.acconfig['SERVER']['UDP_PORT'])
         server_ip = config.config.STRACKER_CONFIG.ac_server_address
@@ -1946,14 +2094,19 @@ def run(dbBackend):
         udp_thread.daemon = True
         udp_thread.start()
         # create the compression thread
-        comp_thread = Thread(target=functools.partial(maintain_forever, dbBackend=dbBackend, udp_plugin=udp_plugin))
+        comp_thread = Thread(target=functools.partial(maintain_forever, database=database, udp_plugin=udp_plugin))
         comp_thread.daemon = True
         comp_thread.start()
+        # create the backup thread
+        if config.config.DB_BACKUP.interval > 0 and config.config.DATABASE.database_type == config.config.DBTYPE_SQLITE3:
+            backup_thread = Thread(target=functools.partial(backup_forever, database=database))
+            backup_thread.daemon = True
+            backup_thread.start()
         # create the http server
         if config.config.HTTP_CONFIG.enabled:
             time.sleep(3) # seems like there is a race condition somewhere...
             acdebug("Starting http server")
-            http_server.start(database, config.config.HTTP_CONFIG.listen_addr, config.config.HTTP_CONFIG.listen_port, banlist, udp_plugin)
+            http_server.start(database, config.config.HTTP_CONFIG.listen_addr, config.config.HTTP_CONFIG.listen_port, banlist, udp_plugin, acmonitor.lapSpool)
         while 1:
             stracker_udp_plugin.synchronizer.processUdpCallbacks(1.0)
             acmonitor.savePendingLaps(False)
@@ -1975,6 +2128,7 @@ def run(dbBackend):
         if not acmonitor is None:
             acinfo("Shutting down acmonitor.")
             acmonitor.shutdown()
+            acmonitor.shutdownLapSpool()
         if not server is None and serverIsActive:
             acinfo("Shutting down the server.")
             server.shutdown()
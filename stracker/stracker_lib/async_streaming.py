@@ -0,0 +1,343 @@
+# Copyright 2015-2016 NEYS
+# This file is part of sptracker.
+#
+#    sptracker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sptracker is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+
+# asyncio based listener for the event streams (livemap and log), see HTTP_CONFIG.streaming_port.
+#
+# Every livemap or log viewer of the cherrypy server pins a worker thread, which mostly sleeps. This listener
+# serves the server-sent event streams from one event loop thread instead, so an idle viewer costs a
+# connection and a coroutine. It runs in the stracker process and uses the same stream producers, shm reader
+# and log processing as the cherrypy handlers (livemap_events, log_events); the pages of the cherrypy
+# server point their EventSource to this listener.
+#
+# The listener does not implement the authentication of the admin pages. Instead, the pages embed a token
+# signed with a per-process secret, which contains the parameters of the stream (including the admin flag).
+# Tokens of admin streams expire soon, the pages fall back to the http server then. Cross origin requests
+# are answered only for pages of the same host.
+#
+# Generator based coroutines are used, so the module works with python 3.3 (asyncio package). Python 3.12
+# and later don't run them anymore, the listener is not started there.
+
+import base64
+import binascii
+import concurrent.futures
+import hashlib
+import hmac
+import json
+import os
+import ssl
+import sys
+import threading
+import time
+import traceback
+import types
+from urllib.parse import urlsplit, parse_qs
+from stracker_lib.logger import *
+from stracker_lib import config
+from stracker_lib import stream_producer
+from stracker_lib import streaming_support
+
+try:
+    import asyncio
+    coroutine = asyncio.coroutine if hasattr(asyncio, 'coroutine') else types.coroutine
+except ImportError:
+    asyncio = None
+    coroutine = lambda f: f
+
+# validity of the stream tokens [s], the browsers reconnect with the token of the page
+TOKEN_LIFETIME = 24*3600
+ADMIN_TOKEN_LIFETIME = 300
+_secret = os.urandom(32)
+_server = None
+
+def streamToken(kind, **params):
+    lifetime = ADMIN_TOKEN_LIFETIME if kind == 'log' or params.get('admin', False) else TOKEN_LIFETIME
+    params = dict(params, kind=kind, expires=int(time.time()) + lifetime)
+    payload = base64.urlsafe_b64encode(json.dumps(params, sort_keys=True).encode('utf-8')).decode('ascii')
+    return payload + "." + hmac.new(_secret, payload.encode('ascii'), hashlib.sha256).hexdigest()
+
+def checkToken(token):
+    # returns the parameters of a valid token, None otherwise
+    try:
+        payload, signature = token.split(".")
+        if not hmac.compare_digest(signature, hmac.new(_secret, payload.encode('ascii'), hashlib.sha256).hexdigest()):
+            return None
+        params = json.loads(base64.urlsafe_b64decode(payload.encode('ascii')).decode('utf-8'))
+        if params['expires'] < time.time():
+            return None
+        return params
+    except (ValueError, KeyError, TypeError, UnicodeError, binascii.Error):
+        return None
+
+def generatorCoroutinesSupported():
+    # asyncio of python >= 3.12 does not accept generator based coroutines (start_server silently ignores the
+    # handler, create_task raises)
+    @coroutine
+    def probe():
+        yield from []
+    c = probe()
+    try:
+        return asyncio.iscoroutine(c)
+    finally:
+        c.close()
+
+def allowedOrigin(headers):
+    # the value of Access-Control-Allow-Origin: the origin of the page if it has been served by this host
+    # (the http server on another port), None otherwise
+    origin = headers.get('origin', None)
+    if origin is None:
+        return None
+    try:
+        if urlsplit(origin).hostname == urlsplit("//" + headers.get('host', '')).hostname:
+            return origin
+    except ValueError:
+        pass
+    return None
+
+def eventSource(kind, fallback, **params):
+    # javascript expression of the url for an EventSource: this listener if it is running, otherwise the
+    # fallback url (the cherrypy handler)
+    if _server is None:
+        return json.dumps(fallback)
+    return "window.location.protocol + '//' + window.location.hostname + %s" % json.dumps(
+        ":%d/events?token=%s" % (_server.port, streamToken(kind, **params)))
+
+class LivemapHub:
+    # mirrors the parts of a stream producer into the event loop. A single executor thread per hub waits for
+    # the producer, the clients wait for the changed event.
+    def __init__(self, key, build):
+        self.key = key
+        self.build = build
+        self.parts = {}
+        self.version = 0
+        self.clients = 0
+        self.changed = asyncio.Event()
+
+    def changes(self, seen):
+        return self.version, dict([(name, p[1]) for name, p in self.parts.items() if p[0] > seen])
+
+    @coroutine
+    def run(self, server):
+        loop = asyncio.get_event_loop()
+        seen = 0
+        try:
+            while self.clients > 0 and not server.stopped:
+                seen, res = yield from loop.run_in_executor(server.executor, stream_producer.update, self.key, self.build, seen, 1.)
+                if len(res) > 0:
+                    for name in res:
+                        self.parts[name] = (seen, res[name])
+                    self.version = seen
+                    changed = self.changed
+                    self.changed = asyncio.Event()
+                    changed.set()
+        except:
+            acdebug("exception in livemap hub %s", str(self.key))
+            acdebug(traceback.format_exc())
+        finally:
+            del server.hubs[self.key]
+
+class AsyncStreamingServer:
+    def __init__(self, app, admin, listen_addr, port, sslContext, maxClients):
+        self.app = app
+        self.admin = admin
+        self.listen_addr = listen_addr
+        self.port = port
+        self.sslContext = sslContext
+        self.maxClients = maxClients
+        self.clients = 0
+        self.hubs = {}
+        self.stopped = False
+        self.loop = None
+        self.listening = False
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=16)
+        self.started = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.started.wait(10.)
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        try:
+            server = self.loop.run_until_complete(asyncio.start_server(self.handle, self.listen_addr, self.port, ssl=self.sslContext))
+        except:
+            acerror("Cannot start the streaming listener on port %d:", self.port)
+            acerror(traceback.format_exc())
+            self.started.set()
+            return
+        acinfo("Streaming listener started on port %d", self.port)
+        self.listening = True
+        self.started.set()
+        self.loop.run_forever()
+        server.close()
+        # end the open streams
+        allTasks = asyncio.all_tasks if hasattr(asyncio, 'all_tasks') else asyncio.Task.all_tasks
+        tasks = list(allTasks(self.loop))
+        for t in tasks:
+            t.cancel()
+        if len(tasks) > 0:
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.run_until_complete(server.wait_closed())
+        self.loop.close()
+
+    def stop(self):
+        self.stopped = True
+        if not self.loop is None:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(5.)
+        self.executor.shutdown(wait=False)
+
+    @coroutine
+    def handle(self, reader, writer):
+        try:
+            requestLine = yield from asyncio.wait_for(reader.readline(), 10.)
+            headers = {}
+            while 1:
+                line = yield from asyncio.wait_for(reader.readline(), 10.)
+                if line in [b"\r\n", b"\n", b""]:
+                    break
+                if len(headers) >= 100:
+                    raise ValueError("too many headers")
+                name, sep, value = line.decode('latin-1').partition(":")
+                headers[name.strip().lower()] = value.strip()
+            method, target, version = requestLine.decode('latin-1').split()
+            url = urlsplit(target)
+            params = None
+            if url.path == "/events":
+                params = checkToken(parse_qs(url.query).get('token', [''])[0])
+            origin = allowedOrigin(headers)
+            if method != "GET" or params is None or ('origin' in headers and origin is None):
+                writer.write(b"HTTP/1.1 403 Forbidden\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+            if self.clients >= self.maxClients:
+                writer.write(b"HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                return
+            self.clients += 1
+            try:
+                # the pages are served by the cherrypy server on another port, the token authorizes the stream
+                header = ("HTTP/1.1 200 OK\r\n"
+                          "Content-Type: text/event-stream\r\n"
+                          "Cache-Control: no-cache\r\n")
+                if not origin is None:
+                    header += "Access-Control-Allow-Origin: %s\r\nVary: Origin\r\n" % origin
+                writer.write((header + "Connection: close\r\n\r\n").encode('latin-1'))
+                writer.write(("retry: %d\n\n" % streaming_support.SSE_RETRY).encode('utf-8'))
+                lastEventId = headers.get('last-event-id', None)
+                if params['kind'] == 'livemap':
+                    yield from self.livemap(reader, writer, params, lastEventId)
+                elif params['kind'] == 'log' and not self.admin is None:
+                    yield from self.log(reader, writer, params, lastEventId)
+            finally:
+                self.clients -= 1
+        except (ConnectionError, asyncio.TimeoutError, ValueError):
+            pass
+        except:
+            acdebug("exception in streaming listener")
+            acdebug(traceback.format_exc())
+        finally:
+            writer.close()
+
+    @coroutine
+    def send(self, writer, data):
+        writer.write(data)
+        # backpressure: wait until the buffer of the connection is below the high-water mark, a slow client
+        # gets the latest state afterwards instead of a queue of old updates
+        yield from writer.drain()
+
+    def hub(self, params):
+        features = self.app.features()
+        features['admin'] = params['admin']
+        key, build = self.app.livemapProducerArgs(params['server'], params['global_scale'], features)
+        if not key in self.hubs:
+            self.hubs[key] = LivemapHub(key, build)
+            self.loop.create_task(self.hubs[key].run(self))
+        return self.hubs[key]
+
+    @coroutine
+    def livemap(self, reader, writer, params, lastEventId):
+        hub = self.hub(params)
+        hub.clients += 1
+        try:
+            seen = stream_producer.resumeVersion(lastEventId)
+            while not reader.at_eof() and not self.stopped:
+                changed = hub.changed
+                version, res = hub.changes(seen)
+                if len(res) > 0:
+                    seen = version
+                    yield from self.send(writer, streaming_support.sse_event(res, stream_producer.eventId(seen)))
+                else:
+                    try:
+                        yield from asyncio.wait_for(changed.wait(), streaming_support.SSE_HEARTBEAT)
+                    except asyncio.TimeoutError:
+                        yield from self.send(writer, b": heartbeat\n\n")
+        finally:
+            hub.clients -= 1
+
+    @coroutine
+    def log(self, reader, writer, params, lastEventId):
+        try:
+            offset = int(lastEventId)
+        except (TypeError, ValueError):
+            offset = None
+        chunks = self.admin.logChunks(params['limit'], params['server'], params['level'], offset, streaming_support.SSE_HEARTBEAT)
+        # the log file is read in the executor, the event loop must not block on the file system
+        pending = None
+        try:
+            while not reader.at_eof() and not self.stopped:
+                pending = self.executor.submit(next, chunks, None)
+                item = yield from asyncio.wrap_future(pending)
+                if item is None:
+                    break
+                offset, rows = item
+                if rows is None:
+                    yield from asyncio.sleep(1.)
+                elif rows == "":
+                    yield from self.send(writer, b": heartbeat\n\n")
+                else:
+                    yield from self.send(writer, streaming_support.sse_event(rows, offset))
+        finally:
+            if pending is None or pending.done():
+                chunks.close()
+            else:
+                # still reading (the stream has been cancelled), close the generator afterwards
+                pending.add_done_callback(lambda f: chunks.close())
+
+def start(app, admin, listen_addr):
+    # starts the listener if HTTP_CONFIG.streaming_port is set; app and admin are the cherrypy applications
+    # (admin is None if the admin pages are disabled)
+    global _server
+    cfg = config.config.HTTP_CONFIG
+    if cfg.streaming_port <= 0:
+        return
+    if asyncio is None:
+        acwarning("streaming_port is set, but the asyncio module is not available (python >= 3.4 or the asyncio package is needed). Streams are served by the http server.")
+        return
+    if not generatorCoroutinesSupported():
+        acerror("streaming_port is set, but the streaming listener does not run with this python version (%s). Streams are served by the http server.", sys.version.split()[0])
+        return
+    sslContext = None
+    if (cfg.ssl and cfg.ssl_certificate != "" and cfg.ssl_private_key != "" and
+            os.access(cfg.ssl_certificate, os.R_OK) and os.access(cfg.ssl_private_key, os.R_OK)):
+        sslContext = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        sslContext.load_cert_chain(cfg.ssl_certificate, cfg.ssl_private_key)
+    server = AsyncStreamingServer(app, admin, listen_addr, cfg.streaming_port, sslContext, cfg.max_async_streaming_clients)
+    if server.listening:
+        _server = server
+
+def stop():
+    global _server
+    if not _server is None:
+        _server.stop()
+        _server = None
@@ -188,12 +188,26 @@ class Config:
             'postgres_db'   : ('stracker', conf.get, 'name of the postgres database.'),
             'postgres_pwd'  : ('password', conf.get, 'name of the postgres user password.'),
             'perform_backups' : (True, conf.getboolean, 'Set to "False", if you do not want stracker to backup the database before migrating to a new db version. Note: The backups will be created as sqlite3 db in the current working directory.'),
+            'blob_store_dir' : ('', conf.get, 'If not empty, the detailed lap infos (telemetry) are stored in append-only segment files in this directory instead of the database, keeping the database small. Existing infos are moved there by the database maintenance. The directory must be kept (and backed up) together with the database; the online backups (see DB_BACKUP) include a copy of it. If a relative path is given, it is relative to the <stracker> executable'),
+            'lap_spool_dir' : ('', conf.get, 'If not empty, sessions and laps are written to a local write-ahead spool in this directory and saved to the database in the background. Laps are not lost if the database is temporarily unavailable (they are saved when it is back, also after a restart of stracker), and the lap saving never waits for the database. If a relative path is given, it is relative to the <stracker> executable'),
+            'read_connections' : (0, conf.getint, 'Number of additional read only database connections serving statistic queries (http pages, ptracker requests) in parallel to lap saving. 0 disables the read pool. If > 0 and database_type=sqlite3, the database is switched to WAL journal mode.'),
         }
         self.sections['DB_COMPRESSION'] = {
             'mode' : (self.DBCOMPRESSION_HI_SAVE_ALL, self.getCompressionLevel,
                      'Various options to minimize database size. Valid values are "none" (no compression, save all available infos), "remove_slow_laps" (save detailed infos for fast laps only) and "remove_all" (save no detailed lap info).'),
             'interval' : (60, conf.getint, 'Interval of database compression in minutes.'),
             'needs_empty_server' : (1, conf.getboolean, 'If set to 1, database compression will only take place if the server is empty.'),
+            'chunk_size' : (2000, conf.getint, 'Only relevant if mode=remove_slow_laps. Number of lap ids processed per database transaction.'),
+            'chunk_pause' : (0.5, conf.getfloat, 'Only relevant if mode=remove_slow_laps. Pause in seconds between two chunks, giving room for other database operations.'),
+            'time_budget' : (120, conf.getint, 'Only relevant if mode=remove_slow_laps. Maximum duration of one compression run in seconds; an incomplete run is continued at the next interval. 0 means unlimited.'),
+        }
+        self.sections['DB_BACKUP'] = {
+            'interval' : (0, conf.getint, 'Only relevant if database_type=sqlite3. Interval of the online database backups in hours, 0 disables them. The backups are created while stracker is running, in small steps between the other database operations. If DATABASE.blob_store_dir is set, its segment files are copied (hard linked if possible) to the directory <backup name>.blobs.'),
+            'backup_dir' : ('', conf.get, 'Directory of the online backups, if empty the directory of the database file is used. If a relative path is given, it is relative to the <stracker> executable'),
+            'keep' : (3, conf.getint, 'Number of online backups to keep, older ones are removed.'),
+            'pages_per_step' : (100, conf.getint, 'Number of database pages (normally 1 kB or 4 kB) copied per step. Smaller values reduce the delay of the lap saving during a backup.'),
+            'step_pause' : (0.05, conf.getfloat, 'Pause in seconds between two backup steps, giving room for other database operations.'),
+            'compress' : (True, conf.getboolean, 'If set to 1, the backups are gzip compressed.'),
         }
         self.sections['HTTP_CONFIG'] = {
             'enabled' : (False, conf.getboolean, 'set to 1, if you want to start a http server for statistics access'),
@@ -207,6 +221,9 @@ class Config:
             'log_requests' : (False, conf.getboolean, 'If set to true, http requests will be logged in stracker.log. Otherwise they are not logged.'),
             'auth_log_file' : ('', conf.get, 'Set to a file to be used for logging http authentication requests. Useful to prevent attacks with external program (e.g., fail2ban).'),
             'max_streaming_clients' : (10, conf.getint, 'Maximum number of streaming clients (LiveMap/Log users) allowed to connect to this server in parallel. The number of threads allocated for http serving will be max(10, max_streaming_clients + 5)'),
+            'streaming_port' : (0, conf.getint, 'If set to a tcp port > 0, the LiveMap/Log streams are served by an asyncio based listener on this port instead of the http serving threads, so many streaming clients are possible (needs python >= 3.4 or the asyncio package). The port must be reachable by the browsers, the ssl settings of the http server are used.'),
+            'max_async_streaming_clients' : (1000, conf.getint, 'Maximum number of streaming clients of the asyncio listener (see streaming_port).'),
+            'page_cache_size' : (200, conf.getint, 'Number of rendered pages (lap times, sessions, players, championships, statistics) kept in memory. The cached pages are used until the database is modified, so repeated views do not query the database. Set to 0 to disable the cache.'),
             'lap_times_add_columns' : ('valid+aids+laps+date', conf.get, 'Additional columns to be displayed in LapTimes table (seperated by a + sign). Columns can be "valid", "aids", "laps", "date", "grip", "cuts", "collisions", "tyres", "temps", "ballast" and "vmax". Note that too many displayed columns might cause problems on some browsers.'),
             'inverse_navbar' : (False, conf.getboolean, 'set to true to get the navbar inverted (i.e., dark instead of bright)'),
             'velocity_unit' : (self.VU_KMH, self.getVelUnit, 'Valid values are "kmh" or "mph".'),
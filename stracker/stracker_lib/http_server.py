@@ -19,6 +19,7 @@
 import pickle
 import datetime
 import functools
+import gzip
 import time
 import os.path
 import re
@@ -36,14 +37,19 @@ from collections import OrderedDict,deque
 
 import cherrypy
 from cherrypy.lib import auth_digest
+from cherrypy.lib import cptools
 
 from ptracker_lib.helpers import isProMode, format_time_ms, format_datetime, unixtime2datetime, datetime2unixtime, format_time, localtime2utc, utc2localtime, unixtime_now, format_time_s
 from ptracker_lib.dbgeneric import decompress
+from ptracker_lib.lrucache import LruCache
+from ptracker_lib.profiler import queryProfiler
 from ptracker_lib import read_ui_data
 from stracker_lib.logger import *
 from stracker_lib import config
 from stracker_lib import entry_list
 from stracker_lib import streaming_support
+from stracker_lib import stream_producer
+from stracker_lib import async_streaming
 from stracker_lib import stracker_shm
 from stracker_lib import livemap
 from stracker_lib import acauth
@@ -61,10 +67,14 @@ from http_templates.tmpl_generaladmin import generalAdminTemplate
 from http_templates.tmpl_log import logTemplate
 from http_templates.tmpl_livemap import livemapTemplate, livemapClassification
 from http_templates.tmpl_chat import chatlogTemplate
+from http_templates.tmpl_querystats import queryStatsTemplate
 
 db = None
 banlist = None
+lapSpool = None
 started = False
+# rendered pages (see page_cached), None if disabled by HTTP_CONFIG.page_cache_size
+pageCache = None
 
 def exceptionLogger(f):
     def new_f(*args, **kw):
@@ -116,29 +126,73 @@ def add_url(f):
         return f(*args, **kw)
     return new_f
 
+def accepts_gzip():
+    for e in cherrypy.request.headers.elements('Accept-Encoding'):
+        if e.value in ['gzip', 'x-gzip'] and e.qvalue > 0:
+            return True
+    return False
+
+def page_cached(f):
+    # caches the html rendered by the page handler f and its gzip compressed form. The key consists of the
+    # handler, the normalized arguments (including curr_url, which is embedded in the pages), the admin flag
+    # and the "Pages" generation of the database; all modifications bump the generation (see
+    # GenericBackend.bumpGeneration), so the pages are rendered again when the data has changed.
+    def new_f(self, *args, **kw):
+        generation = db.pageGeneration(__sync=True)()
+        key = (f.__name__, self.rootpage, bool(self.isAdmin()), generation, args,
+               tuple(sorted([(k, tuple(v) if type(v) == list else v) for k, v in kw.items()])))
+        gzipped = accepts_gzip()
+        # the key determines the page, so a valid etag of the browser is answered with 304 without rendering
+        cherrypy.response.headers['ETag'] = http_server_base.pageEtag(key + (gzipped,))
+        cptools.validate_etags()
+        if pageCache is None:
+            return f(self, *args, **kw)
+        hit, page = pageCache.lookup(key)
+        if not hit:
+            page = [f(self, *args, **kw), None]
+            pageCache.put(key, page)
+        if not gzipped:
+            return page[0]
+        if page[1] is None:
+            page[1] = gzip.compress(page[0].encode('utf-8'), 5)
+        # the gzip tool skips the responses marked as cached
+        cherrypy.request.cached = True
+        cherrypy.response.headers['Content-Encoding'] = 'gzip'
+        return page[1]
+    new_f.__name__ = f.__name__
+    return new_f
+
 class StrackerPublic(http_server_base.StrackerPublicBase):
     cp_config = {
         '/img' : {
             'tools.expires.on'    : True,
             'tools.expires.secs'  : 3600*24*7,
+            'tools.etags.on' : True,
+            'tools.etags.autotags' : True,
             'tools.staticdir.on' : True,
             'tools.staticdir.dir' : os.path.abspath(os.path.join(http_server_base.static_base_dir, "http_static", "img")),
         },
         '/jquery' : {
             'tools.expires.on'    : True,
             'tools.expires.secs'  : 3600*24*7,
+            'tools.etags.on' : True,
+            'tools.etags.autotags' : True,
             'tools.staticdir.on' : True,
             'tools.staticdir.dir' : os.path.abspath(os.path.join(http_server_base.static_base_dir, "http_static", "jquery")),
         },
         '/bootstrap' : {
             'tools.expires.on'    : True,
             'tools.expires.secs'  : 3600*24*7,
+            'tools.etags.on' : True,
+            'tools.etags.autotags' : True,
             'tools.staticdir.on' : True,
             'tools.staticdir.dir' : os.path.abspath(os.path.join(http_server_base.static_base_dir, "http_static", "bootstrap")),
         },
         '/pygal' : {
             'tools.expires.on'    : True,
             'tools.expires.secs'  : 3600*24*7,
+            'tools.etags.on' : True,
+            'tools.etags.autotags' : True,
             'tools.staticdir.on' : True,
             'tools.staticdir.dir' : os.path.abspath(os.path.join(http_server_base.static_base_dir, "http_static", "pygal")),
         }
@@ -147,7 +201,7 @@ class StrackerPublic(http_server_base.StrackerPublicBase):
         super().__init__()
         self.rootpage=rootpage
 
-    lapstat = cherrypy.expose(add_url(cherrypy.tools.caching(delay=60)(http_server_base.StrackerPublicBase.lapstat)))
+    lapstat = cherrypy.expose(add_url(page_cached(http_server_base.StrackerPublicBase.lapstat)))
 
     @cherrypy.expose
     @add_url
@@ -156,21 +210,21 @@ class StrackerPublic(http_server_base.StrackerPublicBase):
         return super().lapdetails(lapid=lapid, cmpbits=cmpbits, cmp_lapid=cherrypy.session.get('cmp_lapid', None), curr_url=curr_url)
     #lapdetails = cherrypy.expose(add_url((http_server_base.StrackerPublicBase.lapdetails)))
 
-    sessionstat = cherrypy.expose(add_url(cherrypy.tools.caching(delay=60)(http_server_base.StrackerPublicBase.sessionstat)))
-    sessiondetails = cherrypy.expose(add_url(cherrypy.tools.caching(delay=60)(http_server_base.StrackerPublicBase.sessiondetails)))
-    players = cherrypy.expose(add_url(cherrypy.tools.caching(delay=60)(http_server_base.StrackerPublicBase.players)))
-    playerdetails = cherrypy.expose(add_url(cherrypy.tools.caching(delay=60)(http_server_base.StrackerPublicBase.playerdetails)))
-    mainpage = cherrypy.expose(add_url(cherrypy.tools.caching(delay=3600)(http_server_base.StrackerPublicBase.mainpage)))
-    statistics = cherrypy.expose(add_url(cherrypy.tools.caching(delay=3600)(http_server_base.StrackerPublicBase.statistics)))
-    lapspertrack_svg = cherrypy.expose(add_url(cherrypy.tools.caching(delay=3600)(http_server_base.StrackerPublicBase.lapspertrack_svg)))
-    lapspercar_svg = cherrypy.expose(add_url(cherrypy.tools.caching(delay=3600)(http_server_base.StrackerPublicBase.lapspercar_svg)))
-    serverstats_svg = cherrypy.expose(add_url(cherrypy.tools.caching(delay=3600)(http_server_base.StrackerPublicBase.serverstats_svg)))
-    lapspercombo_svg = cherrypy.expose(add_url(cherrypy.tools.caching(delay=3600)(http_server_base.StrackerPublicBase.lapspercombo_svg)))
-    ltcomparison_svg = cherrypy.expose(add_url(cherrypy.tools.caching(delay=300)(http_server_base.StrackerPublicBase.ltcomparison_svg)))
-    championship = cherrypy.expose(add_url(cherrypy.tools.caching(delay=300)(http_server_base.StrackerPublicBase.championship)))
-    ltcomparisonmap_svg = cherrypy.expose(add_url(cherrypy.tools.caching(delay=300)(http_server_base.StrackerPublicBase.ltcomparisonmap_svg)))
-    carbadge = cherrypy.expose(add_url(cherrypy.tools.caching(delay=10)(http_server_base.StrackerPublicBase.carbadge)))
-    trackmap = cherrypy.expose(add_url(cherrypy.tools.caching(delay=10)(http_server_base.StrackerPublicBase.trackmap)))
+    sessionstat = cherrypy.expose(add_url(page_cached(http_server_base.StrackerPublicBase.sessionstat)))
+    sessiondetails = cherrypy.expose(add_url(page_cached(http_server_base.StrackerPublicBase.sessiondetails)))
+    players = cherrypy.expose(add_url(page_cached(http_server_base.StrackerPublicBase.players)))
+    playerdetails = cherrypy.expose(add_url(page_cached(http_server_base.StrackerPublicBase.playerdetails)))
+    mainpage = cherrypy.expose(cherrypy.tools.etags(autotags=True)(add_url(http_server_base.StrackerPublicBase.mainpage)))
+    statistics = cherrypy.expose(add_url(page_cached(http_server_base.StrackerPublicBase.statistics)))
+    lapspertrack_svg = cherrypy.expose(cherrypy.tools.etags(autotags=True)(add_url(http_server_base.StrackerPublicBase.lapspertrack_svg)))
+    lapspercar_svg = cherrypy.expose(cherrypy.tools.etags(autotags=True)(add_url(http_server_base.StrackerPublicBase.lapspercar_svg)))
+    serverstats_svg = cherrypy.expose(cherrypy.tools.etags(autotags=True)(add_url(http_server_base.StrackerPublicBase.serverstats_svg)))
+    lapspercombo_svg = cherrypy.expose(cherrypy.tools.etags(autotags=True)(add_url(http_server_base.StrackerPublicBase.lapspercombo_svg)))
+    ltcomparison_svg = cherrypy.expose(cherrypy.tools.etags(autotags=True)(add_url(http_server_base.StrackerPublicBase.ltcomparison_svg)))
+    championship = cherrypy.expose(add_url(page_cached(http_server_base.StrackerPublicBase.championship)))
+    ltcomparisonmap_svg = cherrypy.expose(cherrypy.tools.etags(autotags=True)(add_url(http_server_base.StrackerPublicBase.ltcomparisonmap_svg)))
+    carbadge = cherrypy.expose(cherrypy.tools.etags(autotags=True)(add_url(http_server_base.StrackerPublicBase.carbadge)))
+    trackmap = cherrypy.expose(cherrypy.tools.etags(autotags=True)(add_url(http_server_base.StrackerPublicBase.trackmap)))
 
     def isAdmin(self):
         if (config.config.HTTP_CONFIG.admin_username != "" and
@@ -256,161 +310,171 @@ class StrackerPublic(http_server_base.StrackerPublicBase):
         return baseTemplate.render(base=r, pagination=None, src="livemap", rootpage=self.rootpage, features=self.features(), pygal=True, curr_url=curr_url)
 
 
+    def livemapFrame(self, server, global_scale, features, state):
+        # builds the parts of a livemap frame; called by the shared stream producer (see stream_producer.py)
+        # outside of the request, so the features are passed. state keeps the alive ticker between the frames
+        td = self.trackAndCarDetails()['tracks']
+        td = dict(map(lambda x: (x['acname'], x), td))
+
+        radius = 2*global_scale
+        if radius < 5:
+            radius = 5
+        font_size_f = 14/global_scale
+        font_size = "%dpx" % round(font_size_f)
+
+        # fetch server's session info
+        sessionInfo = livemap.SessionInfo()
+        try:
+            b = stracker_shm.get(server, 'session_info')
+            sessionInfo.from_buffer(b, 1)
+        except stracker_shm.ServerError:
+            sessionInfo.track = "<server down>"
+
+        # fetch server's classification info
+        connected = {}
+        rank_map = {}
+        maxLaps = 0
+        colors = ["maroon", "green", "olive", "navy", "purple", "teal", "gray"]
+        color_map = {}
+        try:
+            classInfo = stracker_shm.get(server, 'classification')
+            carClassEntries = []
+            for b in classInfo:
+                ci = livemap.CarClassification()
+                ci.from_buffer(b, 1)
+                carClassEntries.append(ci)
+                connected[ci.guid] = ci.connected
+                rank_map[ci.guid] = ci.pos
+                maxLaps = max(ci.lapCount, maxLaps)
+            guids = [x.guid for x in carClassEntries]
+            for guid in sorted(guids):
+                color_map[guid] = colors[len(color_map) % len(colors)]
+            res_c = livemapClassification.render(server=server, sessionInfo=sessionInfo, classInfo=classInfo, carClassEntries=carClassEntries, color_map=color_map, features=features)
+        except stracker_shm.ServerError:
+            res_c = ""
+
+        # generate session info
+        res_s = ''
+        types = {
+            ac_server_protocol.SESST_PRACTICE: 'Practice',
+            ac_server_protocol.SESST_QUALIFY: 'Qualify',
+            ac_server_protocol.SESST_RACE: 'Race',
+            ac_server_protocol.SESST_DRAG: 'Drag',
+            ac_server_protocol.SESST_DRIFT: 'Drift',
+        }
+        track = td.get(sessionInfo.track, {}).get('uiname', sessionInfo.track)
+        if track is None: track = sessionInfo.track
+        track = cgi.escape(track)
+        session_type = cgi.escape(types[sessionInfo.session_type])
+        if sessionInfo.session_laps > 0:
+            duration = cgi.escape('%d / %d laps'%(maxLaps, sessionInfo.session_laps))
+        else:
+            timeLeft = sessionInfo.session_duration*60*1000 - sessionInfo.elapsedMS
+            timeLeft = format_time_s(int(timeLeft))
+            duration = cgi.escape(timeLeft)
+        res_s = '<td>%(track)s</td><td>%(session_type)s</td><td>%(duration)s</td>\n' % locals()
+
+        # fetch server's car positions
+        try:
+            cpr = stracker_shm.get(server, 'car_positions')
+            res_p = ''
+            alive = True
+            for r in cpr:
+                cp = livemap.CarPosition()
+                cp.from_buffer(r, 1)
+                guid = cp.guid
+                if connected.get(guid, False):
+                    pos = rank_map[guid]
+                    color = color_map[guid]
+                    x = cp.x
+                    y = cp.y
+                    res_p += '<circle r="%(radius).2f" cx="%(x).2f" cy="%(y).2f" fill="%(color)s" stroke="none"></circle>\n' % locals()
+                    fx = x+radius*1.5
+                    fy = y+radius*1.5
+                    res_p += '<text x="%(fx).2f" y="%(fy).2f" style="font-family:verdana; font-size:%(font_size)s" stroke="%(color)s" fill="%(color)s">%(pos)d</text>' % locals()
+        except stracker_shm.ServerError:
+            res_p = ''
+            alive = False
+
+        # update alive data
+        res_a = ''
+        radius = 2*global_scale
+        if radius < 6:
+            radius = 6
+        center = radius + 3
+        if alive:
+            t = time.time()
+            if t - state.get('last_alive_t', 0) > 1.5:
+                state['last_alive_t'] = t
+                state['last_alive_active'] = not state.get('last_alive_active', True)
+            if state['last_alive_active']:
+                res_a += '<circle r="%(radius)d" cx="%(center)d" cy="%(center)d" fill="green" stroke="darkgreen"></circle>\n' % locals()
+            else:
+                res_a += '<circle r="%(radius)d" cx="%(center)d" cy="%(center)d" fill="none" stroke="none"></circle>\n' % locals()
+        else:
+            res_a += '<circle r="%(radius)d" cx="%(center)d" cy="%(center)d" fill="red" stroke="darkred"></circle>\n' % locals()
+
+        # update chat data
+        try:
+            chat_messages = stracker_shm.get(server, 'chat_messages')
+            y = center + radius + font_size_f
+            res_chat = ''
+            for t,name,msg in chat_messages:
+                res_chat += '<text x="0.0" y="%(y).2f" style="font-family:verdana; font-size:%(font_size)s" stroke="green" fill="green">%(name)s: %(msg)s</text>' % locals()
+                y += font_size_f*1.5
+        except stracker_shm.ServerError:
+            res_chat = ''
+
+        return {'class_data': res_c, 'svg_data': res_p, 'chat_data': res_chat, 'session_data': res_s, 'alive_data': res_a}
+
+    def livemapProducerArgs(self, server, global_scale, features):
+        # key and build function of the shared livemap producer; the viewers of a server get the same scale
+        # from the livemap page, the classification differs for admins
+        global_scale = float(global_scale)
+        key = ("livemap", server, "%.5f" % global_scale, bool(features['admin']))
+        return key, functools.partial(self.livemapFrame, server, global_scale, features, {})
+
     @cherrypy.expose
     @add_url
     @streaming_support.json_yield
     #@cherrypy.tools.caching(delay=0.2)
     def livemap_stream(self, server=None, global_scale=1., curr_url=None):
+        # the frames are built once per server by a shared producer, a client gets the parts changed since
+        # its last update
         self.streamingClientsCount += 1
-        last_res_c = None
-        last_res_s = None
-        last_res_p = None
-        last_res_a = None
-        last_res_chat = None
-        last_alive_t = time.time()
-        last_alive_active = False
         try:
             acdebug("streaming started")
-            td = self.trackAndCarDetails()['tracks']
-            td = dict(map(lambda x: (x['acname'], x), td))
-
-            global_scale = float(global_scale)
-            radius = 2*global_scale
-            if radius < 5:
-                radius = 5
-            font_size_f = 14/global_scale
-            font_size = "%dpx" % round(font_size_f)
-
+            key, build = self.livemapProducerArgs(server, global_scale, self.features())
+            seen = 0
             while not stopNow:
-                # fetch server's session info
-                sessionInfo = livemap.SessionInfo()
-                try:
-                    b = stracker_shm.get(server, 'session_info')
-                    sessionInfo.from_buffer(b, 1)
-                except stracker_shm.ServerError:
-                    sessionInfo.track = "<server down>"
-
-                # fetch server's classification info
-                connected = {}
-                rank_map = {}
-                maxLaps = 0
-                colors = ["maroon", "green", "olive", "navy", "purple", "teal", "gray"]
-                color_map = {}
-                try:
-                    classInfo = stracker_shm.get(server, 'classification')
-                    carClassEntries = []
-                    for b in classInfo:
-                        ci = livemap.CarClassification()
-                        ci.from_buffer(b, 1)
-                        carClassEntries.append(ci)
-                        connected[ci.guid] = ci.connected
-                        rank_map[ci.guid] = ci.pos
-                        maxLaps = max(ci.lapCount, maxLaps)
-                    guids = [x.guid for x in carClassEntries]
-                    for guid in sorted(guids):
-                        color_map[guid] = colors[len(color_map) % len(colors)]
-                    res_c = livemapClassification.render(server=server, sessionInfo=sessionInfo, classInfo=classInfo, carClassEntries=carClassEntries, color_map=color_map, features=self.features())
-                except stracker_shm.ServerError:
-                    res_c = ""
-
-                # generate session info
-                res_s = ''
-                types = {
-                    ac_server_protocol.SESST_PRACTICE: 'Practice',
-                    ac_server_protocol.SESST_QUALIFY: 'Qualify',
-                    ac_server_protocol.SESST_RACE: 'Race',
-                    ac_server_protocol.SESST_DRAG: 'Drag',
-                    ac_server_protocol.SESST_DRIFT: 'Drift',
-                }
-                track = td[sessionInfo.track].get('uiname', sessionInfo.track)
-                if track is None: track = sessionInfo.track
-                track = cgi.escape(track)
-                session_type = cgi.escape(types[sessionInfo.session_type])
-                if sessionInfo.session_laps > 0:
-                    duration = cgi.escape('%d / %d laps'%(maxLaps, sessionInfo.session_laps))
-                else:
-                    timeLeft = sessionInfo.session_duration*60*1000 - sessionInfo.elapsedMS
-                    timeLeft = format_time_s(int(timeLeft))
-                    duration = cgi.escape(timeLeft)
-                res_s = '<td>%(track)s</td><td>%(session_type)s</td><td>%(duration)s</td>\n' % locals()
-
-
-                # fetch server's car positions
-                try:
-                    cpr = stracker_shm.get(server, 'car_positions')
-                    res_p = ''
-                    alive = True
-                    for r in cpr:
-                        cp = livemap.CarPosition()
-                        cp.from_buffer(r, 1)
-                        guid = cp.guid
-                        if connected.get(guid, False):
-                            pos = rank_map[guid]
-                            color = color_map[guid]
-                            x = cp.x
-                            y = cp.y
-                            res_p += '<circle r="%(radius).2f" cx="%(x).2f" cy="%(y).2f" fill="%(color)s" stroke="none"></circle>\n' % locals()
-                            fx = x+radius*1.5
-                            fy = y+radius*1.5
-                            res_p += '<text x="%(fx).2f" y="%(fy).2f" style="font-family:verdana; font-size:%(font_size)s" stroke="%(color)s" fill="%(color)s">%(pos)d</text>' % locals()
-                except stracker_shm.ServerError:
-                    res_p = ''
-                    alive = False
-
-                # update alive data
-                res_a = ''
-                radius = 2*global_scale
-                if radius < 6:
-                    radius = 6
-                center = radius + 3
-                if alive:
-                    t = time.time()
-                    if t - last_alive_t > 1.5:
-                        last_alive_t = t
-                        last_alive_active = not last_alive_active
-                    if last_alive_active:
-                        res_a += '<circle r="%(radius)d" cx="%(center)d" cy="%(center)d" fill="green" stroke="darkgreen"></circle>\n' % locals()
-                    else:
-                        res_a += '<circle r="%(radius)d" cx="%(center)d" cy="%(center)d" fill="none" stroke="none"></circle>\n' % locals()
-                else:
-                    res_a += '<circle r="%(radius)d" cx="%(center)d" cy="%(center)d" fill="red" stroke="darkred"></circle>\n' % locals()
-
-                # update chat data
-                try:
-                    chat_messages = stracker_shm.get(server, 'chat_messages')
-                    y = center + radius + font_size_f
-                    res_chat = ''
-                    for t,name,msg in chat_messages:
-                        res_chat += '<text x="0.0" y="%(y).2f" style="font-family:verdana; font-size:%(font_size)s" stroke="green" fill="green">%(name)s: %(msg)s</text>' % locals()
-                        y += font_size_f*1.5
-                except stracker_shm.ServerError:
-                    res_chat = ''
-
-                res = {}
-                if last_res_c != res_c:
-                    res['class_data'] = res_c
-                    last_res_c = res_c
-                if last_res_p != res_p:
-                    res['svg_data'] = res_p
-                    last_res_p = res_p
-                if last_res_chat != res_chat:
-                    res['chat_data'] = res_chat
-                    last_res_chat = res_chat
-                if last_res_s != res_s:
-                    res['session_data'] = res_s
-                    last_res_s = res_s
-                if last_res_a != res_a:
-                    res['alive_data'] = res_a
-                    last_res_a = res_a
+                seen, res = stream_producer.update(key, build, seen, 5.)
                 if len(res) > 0:
                     yield res
-                time.sleep(0.25)
         except:
             acdebug("exception in livemap_stream")
             acdebug(traceback.format_exc())
         finally:
             self.streamingClientsCount -= 1
 
+    @cherrypy.expose
+    @add_url
+    @streaming_support.sse_yield
+    def livemap_events(self, lastEventId, server=None, global_scale=1., curr_url=None):
+        # server-sent events version of livemap_stream; a reconnecting browser gets the parts changed since
+        # its last event
+        self.streamingClientsCount += 1
+        try:
+            key, build = self.livemapProducerArgs(server, global_scale, self.features())
+            seen = stream_producer.resumeVersion(lastEventId)
+            while not stopNow:
+                seen, res = stream_producer.update(key, build, seen, streaming_support.SSE_HEARTBEAT)
+                if len(res) > 0:
+                    yield stream_producer.eventId(seen), res
+                else:
+                    yield None
+        finally:
+            self.streamingClientsCount -= 1
+
 
 class StrackerAdmin(StrackerPublic):
     def __init__(self, username, password):
@@ -428,12 +492,12 @@ class StrackerAdmin(StrackerPublic):
 
     @cherrypy.expose
     @add_url
-    def banlist(self, search_pattern = "", page = 0, curr_url=None):
+    def banlist(self, search_pattern = "", page = 0, after = None, curr_url=None):
         page = int(page)
         nip = self.itemsPerPage
-        res = db.getPlayers(__sync=True, limit=[page*nip+1, nip], searchPattern = search_pattern, inBanList=True)()
+        res = db.getPlayers(__sync=True, limit=[page*nip+1, nip], searchPattern = search_pattern, inBanList=True, after=self.pageKey(after))()
         r = playersTemplate.render(res=res, search_pattern=search_pattern, features=self.features(), caller = "banlist")
-        return baseTemplate.render(base=r, pagination=(page, (res['count']+nip-1)//nip), src="banlist", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
+        return baseTemplate.render(base=r, pagination=(page, (res['count']+nip-1)//nip, self.pageToken(res['nextKey'])), src="banlist", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
 
     @cherrypy.expose
     @add_url
@@ -451,13 +515,13 @@ class StrackerAdmin(StrackerPublic):
 
     @cherrypy.expose
     @add_url
-    def groups(self, group_id = None, page = 0, curr_url=None):
+    def groups(self, group_id = None, page = 0, after = None, curr_url=None):
         page = int(page)
         group_id = int(group_id if not group_id is None else 0)
         nip = self.itemsPerPage
-        res = db.getPlayers(__sync=True, limit=[page*nip+1, nip], group_id=group_id, include_groups=True)()
+        res = db.getPlayers(__sync=True, limit=[page*nip+1, nip], group_id=group_id, include_groups=True, after=self.pageKey(after))()
         r = groupsTemplate.render(res=res, group_id=group_id, features=self.features())
-        return baseTemplate.render(base=r, pagination=(page,(res['count']+nip-1)//nip), src="groups", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
+        return baseTemplate.render(base=r, pagination=(page,(res['count']+nip-1)//nip,self.pageToken(res['nextKey'])), src="groups", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
 
     @cherrypy.expose
     @add_url
@@ -670,10 +734,11 @@ class StrackerAdmin(StrackerPublic):
         r = logTemplate.render(key=streaming_support.new_key(), limit=limit, server=server, servers=servers, level=level)
         return baseTemplate.render(base=r, pagination=None, src="log", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
 
-    @cherrypy.expose
-    @add_url
-    @streaming_support.json_yield
-    def log_stream(self, limit=10, server=None, level="unclassified", curr_url=None):
+    def logChunks(self, limit, server, level, offset=None, heartbeat=20.):
+        # generator of (file offset, html table rows) of the log file. Starts with the last <limit> lines of the
+        # given level, or at offset when resuming an event stream. Yields (offset, None) if there are no new
+        # lines (the caller waits before continuing, see also async_streaming.py), (offset, "") as heartbeat
+        # and (None, message) if the log cannot be read.
 
         def colorize(line):
             res = ('', cgi.escape(line), 4)
@@ -701,15 +766,16 @@ class StrackerAdmin(StrackerPublic):
                 cl = list(colorize(l))
                 if not lastItem is None:
                     if cl[0] == '':
-                        cl[0] = lines[-1][0]
+                        cl[0] = lastItem[0]
                     if cl[2] == 4:
-                        cl[2] = lines[-1][2]
+                        cl[2] = lastItem[2]
                 lastItem = cl
                 lines.append(tuple(cl))
             return lines
 
-        self.streamingClientsCount += 1
-        acdebug("LOGSTREAM start %d", self.streamingClientsCount)
+        def rows(lines):
+            return "\n".join(["<tr><td>"+l[0]+"</td><td>"+l[1]+"</td></tr>" for l in lines if l[2] <= level])
+
         try:
             limit = int(limit)
             level = {"error":0,"warning":1,"info":2,"debug":3,"unclassified":4}[level]
@@ -722,60 +788,99 @@ class StrackerAdmin(StrackerPublic):
             f = open(logfile, "r")
             f.seek(0, os.SEEK_END)
             oldPos = f.tell()
-            lines = []
-            cnt = 0
-            # search last <limit> lines classified correctly
-            for l in tail.reversed_lines(f):
-                r = process([l], None)[0]
-                lines = [l] + lines
-                if r[2] <= level:
-                    cnt += 1
-                    if cnt == limit:
-                        break
-            f.seek(oldPos, os.SEEK_SET)
             lastItem = None
-            lines = process(lines, lastItem)
-            if len(lines): lastItem = lines[-1]
-            lines = filter(lambda l: l[2] <= level, lines)
-            ctail = "\n".join(["<tr><td>"+l[0]+"</td><td>"+l[1]+"</td></tr>" for l in lines])
-            yield ctail
-            pending = ""
+            if offset is None or offset > oldPos:
+                lines = []
+                cnt = 0
+                # search last <limit> lines classified correctly
+                for l in tail.reversed_lines(f):
+                    r = process([l], None)[0]
+                    lines = [l] + lines
+                    if r[2] <= level:
+                        cnt += 1
+                        if cnt == limit:
+                            break
+                lines = process(lines, lastItem)
+                if len(lines): lastItem = lines[-1]
+                yield oldPos, rows(lines)
+            else:
+                oldPos = offset
+            f.close()
+            # the new lines are read in binary mode, so the offsets are byte positions for resuming
+            f = open(logfile, "rb")
+            f.seek(oldPos, os.SEEK_SET)
+            pending = b""
             lastSendTime = time.time()
             while not stopNow:
-                chunk = f.read()
+                # bounded reads, a slow client gets the rest of a large burst in the next chunks
+                chunk = f.read(65536)
                 if len(chunk) == 0:
-                    time.sleep(5)
+                    yield f.tell() - len(pending), None
                 else:
                     pending += chunk
-                    lines = pending.split("\n")
+                    lines = pending.split(b"\n")
                     pending = lines[-1]
-                    lines = process(lines[:-1], lastItem)
+                    lines = process([l.decode('utf-8', errors='replace').rstrip('\r') for l in lines[:-1]], lastItem)
                     if len(lines): lastItem = lines[-1]
-                    lines = filter(lambda l: l[2] <= level, lines)
-                    fmt = "\n".join(["<tr><td>"+l[0]+"</td><td>"+l[1]+"</td></tr>" for l in lines])
+                    fmt = rows(lines)
                     if fmt != '':
-                        yield fmt
+                        yield f.tell() - len(pending), fmt
                         lastSendTime = time.time()
-                if time.time() - lastSendTime > 20:
-                    yield ""
+                if time.time() - lastSendTime > heartbeat:
+                    yield f.tell() - len(pending), ""
+                    lastSendTime = time.time()
         except GeneratorExit:
             acdebug("generator exit")
         except KeyError:
-            yield cgi.escape("<Server down?>")
+            yield None, cgi.escape("<Server down?>")
         except stracker_shm.ServerError:
-            yield cgi.escape("<Server down?>")
+            yield None, cgi.escape("<Server down?>")
         except:
-            yield cgi.escape("<Interrupted>")
+            yield None, cgi.escape("<Interrupted>")
             acerror("Exception in log_stream:")
             acerror(traceback.format_exc())
+
+    @cherrypy.expose
+    @add_url
+    @streaming_support.json_yield
+    def log_stream(self, limit=10, server=None, level="unclassified", curr_url=None):
+        self.streamingClientsCount += 1
+        acdebug("LOGSTREAM start %d", self.streamingClientsCount)
+        try:
+            for offset, rows in self.logChunks(limit, server, level):
+                if rows is None:
+                    time.sleep(5)
+                else:
+                    yield rows
+        finally:
+            self.streamingClientsCount -= 1
+            acdebug("LOG_STREAM stopped %d", self.streamingClientsCount)
+
+    @cherrypy.expose
+    @add_url
+    @streaming_support.sse_yield
+    def log_events(self, lastEventId, limit=10, server=None, level="unclassified", curr_url=None):
+        # server-sent events version of log_stream; the event ids are the file offsets, so a reconnecting
+        # browser continues after the last lines it got
+        try:
+            offset = int(lastEventId)
+        except (TypeError, ValueError):
+            offset = None
+        self.streamingClientsCount += 1
+        try:
+            for offset, rows in self.logChunks(limit, server, level, offset, streaming_support.SSE_HEARTBEAT):
+                if rows is None:
+                    time.sleep(5)
+                elif rows == "":
+                    yield None
+                else:
+                    yield offset, rows
+        finally:
             self.streamingClientsCount -= 1
-            return
-        self.streamingClientsCount -= 1
-        acdebug("LOG_STREAM stopped %d", self.streamingClientsCount)
 
     @cherrypy.expose
     @add_url
-    def chatlog(self, server=None, date_from=None, date_to=None, page=0, curr_url=None):
+    def chatlog(self, server=None, date_from=None, date_to=None, page=0, after=None, curr_url=None):
         servers = sorted(db.allservers(__sync=True)())
         if server is None:
             server = config.config.STRACKER_CONFIG.server_name
@@ -792,10 +897,10 @@ class StrackerAdmin(StrackerPublic):
         except:
             page = 0
         nip = self.itemsPerPage
-        res = db.filterChat(__sync=True, server=server, startTime=date_from_ts, endTime=date_to_ts, limit=[nip*page+1, nip])()
+        res = db.filterChat(__sync=True, server=server, startTime=date_from_ts, endTime=date_to_ts, limit=[nip*page+1, nip], after=self.pageKey(after))()
         r = chatlogTemplate.render(server=server, servers=servers, date_from=date_from, date_to=date_to, messages=res['messages'])
         totalPages=(res['totalCount']+nip-1)//nip
-        return baseTemplate.render(base=r, pagination=[page, totalPages], src="log", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
+        return baseTemplate.render(base=r, pagination=[page, totalPages, self.pageToken(res['nextKey'])], src="log", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
 
     @cherrypy.expose
     @add_url
@@ -877,6 +982,38 @@ class StrackerAdmin(StrackerPublic):
 
         return chart.render()
 
+    @cherrypy.expose
+    @add_url
+    def db_queue_stats(self, curr_url=None):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(db.queueStats())
+
+    @cherrypy.expose
+    @add_url
+    def db_query_stats(self, sort='total', reset=None, curr_url=None):
+        if not reset is None:
+            queryProfiler.reset()
+            self.redirect("db_query_stats", sort=sort)
+        stats = queryProfiler.dump()
+        if not sort in ['avg', 'max', 'count', 'rows', 'lockWait', 'prepares', 'variants']:
+            sort = 'total'
+        stats['statements'].sort(key=lambda x: x[sort], reverse=True)
+        cacheStats = db.bestTimesCacheStats(__sync=True)()
+        pageCacheStats = pageCache.stats() if not pageCache is None else None
+        spoolStats = lapSpool.stats() if not lapSpool is None else None
+        r = queryStatsTemplate.render(stats=stats, sort=sort, cacheStats=cacheStats, pageCacheStats=pageCacheStats, spoolStats=spoolStats)
+        return baseTemplate.render(base=r, pagination=None, src="querystats", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
+
+    @cherrypy.expose
+    @add_url
+    def db_query_stats_json(self, curr_url=None):
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        res = queryProfiler.dump()
+        res['bestTimesCache'] = db.bestTimesCacheStats(__sync=True)()
+        res['pageCache'] = pageCache.stats() if not pageCache is None else None
+        res['lapSpool'] = lapSpool.stats() if not lapSpool is None else None
+        return json.dumps(res)
+
     @cherrypy.expose
     @add_url
     def whisper(self, guid, text, server, curr_url=None):
@@ -951,9 +1088,12 @@ class LoggerHandler(logging.Handler):
             url = "<unknown>"
         log_f("While processing url: %s\n%s", url, msg)
 
-def start(database, listen_addr, listen_port, refBanlist, udp_plugin_):
-    global db, banlist, udp_plugin, started
+def start(database, listen_addr, listen_port, refBanlist, udp_plugin_, lapSpool_ = None):
+    global db, banlist, udp_plugin, started, lapSpool, pageCache
     db = database
+    lapSpool = lapSpool_
+    if config.config.HTTP_CONFIG.page_cache_size > 0:
+        pageCache = LruCache(config.config.HTTP_CONFIG.page_cache_size)
     http_server_base.db = database
 
     banlist = refBanlist
@@ -962,6 +1102,7 @@ def start(database, listen_addr, listen_port, refBanlist, udp_plugin_):
 
     app = StrackerPublic()
     cherrypy.tree.mount(app, config=app.cp_config)
+    admin = None
     if config.config.HTTP_CONFIG.admin_username != "" and config.config.HTTP_CONFIG.admin_password != "":
         admin = StrackerAdmin(config.config.HTTP_CONFIG.admin_username, config.config.HTTP_CONFIG.admin_password)
         cherrypy.tree.mount(admin, script_name="/admin", config=admin.cp_config)
@@ -998,12 +1139,15 @@ def start(database, listen_addr, listen_port, refBanlist, udp_plugin_):
 
     cherrypy.engine.start()
     started = True
+    async_streaming.start(app, admin, listen_addr)
     acdebug("http server started")
 
 stopNow = False
 def stop():
     global stopNow, started
     stopNow = True
+    async_streaming.stop()
+    stream_producer.shutdown()
     if started:
         print("Stopping http server; please wait - this might take some time")
         cherrypy.engine.exit()
@@ -18,6 +18,8 @@
 
 
 from collections import OrderedDict
+import base64
+import hashlib
 import math
 import os
 import pickle
@@ -26,6 +28,7 @@ import shutil
 import sys
 import time
 import traceback
+import uuid
 
 from threading import RLock
 from urllib.parse import urlparse, parse_qsl
@@ -37,6 +40,7 @@ from stracker_lib import version
 from ptracker_lib.dbgeneric import decompress
 from ptracker_lib.helpers import isProMode, format_time_ms, format_datetime, unixtime2datetime, datetime2unixtime, format_time, localtime2utc, utc2localtime, unixtime_now, format_time_s, setFormatUnits
 from ptracker_lib import read_ui_data
+from ptracker_lib.ps_protocol import ProtocolHandler
 
 import pygal # needed for pyinstaller
 from pygal import Line, Pie, DateLine, XY, Config, StackedLine
@@ -84,8 +88,21 @@ pygalConfig = Config(style=CleanStyle,
                      tooltip_border_radius=10,
                      disable_xml_declaration=True)
 db = None
+# the rendering depends on the version and the configuration, so the page etags are valid in this process only
+etagSalt = uuid.uuid4().hex[:8]
+
+def contentEtag(content):
+    return '"%s"' % hashlib.sha1(content).hexdigest()
+
+def pageEtag(key):
+    # strong etag of a page rendered from the database without rendering it. The key must contain the
+    # "Pages" generation of the database (see GenericBackend.bumpGeneration) and all other inputs.
+    return '"%s-%s"' % (etagSalt, hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
 
 class StrackerPublicBase:
+    # the pages depending only on their url and the database (see pageEtag)
+    generationPages = ['lapstat', 'sessionstat', 'sessiondetails', 'players', 'playerdetails', 'statistics', 'championship']
+
     def __init__(self):
         self.rootpage = '/'
         self.static_base_dir = static_base_dir
@@ -129,6 +146,25 @@ class StrackerPublicBase:
             return (datetime2unixtime(dt)+off, date)
         return (None,"")
 
+    def pageToken(self, key):
+        # opaque continuation token for the URLs of the paged views from the 'nextKey' of a db result
+        if key is None:
+            return None
+        return base64.urlsafe_b64encode(json.dumps(list(key)).encode("utf-8")).decode("ascii").rstrip("=")
+
+    def pageKey(self, token):
+        # inverse of pageToken, returns None for missing or invalid tokens (the page number is used then)
+        if token is None or token == "":
+            return None
+        try:
+            key = json.loads(base64.urlsafe_b64decode((token + "="*(-len(token) % 4)).encode("ascii")).decode("utf-8"))
+            if type(key) == list and len(key) == 2 and all([type(k) in [int, float, str, type(None)] for k in key]):
+                return tuple(key)
+        except Exception:
+            pass
+        acdebug("Ignoring invalid page token %s", repr(token))
+        return None
+
     def trackAndCarDetails(self):
         with self.trackAndCarLock:
             if self._trackAndCarDetails is None or time.time()-self._trackAndCarDetailsTS > 60*30:
@@ -204,7 +240,7 @@ class StrackerPublicBase:
             tmpl_helpers.set_car_info(dict(map(lambda x: (x['acname'], x), self._trackAndCarDetails['cars'])))
             self._trackAndCarDetailsTS = time.time()
 
-    def lapstat(self, track = None, cars = None, page = 0, valid = None, date_from = None, date_to = None, tyres = None, currservers = None, ranking = None, groups = None, curr_url=None):
+    def lapstat(self, track = None, cars = None, page = 0, valid = None, date_from = None, date_to = None, tyres = None, currservers = None, ranking = None, groups = None, after = None, curr_url=None):
         if not currservers is None:
             currservers = currservers.split(",")
             server = currservers[0] if len(currservers) else None
@@ -263,7 +299,8 @@ class StrackerPublicBase:
                           artint=0,
                           server=server,
                           group_by_guid=ranking,
-                          groups=groups)()
+                          groups=groups,
+                          after=self.pageKey(after))()
         if not res is None:
             count = 0
             for i,s in enumerate(res['bestSectors']):
@@ -272,8 +309,10 @@ class StrackerPublicBase:
             totalPages=(res['totalNumLaps']+nip-1)//nip
             lapStatRes = res['laps']
             bestSectors = res['bestSectors']
+            nextToken = self.pageToken(res['nextKey'])
         else:
             totalPages = 1
+            nextToken = None
             count = 0
             lapStatRes = []
             bestSectors = []
@@ -294,7 +333,7 @@ class StrackerPublicBase:
                                         currgroups=groups,
                                         groups=allgroups,
                                         features=self.features())
-        return baseTemplate.render(base=r, pagination=(page, totalPages), src="lapstat", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
+        return baseTemplate.render(base=r, pagination=(page, totalPages, nextToken), src="lapstat", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
 
     def lapdetails(self, lapid, cmpbits=None, cmp_lapid=None, curr_url=None):
         lapid = int(lapid)
@@ -303,7 +342,7 @@ class StrackerPublicBase:
         r = lapDetailsTableTemplate.render(lapdetails=details, cmpbits=cmpbits, features=self.features(), http_server=self, cmp_lapid=cmp_lapid, curr_url=curr_url)
         return baseTemplate.render(base=r, pagination=None, src="lapstat", rootpage=self.rootpage, features=self.features(), pygal=True, curr_url=curr_url)
 
-    def sessionstat(self, track = "(all)", page = 0, start = None, stop = None, session_types = None, num_players = None, num_laps = None, curr_url=None):
+    def sessionstat(self, track = "(all)", page = 0, start = None, stop = None, session_types = None, num_players = None, num_laps = None, after = None, curr_url=None):
         tracks = [dict(track="(all)",uitrack="(all)")] + sorted(db.alltracks(__sync=True)(), key=lambda x: x['uitrack'])
         currtrack = track
         from_time = self.toTimestamp(start)
@@ -328,9 +367,11 @@ class StrackerPublicBase:
                               minSessionStartTime = [from_time[0], to_time[0]],
                               minNumPlayers = num_players,
                               minNumLaps = num_laps,
-                              multiplayer = [0,1])()
+                              multiplayer = [0,1],
+                              after = self.pageKey(after))()
         if not res is None:
             totalPages=(res['numberOfSessions']+nip-1)//nip
+            nextToken = self.pageToken(res['nextKey'])
             r = sesStatTableTemplate.render(sesStatRes=res['sessions'],
                                             tracks=tracks, currtrack=currtrack,
                                             datespan=[from_time[1],to_time[1]],
@@ -340,10 +381,11 @@ class StrackerPublicBase:
                                             features=self.features())
         else:
             totalPages=1
+            nextToken = None
             r = sesStatTableTemplate.render(sesStatRes=[],
                                             tracks=tracks, currtrack=currtrack,
                                             features=self.features())
-        return baseTemplate.render(base=r, pagination=(page,totalPages), src="sesstat", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
+        return baseTemplate.render(base=r, pagination=(page,totalPages,nextToken), src="sesstat", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
 
     def sessiondetails(self, sessionid = None, playerInSessionId = None, curr_url=None):
         if not sessionid is None:
@@ -363,15 +405,15 @@ class StrackerPublicBase:
             r = pisDetailsTemplate.render(res=res, features=self.features())
             return baseTemplate.render(base=r, pagination=None, src="sesstat", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
 
-    def players(self, search_pattern = "", page = 0, orderby = None, curr_url=None):
+    def players(self, search_pattern = "", page = 0, orderby = None, after = None, curr_url=None):
         page = int(page)
         nip = self.itemsPerPage
         orderby_src ={'0': 'lastseen', '1': 'drivername'}
         orderby = orderby_src.get(orderby, 'lastseen')
-        res = db.getPlayers(__sync=True, limit=[page*nip+1, nip], searchPattern = search_pattern, orderby=orderby)()
+        res = db.getPlayers(__sync=True, limit=[page*nip+1, nip], searchPattern = search_pattern, orderby=orderby, after=self.pageKey(after))()
         #acdebug("page=%d nip=%d count=%d", page, nip, res['count'])
         r = playersTemplate.render(res=res, search_pattern=search_pattern, features=self.features(), caller = "players")
-        return baseTemplate.render(base=r, pagination=(page, (res['count']+nip-1)//nip), src="players", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
+        return baseTemplate.render(base=r, pagination=(page, (res['count']+nip-1)//nip, self.pageToken(res['nextKey'])), src="players", rootpage=self.rootpage, features=self.features(), pygal=False, curr_url=curr_url)
 
     def playerdetails(self, pid, curr_url=None):
         res = db.playerDetails(__sync=True, playerid=pid)()
@@ -714,7 +756,9 @@ class StrackerPublicBase:
                         pass
             return ""
 
-    def serve_pts(self, url):
+    def serve_pts(self, url, etag = None):
+        # returns (content, content type, cacheable, etag). If the etag of the client's copy is still valid, the
+        # content is empty and the content type is ProtocolHandler.PTS_NOT_MODIFIED.
         item = '?'
         query = {}
         try:
@@ -726,6 +770,12 @@ class StrackerPublicBase:
             headers = {'png': 'application/octet-stream', '':'image/x-png', 'css': 'text/css', '.js': 'application/javascript', 'ttf': 'application/octet-stream'}
             if not item[-3:] in headers:
                 item = item.replace('.', '_')
+                newEtag = None
+                if item in self.generationPages:
+                    newEtag = pageEtag((item, url, db.pageGeneration(__sync=True)()))
+                    if newEtag == etag:
+                        acinfo("serving %s(%s) - not modified", item, query)
+                        return (b"", ProtocolHandler.PTS_NOT_MODIFIED, False, etag)
                 content = getattr(self, item)(curr_url = url, **query)
                 if type(content) == str:
                     content = content.encode('utf-8')
@@ -739,8 +789,13 @@ class StrackerPublicBase:
                     except:
                         content = str(content).encode('utf-8')
                         ctype = "text/html; charset=utf-8"
+                if newEtag is None:
+                    newEtag = contentEtag(content)
+                if newEtag == etag:
+                    acinfo("serving %s(%s) - not modified", item, query)
+                    return (b"", ProtocolHandler.PTS_NOT_MODIFIED, False, etag)
                 acinfo("serving %s(%s) (size=%d)", item, query, len(content))
-                return (content, ctype, False)
+                return (content, ctype, False, newEtag)
             else:
                 content = None
                 for d in ['http_static', 'http_static/bootstrap', 'http_static/img', 'http_static/jquery', 'http_static/pygal']:
@@ -748,13 +803,17 @@ class StrackerPublicBase:
                     if os.path.exists(p):
                         header = headers[p[-3:]]
                         content = open(p, 'rb').read()
+                        newEtag = contentEtag(content)
+                        if newEtag == etag:
+                            acinfo('serving %s - not modified', p)
+                            return (b"", ProtocolHandler.PTS_NOT_MODIFIED, True, etag)
                         acinfo('serving %s size=%d contenttype=%s', p, len(content), header)
-                        return (content, header, True)
+                        return (content, header, True, newEtag)
                 if content is None:
                     content = "NOT FOUND"
                     acinfo('serving %s(%s) - not found, base dir = %s', item, query, self.static_base_dir)
-                    return (content.encode(), "x-error/not-found", False)
+                    return (content.encode(), "x-error/not-found", False, "")
         except:
             content = traceback.format_exc()
             acinfo("serving %s(%s) - error: %s", item, query, content)
-            return (content.encode(), "x-error/traceback", False)
+            return (content.encode(), "x-error/traceback", False, "")
@@ -0,0 +1,290 @@
+# Copyright 2015-2016 NEYS
+# This file is part of sptracker.
+#
+#    sptracker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sptracker is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Write-ahead spool of the session mutations (newSession, registerLap, finishSession).
+#
+# The calls are appended to a local log file (and fsync'ed) instead of being executed synchronously, so
+# the lap path never blocks on the database and no lap is lost while the database is unavailable (e.g.
+# postgres restarting or sqlite locked by a backup). A drainer thread replays the records in order and in
+# batches (see GenericBackend.applySpoolRecords), retrying with increasing pauses on errors. The sessions
+# must be replayed as well, because registerLap refers to the current session of the backend.
+#
+# Every record carries an idempotency key (spool id and sequence number), the backend remembers the keys
+# of the inserted laps and sessions, so replaying records after a crash between the insert and the
+# acknowledge does not create duplicates. The sequence number of the last applied record is stored in
+# spool.ack; the log is truncated when everything is applied (keeping the last newSession record, which
+# is needed to replay the laps of a session after a restart).
+#
+# Log layout: records of (length, crc32, sequence number) header and the zlib compressed pickle of
+# (kind, keyword arguments, timestamp). A torn record at the end of the log is discarded.
+
+import os
+import zlib
+import time
+import uuid
+import types
+import pickle
+import struct
+import threading
+import traceback
+from collections import deque
+from ptracker_lib.helpers import unixtime_now
+from stracker_lib.logger import *
+
+RECORD_HEADER = struct.Struct("<IIQ")
+KINDS = ["newSession", "registerLap", "finishSession"]
+
+class SpoolRecord:
+    def __init__(self, seq, kind, kw, timestamp):
+        self.seq = seq
+        self.kind = kind
+        self.kw = kw
+        self.timestamp = timestamp
+        self.attempts = 0
+
+class LapSpool:
+    # records per database call, pauses between retries [s], failed attempts until a record with invalid
+    # data is rejected (database errors are retried forever)
+    batchSize = 20
+    minRetryInterval = 1.
+    maxRetryInterval = 60.
+    maxAttempts = 5
+    dataErrors = (AssertionError, TypeError, ValueError, KeyError, AttributeError)
+    # the log is truncated if it is larger than that and nothing is pending [bytes]
+    maxLogSize = 1024*1024
+
+    def __init__(self, directory, database, lapRegistered = lambda notify, lapId: None):
+        self.directory = directory
+        self.database = database
+        # called in the drainer thread after a lap has been inserted (e.g. for the PB/SB messages)
+        self.lapRegistered = lapRegistered
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.pending = deque()
+        self.lastNewSession = None
+        self.appended = 0
+        self.applied = 0
+        self.batches = 0
+        self.failures = 0
+        self.rejected = 0
+        self.lastError = None
+        self.stopped = False
+        os.makedirs(directory, exist_ok=True)
+        idFile = os.path.join(directory, "spool.id")
+        if not os.path.exists(idFile):
+            with open(idFile, "w") as f:
+                f.write(uuid.uuid4().hex)
+        self.spoolId = open(idFile).read().strip()
+        self.ackSeq = 0
+        try:
+            self.ackSeq = int(open(self.path("spool.ack")).read().strip())
+        except (OSError, ValueError):
+            pass
+        self.nextSeq = self.recover() + 1
+        self.log = open(self.path("spool.log"), "ab")
+        self.thread = threading.Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def recover(self):
+        # read the log and queue the records not applied yet; returns the highest sequence number
+        maxSeq = self.ackSeq
+        validSize = 0
+        try:
+            data = open(self.path("spool.log"), "rb").read()
+        except OSError:
+            data = b""
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, crc, seq = RECORD_HEADER.unpack_from(data, offset)
+            payload = data[offset+RECORD_HEADER.size:offset+RECORD_HEADER.size+length]
+            if len(payload) != length or zlib.crc32(payload) != crc:
+                break
+            kind, kw, timestamp = pickle.loads(zlib.decompress(payload))
+            if kind == "registerLap":
+                # no PB/SB messages for the laps of the last run, they might have been sent already
+                kw['notify'] = None
+            r = SpoolRecord(seq, kind, kw, timestamp)
+            if kind == "newSession":
+                self.lastNewSession = r
+            if seq > self.ackSeq:
+                if len(self.pending) == 0 and kind != "newSession" and not self.lastNewSession is None:
+                    # the session of these laps has been applied before the restart, it has to be set again
+                    self.pending.append(self.lastNewSession)
+                self.pending.append(r)
+            maxSeq = max(maxSeq, seq)
+            offset += RECORD_HEADER.size + length
+            validSize = offset
+        if validSize < len(data):
+            acwarning("Lap spool: discarding %d bytes of an incomplete record.", len(data) - validSize)
+            with open(self.path("spool.log"), "r+b") as f:
+                f.truncate(validSize)
+        if len(self.pending) > 0:
+            acinfo("Lap spool: %d records from the last run are pending.", len(self.pending))
+        return maxSeq
+
+    def idempotencyKey(self, seq):
+        return "%s:%d" % (self.spoolId, seq)
+
+    def append(self, kind, **kw):
+        assert kind in KINDS
+        with self.lock:
+            seq = self.nextSeq
+            self.nextSeq += 1
+            kw['idempotencyKey'] = self.idempotencyKey(seq)
+            r = SpoolRecord(seq, kind, kw, time.time())
+            payload = zlib.compress(pickle.dumps((kind, kw, r.timestamp), protocol=3), 6)
+            self.log.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload), seq) + payload)
+            self.log.flush()
+            os.fsync(self.log.fileno())
+            if kind == "newSession":
+                self.lastNewSession = r
+            self.pending.append(r)
+            self.appended += 1
+            self.cond.notify()
+
+    def newSession(self, **kw):
+        kw.setdefault('startTime', unixtime_now())
+        self.append("newSession", **kw)
+
+    def registerLap(self, notify = None, **kw):
+        # notify is passed to the lapRegistered callback, lapHistory is stored as plain attributes
+        kw['lapHistory'] = dict(vars(kw['lapHistory']))
+        kw['notify'] = notify
+        kw.setdefault('timestamp', unixtime_now())
+        self.append("registerLap", **kw)
+
+    def finishSession(self, **kw):
+        kw.setdefault('endTime', unixtime_now())
+        self.append("finishSession", **kw)
+
+    def drain(self):
+        retryInterval = self.minRetryInterval
+        while True:
+            with self.lock:
+                while len(self.pending) == 0 and not self.stopped:
+                    self.cond.wait()
+                if len(self.pending) == 0 or self.stopped:
+                    return
+                batch = list(self.pending)[:self.batchSize]
+            records = []
+            for r in batch:
+                kw = dict(r.kw)
+                if r.kind == "registerLap":
+                    kw['lapHistory'] = types.SimpleNamespace(**kw['lapHistory'])
+                    del kw['notify']
+                records.append((r.kind, kw))
+            try:
+                res, error = self.database.applySpoolRecords(__sync=True, records=records)()
+            except Exception as e:
+                res, error = [], e
+            self.done(batch[:len(res)], res)
+            if error is None:
+                retryInterval = self.minRetryInterval
+                continue
+            self.failed(batch[len(res)], error)
+            with self.lock:
+                if self.stopped:
+                    return
+                self.cond.wait(retryInterval)
+            retryInterval = min(self.maxRetryInterval, retryInterval*2)
+
+    def done(self, batch, results):
+        if len(batch) == 0:
+            return
+        with self.lock:
+            for r in batch:
+                self.pending.popleft()
+            self.applied += len(batch)
+            self.batches += 1
+            self.acknowledge(batch[-1].seq)
+        for r, lapId in zip(batch, results):
+            if r.kind == "registerLap" and not lapId is None and not r.kw['notify'] is None:
+                try:
+                    self.lapRegistered(r.kw['notify'], lapId)
+                except:
+                    acwarning("Lap spool: error in lap notification:")
+                    acwarning(traceback.format_exc())
+
+    def failed(self, r, error):
+        with self.lock:
+            self.failures += 1
+            self.lastError = str(error)
+            r.attempts += 1
+            if r.attempts == 1:
+                acwarning("Lap spool: cannot apply %s (%s), retrying.", r.kind, str(error))
+            if r.attempts >= self.maxAttempts and isinstance(error, self.dataErrors):
+                # not a temporary problem of the database, don't block the other records
+                acerror("Lap spool: giving up %s after %d attempts, the record is moved to spool.rejected.", r.kind, r.attempts)
+                payload = zlib.compress(pickle.dumps((r.kind, r.kw, r.timestamp), protocol=3), 6)
+                with open(self.path("spool.rejected"), "ab") as f:
+                    f.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload), r.seq) + payload)
+                self.pending.popleft()
+                self.rejected += 1
+                self.acknowledge(r.seq)
+
+    def acknowledge(self, seq):
+        # called with the lock held; the ack file needs no fsync, replays are detected by the idempotency keys
+        self.ackSeq = max(self.ackSeq, seq)
+        tmp = self.path("spool.ack.tmp")
+        with open(tmp, "w") as f:
+            f.write("%d" % self.ackSeq)
+        os.replace(tmp, self.path("spool.ack"))
+        if len(self.pending) == 0 and self.log.tell() > self.maxLogSize:
+            self.truncate()
+
+    def truncate(self):
+        # rewrite the log with the last newSession record only (called with the lock held, nothing pending)
+        tmp = self.path("spool.log.tmp")
+        with open(tmp, "wb") as f:
+            r = self.lastNewSession
+            if not r is None:
+                payload = zlib.compress(pickle.dumps((r.kind, r.kw, r.timestamp), protocol=3), 6)
+                f.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload), r.seq) + payload)
+            f.flush()
+            os.fsync(f.fileno())
+        self.log.close()
+        os.replace(tmp, self.path("spool.log"))
+        self.log = open(self.path("spool.log"), "ab")
+
+    def stats(self):
+        with self.lock:
+            now = time.time()
+            return {'depth': len(self.pending),
+                    'oldestAge': now - self.pending[0].timestamp if len(self.pending) > 0 else 0.,
+                    'appended': self.appended,
+                    'applied': self.applied,
+                    'batches': self.batches,
+                    'failures': self.failures,
+                    'rejected': self.rejected,
+                    'logSize': self.log.tell(),
+                    'lastError': self.lastError}
+
+    def shutdown(self, timeout = 10.):
+        # give the drainer some time to apply the pending records, the rest is applied after the next start
+        t0 = time.time()
+        with self.lock:
+            while len(self.pending) > 0 and time.time() - t0 < timeout:
+                self.cond.wait(0.1)
+            self.stopped = True
+            self.cond.notify_all()
+            if len(self.pending) > 0:
+                acwarning("Lap spool: %d records are still pending, they are applied after the next start.", len(self.pending))
+        self.thread.join(1.)
+        with self.lock:
+            self.log.close()
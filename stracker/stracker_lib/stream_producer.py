@@ -0,0 +1,139 @@
+# Copyright 2015-2016 NEYS
+# This file is part of sptracker.
+#
+#    sptracker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sptracker is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Shared producers of streamed frames (e.g. the livemap).
+#
+# A producer thread calls build() periodically; build returns a dict of named parts (e.g. the svg data and
+# the classification html). Each part remembers the version of its last change, so the frame is built and
+# diffed once, independent of the number of clients. A client keeps the version it has seen and gets the
+# parts changed after that version. Producers stop when no client asked for some time and are created again
+# on demand; the versions are global, so a client never misses a change of a re-created producer.
+
+import itertools
+import threading
+import time
+import traceback
+import uuid
+from stracker_lib.logger import *
+
+_versions = itertools.count(1)
+# the versions restart with the process, event ids of an older process must not be used for resuming
+_epoch = uuid.uuid4().hex[:8]
+_producers = {}
+_lock = threading.Lock()
+
+class StreamProducer:
+    def __init__(self, key, build, interval, idleTimeout):
+        self.key = key
+        self.build = build
+        self.interval = interval
+        self.idleTimeout = idleTimeout
+        self.cond = threading.Condition()
+        self.version = 0
+        self.parts = {}
+        self.lastRequest = time.time()
+        self.frames = 0
+        self.buildTime = 0.
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        acdebug("stream producer %s started", str(self.key))
+        while 1:
+            with _lock:
+                with self.cond:
+                    if self.stopped or time.time() - self.lastRequest > self.idleTimeout:
+                        self.stopped = True
+                        if _producers.get(self.key, None) is self:
+                            del _producers[self.key]
+                        self.cond.notify_all()
+                        break
+            t0 = time.time()
+            try:
+                parts = self.build()
+            except:
+                acdebug("exception in stream producer %s", str(self.key))
+                acdebug(traceback.format_exc())
+                parts = {}
+            with self.cond:
+                version = None
+                for name in parts:
+                    if not name in self.parts or self.parts[name][1] != parts[name]:
+                        if version is None:
+                            version = next(_versions)
+                        self.parts[name] = (version, parts[name])
+                if not version is None:
+                    self.version = version
+                    self.cond.notify_all()
+                self.frames += 1
+                self.buildTime += time.time() - t0
+            time.sleep(max(0., self.interval - (time.time() - t0)))
+        acdebug("stream producer %s stopped", str(self.key))
+
+    def changes(self, seen):
+        # returns the current version and the parts changed after version seen (called with the lock held)
+        return self.version, dict([(name, p[1]) for name, p in self.parts.items() if p[0] > seen])
+
+    def update(self, seen, timeout):
+        # waits up to timeout seconds for parts changed after version seen
+        tEnd = time.time() + timeout
+        with self.cond:
+            self.lastRequest = time.time()
+            while self.version <= seen and not self.stopped:
+                remaining = tEnd - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return self.changes(seen)
+
+def producer(key, build, interval = 0.25, idleTimeout = 30.):
+    # returns the running producer for key; build is used only if a new producer is started
+    with _lock:
+        p = _producers.get(key, None)
+        if p is None:
+            p = StreamProducer(key, build, interval, idleTimeout)
+            _producers[key] = p
+        p.lastRequest = time.time()
+        return p
+
+def update(key, build, seen, timeout, interval = 0.25):
+    # convenience function for the clients: (version, changed parts) of the producer of key
+    return producer(key, build, interval).update(seen, timeout)
+
+def eventId(version):
+    return "%s-%d" % (_epoch, version)
+
+def resumeVersion(eventId):
+    # the version seen by a client reconnecting with the given event id (0 for unknown ids)
+    try:
+        epoch, version = eventId.split("-")
+        if epoch == _epoch:
+            return int(version)
+    except (AttributeError, ValueError):
+        pass
+    return 0
+
+def stats():
+    with _lock:
+        return [{'key': str(p.key), 'frames': p.frames, 'buildTime': p.buildTime} for p in _producers.values()]
+
+def shutdown():
+    with _lock:
+        for p in _producers.values():
+            with p.cond:
+                p.stopped = True
+                p.cond.notify_all()
@@ -35,10 +35,16 @@ import functools
 import json
 import uuid
 import time
+import threading
 import traceback
+import cherrypy
 from ptracker_lib.helpers import *
 from stracker_lib import config
 
+# seconds between the heartbeats of idle event streams, reconnect delay of the browsers [ms]
+SSE_HEARTBEAT = 15.
+SSE_RETRY = 2000
+
 def json_yield(fn):
     """
     converts yields from request functions to JSON chunks
@@ -110,8 +116,66 @@ def _cleanup_stale_generators(d):
         if not active and t - lastCall > 5:
             del d[k]
 
-def new_key():
+def sse_event(data, event_id=None):
+    res = ""
+    if not event_id is None:
+        res += "id: %s\n" % event_id
+    # json has no line breaks, so the data fits into one data line
+    res += "data: %s\n\n" % json.dumps(data)
+    return res.encode('utf-8')
+
+def sse_yield(fn):
+    """
+    converts yields from request functions to a server-sent events stream
+    (one long-lived response instead of one request per chunk).
+
+    fn is called with the id of the last event received by the browser (None
+    on the first connect, the browser sends it when reconnecting) and yields
+    (event id, data) tuples, or None when there is nothing new; None is sent
+    as a heartbeat comment, so fn should yield at least every SSE_HEARTBEAT
+    seconds. Writing to a slow client blocks the generator, so producers
+    should send the latest state instead of queueing intermediate updates.
+    """
+    @functools.wraps(fn)
+    def _(self, *o, **k):
+        n = streaming_clients()
+        if n >= config.config.HTTP_CONFIG.max_streaming_clients:
+            raise cherrypy.HTTPError(503, "Too many streaming clients connected (%d). Try again later." % n)
+        gen = fn(self, cherrypy.request.headers.get('Last-Event-ID', None), *o, **k)
+        cherrypy.response.headers['Content-Type'] = 'text/event-stream'
+        cherrypy.response.headers['Cache-Control'] = 'no-cache'
+        # prevent reverse proxies (e.g. nginx) from buffering the stream
+        cherrypy.response.headers['X-Accel-Buffering'] = 'no'
+        cherrypy.response.stream = True
+        def stream():
+            with _sse_lock:
+                sse_yield.clients += 1
+            try:
+                yield ("retry: %d\n\n" % SSE_RETRY).encode('utf-8')
+                for item in gen:
+                    if item is None:
+                        yield b": heartbeat\n\n"
+                    else:
+                        yield sse_event(item[1], item[0])
+            except GeneratorExit:
+                acdebug("event stream closed")
+            except:
+                acdebug(traceback.format_exc())
+            finally:
+                gen.close()
+                with _sse_lock:
+                    sse_yield.clients -= 1
+        return stream()
+    return _
+sse_yield.clients = 0
+_sse_lock = threading.Lock()
+
+def streaming_clients():
     _cleanup_stale_generators(json_yield._gen_dict)
-    if len(json_yield._gen_dict) >= config.config.HTTP_CONFIG.max_streaming_clients:
-        raise RuntimeError("Too many streaming clients connected (%d). Try again later." % len(json_yield._gen_dict))
+    return len(json_yield._gen_dict) + sse_yield.clients
+
+def new_key():
+    n = streaming_clients()
+    if n >= config.config.HTTP_CONFIG.max_streaming_clients:
+        raise RuntimeError("Too many streaming clients connected (%d). Try again later." % n)
     return uuid.uuid4().hex
@@ -0,0 +1,155 @@
+# Copyright 2015-2016 NEYS
+# This file is part of sptracker.
+#
+#    sptracker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sptracker is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the GenericBackend queries used by the http server on synthetic databases (see dbgen.py).
+# Usage: python bench_backend.py [--sizes 100000,1000000,10000000] [--dir directory] [--reps 10]
+#                                [--json result.json] [--compare previous.json]
+# For each size, the database bench_<size>.db3 is generated in the given directory if it does not exist yet,
+# otherwise it is reused. The report lists per size and query the number of calls, the sql statements per
+# call and the latency; with --compare, the ratio to the average latency of a previous --json run is added.
+
+import sys
+import os.path
+import json
+import random
+import shutil
+import time
+localp = os.path.split(__file__)[0]
+if localp == "": localp = "."
+sys.path.append(localp + "/..")
+sys.path.append(localp)
+from ptracker_lib.dbapsw import SqliteBackend
+from ptracker_lib.constants import *
+from ptracker_lib.profiler import queryProfiler
+import dbgen
+
+def statementCount():
+    return sum(s['count'] for s in queryProfiler.dump()['statements'])
+
+def bench(f, args):
+    counts = []
+    times = []
+    for a in args:
+        c0 = statementCount()
+        t0 = time.time()
+        f(a)
+        times.append(time.time()-t0)
+        counts.append(statementCount()-c0)
+    times.sort()
+    return dict(calls=len(times), minStatements=min(counts), maxStatements=max(counts),
+                avg=sum(times)/len(times), median=times[len(times)//2], max=times[-1])
+
+def queries(backend, reps):
+    with backend.db:
+        cur = backend.db.cursor()
+        combos = cur.execute("""
+            SELECT Track, Car FROM Leaderboard JOIN Tracks USING (TrackId) JOIN Cars USING (CarId)
+            GROUP BY Track, Car ORDER BY COUNT(*) DESC
+        """).fetchall()
+        lapIds = [r[0] for r in cur.execute("SELECT LapId FROM Leaderboard ORDER BY RANDOM() LIMIT :reps", locals()).fetchall()]
+        guids = [r[0] for r in cur.execute("SELECT SteamGuid FROM Players ORDER BY RANDOM() LIMIT :reps", locals()).fetchall()]
+        tracks = [r[0] for r in cur.execute("SELECT Track FROM Tracks").fetchall()]
+    random.seed(7)
+    random.shuffle(combos)
+    combos = (combos*reps)[:reps]
+    tracks = (tracks*reps)[:reps]
+    now = int(time.time())
+    res = []
+    res.append(("lapStats top", lambda c: backend.lapStats(
+        mode='top', limit=[None,30], track=c[0], artint=0, cars=[c[1]], ego_guid=guids[0], valid=[1,2],
+        minSessionStartTime=0, group_by_guid=True), combos))
+    res.append(("lapStats top-extended", lambda c: backend.lapStats(
+        mode='top-extended', limit=[0,30], track=c[0], artint=0, cars=[c[1]], ego_guid=guids[0], valid=[1,2],
+        minSessionStartTime=0), combos))
+    res.append(("lapStats page 10", lambda c: backend.lapStats(
+        mode='top', limit=[270,30], track=c[0], artint=0, cars=[c[1]], ego_guid=guids[0], valid=[1,2],
+        minSessionStartTime=0, group_by_guid=True), combos))
+    res.append(("lapDetails", lambda l: backend.lapDetails(l), lapIds))
+    res.append(("sessionStats", lambda t: backend.sessionStats(
+        limit=[0,30], tracks=None, sessionTypes=None, ego_guid=guids[0], minSessionStartTime=0, minNumPlayers=1,
+        multiplayer=[0,1]), tracks))
+    res.append(("sessionStats track", lambda t: backend.sessionStats(
+        limit=[0,30], tracks=[t], sessionTypes=['Race'], ego_guid=guids[0], minSessionStartTime=0, minNumPlayers=1,
+        multiplayer=[0,1]), tracks))
+    sesArgs = dict(tracks=None, sessionTypes=None, ego_guid=guids[0], minSessionStartTime=0, minNumPlayers=1, multiplayer=[0,1])
+    sesKey = backend.sessionStats(limit=[241,30], **sesArgs)['nextKey']
+    res.append(("sessionStats page 10", lambda t: backend.sessionStats(limit=[271,30], **sesArgs), tracks))
+    res.append(("sessionStats page 10 keyset", lambda t: backend.sessionStats(limit=[271,30], after=sesKey, **sesArgs), tracks))
+    res.append(("getPlayers", lambda i: backend.getPlayers(limit=[i*30,30]), list(range(len(tracks)))))
+    res.append(("getPlayers search", lambda g: backend.getPlayers(limit=[0,30], searchPattern=g[4:]), guids))
+    res.append(("statistics all", lambda t: backend.statistics(), tracks[:max(1, reps//5)]))
+    res.append(("statistics 30 days", lambda t: backend.statistics(startDate=now-30*24*3600, tracks=[t]), tracks))
+    res.append(("csGetSeasons", lambda t: backend.csGetSeasons(), tracks))
+    res.append(("auth", lambda g: backend.auth(g, track=combos[0][0], cars=[combos[0][1]], valid=[1,2], maxRank=10), guids))
+    return res
+
+def benchSize(directory, size, reps, cfg):
+    dbname = os.path.join(directory, "bench_%d.db3" % size)
+    if not os.path.exists(dbname):
+        cfg.numLaps = size
+        dbgen.generate(dbname, cfg).db.close()
+    backend = SqliteBackend(dbgen.LapHistory, dbname, perform_backups=False)
+    res = {}
+    for name, f, args in queries(backend, reps):
+        res[name] = bench(f, args)
+        printLine(size, name, res[name])
+    backend.db.close()
+    # compressDB modifies the database, so it runs on a copy
+    copyname = os.path.join(directory, "bench_%d_copy.db3" % size)
+    shutil.copyfile(dbname, copyname)
+    backend = SqliteBackend(dbgen.LapHistory, copyname, perform_backups=False)
+    res["compressDB slow blobs"] = bench(lambda m: backend.compressDB(m), [COMPRESS_NULL_SLOW_BINARY_BLOBS])
+    printLine(size, "compressDB slow blobs", res["compressDB slow blobs"])
+    backend.db.close()
+    os.remove(copyname)
+    return res
+
+def printLine(size, name, r, ref=None):
+    s = "%10d %-24s calls=%4d statements/call=%4d..%4d latency [ms]: avg=%9.2f median=%9.2f max=%9.2f" % (
+        size, name, r['calls'], r['minStatements'], r['maxStatements'], r['avg']*1000., r['median']*1000., r['max']*1000.)
+    if not ref is None:
+        s += " ratio=%5.2f" % (r['avg']/max(ref['avg'], 1e-9))
+    print(s)
+
+def report(results, reference):
+    print()
+    print("Summary" + (" (ratio = avg latency / avg latency of reference)" if not reference is None else ""))
+    for size in sorted(results.keys(), key=int):
+        for name in sorted(results[size].keys()):
+            ref = None
+            if not reference is None:
+                ref = reference.get(size, {}).get(name, None)
+            printLine(int(size), name, results[size][name], ref)
+
+if __name__ == "__main__":
+    parser = dbgen.argParser()
+    parser.description = 'Benchmark the backend queries on synthetic databases.'
+    parser.add_argument('--sizes', default="100000,1000000,10000000", help='comma separated list of lap counts')
+    parser.add_argument('--dir', default=localp, help='directory of the generated databases')
+    parser.add_argument('--reps', type=int, default=10, help='calls per query')
+    parser.add_argument('--json', default=None, help='write the results to this file')
+    parser.add_argument('--compare', default=None, help='compare with the results of a previous --json run')
+    args = parser.parse_args()
+    cfg = dbgen.configFromArgs(args)
+    reference = None
+    if not args.compare is None:
+        reference = json.load(open(args.compare))
+    results = {}
+    for size in [int(s) for s in args.sizes.split(",")]:
+        results[str(size)] = benchSize(args.dir, size, args.reps, cfg)
+    report(results, reference)
+    if not args.json is None:
+        json.dump(results, open(args.json, "w"), indent=1, sort_keys=True)
@@ -0,0 +1,136 @@
+# Copyright 2015-2016 NEYS
+# This file is part of sptracker.
+#
+#    sptracker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sptracker is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the lap saving latency while a backup of the sqlite database is running.
+# Usage: python bench_backup.py [--size 1000000] [--dir directory] [--rate 20] [--pages_per_step 100]
+#                               [--step_pause 0.05] [dbgen options]
+# The database bench_<size>.db3 is generated in the given directory if it does not exist yet (see dbgen.py)
+# and copied, the laps are saved into the copy. While laps are registered at a constant rate, the following
+# phases are measured: no backup, a backup in a single worker job (like the migration backups) and the
+# online backups of LapDatabase.onlineBackup with and without compression.
+
+import sys
+import os.path
+import functools
+import random
+import shutil
+import threading
+import time
+localp = os.path.split(__file__)[0]
+if localp == "": localp = "."
+sys.path.append(localp + "/..")
+sys.path.append(localp)
+import ptracker_lib
+from ptracker_lib.dbapsw import SqliteBackend
+from ptracker_lib.database import LapDatabase
+import dbgen
+
+class LapWriter(threading.Thread):
+    # registers laps at a constant rate and records the latencies of the registerLap calls
+    def __init__(self, database, rate):
+        threading.Thread.__init__(self, daemon=True)
+        self.database = database
+        self.interval = 1./rate
+        self.latencies = []
+        self.stopped = False
+        self.lapCount = 0
+
+    def run(self):
+        tNext = time.time()
+        while not self.stopped:
+            lapTime = random.randint(90000, 100000)
+            sampleTimes, worldPositions, velocities, normSplinePositions = dbgen.history(lapTime)
+            lh = dbgen.LapHistory(lapTime=lapTime, sectorTimes=[lapTime//3, lapTime//3, lapTime - 2*(lapTime//3)],
+                                  sampleTimes=sampleTimes, worldPositions=worldPositions, velocities=velocities,
+                                  normSplinePositions=normSplinePositions, sectorsAreSoftSplits=False)
+            self.lapCount += 1
+            player = random.randint(0, 15)
+            t0 = time.time()
+            self.database.registerLap(__sync=True, trackChecksum='tcs', carChecksum='ccs', acVersion='1.2', steamGuid='guid%d' % player,
+                                      playerName='Driver %d' % player, playerIsAI=0, lapHistory=lh, tyre='M', lapCount=self.lapCount,
+                                      sessionTime=0, fuelRatio=0.5, valid=1, carname='bench_car', staticAssists={}, dynamicAssists={},
+                                      maxSpeed=200., timeInPitLane=0, timeInPit=0, escKeyPressed=False, teamName=None, gripLevel=1.0,
+                                      collisionsCar=0, collisionsEnv=0, cuts=0, ballast=0)()
+            self.latencies.append(time.time() - t0)
+            tNext += self.interval
+            time.sleep(max(0., tNext - time.time()))
+
+    def take(self):
+        res = self.latencies
+        self.latencies = []
+        return res
+
+def blockingBackup(database, backupName):
+    # the whole copy in one job of the worker
+    database.backupStart(__sync=True, backupName=backupName)()
+    database.backupStep(__sync=True, pages=-1)()
+
+def printLine(name, latencies, duration):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    if n == 0:
+        print("%-28s no laps saved in %.1f s" % (name, duration))
+        return
+    print("%-28s duration=%7.1f s laps=%5d latency [ms]: median=%8.2f q95=%8.2f max=%8.2f" % (
+        name, duration, n, latencies[n//2]*1000., latencies[min(n-1, n*95//100)]*1000., latencies[-1]*1000.))
+
+def benchmark(directory, size, rate, pagesPerStep, stepPause, cfg):
+    dbname = os.path.join(directory, "bench_%d.db3" % size)
+    if not os.path.exists(dbname):
+        cfg.numLaps = size
+        dbgen.generate(dbname, cfg).db.close()
+    workname = os.path.join(directory, "bench_%d_backup_src.db3" % size)
+    backupName = os.path.join(directory, "bench_%d_backup.db3" % size)
+    shutil.copyfile(dbname, workname)
+    print("database size: %.1f MB" % (os.path.getsize(workname)/1024./1024.))
+    ptracker_lib.version = getattr(ptracker_lib, 'version', 'bench')
+    database = LapDatabase(dbgen.LapHistory, LapDatabase.DB_MODE_NORMAL, functools.partial(SqliteBackend, dbname=workname, perform_backups=False))
+    database.newSession(__sync=True, trackname='bench_track', carnames=['bench_car'], sessionType='Practice', multiplayer=True,
+                        numberOfLaps=0, duration=0, server='bench', sessionState={})()
+    writer = LapWriter(database, rate)
+    writer.start()
+    phases = [
+        ("no backup", lambda: time.sleep(5.)),
+        ("single job backup", lambda: blockingBackup(database, backupName)),
+        ("online backup", lambda: database.onlineBackup(backupName, pagesPerStep=pagesPerStep, stepPause=stepPause)),
+        ("online backup compressed", lambda: database.onlineBackup(backupName, pagesPerStep=pagesPerStep, stepPause=stepPause, compress=True)),
+    ]
+    for name, f in phases:
+        for fn in [backupName, backupName + ".gz"]:
+            if os.path.exists(fn):
+                os.remove(fn)
+        writer.take()
+        t0 = time.time()
+        f()
+        printLine(name, writer.take(), time.time() - t0)
+    writer.stopped = True
+    writer.join()
+    database.finishSession(__sync=True, positions=[])()
+    database.shutdown()
+    for fn in [workname, backupName, backupName + ".gz"]:
+        if os.path.exists(fn):
+            os.remove(fn)
+
+if __name__ == "__main__":
+    parser = dbgen.argParser()
+    parser.description = 'Benchmark the lap saving latency during database backups.'
+    parser.add_argument('--size', type=int, default=1000000, help='number of laps in the database')
+    parser.add_argument('--dir', default=localp, help='directory of the generated databases')
+    parser.add_argument('--rate', type=float, default=20., help='saved laps per second')
+    parser.add_argument('--pages_per_step', type=int, default=100, help='pages per step of the online backup')
+    parser.add_argument('--step_pause', type=float, default=0.05, help='pause between the steps of the online backup [s]')
+    args = parser.parse_args()
+    benchmark(args.dir, args.size, args.rate, args.pages_per_step, args.step_pause, dbgen.configFromArgs(args))
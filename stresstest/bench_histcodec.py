@@ -0,0 +1,71 @@
+
+# Copyright 2015-2016 NEYS
+# This file is part of sptracker.
+#
+#    sptracker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sptracker is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the history info blob formats (legacy vs. columnar).
+# Usage: python bench_histcodec.py [lap time in seconds] [sample interval in ms] [repetitions]
+
+import sys
+import os.path
+import math
+import random
+import time
+localp = os.path.split(__file__)[0]
+if localp == "": localp = "."
+sys.path.append(localp + "/..")
+from ptracker_lib import dbgeneric
+
+def synthetic_lap(lapTime, dt):
+    # a noisy closed loop, roughly resembling the telemetry of a real lap
+    sampleTimes = list(range(0, lapTime, dt))
+    n = len(sampleTimes)
+    worldPositions = []
+    velocities = []
+    normSplinePositions = []
+    for i,t in enumerate(sampleTimes):
+        phi = 2*math.pi*i/n
+        r = 800. + 150.*math.sin(5*phi)
+        worldPositions.append((r*math.cos(phi) + random.gauss(0, 0.05),
+                               20.*math.sin(3*phi) + random.gauss(0, 0.01),
+                               r*math.sin(phi) + random.gauss(0, 0.05)))
+        velocities.append((-60.*math.sin(phi) + random.gauss(0, 0.1),
+                           random.gauss(0, 0.05),
+                           60.*math.cos(phi) + random.gauss(0, 0.1)))
+        normSplinePositions.append(i/n)
+    return sampleTimes, worldPositions, velocities, normSplinePositions
+
+def bench(version, lap, reps):
+    t0 = time.time()
+    for r in range(reps):
+        blob = dbgeneric.compress(*lap, version=version)
+    t1 = time.time()
+    for r in range(reps):
+        dbgeneric.decompress(blob)
+    t2 = time.time()
+    return len(blob), (t1-t0)/reps, (t2-t1)/reps
+
+if __name__ == "__main__":
+    lapTime = int(float(sys.argv[1])*1000) if len(sys.argv) > 1 else 120000
+    dt = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    reps = int(sys.argv[3]) if len(sys.argv) > 3 else 50
+    random.seed(7)
+    lap = synthetic_lap(lapTime, dt)
+    n = len(lap[0])
+    print("%d samples per lap, %d repetitions" % (n, reps))
+    print("%-10s %10s %12s %12s %14s %14s" % ("format", "bytes", "encode [ms]", "decode [ms]", "enc [smpl/s]", "dec [smpl/s]"))
+    for name, version in [("legacy", dbgeneric.HISTORY_INFO_LEGACY), ("columnar", dbgeneric.HISTORY_INFO_COLUMNAR)]:
+        size, tenc, tdec = bench(version, lap, reps)
+        print("%-10s %10d %12.2f %12.2f %14.0f %14.0f" % (name, size, tenc*1000, tdec*1000, n/tenc, n/tdec))
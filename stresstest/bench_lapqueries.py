@@ -0,0 +1,111 @@
+
+# Copyright 2015-2016 NEYS
+# This file is part of sptracker.
+#
+#    sptracker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sptracker is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Regression benchmark for the lap statistic queries (lapStats 'top-extended' and lapDetails)
+# on a synthetic sqlite database (see dbgen.py). Guards the number of sql statements per call and the latency.
+# Usage: python bench_lapqueries.py [number of laps] [database file] [repetitions]
+# The database file is generated if it does not exist yet, otherwise it is reused.
+# The exit code is 1 if the statement budgets or the latency limits are exceeded.
+
+import sys
+import os.path
+import random
+import time
+localp = os.path.split(__file__)[0]
+if localp == "": localp = "."
+sys.path.append(localp + "/..")
+sys.path.append(localp)
+from ptracker_lib.dbapsw import SqliteBackend
+import dbgen
+
+# maximum number of statements per call (including BEGIN and COMMIT)
+LAPSTATS_MAX_STATEMENTS = 7
+LAPDETAILS_MAX_STATEMENTS = 8
+# maximum average latency per call [s]
+LAPSTATS_MAX_LATENCY = 0.25
+LAPDETAILS_MAX_LATENCY = 0.25
+
+class CountingCursor:
+    def __init__(self, cur, counter):
+        self.cur = cur
+        self.counter = counter
+
+    def execute(self, *args, **kw):
+        self.counter[0] += 1
+        return self.cur.execute(*args, **kw)
+
+    def __getattr__(self, a):
+        return getattr(self.cur, a)
+
+def instrument(backend):
+    counter = [0]
+    cursor = backend.db.cursor
+    backend.db.cursor = lambda *args, **kw: CountingCursor(cursor(*args, **kw), counter)
+    return counter
+
+def generate(dbname, numLaps):
+    cfg = dbgen.Config()
+    cfg.numLaps = numLaps
+    cfg.numTracks = 5
+    cfg.numCars = 20
+    cfg.numCombos = 20
+    cfg.lapsPerPlayer = 12
+    return dbgen.generate(dbname, cfg)
+
+def bench(name, f, args, counter, reps):
+    counts = []
+    times = []
+    for a in args[:reps]:
+        c0 = counter[0]
+        t0 = time.time()
+        f(a)
+        times.append(time.time()-t0)
+        counts.append(counter[0]-c0)
+    avg = sum(times)/len(times)
+    print("%-22s calls=%4d statements/call=%3d..%3d latency [ms]: avg=%8.2f max=%8.2f" % (
+          name, len(times), min(counts), max(counts), avg*1000., max(times)*1000.))
+    return max(counts), avg
+
+if __name__ == "__main__":
+    numLaps = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    dbname = sys.argv[2] if len(sys.argv) > 2 else localp + "/bench_lapqueries.db3"
+    reps = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    if os.path.exists(dbname):
+        backend = SqliteBackend(dbgen.LapHistory, dbname, perform_backups=False)
+    else:
+        backend = generate(dbname, numLaps)
+    counter = instrument(backend)
+    with backend.db:
+        cur = backend.db.cursor()
+        combos = cur.execute("""
+            SELECT Track, Car FROM Leaderboard JOIN Tracks USING (TrackId) JOIN Cars USING (CarId)
+            GROUP BY Track, Car ORDER BY COUNT(*) DESC
+        """).fetchall()
+        lapIds = [r[0] for r in cur.execute("SELECT LapId FROM Leaderboard ORDER BY RANDOM() LIMIT :reps", locals()).fetchall()]
+    random.seed(7)
+    random.shuffle(combos)
+    ok = True
+    n, t = bench("lapStats top-extended",
+                 lambda combo: backend.lapStats(mode='top-extended', limit=[0,30], track=combo[0], artint=0, cars=[combo[1]],
+                                                ego_guid='guid1', valid=[1,2], minSessionStartTime=0),
+                 combos, counter, reps)
+    ok = ok and n <= LAPSTATS_MAX_STATEMENTS and t <= LAPSTATS_MAX_LATENCY
+    n, t = bench("lapDetails", lambda lapId: backend.lapDetails(lapId), lapIds, counter, reps)
+    ok = ok and n <= LAPDETAILS_MAX_STATEMENTS and t <= LAPDETAILS_MAX_LATENCY
+    print("OK" if ok else "FAILED (budgets: lapStats %d statements / %.0f ms, lapDetails %d statements / %.0f ms)" % (
+          LAPSTATS_MAX_STATEMENTS, LAPSTATS_MAX_LATENCY*1000., LAPDETAILS_MAX_STATEMENTS, LAPDETAILS_MAX_LATENCY*1000.))
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,110 @@
+# Copyright 2015-2016 NEYS
+# This file is part of sptracker.
+#
+#    sptracker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sptracker is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the race position calculation (finishSession with results.json corrections and the
+# recalculation after penalty edits) on large race sessions.
+# Usage: python bench_positions.py [--drivers 40] [--race_laps 150] [--corrected 8] [--edits 20] [--dir directory]
+# A race with the given number of drivers and laps is registered in a new database, a few drivers reconnect
+# during the race (so they have duplicated lap counts). The report lists the latency and the number of sql
+# statements of finishSession and of the penalty edits (playerInSessionPaCModify).
+
+import sys
+import os.path
+import random
+import time
+localp = os.path.split(__file__)[0]
+if localp == "": localp = "."
+sys.path.append(localp + "/..")
+sys.path.append(localp)
+import ptracker_lib
+from ptracker_lib.dbapsw import SqliteBackend
+from ptracker_lib.profiler import queryProfiler
+import dbgen
+
+def statementCount():
+    return sum(s['count'] for s in queryProfiler.dump()['statements'])
+
+def registerRace(backend, drivers, raceLaps):
+    backend.newSession(trackname='bench_track', carnames=['bench_car'], sessionType='Race', multiplayer=True,
+                       numberOfLaps=raceLaps, duration=0, server='bench', sessionState={})
+    finishTimes = []
+    for d in range(drivers):
+        pace = random.randint(90000, 95000)
+        lapTimes = [pace + random.randint(0, 3000) for i in range(raceLaps)]
+        if d % 10 == 9:
+            # reconnect after some laps, the lap counter starts again
+            lapTimes = lapTimes[:raceLaps//3] + lapTimes
+        lapCount = 0
+        for i,lapTime in enumerate(lapTimes):
+            lapCount = lapCount + 1 if not (d % 10 == 9 and i == raceLaps//3) else 1
+            sampleTimes, worldPositions, velocities, normSplinePositions = dbgen.history(lapTime, 10000)
+            lh = dbgen.LapHistory(lapTime=lapTime, sectorTimes=[lapTime//3, lapTime//3, lapTime - 2*(lapTime//3)],
+                                  sampleTimes=sampleTimes, worldPositions=worldPositions, velocities=velocities,
+                                  normSplinePositions=normSplinePositions, sectorsAreSoftSplits=False)
+            backend.registerLap(trackChecksum='tcs', carChecksum='ccs', acVersion='1.2', steamGuid='guid%d' % d,
+                                playerName='Driver %d' % d, playerIsAI=0, lapHistory=lh, tyre='M', lapCount=lapCount,
+                                sessionTime=0, fuelRatio=0.5, valid=1, carname='bench_car', staticAssists={}, dynamicAssists={},
+                                maxSpeed=200., timeInPitLane=0, timeInPit=0, escKeyPressed=False, teamName=None, gripLevel=1.0,
+                                collisionsCar=0, collisionsEnv=0, cuts=0, ballast=0)
+        finishTimes.append((sum(lapTimes[-raceLaps:]), d))
+    return sorted(finishTimes)
+
+def measure(name, f):
+    c0 = statementCount()
+    t0 = time.time()
+    f()
+    dt = time.time() - t0
+    print("%-32s latency [ms]=%9.2f statements=%6d" % (name, dt*1000., statementCount() - c0))
+
+def benchmark(directory, drivers, raceLaps, corrected, edits):
+    dbname = os.path.join(directory, "bench_positions.db3")
+    if os.path.exists(dbname):
+        os.remove(dbname)
+    ptracker_lib.version = getattr(ptracker_lib, 'version', 'bench')
+    backend = SqliteBackend(dbgen.LapHistory, dbname, perform_backups=False)
+    random.seed(7)
+    t0 = time.time()
+    finishTimes = registerRace(backend, drivers, raceLaps)
+    print("race with %d drivers and %d laps registered in %.1f s" % (drivers, raceLaps, time.time() - t0))
+    positions = []
+    ac_positions = {}
+    for i,(ft,d) in enumerate(finishTimes):
+        positions.append(dict(steamGuid='guid%d' % d, playerName='Driver %d' % d, playerIsAI=0,
+                              raceFinished=1, finishTime=ft))
+        if i % max(1, drivers//max(1, corrected)) == 0 and len(ac_positions) < corrected:
+            # the AC lap timing bug: results.json reports a different time and lap count
+            ac_positions[('guid%d' % d, 'bench_car')] = dict(numlaps=raceLaps + random.randint(-1, 1), totaltime=ft + random.randint(-30000, 30000))
+    measure("finishSession (%d corrections)" % len(ac_positions), lambda: backend.finishSession(positions=positions, ac_positions=ac_positions))
+    with backend.db:
+        pisIds = [r[0] for r in backend.db.cursor().execute("SELECT PlayerInSessionId FROM PlayerInSession").fetchall()]
+    def penaltyEdits():
+        for i in range(edits):
+            backend.playerInSessionPaCModify(pis_id=random.choice(pisIds), delta_time=random.choice([5000, 30000, None]),
+                                             delta_points=None, delta_laps=random.choice([-1, None]), comment="penalty")
+    measure("%d penalty edits" % edits, penaltyEdits)
+    backend.db.close()
+    os.remove(dbname)
+
+if __name__ == "__main__":
+    parser = dbgen.argParser()
+    parser.description = 'Benchmark the calculation of the race positions on large sessions.'
+    parser.add_argument('--drivers', type=int, default=40, help='drivers in the race')
+    parser.add_argument('--race_laps', type=int, default=150, help='laps of the race')
+    parser.add_argument('--corrected', type=int, default=8, help='drivers with results.json corrections')
+    parser.add_argument('--edits', type=int, default=20, help='number of penalty edits')
+    parser.add_argument('--dir', default=localp, help='directory of the generated database')
+    args = parser.parse_args()
+    benchmark(args.dir, args.drivers, args.race_laps, args.corrected, args.edits)
@@ -0,0 +1,312 @@
+# Copyright 2015-2016 NEYS
+# This file is part of sptracker.
+#
+#    sptracker is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    sptracker is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with Foobar.  If not, see <http://www.gnu.org/licenses/>.
+
+# Generator of synthetic stracker databases in production scale.
+# Usage: python dbgen.py [options] database_file      (see python dbgen.py --help)
+#
+# By default, the rows are bulk inserted into a sqlite database and the derived tables (Leaderboard,
+# StatsDaily) are rebuilt afterwards. With --api, the database is filled through newSession, registerLap
+# and finishSession instead (much slower, but exercising the write path). With --postgres, the generated
+# sqlite database is copied into the given postgres database.
+# Sessions are spread over the last --days days, the players' activity is skewed (few players drive most
+# of the laps) and --blob-ratio of the laps get a history info.
+
+import sys
+import os.path
+import argparse
+import random
+import time
+localp = os.path.split(__file__)[0]
+if localp == "": localp = "."
+sys.path.append(localp + "/..")
+import ptracker_lib
+from ptracker_lib.dbapsw import SqliteBackend
+from ptracker_lib import dbgeneric
+
+SESSION_TYPES = ['Practice', 'Qualify', 'Race']
+TYRES = ['SM', 'S', 'M', 'H']
+
+class LapHistory:
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+class Config:
+    # the default parameters, overridden by the command line options
+    numLaps = 100000
+    numPlayers = 5000
+    numTracks = 10
+    numCars = 40
+    numCombos = 30
+    numServers = 3
+    numDays = 365
+    playersPerSession = 16
+    lapsPerPlayer = 10
+    blobRatio = 0.01
+    seed = 7
+    useApi = False
+
+def history(lapTime, sampleInterval=100):
+    sampleTimes = list(range(0, lapTime, sampleInterval))
+    n = len(sampleTimes)
+    worldPositions = [(1000.*random.random(), 10.*random.random(), 1000.*random.random()) for i in range(n)]
+    velocities = [(50.*random.random(), 0., 50.*random.random()) for i in range(n)]
+    normSplinePositions = [i/n for i in range(n)]
+    return sampleTimes, worldPositions, velocities, normSplinePositions
+
+class Generator:
+    def __init__(self, cfg):
+        self.cfg = cfg
+        random.seed(cfg.seed)
+        self.now = int(time.time())
+        self.tracks = ["track%d" % i for i in range(cfg.numTracks)]
+        self.cars = ["car%d" % i for i in range(cfg.numCars)]
+        # base lap time per track and relative speed per car
+        self.trackTimes = [60000 + random.randint(0, 90000) for t in self.tracks]
+        self.carFactors = [0.9 + 0.3*random.random() for c in self.cars]
+        self.combos = []
+        for i in range(cfg.numCombos):
+            self.combos.append((i % cfg.numTracks, random.sample(range(cfg.numCars), random.choice([1,1,2,3,5]))))
+        self.servers = ["server %d" % i for i in range(cfg.numServers)]
+        # history infos are expensive to compress, so a pool per track is reused
+        self.blobPool = [[dbgeneric.compress(*history(self.trackTimes[t])) for i in range(4)] for t in range(cfg.numTracks)]
+
+    def player(self):
+        # skewed activity: low player ids drive most of the sessions
+        return int(self.cfg.numPlayers * random.random()**3)
+
+    def skill(self, player):
+        return 1.0 + ((player*7919) % 1000)/10000.
+
+    def sessions(self):
+        cfg = self.cfg
+        lapsPerSession = cfg.playersPerSession*cfg.lapsPerPlayer
+        numSessions = max(1, cfg.numLaps // lapsPerSession)
+        for s in range(numSessions):
+            combo = random.randrange(cfg.numCombos)
+            startTime = self.now - int((numSessions - s) * cfg.numDays*24*3600 / numSessions)
+            sessionType = random.choice(SESSION_TYPES)
+            players = set()
+            while len(players) < min(cfg.playersPerSession, cfg.numPlayers):
+                players.add(self.player())
+            yield s, combo, startTime, sessionType, sorted(players)
+
+    def laps(self, combo, player):
+        trackIdx, carIdxs = self.combos[combo]
+        carIdx = carIdxs[player % len(carIdxs)]
+        base = self.trackTimes[trackIdx]*self.carFactors[carIdx]*self.skill(player)
+        for lapCount in range(1, self.cfg.lapsPerPlayer+1):
+            lapTime = int(base*(1.0 + 0.05*random.random()*random.random()))
+            s0 = lapTime//3
+            valid = random.choice([0,1,1,1,1,2])
+            blob = random.choice(self.blobPool[trackIdx]) if random.random() < self.cfg.blobRatio else None
+            yield carIdx, lapCount, lapTime, [s0, s0, lapTime-2*s0], valid, blob
+
+    def generateBulk(self, backend):
+        cfg = self.cfg
+        inv = backend.invalidSplit
+        t0 = time.time()
+        # bulk inserts using the raw apsw cursor
+        cur = backend.db.db.cursor()
+        cur.execute("BEGIN")
+        cur.executemany("INSERT INTO Tracks(TrackId,Track,UiTrackName,Length) VALUES(?,?,?,?)",
+                        [(i+1, t, t.upper(), self.trackTimes[i]/20.) for i,t in enumerate(self.tracks)])
+        cur.executemany("INSERT INTO Cars(CarId,Car,UiCarName,Brand) VALUES(?,?,?,?)",
+                        [(i+1, c, c.upper(), "brand%d" % (i % 7)) for i,c in enumerate(self.cars)])
+        cur.executemany("INSERT INTO Players(PlayerId,SteamGuid,Name,ArtInt) VALUES(?,?,?,?)",
+                        [(i+1, "guid%d" % i, "Driver %d" % i, 1 if i % 50 == 49 else 0) for i in range(cfg.numPlayers)])
+        cur.executemany("INSERT INTO TyreCompounds(TyreCompoundId,TyreCompound) VALUES(?,?)", [(i+1, t) for i,t in enumerate(TYRES)])
+        cur.executemany("INSERT INTO Combos(ComboId,TrackId) VALUES(?,?)", [(i+1, c[0]+1) for i,c in enumerate(self.combos)])
+        cur.executemany("INSERT INTO ComboCars(ComboId,CarId) VALUES(?,?)", [(i+1, car+1) for i,c in enumerate(self.combos) for car in c[1]])
+        lapId = 0
+        pisId = 0
+        races = []
+        for s, combo, startTime, sessionType, players in self.sessions():
+            sessionId = s+1
+            duration = cfg.lapsPerPlayer*self.trackTimes[self.combos[combo][0]]
+            cur.execute("""
+                INSERT INTO Session(SessionId,TrackId,SessionType,Multiplayer,NumberOfLaps,Duration,ServerIpPort,StartTimeDate,EndTimeDate,ComboId)
+                VALUES(?,?,?,1,?,?,?,?,?,?)
+            """, (sessionId, self.combos[combo][0]+1, sessionType, cfg.lapsPerPlayer if sessionType == 'Race' else 0,
+                  0 if sessionType == 'Race' else duration//1000, self.servers[s % cfg.numServers], startTime, startTime+duration//1000, combo+1))
+            pis = []
+            laps = []
+            blobs = []
+            finish = []
+            for player in players:
+                pisId += 1
+                total = 0
+                for carIdx, lapCount, lapTime, sectors, valid, blob in self.laps(combo, player):
+                    lapId += 1
+                    total += lapTime
+                    laps.append((lapId, pisId, 1 + (lapId % len(TYRES)), lapCount, total, lapTime, sectors[0], sectors[1], sectors[2],
+                                 valid, startTime + total//1000, random.randint(0,3), random.randint(0,2), random.randint(0,4),
+                                 0.8 + 0.2*random.random(), 150. + 150.*random.random()))
+                    if not blob is None:
+                        blobs.append((lapId, blob))
+                pis.append([pisId, sessionId, player+1, carIdx+1, total])
+                finish.append((total, pisId))
+            if sessionType == 'Race':
+                positions = dict((p, pos+1) for pos, (total, p) in enumerate(sorted(finish)))
+                for p in pis:
+                    p.extend([positions[p[0]], positions[p[0]], 1])
+                races.append(sessionId)
+            else:
+                for p in pis:
+                    p.extend([backend.invalidFinishPosition, None, 0])
+            cur.executemany("""
+                INSERT INTO PlayerInSession(PlayerInSessionId,SessionId,PlayerId,CarId,FinishTime,FinishPosition,FinishPositionOrig,RaceFinished,ACVersion,PTVersion)
+                VALUES(?,?,?,?,?,?,?,?,'1.2','3.5')
+            """, pis)
+            cur.executemany("""
+                INSERT INTO Lap(LapId,PlayerInSessionId,TyreCompoundId,LapCount,SessionTime,LapTime,SectorTime0,SectorTime1,SectorTime2,
+                                SectorTime3,SectorTime4,SectorTime5,SectorTime6,SectorTime7,SectorTime8,SectorTime9,
+                                Valid,Timestamp,Cuts,CollisionsCar,CollisionsEnv,GripLevel,MaxSpeed_KMH,Ballast,FuelRatio,SectorsAreSoftSplits)
+                VALUES(?,?,?,?,?,?,?,?,?,%s,?,?,?,?,?,?,?,0,1.0,0)
+            """ % ",".join([str(inv)]*7), laps)
+            cur.executemany("INSERT INTO LapBinBlob(LapId,HistoryInfo) VALUES(?,?)", blobs)
+            if random.random() < 0.3:
+                cur.execute("INSERT INTO ChatHistory(PlayerId,Timestamp,Content,Server) VALUES(?,?,?,?)",
+                            (players[0]+1, startTime, "gg %d" % sessionId, self.servers[s % cfg.numServers]))
+            if sessionId % 1000 == 0:
+                cur.execute("COMMIT")
+                cur.execute("BEGIN")
+                print("%d laps (%.0f laps/s)" % (lapId, lapId/(time.time()-t0)))
+        cur.execute("COMMIT")
+        self.championship(backend, races)
+        with backend.db:
+            c = backend.db.cursor()
+            backend.rebuildLeaderboard(c)
+            backend.rebuildStatsDaily(c)
+            backend.rebuildPlayerNameTrigrams(c)
+        return lapId
+
+    def generateApi(self, backend):
+        cfg = self.cfg
+        ptracker_lib.version = getattr(ptracker_lib, 'version', 'dbgen')
+        numLaps = 0
+        races = []
+        for s, combo, startTime, sessionType, players in self.sessions():
+            trackIdx, carIdxs = self.combos[combo]
+            backend.newSession(trackname=self.tracks[trackIdx], carnames=[self.cars[c] for c in carIdxs], sessionType=sessionType,
+                               multiplayer=True, numberOfLaps=cfg.lapsPerPlayer, duration=0, server=self.servers[s % cfg.numServers],
+                               sessionState={})
+            # sessions are spread over the past
+            backend.currentSession.startTime = startTime
+            positions = []
+            for player in players:
+                total = 0
+                for carIdx, lapCount, lapTime, sectors, valid, blob in self.laps(combo, player):
+                    total += lapTime
+                    numLaps += 1
+                    if blob is None:
+                        sampleTimes, worldPositions, velocities, normSplinePositions = None, None, None, None
+                    else:
+                        sampleTimes, worldPositions, velocities, normSplinePositions = dbgeneric.decompress(blob)
+                    lh = LapHistory(lapTime=lapTime, sectorTimes=sectors, sampleTimes=sampleTimes, worldPositions=worldPositions,
+                                    velocities=velocities, normSplinePositions=normSplinePositions, sectorsAreSoftSplits=False)
+                    backend.registerLap(trackChecksum='tcs', carChecksum='ccs', acVersion='1.2', steamGuid='guid%d' % player,
+                                        playerName='Driver %d' % player, playerIsAI=1 if player % 50 == 49 else 0, lapHistory=lh,
+                                        tyre=random.choice(TYRES), lapCount=lapCount, sessionTime=total, fuelRatio=0.5, valid=valid,
+                                        carname=self.cars[carIdx], staticAssists={}, dynamicAssists={}, maxSpeed=200.,
+                                        timeInPitLane=0, timeInPit=0, escKeyPressed=False, teamName=None, gripLevel=1.0,
+                                        collisionsCar=random.randint(0,2), collisionsEnv=random.randint(0,4), cuts=random.randint(0,3),
+                                        ballast=0)
+                positions.append(dict(steamGuid='guid%d' % player, playerName='Driver %d' % player, playerIsAI=0,
+                                      raceFinished=1, finishTime=total))
+            positions.sort(key=lambda x: x['finishTime'])
+            if sessionType == 'Race':
+                races.append(backend.currentSession.dbSessionId)
+            backend.finishSession(positions)
+            if (s+1) % 100 == 0:
+                print("%d laps" % numLaps)
+        self.championship(backend, races)
+        return numLaps
+
+    def championship(self, backend, races):
+        # one season with the last race sessions as events
+        if len(races) == 0:
+            return
+        cs_id = backend.csModify(add_season_name="Season")
+        ps_id = backend.csModify(add_schema_name="Points")
+        for pos, points in enumerate([25, 18, 15, 12, 10, 8, 6, 4, 2, 1]):
+            backend.csModify(pos=pos, points=points, ps_id=ps_id)
+        for i, sessionId in enumerate(races[-20:]):
+            event_id = backend.csModify(add_event_name="Event %d" % (i+1), cs_id=cs_id)
+            backend.csModify(add_session_name="Race", event_id=event_id, ps_id=ps_id, session_id=sessionId)
+
+def generate(dbname, cfg):
+    backend = SqliteBackend(LapHistory, dbname, perform_backups=False)
+    g = Generator(cfg)
+    t0 = time.time()
+    if cfg.useApi:
+        numLaps = g.generateApi(backend)
+    else:
+        numLaps = g.generateBulk(backend)
+    print("generated %d laps in %.1f s" % (numLaps, time.time()-t0))
+    return backend
+
+def argParser():
+    parser = argparse.ArgumentParser(description='Generate a synthetic stracker database.')
+    parser.add_argument('--laps', type=int, default=Config.numLaps, help='number of laps')
+    parser.add_argument('--players', type=int, default=Config.numPlayers, help='number of players')
+    parser.add_argument('--tracks', type=int, default=Config.numTracks, help='number of tracks')
+    parser.add_argument('--cars', type=int, default=Config.numCars, help='number of cars')
+    parser.add_argument('--combos', type=int, default=Config.numCombos, help='number of track/car combinations')
+    parser.add_argument('--servers', type=int, default=Config.numServers, help='number of servers')
+    parser.add_argument('--days', type=int, default=Config.numDays, help='the sessions are spread over this number of days')
+    parser.add_argument('--players_per_session', type=int, default=Config.playersPerSession)
+    parser.add_argument('--laps_per_player', type=int, default=Config.lapsPerPlayer, help='laps per player and session')
+    parser.add_argument('--blob_ratio', type=float, default=Config.blobRatio, help='fraction of laps with history info (0 for none)')
+    parser.add_argument('--seed', type=int, default=Config.seed)
+    parser.add_argument('--api', action='store_true', help='use the GenericBackend API instead of bulk inserts')
+    return parser
+
+def configFromArgs(args):
+    cfg = Config()
+    cfg.numLaps = args.laps
+    cfg.numPlayers = args.players
+    cfg.numTracks = args.tracks
+    cfg.numCars = args.cars
+    cfg.numCombos = args.combos
+    cfg.numServers = args.servers
+    cfg.numDays = args.days
+    cfg.playersPerSession = args.players_per_session
+    cfg.lapsPerPlayer = args.laps_per_player
+    cfg.blobRatio = args.blob_ratio
+    cfg.seed = args.seed
+    cfg.useApi = args.api
+    return cfg
+
+def postgresBackend(spec):
+    from ptracker_lib.dbpostgres import PostgresqlBackend
+    userpwd, hostdb = spec.split("@")
+    user, password = userpwd.split(":")
+    host, database = hostdb.split("/")
+    return PostgresqlBackend(LapHistory, user=user, password=password, host=host, database=database, perform_backups=False)
+
+if __name__ == "__main__":
+    parser = argParser()
+    parser.add_argument('--postgres', default=None, help='user:password@host/database - copy the generated database to postgres')
+    parser.add_argument('database_file')
+    args = parser.parse_args()
+    if os.path.exists(args.database_file):
+        print("%s already exists." % args.database_file)
+        sys.exit(1)
+    backend = generate(args.database_file, configFromArgs(args))
+    if not args.postgres is None:
+        t0 = time.time()
+        postgresBackend(args.postgres).populate(backend)
+        print("copied to postgres in %.1f s" % (time.time()-t0))